@@ -1,15 +1,28 @@
 # -*- test-case-name: vumi.application.tests.test_http_relay -*-
 
+import re
+import time
+import hashlib
+from collections import deque
 from base64 import b64encode
+from urlparse import urlsplit
 
 from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.web import http
-from twisted.internet.defer import inlineCallbacks
+from twisted.web.client import HTTPConnectionPool
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredList, DeferredSemaphore,
+    succeed)
+from twisted.internet.task import deferLater
 
 from vumi.application.base import ApplicationWorker
+from vumi.blinkenlights.metrics import (
+    MetricManager, Metric, Count, AVG, MAX)
 from vumi.utils import http_request_full
 from vumi.errors import VumiError
-from vumi.config import ConfigText, ConfigUrl
+from vumi.config import ConfigText, ConfigUrl, ConfigInt, ConfigFloat
 
 
 class HTTPRelayError(VumiError):
@@ -32,11 +45,193 @@ class HTTPRelayConfig(ApplicationWorker.CONFIG_CLASS):
     username = ConfigText("Username for HTTP authentication.", default='')
     password = ConfigText("Password for HTTP authentication.", default='')
 
+    concurrency_limit = ConfigInt(
+        "Maximum number of requests in flight to each URL. Further requests"
+        " wait for one to finish. Each consumer relays one message at a"
+        " time, so this mostly limits batches of events being sent at the"
+        " same time. Connections to each host are kept open and reused.",
+        default=10, static=True)
+    timeout = ConfigFloat(
+        "Seconds to wait for a response before giving up on a request.",
+        default=30, static=True)
+    circuit_breaker_failures = ConfigInt(
+        "Number of consecutive failed requests to a URL after which the"
+        " relay stops consuming messages for `circuit_breaker_reset`"
+        " seconds. Connection errors, timeouts and 5xx responses are"
+        " failures. Set to 0 to never stop consuming.",
+        default=5, static=True)
+    circuit_breaker_reset = ConfigFloat(
+        "Seconds to stop consuming messages for when the circuit breaker"
+        " trips. A single failure after consuming resumes trips it again.",
+        default=30, static=True)
+    metrics_prefix = ConfigText(
+        "Prefix for the per-URL request latency, failure and response code"
+        " metrics. Defaults to `http_relay.<transport_name>.`.",
+        static=True)
+
+    event_batch_size = ConfigInt(
+        "If set, events are sent to `event_url` in batches of up to this"
+        " many events instead of one request per event. Events are"
+        " acknowledged once they have been added to a batch, so any that"
+        " haven't been sent yet are lost if the relay stops suddenly.",
+        static=True)
+    event_buffer_size = ConfigInt(
+        "Maximum number of acknowledged events waiting to be sent in"
+        " batches. Further events aren't acknowledged until older ones have"
+        " been sent. Defaults to ten times `event_batch_size`.",
+        static=True)
+    event_batch_interval = ConfigFloat(
+        "Maximum number of seconds to wait for a batch of events to fill"
+        " up before sending it anyway.", default=1.0, static=True)
+    event_batch_format = ConfigText(
+        "Body format for batches of events: `json` for a JSON list of"
+        " events or `ndjson` for one JSON event per line.",
+        default='json', static=True)
+    event_batch_retries = ConfigInt(
+        "Number of times to retry sending a batch of events that failed"
+        " with a connection error, a timeout or a non-2xx response.",
+        default=3, static=True)
+    event_batch_retry_delay = ConfigFloat(
+        "Seconds to wait before retrying a failed batch of events.",
+        default=1.0, static=True)
+
+
+class RelayTarget(object):
+    """A URL the relay sends requests to.
+
+    Tracks the requests in flight to the URL, its consecutive failures
+    and its metrics.
+
+    :param str url:
+        The URL.
+    :param int concurrency_limit:
+        Maximum number of requests in flight.
+    :param MetricManager metrics:
+        Metric manager to register the URL's metrics with.
+    """
+
+    def __init__(self, url, concurrency_limit, metrics):
+        self.url = url
+        self.semaphore = DeferredSemaphore(concurrency_limit)
+        self.failures = 0
+        self.metrics = metrics
+        self.metric_name = self.metric_name_for_url(url)
+        self.latency = self._metric(
+            Metric, '%s.latency' % (self.metric_name,), [AVG, MAX])
+        self.failed = self._metric(
+            Count, '%s.failures' % (self.metric_name,))
+
+    @staticmethod
+    def metric_name_for_url(url):
+        """
+        Return the name to prefix a URL's metrics with.
+
+        Credentials, the query string and the fragment are left out, so
+        URLs that only differ in those share metrics. The rest of the URL
+        is made readable and hashed, so that URLs that only differ in
+        punctuation still get different names.
+        """
+        parts = urlsplit(url)
+        port = parts.port
+        if port is None:
+            port = {'http': 80, 'https': 443}.get(parts.scheme)
+        base = '%s://%s:%s%s' % (
+            parts.scheme, parts.hostname, port, parts.path)
+        readable = re.sub(r'[^A-Za-z0-9]+', '_', base).strip('_')
+        return '%s_%s' % (readable, hashlib.md5(base).hexdigest()[:8])
+
+    def _metric(self, metric_class, name, *args):
+        if name not in self.metrics:
+            self.metrics.register(metric_class(name, *args))
+        return self.metrics[name]
+
+    def count_response(self, code):
+        self._metric(
+            Count, '%s.status.%s' % (self.metric_name, code)).inc()
+
+
+class EventBatch(object):
+    """Events waiting to be sent to an event URL in one request.
+
+    :param config:
+        Config of the first event in the batch. All events in a batch
+        share the event URL and authentication details.
+    :param float started:
+        When the first event was added.
+    """
+
+    CONTENT_TYPES = {
+        'json': 'application/json',
+        'ndjson': 'application/x-ndjson',
+    }
+
+    def __init__(self, config, started):
+        self.config = config
+        self.started = started
+        self.events = []
+        self.timer = None
+
+    def __len__(self):
+        return len(self.events)
+
+    def add(self, event):
+        self.events.append(event)
+
+    def body(self, batch_format):
+        if batch_format == 'ndjson':
+            return ''.join('%s\n' % (e.to_json(),) for e in self.events)
+        return '[%s]' % (','.join(e.to_json() for e in self.events),)
+
 
 class HTTPRelayApplication(ApplicationWorker):
     CONFIG_CLASS = HTTPRelayConfig
 
     reply_header = 'X-Vumi-HTTPRelay-Reply'
+    pool = None
+
+    @inlineCallbacks
+    def setup_application(self):
+        config = self.get_static_config()
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = config.concurrency_limit
+        metrics_prefix = config.metrics_prefix
+        if metrics_prefix is None:
+            metrics_prefix = 'http_relay.%s.' % (config.transport_name,)
+        self.metrics = yield self.start_publisher(
+            MetricManager, metrics_prefix)
+        self._targets = {}
+        self._reset_calls = {}
+        self._event_batches = {}
+        self._event_batch_sends = set()
+        self._unsent_events = 0
+        self._event_buffer_waiters = deque()
+        self.event_buffer_size = config.event_buffer_size
+        if self.event_buffer_size is None and config.event_batch_size:
+            self.event_buffer_size = 10 * config.event_batch_size
+        self.event_batch_size = self.metrics.register(
+            Metric('event_batch.size', [AVG, MAX]))
+        self.event_batch_latency = self.metrics.register(
+            Metric('event_batch.flush_latency', [AVG, MAX]))
+        self.event_batch_failures = self.metrics.register(
+            Count('event_batch.failures'))
+
+    @inlineCallbacks
+    def teardown_application(self):
+        if self.pool is None:
+            # We were never set up.
+            return
+        for key in self._event_batches.keys():
+            self.flush_event_batch(key)
+        yield self.wait_for_event_batches()
+        for delayed_call in self._reset_calls.values():
+            if delayed_call.active():
+                delayed_call.cancel()
+        self._reset_calls = {}
+        self.metrics.stop()
+        yield self.pool.closeCachedConnections()
+
+    def get_clock(self):
+        return reactor
 
     def validate_config(self):
         self.supported_auth_methods = {
@@ -46,6 +241,10 @@ class HTTPRelayApplication(ApplicationWorker):
         if 'event_url' not in self.config:
             self.config['event_url'] = self.config['url']
         config = self.get_static_config()
+        if config.event_batch_format not in EventBatch.CONTENT_TYPES:
+            raise HTTPRelayError(
+                'Event batch format %r not supported' % (
+                    config.event_batch_format,))
         if config.auth_method not in self.supported_auth_methods:
             raise HTTPRelayError(
                     'HTTP Authentication method %s not supported' % (
@@ -64,12 +263,77 @@ class HTTPRelayApplication(ApplicationWorker):
             return handler(config.username, config.password)
         return {}
 
+    def get_target(self, url):
+        if url not in self._targets:
+            self._targets[url] = RelayTarget(
+                url, self.get_static_config().concurrency_limit,
+                self.metrics)
+        return self._targets[url]
+
+    @inlineCallbacks
+    def relay_request(self, url, data, config, headers=None):
+        """
+        Send `data` to `url` once there is room in the URL's window of
+        requests in flight and return the response.
+        """
+        target = self.get_target(url)
+        request_headers = self.get_auth_headers(config)
+        if headers is not None:
+            request_headers.update(headers)
+        yield target.semaphore.acquire()
+        start = time.time()
+        try:
+            response = yield http_request_full(
+                url, data, request_headers, config.http_method,
+                timeout=config.timeout, pool=self.pool)
+        except Exception:
+            self.record_failure(target)
+            raise
+        finally:
+            target.semaphore.release()
+            target.latency.set(time.time() - start)
+        target.count_response(response.code)
+        if response.code >= 500:
+            self.record_failure(target)
+        else:
+            target.failures = 0
+        returnValue(response)
+
+    def record_failure(self, target):
+        """
+        Count a failed request and stop consuming messages if the URL has
+        failed too many times in a row.
+        """
+        config = self.get_static_config()
+        target.failed.inc()
+        target.failures += 1
+        threshold = config.circuit_breaker_failures
+        if (threshold and target.failures >= threshold
+                and target.url not in self._reset_calls):
+            log.msg("%s failed %d times in a row, pausing for %s seconds" % (
+                target.url, target.failures, config.circuit_breaker_reset))
+            self._reset_calls[target.url] = self.get_clock().callLater(
+                config.circuit_breaker_reset, self.reset_circuit, target)
+            # We don't wait for the messages being processed to finish,
+            # since this may be one of them.
+            self.pause_connectors()
+
+    def reset_circuit(self, target):
+        """
+        Resume consuming messages after a URL's circuit breaker tripped,
+        unless another URL's is still tripped.
+        """
+        del self._reset_calls[target.url]
+        # Trip again on the next failure.
+        target.failures = self.get_static_config().circuit_breaker_failures - 1
+        if not self._reset_calls:
+            self.unpause_connectors()
+
     @inlineCallbacks
     def consume_user_message(self, message):
         config = yield self.get_config(message)
-        headers = self.get_auth_headers(config)
-        response = yield http_request_full(config.url.geturl(),
-                            message.to_json(), headers, config.http_method)
+        response = yield self.relay_request(
+            config.url.geturl(), message.to_json(), config)
         headers = response.headers
         if response.code == http.OK:
             if headers.hasHeader(self.reply_header):
@@ -84,9 +348,114 @@ class HTTPRelayApplication(ApplicationWorker):
     @inlineCallbacks
     def relay_event(self, event):
         config = yield self.get_config(event)
-        headers = self.get_auth_headers(config)
-        yield http_request_full(config.event_url.geturl(),
-            event.to_json(), headers, config.http_method)
+        if config.event_batch_size:
+            yield self.batch_event(event, config)
+        else:
+            yield self.relay_request(
+                config.event_url.geturl(), event.to_json(), config)
+
+    def batch_event(self, event, config):
+        """
+        Add an event to the batch for its event URL and credentials.
+
+        Returns a deferred that fires once there is room in the buffer of
+        events waiting to be sent.
+        """
+        key = (config.event_url.geturl(), config.username, config.password)
+        batch = self._event_batches.get(key)
+        if batch is None:
+            clock = self.get_clock()
+            batch = EventBatch(config, clock.seconds())
+            batch.timer = clock.callLater(
+                config.event_batch_interval, self.flush_event_batch, key)
+            self._event_batches[key] = batch
+        batch.add(event)
+        self._unsent_events += 1
+        if len(batch) >= config.event_batch_size:
+            self.flush_event_batch(key)
+        if (not self._event_buffer_waiters
+                and self._unsent_events <= self.event_buffer_size):
+            return succeed(None)
+        d = Deferred()
+        self._event_buffer_waiters.append(d)
+        return d
+
+    def flush_event_batch(self, key):
+        """
+        Start sending the batch of events for `key` and return a deferred
+        that fires once it has been sent, or dropped after failing.
+        """
+        batch = self._event_batches.pop(key, None)
+        if batch is None:
+            return succeed(None)
+        if batch.timer.active():
+            batch.timer.cancel()
+        d = self._send_event_batch(key, batch)
+        self._event_batch_sends.add(d)
+        d.addBoth(self._event_batch_sent, d)
+        return d
+
+    def wait_for_event_batches(self):
+        """
+        Return a deferred that fires once the batches of events being sent
+        have been sent or dropped.
+        """
+        return DeferredList(list(self._event_batch_sends))
+
+    def _event_batch_sent(self, result, d):
+        self._event_batch_sends.discard(d)
+        return result
+
+    @inlineCallbacks
+    def _send_event_batch(self, key, batch):
+        """
+        Send a batch of events, retrying failed attempts. Events in batches
+        that can't be sent are logged and dropped.
+        """
+        self.event_batch_size.set(len(batch))
+        try:
+            yield self.send_event_batch(batch)
+        except Exception:
+            self.event_batch_failures.inc()
+            log.err(Failure(), 'Dropping batch of %d events for %s' % (
+                len(batch), key[0]))
+        self.event_batch_latency.set(
+            self.get_clock().seconds() - batch.started)
+        self._unsent_events -= len(batch)
+        # Events still waiting to be acknowledged are already counted as
+        # unsent.
+        waiters = self._event_buffer_waiters
+        while waiters and (
+                self._unsent_events - len(waiters) < self.event_buffer_size):
+            waiters.popleft().callback(None)
+
+    @inlineCallbacks
+    def send_event_batch(self, batch):
+        config = batch.config
+        url = config.event_url.geturl()
+        body = batch.body(config.event_batch_format)
+        headers = {
+            'Content-Type': EventBatch.CONTENT_TYPES[
+                config.event_batch_format],
+        }
+        attempts = config.event_batch_retries + 1
+        for attempt in range(1, attempts + 1):
+            try:
+                response = yield self.relay_request(
+                    url, body, config, headers)
+                if 200 <= response.code < 300:
+                    return
+                reason = 'responded with %s' % (response.code,)
+            except Exception, e:
+                reason = 'failed with %r' % (e,)
+            log.msg('Sending batch of %d events to %s %s (attempt %d of %d)'
+                    % (len(batch), url, reason, attempt, attempts))
+            if attempt < attempts:
+                yield deferLater(
+                    self.get_clock(), config.event_batch_retry_delay,
+                    lambda: None)
+        raise HTTPRelayError('Giving up sending batch of %d events to %s' % (
+            len(batch), url))
 
     @inlineCallbacks
     def consume_ack(self, event):
@@ -8,6 +8,7 @@ import json
 import pkg_resources
 import logging
 import operator
+from copy import deepcopy
 from uuid import uuid4
 
 from twisted.internet import reactor
@@ -220,6 +221,7 @@ class SandboxResources(object):
         #        It does not validate configs. It constructs resources objects.
         #        Fixing that is beyond the scope of this commit, however.
         for name, config in self.config.iteritems():
+            config = deepcopy(config)
             cls = load_class_by_string(config.pop('cls'))
             self.resources[name] = cls(name, self.app_worker, config)
 
@@ -763,7 +765,8 @@ class Sandbox(ApplicationWorker):
     def get_config(self, msg):
         config = self.config.copy()
         config['sandbox_id'] = self.sandbox_id_for_message(msg)
-        return succeed(self.CONFIG_CLASS(config))
+        return succeed(self.CONFIG_CLASS(
+            config, base=self.get_static_config()))
 
     def _convert_rlimits(self, rlimits_config):
         rlimits = dict((getattr(resource, key, key), value) for key, value in
@@ -805,7 +808,7 @@ class Sandbox(ApplicationWorker):
         executable, args = self.get_executable_and_args(api.config)
         rlimits = self.get_rlimits(api.config)
         spawn_kwargs = dict(
-            args=args, env=api.config.env, path=api.config.path)
+            args=args, env=dict(api.config.env), path=api.config.path)
         return SandboxProtocol(
             api.config.sandbox_id, api, executable, spawn_kwargs, rlimits,
             api.config.timeout, api.config.recv_limit)
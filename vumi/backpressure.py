@@ -0,0 +1,210 @@
+# -*- test-case-name: vumi.tests.test_backpressure -*-
+
+"""Pausing connectors while their message handlers are slow."""
+
+from twisted.internet import reactor
+
+from vumi.blinkenlights.metrics import Metric, Count, SUM
+from vumi import log
+
+
+class BackpressureController(object):
+    """Pauses a connector's consumers when its message handlers back up
+    and unpauses them once they've caught up.
+
+    The controller engages when either the number of messages being
+    handled reaches `high_watermark` or the average handler latency
+    reaches `high_latency`. It releases once the number of messages being
+    handled has dropped to `low_watermark` and the average latency has
+    dropped to `low_latency`. The gap between the high and low marks stops
+    the connector from flapping between paused and unpaused.
+
+    While engaged, the controller checks again every `recheck_interval`
+    seconds. No new latencies are measured while nothing is being
+    handled, so each of these checks decays the average latency towards
+    zero instead. A connector paused for being slow is therefore let go
+    after a while even if no more messages arrive, and sooner the less
+    slow it was.
+
+    Each of a connector's consumers handles one message at a time, so at
+    most one message per consumer is in flight. A `high_watermark` above
+    the number of consumers is never reached; use `high_latency` for
+    connectors with few consumers.
+
+    Connectors that were already paused by something else are left
+    alone.
+
+    :param connector:
+        The :class:`vumi.connectors.BaseConnector` to control.
+    :param int high_watermark:
+        Messages in flight at which to pause. `None` to ignore the number
+        of messages in flight.
+    :param int low_watermark:
+        Messages in flight at which to unpause. Defaults to half of
+        `high_watermark`.
+    :param float high_latency:
+        Average handler latency in seconds at which to pause. `None` to
+        ignore latency.
+    :param float low_latency:
+        Average handler latency in seconds at which to unpause. Defaults
+        to half of `high_latency`.
+    :param float recheck_interval:
+        Seconds between checks while engaged. Defaults to 1.
+    :param MetricManager metrics:
+        If given, ``<connector>.backpressure.paused_time`` (seconds spent
+        paused) and ``<connector>.backpressure.pauses`` metrics are
+        registered with it.
+    :param clock:
+        An `IReactorTime` provider. Defaults to the reactor.
+    """
+
+    # Weight of the newest sample in the average handler latency.
+    LATENCY_WEIGHT = 0.2
+
+    def __init__(self, connector, high_watermark=None, low_watermark=None,
+                 high_latency=None, low_latency=None, recheck_interval=1.0,
+                 metrics=None, clock=None):
+        self.connector = connector
+        self.high_watermark = high_watermark
+        if low_watermark is None and high_watermark is not None:
+            low_watermark = high_watermark // 2
+        self.low_watermark = low_watermark
+        self.high_latency = high_latency
+        if low_latency is None and high_latency is not None:
+            low_latency = high_latency / 2.0
+        self.low_latency = low_latency
+        self.recheck_interval = recheck_interval
+        self.clock = clock if clock is not None else reactor
+
+        self.engaged = False
+        self.latency = None
+        self.pauses = 0
+        self.paused_time = 0.0
+        self._paused_at = None
+        self._recheck_call = None
+
+        self._paused_time_metric = None
+        self._pauses_metric = None
+        if metrics is not None:
+            self._register_metrics(metrics)
+
+    def _register_metrics(self, metrics):
+        name = '%s.backpressure.paused_time' % (self.connector.name,)
+        if name not in metrics:
+            metrics.register(Metric(name, [SUM]))
+        self._paused_time_metric = metrics[name]
+        name = '%s.backpressure.pauses' % (self.connector.name,)
+        if name not in metrics:
+            metrics.register(Count(name))
+        self._pauses_metric = metrics[name]
+
+    def check_consumers(self, consumers):
+        """
+        Warn if `high_watermark` can't be reached by a connector with
+        `consumers` consumers.
+        """
+        if (self.high_watermark is not None
+                and self.high_watermark > consumers):
+            log.warning(
+                format="Backpressure high watermark %(high_watermark)s for"
+                " connector %(connector)s is above its %(consumers)s"
+                " consumers, so it will never be reached.",
+                high_watermark=self.high_watermark,
+                connector=self.connector.name, consumers=consumers)
+
+    def stop(self):
+        """
+        Stop checking whether to release the connector.
+        """
+        if self._recheck_call is not None:
+            if self._recheck_call.active():
+                self._recheck_call.cancel()
+            self._recheck_call = None
+
+    def message_started(self):
+        """
+        Called when the connector starts handling a message. Returns the
+        time the message was started, which should be passed to
+        :meth:`message_done`.
+        """
+        self.check()
+        return self.clock.seconds()
+
+    def message_done(self, started):
+        """
+        Called when the connector has finished handling a message.
+        """
+        latency = self.clock.seconds() - started
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.LATENCY_WEIGHT * (latency - self.latency)
+        self.check()
+
+    def _above_high(self):
+        in_flight = self.connector.in_flight
+        if (self.high_watermark is not None
+                and in_flight >= self.high_watermark):
+            return True
+        return (self.high_latency is not None and self.latency is not None
+                and self.latency >= self.high_latency)
+
+    def _below_low(self):
+        in_flight = self.connector.in_flight
+        if (self.low_watermark is not None
+                and in_flight > self.low_watermark):
+            return False
+        return (self.low_latency is None or self.latency is None
+                or self.latency <= self.low_latency)
+
+    def check(self):
+        """
+        Pause or unpause the connector if a watermark has been crossed.
+        """
+        if self.engaged:
+            if self._below_low():
+                self.release()
+        elif self._above_high() and not self.connector.paused:
+            self.engage()
+
+    def _recheck(self):
+        self._recheck_call = None
+        if self.connector.in_flight == 0 and self.latency is not None:
+            # Nothing is being handled, so there are no new latencies to
+            # measure.
+            self.latency *= 1 - self.LATENCY_WEIGHT
+        self.check()
+        if self.engaged:
+            self._schedule_recheck()
+
+    def _schedule_recheck(self):
+        self._recheck_call = self.clock.callLater(
+            self.recheck_interval, self._recheck)
+
+    def engage(self):
+        self.engaged = True
+        self.pauses += 1
+        self._paused_at = self.clock.seconds()
+        if self._pauses_metric is not None:
+            self._pauses_metric.inc()
+        log.warning(
+            format="Pausing connector %(connector)s: %(in_flight)s messages"
+            " in flight, average handler latency %(latency)s.",
+            connector=self.connector.name,
+            in_flight=self.connector.in_flight, latency=self.latency)
+        self._schedule_recheck()
+        self.connector.pause()
+
+    def release(self):
+        self.engaged = False
+        self.stop()
+        paused_for = self.clock.seconds() - self._paused_at
+        self._paused_at = None
+        self.paused_time += paused_for
+        if self._paused_time_metric is not None:
+            self._paused_time_metric.set(paused_for)
+        log.info(
+            format="Unpausing connector %(connector)s after %(paused_for).3f"
+            " seconds.", connector=self.connector.name,
+            paused_for=paused_for)
+        self.connector.unpause()
@@ -8,7 +8,8 @@ from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import LoopingCall
 
 from vumi.worker import BaseWorker
-from vumi.config import ConfigDict, ConfigInt
+from vumi.config import ConfigDict, ConfigInt, ConfigText
+from vumi.blinkenlights.metrics import MetricManager, Timer
 from vumi.blinkenlights.heartbeat.publisher import HeartBeatMessage
 from vumi.blinkenlights.heartbeat.storage import Storage
 from vumi.persist.txredis_manager import TxRedisManager
@@ -22,6 +23,16 @@ WorkerIssue = collections.namedtuple('WorkerIssue',
                                       'start_time',
                                       'procs_count'])
 
+# Performance data workers include in their heartbeats (see
+# vumi.blinkenlights.heartbeat.telemetry).
+STATS_FIELDS = ('reactor_lag', 'rss', 'consumed_rate', 'published_rate',
+                'in_flight', 'paused')
+
+DEFAULT_MAX_REACTOR_LAG = 1.0
+DEFAULT_MIN_THROUGHPUT_RATIO = 0.1
+DEFAULT_MIN_BASELINE_RATE = 1.0
+DEFAULT_SUSTAINED_INTERVALS = 3
+
 
 def assert_field(cfg, key):
     """
@@ -53,25 +64,75 @@ class WorkerInstance(object):
 
 
 class Worker(object):
+    """A monitored worker and the instances of it that checked in.
+
+    Besides checking that at least `min_procs` instances check in, the
+    performance data in their heartbeats is checked for sustained
+    problems:
+
+    :param float max_reactor_lag:
+        A `reactor-lag` issue is opened if any instance's reactor runs
+        more than this many seconds late for `sustained_intervals`
+        intervals in a row.
+    :param float min_throughput_ratio:
+        A `throughput-collapse` issue is opened if the rate at which the
+        worker's instances consume messages falls below this fraction of
+        its usual rate for `sustained_intervals` intervals in a row. The
+        usual rate is a moving average that must be at least
+        `min_baseline_rate` messages per second. Workers whose instances
+        are all paused aren't checked.
+    :param int sustained_intervals:
+        Number of monitor intervals a performance problem must last for
+        before an issue is opened.
+    """
 
-    def __init__(self, system_id, worker_name, min_procs):
+    # Weight of the latest interval in the usual throughput average.
+    BASELINE_WEIGHT = 0.3
+
+    def __init__(self, system_id, worker_name, min_procs,
+                 max_reactor_lag=None, min_throughput_ratio=None,
+                 min_baseline_rate=None, sustained_intervals=None):
         self.system_id = system_id
         self.name = worker_name
         self.min_procs = min_procs
+        self.max_reactor_lag = (
+            max_reactor_lag if max_reactor_lag is not None
+            else DEFAULT_MAX_REACTOR_LAG)
+        self.min_throughput_ratio = (
+            min_throughput_ratio if min_throughput_ratio is not None
+            else DEFAULT_MIN_THROUGHPUT_RATIO)
+        self.min_baseline_rate = (
+            min_baseline_rate if min_baseline_rate is not None
+            else DEFAULT_MIN_BASELINE_RATE)
+        self.sustained_intervals = (
+            sustained_intervals if sustained_intervals is not None
+            else DEFAULT_SUSTAINED_INTERVALS)
         self.worker_id = generate_worker_id(system_id, worker_name)
         self._instances = set()
         self._instances_active = set()
+        self._stats = {}
+        self._stats_active = {}
         self.procs_count = 0
+        self.baseline_rate = None
+        self._problem_intervals = {
+            'reactor-lag': 0,
+            'throughput-collapse': 0,
+        }
+        self._open_issues = set()
 
     def to_dict(self):
         """Serializes information into basic dicts"""
         counts = self._compute_host_info(self._instances)
         hosts = []
         for host, count in counts.iteritems():
-            hosts.append({
-                    'host': host,
-                    'proc_count': count,
-            })
+            host_info = {
+                'host': host,
+                'proc_count': count,
+            }
+            host_info.update(self._aggregate_stats(
+                stats for ins, stats in self._stats.iteritems()
+                if ins.hostname == host))
+            hosts.append(host_info)
         obj = {
             'id': self.worker_id,
             'name': self.name,
@@ -79,8 +140,30 @@ class Worker(object):
             'min_procs': self.min_procs,
             'hosts': hosts,
         }
+        stats = self._aggregate_stats(self._stats.itervalues())
+        if stats:
+            obj['stats'] = stats
         return obj
 
+    def _aggregate_stats(self, stats_list):
+        """
+        Combine the performance data from a set of instances. Lag is the
+        worst lag of any instance, paused is the number of paused
+        instances and everything else is summed.
+        """
+        totals = {}
+        for stats in stats_list:
+            for field, value in stats.iteritems():
+                if value is None:
+                    continue
+                if field == 'reactor_lag':
+                    totals[field] = max(totals.get(field, 0.0), value)
+                elif field == 'paused':
+                    totals[field] = totals.get(field, 0) + int(bool(value))
+                else:
+                    totals[field] = totals.get(field, 0) + value
+        return totals
+
     def _compute_host_info(self, instances):
         """Compute the number of worker instances running on each host."""
         counts = {}
@@ -95,7 +178,10 @@ class Worker(object):
     @inlineCallbacks
     def audit(self, storage):
         """
-        Verify whether enough workers checked in.
+        Verify whether enough workers checked in and whether their
+        performance data shows sustained problems. Issues are written to
+        `storage`, which may be a :class:`Storage` or a
+        :class:`StorageBatch`.
         Make sure to call snapshot() before running this method
         """
         count = len(self._instances)
@@ -108,6 +194,53 @@ class Worker(object):
             yield storage.open_or_update_issue(self.worker_id, issue)
         self.procs_count = count
 
+        stats = self._aggregate_stats(self._stats.itervalues())
+        yield self._check_problem(
+            storage, 'reactor-lag', self._lagging(stats))
+        yield self._check_problem(
+            storage, 'throughput-collapse', self._collapsed(stats))
+
+    def _lagging(self, stats):
+        return stats.get('reactor_lag', 0.0) > self.max_reactor_lag
+
+    def _collapsed(self, stats):
+        rate = stats.get('consumed_rate')
+        if rate is None:
+            return False
+        if stats.get('paused', 0) >= len(self._stats):
+            # Paused workers aren't expected to consume anything.
+            return False
+        baseline = self.baseline_rate
+        if (baseline is not None and baseline >= self.min_baseline_rate and
+                rate < baseline * self.min_throughput_ratio):
+            # Leave the baseline alone so that it still reflects the
+            # usual rate while throughput is low.
+            return True
+        if baseline is None:
+            self.baseline_rate = rate
+        else:
+            self.baseline_rate = (self.BASELINE_WEIGHT * rate +
+                                  (1 - self.BASELINE_WEIGHT) * baseline)
+        return False
+
+    @inlineCallbacks
+    def _check_problem(self, storage, issue_type, failing):
+        """
+        Open an issue of the given type once a problem has lasted for
+        `sustained_intervals` audits and close it once it's gone.
+        """
+        if not failing:
+            self._problem_intervals[issue_type] = 0
+            if issue_type in self._open_issues:
+                self._open_issues.discard(issue_type)
+                yield storage.delete_worker_issue(self.worker_id, issue_type)
+            return
+        self._problem_intervals[issue_type] += 1
+        if self._problem_intervals[issue_type] >= self.sustained_intervals:
+            self._open_issues.add(issue_type)
+            issue = WorkerIssue(issue_type, time.time(), len(self._instances))
+            yield storage.open_or_update_issue(self.worker_id, issue)
+
     def snapshot(self):
         """
         This method must be run before any diagnostic audit and analyses
@@ -120,10 +253,16 @@ class Worker(object):
         """
         self._instances = self._instances_active
         self._instances_active = set()
+        self._stats = self._stats_active
+        self._stats_active = {}
 
-    def record(self, hostname, pid):
-        """Record that process (hostname,pid) checked in."""
-        self._instances_active.add(WorkerInstance(hostname, pid))
+    def record(self, hostname, pid, stats=None):
+        """Record that process (hostname,pid) checked in, along with
+        any performance data from its heartbeat."""
+        instance = WorkerInstance(hostname, pid)
+        self._instances_active.add(instance)
+        if stats:
+            self._stats_active[instance] = stats
 
 
 class System(object):
@@ -158,8 +297,16 @@ class HeartBeatMonitor(BaseWorker):
             "Redis client configuration.",
             required=True, static=True)
         monitored_systems = ConfigDict(
-            "Tree of systems and workers.",
+            "Tree of systems and workers. Each worker entry needs a `name`"
+            " and `min_procs` and may set `max_reactor_lag`,"
+            " `min_throughput_ratio`, `min_baseline_rate` and"
+            " `sustained_intervals` (see"
+            " :class:`vumi.blinkenlights.heartbeat.monitor.Worker`).",
             required=True, static=True)
+        metrics_prefix = ConfigText(
+            "Prefix for the monitor's own metrics. The time taken by each"
+            " audit pass is published as `<prefix>audit_duration`.",
+            default="vumi.heartbeat.monitor.", static=True)
 
     _task = None
 
@@ -177,6 +324,10 @@ class HeartBeatMonitor(BaseWorker):
         self._systems, self._workers = self.parse_config(
             config.monitored_systems)
 
+        self.metrics = yield self.start_publisher(
+            MetricManager, config.metrics_prefix)
+        self._audit_timer = self.metrics.register(Timer('audit_duration'))
+
         # Start consuming heartbeats
         yield self.consume("heartbeat.inbound", self._consume_message,
                            exchange_name='vumi.health',
@@ -191,6 +342,7 @@ class HeartBeatMonitor(BaseWorker):
             self._task.stop()
             self._task = None
             yield self._task_done
+        self.metrics.stop()
         self._redis.close_manager()
 
     def parse_config(self, config):
@@ -213,7 +365,11 @@ class HeartBeatMonitor(BaseWorker):
                 min_procs = wkr_entry['min_procs']
                 wkr = Worker(system_id,
                              worker_name,
-                             min_procs)
+                             min_procs,
+                             wkr_entry.get('max_reactor_lag'),
+                             wkr_entry.get('min_throughput_ratio'),
+                             wkr_entry.get('min_baseline_rate'),
+                             wkr_entry.get('sustained_intervals'))
                 workers[wkr.worker_id] = wkr
                 system_workers.append(wkr)
             systems.append(System(system_id, system_id, system_workers))
@@ -239,19 +395,20 @@ class HeartBeatMonitor(BaseWorker):
             log.msg("Discarding heartbeat from '%s'. Too old" % worker_id)
             return
 
-        wkr.record(hostname, pid)
+        stats = dict((field, msg[field]) for field in STATS_FIELDS
+                     if field in msg)
+        wkr.record(hostname, pid, stats)
 
-    @inlineCallbacks
-    def _sync_to_storage(self):
+    def _sync_to_storage(self, batch):
         """
-        Write systems data to storage
+        Add systems data to a storage batch
         """
         # write system ids
         system_ids = [sys.system_id for sys in self._systems]
-        yield self._storage.add_system_ids(system_ids)
+        batch.add_system_ids(system_ids)
         # dump each system
         for sys in self._systems:
-            yield self._storage.write_system(sys)
+            batch.write_system(sys)
 
     @inlineCallbacks
     def _periodic_task(self):
@@ -261,15 +418,21 @@ class HeartBeatMonitor(BaseWorker):
 
         We call snapshot() first, since the execution of tasks here is
         interleaved with the processing of worker heartbeat messages.
+
+        Audits record their writes in a storage batch, which is applied
+        in a single transaction at the end.
         """
-        # snapshot the the set of checked-in instances
-        for wkr in self._workers.values():
-            wkr.snapshot()
-        # run diagnostic audits on all workers
-        for wkr in self._workers.values():
-            yield wkr.audit(self._storage)
-        # write everything to redis
-        yield self._sync_to_storage()
+        with self._audit_timer:
+            # snapshot the the set of checked-in instances
+            for wkr in self._workers.values():
+                wkr.snapshot()
+            batch = self._storage.batch()
+            # run diagnostic audits on all workers
+            for wkr in self._workers.values():
+                yield wkr.audit(batch)
+            # write everything to redis
+            self._sync_to_storage(batch)
+            yield batch.execute()
 
     def _start_task(self):
         """Create a timer task to check for missing worker"""
@@ -7,6 +7,9 @@ Storage Schema:
  List of systems (JSON list): key = systems
  System state (JSON dict):    key = system:$SYSTEM_ID
  Worker issue (JSON dict):    key = worker:$WORKER_ID:issue
+   (for min-procs-fail issues)
+                              key = worker:$WORKER_ID:issue:$ISSUE_TYPE
+   (for other issue types)
 """
 
 import json
@@ -17,8 +20,12 @@ TIMESTAMP_KEY = "timestamp"
 SYSTEMS_KEY = "systems"
 
 
-def issue_key(worker_id):
-    return "worker:%s:issue" % worker_id
+def issue_key(worker_id, issue_type="min-procs-fail"):
+    # min-procs-fail issues predate other issue types and keep their
+    # original key so that existing readers still find them.
+    if issue_type == "min-procs-fail":
+        return "worker:%s:issue" % worker_id
+    return "worker:%s:issue:%s" % (worker_id, issue_type)
 
 
 def system_key(system_id):
@@ -36,6 +43,10 @@ class Storage(object):
         self._redis = redis
         self.manager = redis
 
+    def batch(self):
+        """Return a :class:`StorageBatch` for this storage."""
+        return StorageBatch(self)
+
     @Manager.calls_manager
     def add_system_ids(self, system_ids):
         yield self._redis.sadd(SYSTEMS_KEY, *system_ids)
@@ -52,18 +63,92 @@ class Storage(object):
             'procs_count': issue.procs_count,
         }
 
+    def _merge_issue(self, issue_raw, issue):
+        """
+        Return the JSON for an issue, keeping the start time of the
+        stored issue if there is one.
+        """
+        if issue_raw is None:
+            issue_data = self._issue_to_dict(issue)
+        else:
+            issue_data = json.loads(issue_raw)
+            issue_data['procs_count'] = issue.procs_count
+        return json.dumps(issue_data)
+
     @Manager.calls_manager
-    def delete_worker_issue(self, worker_id):
-        key = issue_key(worker_id)
+    def delete_worker_issue(self, worker_id, issue_type="min-procs-fail"):
+        key = issue_key(worker_id, issue_type)
         yield self._redis.delete(key)
 
     @Manager.calls_manager
     def open_or_update_issue(self, worker_id, issue):
-        key = issue_key(worker_id)
+        key = issue_key(worker_id, issue.issue_type)
         issue_raw = yield self._redis.get(key)
-        if issue_raw is None:
-            issue_data = self._issue_to_dict(issue)
-        else:
-            issue_data = json.loads(issue_raw)
-            issue_data['procs_count'] = issue.procs_count
-        yield self._redis.set(key, json.dumps(issue_data))
+        yield self._redis.set(key, self._merge_issue(issue_raw, issue))
+
+
+class StorageBatch(object):
+    """
+    Collects writes to heartbeat storage and applies them together.
+
+    This has the same mutating methods as :class:`Storage`, but they
+    only record the write. :meth:`execute` fetches the stored versions of
+    all the issues being updated in one pipelined round trip and then
+    makes all the writes in a single transaction, so the number of round
+    trips doesn't grow with the number of systems and workers.
+    """
+
+    def __init__(self, storage):
+        self._storage = storage
+        self._redis = storage._redis
+        self.manager = storage.manager
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+    def add_system_ids(self, system_ids):
+        if system_ids:
+            self._writes.append(('sadd', SYSTEMS_KEY, list(system_ids)))
+
+    def write_system(self, sys):
+        self._writes.append(('set', system_key(sys.system_id), sys.dumps()))
+
+    def delete_worker_issue(self, worker_id, issue_type="min-procs-fail"):
+        self._writes.append(('delete', issue_key(worker_id, issue_type)))
+
+    def open_or_update_issue(self, worker_id, issue):
+        self._writes.append(
+            ('issue', issue_key(worker_id, issue.issue_type), issue))
+
+    @Manager.calls_manager
+    def execute(self):
+        writes, self._writes = self._writes, []
+        if not writes:
+            return
+        issue_keys = [write[1] for write in writes if write[0] == 'issue']
+        stored_issues = {}
+        if issue_keys:
+            pipe = self._redis.pipeline()
+            for key in issue_keys:
+                pipe.get(key)
+            issues_raw = yield pipe.execute()
+            stored_issues = dict(zip(issue_keys, issues_raw))
+
+        txn = self._redis.transaction()
+        for write in writes:
+            if write[0] == 'sadd':
+                txn.sadd(write[1], *write[2])
+            elif write[0] == 'set':
+                txn.set(write[1], write[2])
+            elif write[0] == 'delete':
+                txn.delete(write[1])
+                stored_issues[write[1]] = None
+            else:
+                key, issue = write[1:]
+                # Later writes to the same issue in this batch build on
+                # this one rather than on what was stored.
+                stored_issues[key] = self._storage._merge_issue(
+                    stored_issues.get(key), issue)
+                txn.set(key, stored_issues[key])
+        yield txn.execute()
@@ -0,0 +1,142 @@
+# -*- test-case-name: vumi.blinkenlights.heartbeat.tests.test_telemetry -*-
+
+"""Runtime performance data for worker heartbeats."""
+
+import resource
+
+from twisted.internet import reactor
+
+
+def get_rss():
+    """
+    Return the resident set size of this process in bytes, or `None` if
+    it can't be determined.
+
+    This reads ``/proc/self/statm`` where it exists and falls back to
+    the peak resident set size reported by :func:`resource.getrusage`.
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * resource.getpagesize()
+    except (IOError, OSError, IndexError, ValueError):
+        pass
+    try:
+        # ru_maxrss is in kilobytes on Linux.
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except (resource.error, AttributeError):
+        return None
+
+
+class ReactorLagMonitor(object):
+    """Measures how late the reactor runs timed calls.
+
+    A call is scheduled every `interval` seconds and the difference
+    between when it was due and when it ran is recorded. A busy or
+    blocked reactor runs calls late.
+
+    :param float interval:
+        Seconds between measurements.
+    :param clock:
+        An `IReactorTime` provider. Defaults to the reactor.
+    """
+
+    def __init__(self, interval=1.0, clock=None):
+        self.interval = interval
+        self.clock = clock if clock is not None else reactor
+        self._delayed_call = None
+        self._expected = None
+        self._max_lag = 0.0
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._delayed_call is not None and self._delayed_call.active():
+            self._delayed_call.cancel()
+        self._delayed_call = None
+
+    def _schedule(self):
+        self._expected = self.clock.seconds() + self.interval
+        self._delayed_call = self.clock.callLater(
+            self.interval, self._measure)
+
+    def _measure(self):
+        lag = self.clock.seconds() - self._expected
+        self._max_lag = max(self._max_lag, lag)
+        self._schedule()
+
+    def pop_max_lag(self):
+        """Return the largest lag measured since the last call."""
+        max_lag, self._max_lag = self._max_lag, 0.0
+        return max_lag
+
+
+class WorkerTelemetry(object):
+    """Collects performance data about a worker's connectors for its
+    heartbeats.
+
+    :param clock:
+        An `IReactorTime` provider. Defaults to the reactor.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else reactor
+        self.lag_monitor = ReactorLagMonitor(clock=self.clock)
+        self._last_time = None
+        self._last_counts = {}
+
+    def start(self):
+        self._last_time = self.clock.seconds()
+        self.lag_monitor.start()
+
+    def stop(self):
+        self.lag_monitor.stop()
+
+    def _rate(self, count, last_count, elapsed):
+        if elapsed <= 0:
+            return 0.0
+        return max(count - last_count, 0) / elapsed
+
+    def collect(self, connectors):
+        """
+        Return a dict of heartbeat attributes describing the worker's
+        performance since the last call.
+
+        :param dict connectors:
+            The worker's connectors, keyed by name.
+        """
+        now = self.clock.seconds()
+        elapsed = now - (self._last_time if self._last_time is not None
+                         else now)
+        self._last_time = now
+
+        connector_stats = {}
+        totals = {'consumed_rate': 0.0, 'published_rate': 0.0,
+                  'in_flight': 0}
+        for name, connector in connectors.iteritems():
+            last_consumed, last_published = self._last_counts.get(
+                name, (connector.consumed, connector.published))
+            self._last_counts[name] = (
+                connector.consumed, connector.published)
+            stats = {
+                'in_flight': connector.in_flight,
+                'consumed_rate': self._rate(
+                    connector.consumed, last_consumed, elapsed),
+                'published_rate': self._rate(
+                    connector.published, last_published, elapsed),
+                'paused': connector.paused,
+            }
+            connector_stats[name] = stats
+            for key in totals:
+                totals[key] += stats[key]
+
+        attrs = {
+            'reactor_lag': self.lag_monitor.pop_max_lag(),
+            'rss': get_rss(),
+            'paused': bool(connectors) and all(
+                stats['paused'] for stats in connector_stats.itervalues()),
+            'connectors': connector_stats,
+        }
+        attrs.update(totals)
+        return attrs
@@ -95,6 +95,42 @@ class TestWorker(VumiTestCase):
         self.assertEqual(len(wkr._instances_active), 0)
         self.assertEqual(len(wkr._instances), 2)
 
+    def test_to_dict_with_stats(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {
+            'reactor_lag': 0.5, 'rss': 100, 'consumed_rate': 2.0,
+            'published_rate': 1.0, 'in_flight': 3, 'paused': False})
+        wkr.record('host-1', 35, {
+            'reactor_lag': 0.25, 'rss': 200, 'consumed_rate': 3.0,
+            'published_rate': 2.0, 'in_flight': 1, 'paused': True})
+        wkr.record('host-2', 36, {'reactor_lag': 0.75, 'rss': 50})
+        wkr.snapshot()
+
+        stats = {
+            'reactor_lag': 0.75, 'rss': 350, 'consumed_rate': 5.0,
+            'published_rate': 3.0, 'in_flight': 4, 'paused': 1,
+        }
+        obj = wkr.to_dict()
+        self.assertEqual(obj['stats'], stats)
+        hosts = dict((h['host'], h) for h in obj['hosts'])
+        self.assertEqual(hosts['host-1'], {
+            'host': 'host-1', 'proc_count': 2, 'reactor_lag': 0.5,
+            'rss': 300, 'consumed_rate': 5.0, 'published_rate': 3.0,
+            'in_flight': 4, 'paused': 1,
+        })
+        self.assertEqual(hosts['host-2'], {
+            'host': 'host-2', 'proc_count': 1, 'reactor_lag': 0.75,
+            'rss': 50,
+        })
+
+    def test_snapshot_stats(self):
+        wkr = monitor.Worker('system-1', 'foo', 1)
+        wkr.record('host-1', 34, {'rss': 100})
+        wkr.snapshot()
+        self.assertEqual(wkr.to_dict()['stats'], {'rss': 100})
+        wkr.snapshot()
+        self.assertFalse('stats' in wkr.to_dict())
+
 
 class TestSystem(VumiTestCase):
 
@@ -241,6 +277,121 @@ class TestHeartBeatMonitor(VumiTestCase):
         issue = yield fkredis.get(key)
         self.assertEqual(issue, None)
 
+    @inlineCallbacks
+    def audit_with_stats(self, wkr, **stats):
+        attrs = self.gen_fake_attrs(time.time())
+        attrs.update(stats)
+        self.worker.update(attrs)
+        attrs['pid'] = 346
+        self.worker.update(attrs)
+        wkr.snapshot()
+        yield wkr.audit(self.worker._storage)
+
+    @inlineCallbacks
+    def test_update_records_stats(self):
+        yield self.worker.startWorker()
+        attrs = self.gen_fake_attrs(time.time())
+        attrs.update({'reactor_lag': 0.1, 'rss': 1024, 'connectors': {}})
+        self.worker.update(attrs)
+        wkr = self.worker._workers[attrs['worker_id']]
+        [stats] = wkr._stats_active.values()
+        self.assertEqual(stats, {'reactor_lag': 0.1, 'rss': 1024})
+
+    @inlineCallbacks
+    def test_audit_reactor_lag(self):
+        yield self.worker.startWorker()
+        fkredis = self.worker._redis
+        wkr_id = generate_worker_id('system-1', 'twitter_transport')
+        wkr = self.worker._workers[wkr_id]
+        key = issue_key(wkr_id, 'reactor-lag')
+
+        # a short spike doesn't open an issue
+        for i in range(wkr.sustained_intervals - 1):
+            yield self.audit_with_stats(wkr, reactor_lag=2.0)
+        self.assertEqual((yield fkredis.get(key)), None)
+
+        yield self.audit_with_stats(wkr, reactor_lag=2.0)
+        issue = json.loads((yield fkredis.get(key)))
+        self.assertEqual(issue['issue_type'], 'reactor-lag')
+        # the min-procs issue is stored separately
+        self.assertEqual((yield fkredis.get(issue_key(wkr_id))), None)
+
+        yield self.audit_with_stats(wkr, reactor_lag=0.01)
+        self.assertEqual((yield fkredis.get(key)), None)
+
+    @inlineCallbacks
+    def test_audit_throughput_collapse(self):
+        yield self.worker.startWorker()
+        fkredis = self.worker._redis
+        wkr_id = generate_worker_id('system-1', 'twitter_transport')
+        wkr = self.worker._workers[wkr_id]
+        key = issue_key(wkr_id, 'throughput-collapse')
+
+        for i in range(5):
+            yield self.audit_with_stats(wkr, consumed_rate=50.0)
+        self.assertEqual(wkr.baseline_rate, 100.0)
+
+        for i in range(wkr.sustained_intervals):
+            yield self.audit_with_stats(wkr, consumed_rate=1.0)
+        issue = json.loads((yield fkredis.get(key)))
+        self.assertEqual(issue['issue_type'], 'throughput-collapse')
+        self.assertEqual(wkr.baseline_rate, 100.0)
+
+        yield self.audit_with_stats(wkr, consumed_rate=50.0)
+        self.assertEqual((yield fkredis.get(key)), None)
+
+    @inlineCallbacks
+    def test_audit_throughput_paused(self):
+        yield self.worker.startWorker()
+        fkredis = self.worker._redis
+        wkr_id = generate_worker_id('system-1', 'twitter_transport')
+        wkr = self.worker._workers[wkr_id]
+        key = issue_key(wkr_id, 'throughput-collapse')
+
+        yield self.audit_with_stats(wkr, consumed_rate=50.0)
+        for i in range(wkr.sustained_intervals):
+            yield self.audit_with_stats(wkr, consumed_rate=0.0, paused=True)
+        self.assertEqual((yield fkredis.get(key)), None)
+
+    @inlineCallbacks
+    def test_audit_throughput_low_baseline(self):
+        yield self.worker.startWorker()
+        fkredis = self.worker._redis
+        wkr_id = generate_worker_id('system-1', 'twitter_transport')
+        wkr = self.worker._workers[wkr_id]
+        key = issue_key(wkr_id, 'throughput-collapse')
+
+        # an idle worker going quiet isn't a collapse
+        yield self.audit_with_stats(wkr, consumed_rate=0.2)
+        for i in range(wkr.sustained_intervals):
+            yield self.audit_with_stats(wkr, consumed_rate=0.0)
+        self.assertEqual((yield fkredis.get(key)), None)
+
+    @inlineCallbacks
+    def test_worker_thresholds_from_config(self):
+        yield self.worker.startWorker()
+        systems, workers = self.worker.parse_config({
+            'system-1': {
+                'system_name': 'system-1',
+                'system_id': 'system-1',
+                'workers': {
+                    'foo': {
+                        'name': 'foo',
+                        'min_procs': 1,
+                        'max_reactor_lag': 5.0,
+                        'min_throughput_ratio': 0.5,
+                        'min_baseline_rate': 10.0,
+                        'sustained_intervals': 1,
+                    }
+                }
+            }
+        })
+        wkr = workers[generate_worker_id('system-1', 'foo')]
+        self.assertEqual(wkr.max_reactor_lag, 5.0)
+        self.assertEqual(wkr.min_throughput_ratio, 0.5)
+        self.assertEqual(wkr.min_baseline_rate, 10.0)
+        self.assertEqual(wkr.sustained_intervals, 1)
+
     @inlineCallbacks
     def test_serialize_to_redis(self):
         # This covers a lot of the serialization methods
@@ -274,3 +425,35 @@ class TestHeartBeatMonitor(VumiTestCase):
         system = json.loads((yield fkredis.get('system:system-1')))
         system['timestamp'] = 2
         self.assertEqual(system, expected)
+
+    @inlineCallbacks
+    def test_periodic_task_batches_writes(self):
+        yield self.worker.startWorker()
+        fkredis = self.worker._redis
+        calls = []
+        orig_transaction = fkredis.transaction
+
+        def transaction():
+            calls.append('transaction')
+            return orig_transaction()
+        self.patch(fkredis, 'transaction', transaction)
+        self.patch(fkredis, 'set', lambda *a: calls.append('set'))
+
+        # the only instance is below min_procs, so an issue is opened
+        self.worker.update(self.gen_fake_attrs(time.time()))
+        yield self.worker._periodic_task()
+
+        self.assertEqual(calls, ['transaction'])
+        wkr_id = generate_worker_id('system-1', 'twitter_transport')
+        issue = json.loads((yield fkredis.get(issue_key(wkr_id))))
+        self.assertEqual(issue['issue_type'], 'min-procs-fail')
+        self.assertEqual(issue['procs_count'], 1)
+        system = json.loads((yield fkredis.get('system:system-1')))
+        self.assertEqual(system['id'], 'system-1')
+
+    @inlineCallbacks
+    def test_audit_duration_metric(self):
+        yield self.worker.startWorker()
+        yield self.worker._periodic_task()
+        [(_, duration)] = self.worker._audit_timer.poll()
+        self.assertTrue(duration >= 0)
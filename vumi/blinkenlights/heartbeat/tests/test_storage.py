@@ -81,3 +81,78 @@ class TestStorage(VumiTestCase):
         yield self.stg.open_or_update_issue('foo', iss)
         res = yield self.redis.get(storage.issue_key('foo'))
         self.assertEqual(res, json.dumps(obj))
+
+    @inlineCallbacks
+    def test_issue_types_stored_separately(self):
+        yield self.stg.open_or_update_issue(
+            'foo', monitor.WorkerIssue('min-procs-fail', 5, 1))
+        yield self.stg.open_or_update_issue(
+            'foo', monitor.WorkerIssue('reactor-lag', 6, 2))
+        self.assertEqual(storage.issue_key('foo'), 'worker:foo:issue')
+        lag_key = storage.issue_key('foo', 'reactor-lag')
+        self.assertEqual(lag_key, 'worker:foo:issue:reactor-lag')
+        res = json.loads((yield self.redis.get(lag_key)))
+        self.assertEqual(res['issue_type'], 'reactor-lag')
+
+        yield self.stg.delete_worker_issue('foo', 'reactor-lag')
+        self.assertEqual((yield self.redis.get(lag_key)), None)
+        res = json.loads((yield self.redis.get(storage.issue_key('foo'))))
+        self.assertEqual(res['issue_type'], 'min-procs-fail')
+
+    @inlineCallbacks
+    def test_batch(self):
+        yield self.stg.open_or_update_issue(
+            'foo', monitor.WorkerIssue('min-procs-fail', 5, 1))
+        yield self.stg.open_or_update_issue(
+            'bar', monitor.WorkerIssue('min-procs-fail', 5, 1))
+
+        batch = self.stg.batch()
+        batch.add_system_ids(['haha'])
+        batch.write_system(DummySystem())
+        batch.open_or_update_issue(
+            'foo', monitor.WorkerIssue('min-procs-fail', 10, 2))
+        batch.open_or_update_issue(
+            'baz', monitor.WorkerIssue('reactor-lag', 10, 3))
+        batch.delete_worker_issue('bar')
+        self.assertEqual(len(batch), 5)
+        # nothing is written until the batch is executed
+        self.assertEqual((yield self.redis.smembers(storage.SYSTEMS_KEY)),
+                         set())
+        yield batch.execute()
+        self.assertEqual(len(batch), 0)
+
+        res = yield self.redis.smembers(storage.SYSTEMS_KEY)
+        self.assertEqual(tuple(res), ('haha',))
+        res = yield self.redis.get(storage.system_key('haha'))
+        self.assertEqual(res, 'Ha!')
+        # existing issues keep their start time
+        res = json.loads((yield self.redis.get(storage.issue_key('foo'))))
+        self.assertEqual(res['start_time'], 5)
+        self.assertEqual(res['procs_count'], 2)
+        res = json.loads((yield self.redis.get(
+            storage.issue_key('baz', 'reactor-lag'))))
+        self.assertEqual(res, {
+            'issue_type': 'reactor-lag',
+            'start_time': 10,
+            'procs_count': 3,
+        })
+        res = yield self.redis.get(storage.issue_key('bar'))
+        self.assertEqual(res, None)
+
+    @inlineCallbacks
+    def test_batch_repeated_issue(self):
+        batch = self.stg.batch()
+        batch.open_or_update_issue(
+            'foo', monitor.WorkerIssue('min-procs-fail', 5, 1))
+        batch.open_or_update_issue(
+            'foo', monitor.WorkerIssue('min-procs-fail', 10, 2))
+        yield batch.execute()
+        res = json.loads((yield self.redis.get(storage.issue_key('foo'))))
+        self.assertEqual(res['start_time'], 5)
+        self.assertEqual(res['procs_count'], 2)
+
+    @inlineCallbacks
+    def test_empty_batch(self):
+        yield self.stg.batch().execute()
+        res = yield self.redis.keys()
+        self.assertEqual(res, [])
@@ -0,0 +1,81 @@
+"""Tests for vumi.blinkenlights.heartbeat.telemetry"""
+
+from twisted.internet.task import Clock
+
+from vumi.blinkenlights.heartbeat import telemetry
+from vumi.tests.helpers import VumiTestCase
+
+
+class DummyConnector(object):
+    def __init__(self, consumed=0, published=0, in_flight=0, paused=False):
+        self.consumed = consumed
+        self.published = published
+        self.in_flight = in_flight
+        self.paused = paused
+
+
+class TestReactorLagMonitor(VumiTestCase):
+
+    def test_lag(self):
+        clock = Clock()
+        lag_monitor = telemetry.ReactorLagMonitor(interval=1.0, clock=clock)
+        lag_monitor.start()
+        self.add_cleanup(lag_monitor.stop)
+        clock.advance(1.0)
+        self.assertEqual(lag_monitor.pop_max_lag(), 0.0)
+        # the reactor was blocked and the next call ran late
+        clock.advance(3.5)
+        clock.advance(1.0)
+        self.assertEqual(lag_monitor.pop_max_lag(), 2.5)
+        self.assertEqual(lag_monitor.pop_max_lag(), 0.0)
+
+    def test_stop(self):
+        clock = Clock()
+        lag_monitor = telemetry.ReactorLagMonitor(clock=clock)
+        lag_monitor.start()
+        lag_monitor.stop()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+class TestWorkerTelemetry(VumiTestCase):
+
+    def mk_telemetry(self):
+        clock = Clock()
+        worker_telemetry = telemetry.WorkerTelemetry(clock=clock)
+        worker_telemetry.start()
+        self.add_cleanup(worker_telemetry.stop)
+        return clock, worker_telemetry
+
+    def test_get_rss(self):
+        rss = telemetry.get_rss()
+        self.assertTrue(rss is None or rss > 0)
+
+    def test_collect(self):
+        clock, worker_telemetry = self.mk_telemetry()
+        conn1 = DummyConnector()
+        conn2 = DummyConnector(paused=True)
+        connectors = {'conn1': conn1, 'conn2': conn2}
+        worker_telemetry.collect(connectors)
+
+        clock.pump([1.0] * 10)
+        conn1.consumed, conn1.published, conn1.in_flight = 50, 20, 3
+        conn2.consumed = 10
+        attrs = worker_telemetry.collect(connectors)
+        self.assertEqual(attrs['consumed_rate'], 6.0)
+        self.assertEqual(attrs['published_rate'], 2.0)
+        self.assertEqual(attrs['in_flight'], 3)
+        self.assertEqual(attrs['paused'], False)
+        self.assertEqual(attrs['reactor_lag'], 0.0)
+        self.assertTrue('rss' in attrs)
+        self.assertEqual(attrs['connectors']['conn1'], {
+            'consumed_rate': 5.0, 'published_rate': 2.0, 'in_flight': 3,
+            'paused': False,
+        })
+        self.assertEqual(attrs['connectors']['conn2']['paused'], True)
+
+    def test_collect_all_paused(self):
+        clock, worker_telemetry = self.mk_telemetry()
+        attrs = worker_telemetry.collect({'conn': DummyConnector(paused=True)})
+        self.assertEqual(attrs['paused'], True)
+        attrs = worker_telemetry.collect({})
+        self.assertEqual(attrs['paused'], False)
@@ -57,6 +57,10 @@ class MetricManager(Publisher):
             self._task.stop()
             self._task = None
 
+    def is_started(self):
+        """Return True if the manager is publishing metrics."""
+        return self._task is not None
+
     def _publish_metrics(self):
         msg = MetricMessage()
         # oneshot metrics
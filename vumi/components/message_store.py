@@ -13,7 +13,10 @@ from vumi.persist.fields import (
     VumiMessage, ForeignKey, ManyToMany, ListOf, Tag, Dynamic, Unicode)
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi import log
-from vumi.components.message_store_cache import MessageStoreCache
+from vumi.utils import LRUCache
+from vumi.blinkenlights.metrics import Count
+from vumi.components.message_store_cache import (
+    MessageStoreCache, MessageStoreCacheException)
 from vumi.components.message_store_migrators import (
     InboundMessageMigrator, OutboundMessageMigrator)
 
@@ -96,10 +99,43 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    :param int index_page_size:
+        Number of keys to fetch in each secondary index query when listing
+        or counting the messages in a batch. Defaults to
+        ``DEFAULT_INDEX_PAGE_SIZE``.
+    :param int tag_cache_size:
+        Number of tag to batch_id mappings to keep in an in-process cache
+        so that storing a tagged message doesn't need to load the tag's
+        :class:`CurrentTag` from Riak every time. The cache is disabled
+        if this is zero (the default).
+    :param float tag_cache_ttl:
+        Seconds to keep cached tag mappings for. Defaults to
+        ``DEFAULT_TAG_CACHE_TTL``.
+    :param float tag_cache_check_interval:
+        How often, in seconds, to check whether a batch has been started
+        or finished (by this or any other message store using the same
+        Redis) since the cached tag mappings were loaded. Defaults to
+        ``DEFAULT_TAG_CACHE_CHECK_INTERVAL``. Zero checks before every
+        lookup.
+    :param metrics:
+        An optional :class:`vumi.blinkenlights.metrics.MetricManager` to
+        count tag cache hits and misses with.
     """
 
-    def __init__(self, manager, redis):
+    DEFAULT_INDEX_PAGE_SIZE = 1000
+    DEFAULT_TAG_CACHE_TTL = 60
+    DEFAULT_TAG_CACHE_CHECK_INTERVAL = 1
+
+    # Cached batch ids may be None, so we need a different marker for
+    # tags that aren't in the cache.
+    _TAG_CACHE_MISS = object()
+
+    def __init__(self, manager, redis, index_page_size=None,
+                 tag_cache_size=0, tag_cache_ttl=None,
+                 tag_cache_check_interval=None, metrics=None):
         self.manager = manager
+        self.index_page_size = index_page_size or self.DEFAULT_INDEX_PAGE_SIZE
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
         self.events = manager.proxy(Event)
@@ -107,6 +143,22 @@ class MessageStore(object):
         self.current_tags = manager.proxy(CurrentTag)
         self.cache = MessageStoreCache(redis)
 
+        self.tag_cache = None
+        if tag_cache_size:
+            if tag_cache_ttl is None:
+                tag_cache_ttl = self.DEFAULT_TAG_CACHE_TTL
+            self.tag_cache = LRUCache(tag_cache_size, ttl=tag_cache_ttl)
+        if tag_cache_check_interval is None:
+            tag_cache_check_interval = self.DEFAULT_TAG_CACHE_CHECK_INTERVAL
+        self.tag_cache_check_interval = tag_cache_check_interval
+        self._tag_cache_version = None
+        self._tag_cache_checked_at = None
+
+        self.metrics = metrics
+        if metrics is not None and self.tag_cache is not None:
+            metrics.register(Count('tag_cache.hits'))
+            metrics.register(Count('tag_cache.misses'))
+
     @Manager.calls_manager
     def needs_reconciliation(self, batch_id, delta=0.01):
         """
@@ -134,39 +186,144 @@ class MessageStore(object):
         returnValue(False)
 
     @Manager.calls_manager
-    def reconcile_cache(self, batch_id):
-        yield self.cache.clear_batch(batch_id)
-        yield self.cache.batch_start(batch_id)
-        yield self.reconcile_inbound_cache(batch_id)
-        yield self.reconcile_outbound_cache(batch_id)
+    def reconcile_cache(self, batch_id, start_timestamp=None,
+                        end_timestamp=None, progress_callback=None):
+        """
+        Rebuild the cached information for a batch from the messages and
+        events stored in Riak.
+
+        Messages and events are loaded in bunches, several at a time (see
+        :meth:`Manager.load_all_bunches`). The new cache is built alongside
+        the current one and atomically replaces it once complete, so the
+        cached values stay usable while reconciliation is in progress.
+
+        :param datetime start_timestamp:
+            If given, only messages with timestamps at or after this are
+            reconciled.
+        :param datetime end_timestamp:
+            If given, only messages with timestamps before this are
+            reconciled.
+        :param callable progress_callback:
+            Called with the direction (``'inbound'`` or ``'outbound'``) and
+            the number of messages in that direction processed so far after
+            each bunch of messages.
+
+        If a time window is given, the messages in it (and their events)
+        are added to the existing cached values instead of replacing them.
+        All the batch's messages still need to be loaded to find the ones
+        in the window, but only those are written to the cache.
+
+        Bunches that fail to load are logged and skipped. If any did, a
+        full reconciliation throws the new cache away and raises
+        :class:`MessageStoreCacheException` instead of replacing the
+        current cached values with an incomplete set.
+        """
+        window = (start_timestamp, end_timestamp)
+        incremental = window != (None, None)
+        if incremental:
+            yield self.cache.batch_start(batch_id)
+            cache_batch_id = batch_id
+        else:
+            cache_batch_id = yield self.cache.start_reconciliation(batch_id)
+
+        try:
+            failed = yield self.reconcile_inbound_cache(
+                batch_id, cache_batch_id, window, progress_callback)
+            failed += yield self.reconcile_outbound_cache(
+                batch_id, cache_batch_id, window, progress_callback)
+        except Exception:
+            if not incremental:
+                yield self.cache.abort_reconciliation(batch_id)
+            raise
+
+        if not incremental:
+            if failed:
+                yield self.cache.abort_reconciliation(batch_id)
+                raise MessageStoreCacheException(
+                    "Failed to load %d bunches of messages while reconciling"
+                    " batch %r." % (failed, batch_id))
+            yield self.cache.finish_reconciliation(batch_id)
+
+    def _msgs_in_window(self, msg_records, window):
+        start, end = window
+        msgs = [record.msg for record in msg_records]
+        if start is not None:
+            msgs = [msg for msg in msgs if msg['timestamp'] >= start]
+        if end is not None:
+            msgs = [msg for msg in msgs if msg['timestamp'] < end]
+        return msgs
 
     @Manager.calls_manager
-    def reconcile_inbound_cache(self, batch_id):
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+    def reconcile_inbound_cache(self, batch_id, cache_batch_id=None,
+                                window=(None, None), progress_callback=None):
+        if cache_batch_id is None:
+            cache_batch_id = batch_id
+        processed = [0]
+        failed = [0]
+
+        def reconcile_page(page):
+            for bunch in self.inbound_messages.load_all_bunches(page.keys):
+                try:
+                    msg_records = yield bunch
+                    yield self.cache.add_inbound_messages(
+                        cache_batch_id,
+                        self._msgs_in_window(msg_records, window))
+                except Exception:
+                    log.err()
+                    failed[0] += 1
+            processed[0] += len(page)
+            if progress_callback is not None:
+                progress_callback('inbound', processed[0])
+
+        page = yield self.batch_inbound_keys_page(batch_id)
+        yield page.foreach_page(self.manager.call_decorator(reconcile_page))
+        returnValue(failed[0])
 
     @Manager.calls_manager
-    def reconcile_outbound_cache(self, batch_id):
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+    def reconcile_outbound_cache(self, batch_id, cache_batch_id=None,
+                                 window=(None, None), progress_callback=None):
+        if cache_batch_id is None:
+            cache_batch_id = batch_id
+        processed = [0]
+        failed = [0]
+
+        def reconcile_page(page):
+            for bunch in self.outbound_messages.load_all_bunches(page.keys):
+                try:
+                    msg_records = yield bunch
+                    msgs = self._msgs_in_window(msg_records, window)
+                    yield self.cache.add_outbound_messages(
+                        cache_batch_id, msgs)
+                    yield self._reconcile_events(
+                        cache_batch_id, [msg['message_id'] for msg in msgs])
+                except Exception:
+                    log.err()
+                    failed[0] += 1
+            processed[0] += len(page)
+            if progress_callback is not None:
+                progress_callback('outbound', processed[0])
+
+        page = yield self.batch_outbound_keys_page(batch_id)
+        yield page.foreach_page(self.manager.call_decorator(reconcile_page))
+        returnValue(failed[0])
+
+    @Manager.calls_manager
+    def _reconcile_events(self, cache_batch_id, message_ids):
+        # We start all the index queries before waiting for any of them so
+        # that they run concurrently.
+        event_keys_results = [
+            self.message_event_keys(message_id) for message_id in message_ids]
+        event_keys = []
+        for keys in event_keys_results:
+            event_keys.extend((yield keys))
+        for bunch in self.events.load_all_bunches(event_keys):
+            event_records = yield bunch
+            yield self.cache.add_events(
+                cache_batch_id, [record.event for record in event_records])
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
-        event_keys = yield self.message_event_keys(message_id)
-        for event_key in event_keys:
-            event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+        yield self._reconcile_events(batch_id, [message_id])
 
     @Manager.calls_manager
     def batch_start(self, tags=(), **metadata):
@@ -184,6 +341,8 @@ class MessageStore(object):
             tag_record.current_batch.set(batch)
             yield tag_record.save()
 
+        if tags:
+            yield self.invalidate_tag_cache()
         yield self.cache.batch_start(batch_id)
         returnValue(batch_id)
 
@@ -195,6 +354,80 @@ class MessageStore(object):
             for tag in (yield tags_bunch):
                 tag.current_batch.set(None)
                 yield tag.save()
+        if tag_keys:
+            yield self.invalidate_tag_cache()
+
+    @Manager.calls_manager
+    def invalidate_tag_cache(self):
+        """
+        Discard the cached tag mappings in this message store and tell any
+        other message stores sharing our Redis to discard theirs.
+
+        This must be called after changing a :class:`CurrentTag` so that
+        the change is seen by anything storing messages for the tag.
+        """
+        yield self.cache.incr_current_tag_version()
+        if self.tag_cache is not None:
+            self.tag_cache.clear()
+        # We don't record the new version here, so the next lookup sees
+        # that it has changed and clears the cache again in case a lookup
+        # that was already in progress cached an old mapping.
+        self._tag_cache_checked_at = None
+
+    @Manager.calls_manager
+    def _check_tag_cache_version(self):
+        now = self.tag_cache.clock.seconds()
+        if (self._tag_cache_checked_at is not None and
+                now - self._tag_cache_checked_at <
+                self.tag_cache_check_interval):
+            return
+        self._tag_cache_checked_at = now
+        version = yield self.cache.get_current_tag_version()
+        if version != self._tag_cache_version:
+            self.tag_cache.clear()
+            self._tag_cache_version = version
+
+    def _count_tag_cache(self, name):
+        if self.metrics is not None:
+            self.metrics[name].inc()
+
+    @Manager.calls_manager
+    def get_current_batch_id(self, tag):
+        """
+        Return the id of the batch the given tag is currently associated
+        with, or `None` if it isn't associated with one.
+        """
+        tag = tuple(tag)
+        if self.tag_cache is not None:
+            yield self._check_tag_cache_version()
+            batch_id = self.tag_cache.get(tag, self._TAG_CACHE_MISS)
+            if batch_id is not self._TAG_CACHE_MISS:
+                self._count_tag_cache('tag_cache.hits')
+                returnValue(batch_id)
+            self._count_tag_cache('tag_cache.misses')
+
+        tag_record = yield self.current_tags.load(tag)
+        batch_id = None
+        if tag_record is not None:
+            batch_id = tag_record.current_batch.key
+        if self.tag_cache is not None:
+            self.tag_cache.set(tag, batch_id)
+        returnValue(batch_id)
+
+    def tag_cache_stats(self):
+        """
+        Return a dict of the number of tag cache hits and misses since
+        the message store was created and the resulting hit rate.
+        """
+        if self.tag_cache is None:
+            return {'hits': 0, 'misses': 0, 'hit_rate': 0.0}
+        hits, misses = self.tag_cache.hits, self.tag_cache.misses
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': (float(hits) / lookups) if lookups else 0.0,
+        }
 
     @Manager.calls_manager
     def add_outbound_message(self, msg, tag=None, batch_id=None):
@@ -206,9 +439,7 @@ class MessageStore(object):
             msg_record.msg = msg
 
         if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
+            batch_id = yield self.get_current_batch_id(tag)
 
         if batch_id is not None:
             msg_record.batches.add_key(batch_id)
@@ -222,21 +453,44 @@ class MessageStore(object):
         returnValue(msg.msg if msg is not None else None)
 
     @Manager.calls_manager
-    def add_event(self, event):
+    def _save_event_record(self, event):
         event_id = event['event_id']
-        msg_id = event['user_message_id']
         event_record = yield self.events.load(event_id)
         if event_record is None:
-            event_record = self.events(event_id, event=event, message=msg_id)
+            event_record = self.events(
+                event_id, event=event, message=event['user_message_id'])
         else:
             event_record.event = event
         yield event_record.save()
 
-        msg_record = yield self.outbound_messages.load(msg_id)
+    @Manager.calls_manager
+    def add_event(self, event):
+        yield self._save_event_record(event)
+
+        msg_record = yield self.outbound_messages.load(
+            event['user_message_id'])
         if msg_record is not None:
             for batch_id in msg_record.batches.keys():
                 yield self.cache.add_event(batch_id, event)
 
+    @Manager.calls_manager
+    def add_events(self, events):
+        """
+        Store a list of events, loading the outbound message for each
+        message id they refer to only once.
+        """
+        events_by_msg_id = {}
+        for event in events:
+            yield self._save_event_record(event)
+            events_by_msg_id.setdefault(
+                event['user_message_id'], []).append(event)
+
+        for msg_id, msg_events in events_by_msg_id.iteritems():
+            msg_record = yield self.outbound_messages.load(msg_id)
+            if msg_record is not None:
+                for batch_id in msg_record.batches.keys():
+                    yield self.cache.add_events(batch_id, msg_events)
+
     @Manager.calls_manager
     def get_event(self, event_id):
         event = yield self.events.load(event_id)
@@ -252,9 +506,7 @@ class MessageStore(object):
             msg_record.msg = msg
 
         if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
+            batch_id = yield self.get_current_batch_id(tag)
 
         if batch_id is not None:
             msg_record.batches.add_key(batch_id)
@@ -280,32 +532,74 @@ class MessageStore(object):
     def batch_status(self, batch_id):
         return self.cache.get_event_status(batch_id)
 
+    @Manager.calls_manager
+    def _collect_keys(self, page):
+        keys = []
+        yield page.foreach_page(keys.extend)
+        returnValue(keys)
+
+    def _index_keys_page(self, proxy, field_name, value, max_results,
+                         continuation):
+        if max_results is None:
+            max_results = self.index_page_size
+        return proxy.index_keys_page(
+            field_name, value, max_results=max_results,
+            continuation=continuation)
+
+    def batch_outbound_keys_page(self, batch_id, max_results=None,
+                                 continuation=None):
+        return self._index_keys_page(
+            self.outbound_messages, 'batches', batch_id, max_results,
+            continuation)
+
+    @Manager.calls_manager
     def batch_outbound_keys(self, batch_id):
-        return self.outbound_messages.index_keys('batches', batch_id)
+        page = yield self.batch_outbound_keys_page(batch_id)
+        keys = yield self._collect_keys(page)
+        returnValue(keys)
 
     def batch_outbound_keys_matching(self, batch_id, query):
         mr = self.outbound_messages.index_match(query, 'batches', batch_id)
         return mr.get_keys()
 
+    def batch_inbound_keys_page(self, batch_id, max_results=None,
+                                continuation=None):
+        return self._index_keys_page(
+            self.inbound_messages, 'batches', batch_id, max_results,
+            continuation)
+
+    @Manager.calls_manager
     def batch_inbound_keys(self, batch_id):
-        return self.inbound_messages.index_keys('batches', batch_id)
+        page = yield self.batch_inbound_keys_page(batch_id)
+        keys = yield self._collect_keys(page)
+        returnValue(keys)
 
     def batch_inbound_keys_matching(self, batch_id, query):
         mr = self.inbound_messages.index_match(query, 'batches', batch_id)
         return mr.get_keys()
 
+    def message_event_keys_page(self, msg_id, max_results=None,
+                                continuation=None):
+        return self._index_keys_page(
+            self.events, 'message', msg_id, max_results, continuation)
+
+    @Manager.calls_manager
     def message_event_keys(self, msg_id):
-        return self.events.index_keys('message', msg_id)
+        page = yield self.message_event_keys_page(msg_id)
+        keys = yield self._collect_keys(page)
+        returnValue(keys)
 
     @Manager.calls_manager
     def batch_inbound_count(self, batch_id):
-        keys = yield self.batch_inbound_keys(batch_id)
-        returnValue(len(keys))
+        page = yield self.batch_inbound_keys_page(batch_id)
+        count = yield page.count()
+        returnValue(count)
 
     @Manager.calls_manager
     def batch_outbound_count(self, batch_id):
-        keys = yield self.batch_outbound_keys(batch_id)
-        returnValue(len(keys))
+        page = yield self.batch_outbound_keys_page(batch_id)
+        count = yield page.count()
+        returnValue(count)
 
     @inlineCallbacks
     def find_inbound_keys_matching(self, batch_id, query, ttl=None,
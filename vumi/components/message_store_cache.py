@@ -3,6 +3,7 @@
 import time
 import hashlib
 import json
+from collections import defaultdict
 
 from twisted.internet.defer import returnValue
 
@@ -29,6 +30,9 @@ class MessageStoreCache(object):
     STATUS_KEY = 'status'
     SEARCH_TOKEN_KEY = 'search_token'
     SEARCH_RESULT_KEY = 'search_result'
+    RECONCILE_KEY = 'reconcile'
+    RECONCILING_KEY = 'reconciling'
+    CURRENT_TAG_VERSION_KEY = 'current_tag_version'
 
     # Cache search results for 24 hrs
     DEFAULT_SEARCH_RESULT_TTL = 60 * 60 * 24
@@ -68,6 +72,29 @@ class MessageStoreCache(object):
     def search_result_key(self, batch_id, token):
         return self.batch_key(self.SEARCH_RESULT_KEY, batch_id, token)
 
+    def reconciling_key(self):
+        return self.batch_key(self.RECONCILING_KEY)
+
+    def current_tag_version_key(self):
+        return self.key(self.CURRENT_TAG_VERSION_KEY)
+
+    def shadow_batch_id(self, batch_id):
+        """
+        Return the id under which a new cache for the given batch_id is
+        built during reconciliation.
+        """
+        return self.key(self.RECONCILE_KEY, batch_id)
+
+    def _cached_batch_keys(self, batch_id):
+        return [
+            self.inbound_key(batch_id),
+            self.outbound_key(batch_id),
+            self.event_key(batch_id),
+            self.status_key(batch_id),
+            self.to_addr_key(batch_id),
+            self.from_addr_key(batch_id),
+        ]
+
     @Manager.calls_manager
     def batch_start(self, batch_id):
         """
@@ -105,6 +132,19 @@ class MessageStoreCache(object):
     def batch_exists(self, batch_id):
         return self.redis.sismember(self.batch_key(), batch_id)
 
+    @Manager.calls_manager
+    def get_current_tag_version(self):
+        """
+        Return a counter that changes whenever a tag is associated with
+        or removed from a batch, so that cached tag mappings can be
+        checked for staleness.
+        """
+        version = yield self.redis.get(self.current_tag_version_key())
+        returnValue(int(version or 0))
+
+    def incr_current_tag_version(self):
+        return self.redis.incr(self.current_tag_version_key())
+
     @Manager.calls_manager
     def clear_batch(self, batch_id):
         """
@@ -124,21 +164,115 @@ class MessageStoreCache(object):
         yield self.redis.delete(self.from_addr_key(batch_id))
         yield self.redis.srem(self.batch_key(), batch_id)
 
+    @Manager.calls_manager
+    def start_reconciliation(self, batch_id):
+        """
+        Prepare an empty cache for the given batch_id to be rebuilt in,
+        without touching the current cached values. Returns the shadow
+        batch_id the new cache should be built under.
+
+        Until `finish_reconciliation()` is called, messages and events
+        added for the batch_id are added to the new cache as well.
+        """
+        shadow_batch_id = self.shadow_batch_id(batch_id)
+        yield self.clear_batch(shadow_batch_id)
+        yield self.init_status(shadow_batch_id)
+        yield self.redis.sadd(self.reconciling_key(), batch_id)
+        returnValue(shadow_batch_id)
+
+    @Manager.calls_manager
+    def finish_reconciliation(self, batch_id):
+        """
+        Atomically replace the cached values for the given batch_id with
+        the cache rebuilt since `start_reconciliation()` was called.
+        """
+        shadow_keys = self._cached_batch_keys(self.shadow_batch_id(batch_id))
+        batch_keys = self._cached_batch_keys(batch_id)
+
+        pipe = self.redis.pipeline()
+        for key in shadow_keys:
+            pipe.exists(key)
+        shadow_keys_exist = yield pipe.execute()
+
+        txn = self.redis.transaction()
+        for shadow_key, key, exists in zip(
+                shadow_keys, batch_keys, shadow_keys_exist):
+            if exists:
+                txn.rename(shadow_key, key)
+            else:
+                # Nothing was cached in the new cache for this key, so the
+                # old value should go too.
+                txn.delete(key)
+        txn.sadd(self.batch_key(), batch_id)
+        txn.srem(self.reconciling_key(), batch_id)
+        yield txn.execute()
+
+    @Manager.calls_manager
+    def abort_reconciliation(self, batch_id):
+        """
+        Throw away the cache rebuilt since `start_reconciliation()` was
+        called, leaving the current cached values for the batch_id as they
+        are.
+        """
+        yield self.redis.srem(self.reconciling_key(), batch_id)
+        yield self.clear_batch(self.shadow_batch_id(batch_id))
+
     def get_timestamp(self, datetime):
         """
         Return a timestamp value for a datetime value.
         """
         return time.mktime(datetime.timetuple())
 
-    @Manager.calls_manager
     def add_outbound_message(self, batch_id, msg):
         """
         Add an outbound message to the cache for the given batch_id
         """
-        timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_outbound_message_key(batch_id, msg['message_id'],
-            timestamp)
-        yield self.add_to_addr(batch_id, msg['to_addr'], timestamp)
+        return self.add_outbound_messages(batch_id, [msg])
+
+    @Manager.calls_manager
+    def add_outbound_messages(self, batch_id, msgs):
+        """
+        Add a list of outbound messages to the cache for the given batch_id,
+        using pipelined redis calls.
+        """
+        if not msgs:
+            return
+        reconciling = yield self._add_outbound_messages(
+            batch_id, msgs, check_reconciling=True)
+        if reconciling:
+            yield self._add_outbound_messages(
+                self.shadow_batch_id(batch_id), msgs)
+
+    def _check_reconciling(self, pipe, batch_id, check_reconciling):
+        """
+        Queue a check for whether the given batch_id is being reconciled at
+        the start of a pipeline, so that writes which don't need to go to a
+        shadow cache don't cost an extra round trip. Returns the number of
+        results to skip.
+        """
+        if not check_reconciling:
+            return 0
+        pipe.sismember(self.reconciling_key(), batch_id)
+        return 1
+
+    @Manager.calls_manager
+    def _add_outbound_messages(self, batch_id, msgs, check_reconciling=False):
+        pipe = self.redis.pipeline()
+        skip = self._check_reconciling(pipe, batch_id, check_reconciling)
+        for msg in msgs:
+            timestamp = self.get_timestamp(msg['timestamp'])
+            pipe.zadd(self.outbound_key(batch_id), **{
+                msg['message_id'].encode('utf-8'): timestamp,
+                })
+            pipe.zadd(self.to_addr_key(batch_id), **{
+                msg['to_addr'].encode('utf-8'): timestamp,
+                })
+        results = yield pipe.execute()
+        new_entries = sum(results[skip::2])
+        if new_entries:
+            yield self.redis.hincrby(
+                self.status_key(batch_id), 'sent', new_entries)
+        returnValue(skip and results[0])
 
     @Manager.calls_manager
     def add_outbound_message_key(self, batch_id, message_key, timestamp):
@@ -151,20 +285,47 @@ class MessageStoreCache(object):
         if new_entry:
             yield self.increment_event_status(batch_id, 'sent')
 
-    @Manager.calls_manager
     def add_event(self, batch_id, event):
         """
         Add an event to the cache for the given batch_id
         """
+        return self.add_events(batch_id, [event])
 
-        event_id = event['event_id']
-        new_entry = yield self.add_event_key(batch_id, event_id)
-        if new_entry:
-            event_type = event['event_type']
-            yield self.increment_event_status(batch_id, event_type)
-            if event_type == 'delivery_report':
-                yield self.increment_event_status(batch_id,
-                    '%s.%s' % (event_type, event['delivery_status']))
+    @Manager.calls_manager
+    def add_events(self, batch_id, events):
+        """
+        Add a list of events to the cache for the given batch_id, using
+        pipelined redis calls.
+        """
+        if not events:
+            return
+        reconciling = yield self._add_events(
+            batch_id, events, check_reconciling=True)
+        if reconciling:
+            yield self._add_events(self.shadow_batch_id(batch_id), events)
+
+    @Manager.calls_manager
+    def _add_events(self, batch_id, events, check_reconciling=False):
+        pipe = self.redis.pipeline()
+        skip = self._check_reconciling(pipe, batch_id, check_reconciling)
+        for event in events:
+            pipe.sadd(self.event_key(batch_id), event['event_id'])
+        results = yield pipe.execute()
+
+        statuses = defaultdict(int)
+        for event, new_entry in zip(events, results[skip:]):
+            if new_entry:
+                event_type = event['event_type']
+                statuses[event_type] += 1
+                if event_type == 'delivery_report':
+                    statuses['%s.%s' % (
+                        event_type, event['delivery_status'])] += 1
+        if statuses:
+            pipe = self.redis.pipeline()
+            for event_type, count in statuses.iteritems():
+                pipe.hincrby(self.status_key(batch_id), event_type, count)
+            yield pipe.execute()
+        returnValue(skip and results[0])
 
     def add_event_key(self, batch_id, event_key):
         """
@@ -189,15 +350,40 @@ class MessageStoreCache(object):
         stats = yield self.redis.hgetall(self.status_key(batch_id))
         returnValue(dict([(k, int(v)) for k, v in stats.iteritems()]))
 
-    @Manager.calls_manager
     def add_inbound_message(self, batch_id, msg):
         """
         Add an inbound message to the cache for the given batch_id
         """
-        timestamp = self.get_timestamp(msg['timestamp'])
-        yield self.add_inbound_message_key(batch_id, msg['message_id'],
-            timestamp)
-        yield self.add_from_addr(batch_id, msg['from_addr'], timestamp)
+        return self.add_inbound_messages(batch_id, [msg])
+
+    @Manager.calls_manager
+    def add_inbound_messages(self, batch_id, msgs):
+        """
+        Add a list of inbound messages to the cache for the given batch_id,
+        using pipelined redis calls.
+        """
+        if not msgs:
+            return
+        reconciling = yield self._add_inbound_messages(
+            batch_id, msgs, check_reconciling=True)
+        if reconciling:
+            yield self._add_inbound_messages(
+                self.shadow_batch_id(batch_id), msgs)
+
+    @Manager.calls_manager
+    def _add_inbound_messages(self, batch_id, msgs, check_reconciling=False):
+        pipe = self.redis.pipeline()
+        skip = self._check_reconciling(pipe, batch_id, check_reconciling)
+        for msg in msgs:
+            timestamp = self.get_timestamp(msg['timestamp'])
+            pipe.zadd(self.inbound_key(batch_id), **{
+                msg['message_id'].encode('utf-8'): timestamp,
+                })
+            pipe.zadd(self.from_addr_key(batch_id), **{
+                msg['from_addr'].encode('utf-8'): timestamp,
+                })
+        results = yield pipe.execute()
+        returnValue(skip and results[0])
 
     def add_inbound_message_key(self, batch_id, message_key, timestamp):
         """
@@ -0,0 +1,274 @@
+# -*- test-case-name: vumi.components.tests.test_scheduler -*-
+
+import json
+import uuid
+
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, maybeDeferred, gatherResults)
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+from vumi.message import JSONMessageEncoder, date_time_decoder
+
+
+class Scheduler(object):
+    """Deliver JSON payloads to a callback at (or shortly after) a given time.
+
+    This replaces :class:`vumi.transports.scheduler.Scheduler`. All Redis
+    access is asynchronous and goes through the Redis manager passed in,
+    usually a :class:`vumi.persist.txredis_manager.TxRedisManager` (or a
+    ``sub_manager()`` of one).
+
+    Scheduled entries are indexed in a sorted set scored by their due time,
+    so finding due entries is a single ``ZRANGEBYSCORE`` regardless of how
+    many entries are scheduled further in the future. Due entries are
+    claimed in batches. An entry is claimed by whichever process manages to
+    ``ZREM`` it from the due set, so several processes can share a scheduler
+    namespace without delivering the same entry twice.
+
+    Delivery is at-least-once. An entry is moved from the due set to a
+    lease in a second sorted set, scored by the time the lease expires, in
+    the same MULTI/EXEC block that claims it. The lease is released (and
+    the entry deleted) once the callback's deferred fires successfully. If
+    the callback fails or the process dies before then, the entry is
+    returned to the due set when its lease expires and is delivered again.
+
+    :param redis:
+        Redis manager to store scheduled entries in.
+    :param callback:
+        Callable called as ``callback(scheduled_at, payload)`` for each due
+        entry, where ``scheduled_at`` is the timestamp the entry was
+        scheduled for. It may return a deferred.
+    :param float delivery_period:
+        Seconds between checks for due entries once :meth:`start` has been
+        called.
+    :param int batch_size:
+        Maximum number of due entries claimed (and delivered concurrently)
+        at a time.
+    :param float lease_time:
+        Seconds a claimed entry may remain undelivered before it is
+        redelivered.
+    """
+
+    DUE_KEY = 'due'
+    LEASE_KEY = 'leased'
+    ENTRY_KEY = 'entry'
+
+    def __init__(self, redis, callback, delivery_period=3, batch_size=100,
+                 lease_time=60, json_encoder=None, json_decoder=None):
+        self.redis = redis
+        self.callback = callback
+        self.delivery_period = delivery_period
+        self.batch_size = batch_size
+        self.lease_time = lease_time
+        self.json_encoder = json_encoder or JSONMessageEncoder
+        self.json_decoder = json_decoder or date_time_decoder
+        self.clock = self.get_clock()
+        self.loop = LoopingCall(self.deliver_due)
+        self.loop.clock = self.clock
+
+    def get_clock(self):
+        return reactor
+
+    def get_clocktime(self):
+        return self.clock.seconds()
+
+    @property
+    def is_running(self):
+        return self.loop.running
+
+    def start(self):
+        if not self.loop.running:
+            d = self.loop.start(self.delivery_period, now=True)
+            d.addErrback(lambda f: log.err(f, "Scheduler delivery failed."))
+
+    def stop(self):
+        if self.loop.running:
+            self.loop.stop()
+
+    def due_key(self):
+        return self.DUE_KEY
+
+    def lease_key(self):
+        return self.LEASE_KEY
+
+    def entry_key(self, entry_id):
+        return ':'.join([self.ENTRY_KEY, entry_id])
+
+    def schedule(self, delay, payload, now=None):
+        """Schedule ``payload`` for delivery ``delay`` seconds from ``now``.
+
+        If ``now`` is ``None``, the current clock time is used. Returns a
+        deferred that fires with the id of the scheduled entry.
+        """
+        if now is None:
+            now = self.get_clocktime()
+        return self.schedule_at(now + delay, payload)
+
+    @inlineCallbacks
+    def schedule_at(self, timestamp, payload):
+        """Schedule ``payload`` for delivery at ``timestamp``.
+
+        Returns a deferred that fires with the id of the scheduled entry.
+        """
+        # Encode first so unencodable payloads fail before we write anything.
+        data = json.dumps({
+            'scheduled_at': timestamp,
+            'payload': payload,
+        }, cls=self.json_encoder)
+        entry_id = uuid.uuid4().get_hex()
+        # The entry has to be stored before it's indexed, otherwise it may
+        # be claimed before the data is available.
+        yield self.redis.set(self.entry_key(entry_id), data)
+        yield self.redis.zadd(self.due_key(), **{entry_id: timestamp})
+        returnValue(entry_id)
+
+    @inlineCallbacks
+    def cancel(self, entry_id):
+        """Remove a scheduled entry that hasn't been delivered yet.
+
+        Returns a deferred that fires with ``True`` if the entry was
+        cancelled and ``False`` if it was already claimed for delivery.
+        """
+        removed = yield self.redis.zrem(self.due_key(), entry_id)
+        if removed:
+            yield self.redis.delete(self.entry_key(entry_id))
+        returnValue(bool(removed))
+
+    @inlineCallbacks
+    def get_entry(self, entry_id):
+        """Fetch the stored ``(scheduled_at, payload)`` pair for an entry.
+
+        Returns ``None`` if the entry doesn't exist.
+        """
+        data = yield self.redis.get(self.entry_key(entry_id))
+        if data is None:
+            returnValue(None)
+        entry = json.loads(data, object_hook=self.json_decoder)
+        returnValue((entry['scheduled_at'], entry['payload']))
+
+    @inlineCallbacks
+    def count_due(self, now=None):
+        if now is None:
+            now = self.get_clocktime()
+        count = yield self.redis.zcount(self.due_key(), '-inf', now)
+        returnValue(int(count))
+
+    def count_scheduled(self):
+        return self.redis.zcard(self.due_key())
+
+    def count_leased(self):
+        return self.redis.zcard(self.lease_key())
+
+    @inlineCallbacks
+    def requeue_expired_leases(self, now=None):
+        """Return entries whose lease has expired to the due set.
+
+        Returns a deferred that fires with the number of entries requeued.
+        """
+        if now is None:
+            now = self.get_clocktime()
+        requeued = 0
+        while True:
+            entry_ids = yield self.redis.zrangebyscore(
+                self.lease_key(), '-inf', now, 0, self.batch_size)
+            if not entry_ids:
+                break
+            # Only the process that removes the lease gets to requeue.
+            won = yield self._move(
+                self.lease_key(), self.due_key(), entry_ids, now)
+            requeued += len(won)
+        returnValue(requeued)
+
+    @inlineCallbacks
+    def claim_due(self, now=None):
+        """Claim up to ``batch_size`` due entries.
+
+        Returns a deferred that fires with the list of claimed entry ids.
+        """
+        if now is None:
+            now = self.get_clocktime()
+        entry_ids = yield self.redis.zrangebyscore(
+            self.due_key(), '-inf', now, 0, self.batch_size)
+        if not entry_ids:
+            returnValue([])
+        claimed = yield self._move(
+            self.due_key(), self.lease_key(), entry_ids,
+            now + self.lease_time)
+        returnValue(claimed)
+
+    @inlineCallbacks
+    def _move(self, from_key, to_key, entry_ids, score):
+        """Move entries between sorted sets, returning the ones we moved.
+
+        All the entries are moved in a single MULTI/EXEC block, so a crash
+        can't leave an entry in neither set. An entry belongs to whichever
+        process removes it from `from_key`. Redis can't make the ``ZADD``
+        conditional on the ``ZREM``, so if another process got there first
+        we may have re-added an entry it has since finished with. Those
+        entries are new members of `to_key` that we didn't remove from
+        `from_key`, and they're cleaned up afterwards.
+        """
+        tx = self.redis.transaction()
+        for entry_id in entry_ids:
+            tx.zrem(from_key, entry_id)
+            tx.zadd(to_key, **{entry_id: score})
+        results = yield tx.execute()
+        moved = []
+        stale = []
+        for i, entry_id in enumerate(entry_ids):
+            removed, added = results[2 * i], results[2 * i + 1]
+            if removed:
+                moved.append(entry_id)
+            elif added:
+                stale.append(entry_id)
+        if stale:
+            tx = self.redis.transaction()
+            for entry_id in stale:
+                tx.zrem(to_key, entry_id)
+            yield tx.execute()
+        returnValue(moved)
+
+    @inlineCallbacks
+    def release(self, entry_id):
+        """Acknowledge delivery of a claimed entry and delete it."""
+        yield self.redis.zrem(self.lease_key(), entry_id)
+        yield self.redis.delete(self.entry_key(entry_id))
+
+    @inlineCallbacks
+    def deliver_entry(self, entry_id):
+        entry = yield self.get_entry(entry_id)
+        if entry is None:
+            # Already delivered by someone whose lease we raced with.
+            yield self.redis.zrem(self.lease_key(), entry_id)
+            returnValue(False)
+        scheduled_at, payload = entry
+        try:
+            yield maybeDeferred(self.callback, scheduled_at, payload)
+        except Exception:
+            log.err(None, "Error delivering scheduled entry %r. It will be"
+                    " redelivered when its lease expires." % (entry_id,))
+            returnValue(False)
+        yield self.release(entry_id)
+        returnValue(True)
+
+    @inlineCallbacks
+    def deliver_due(self, now=None):
+        """Deliver all entries that are due at ``now``.
+
+        Returns a deferred that fires with the number of entries delivered.
+        """
+        if now is None:
+            now = self.get_clocktime()
+        yield self.requeue_expired_leases(now)
+        delivered = 0
+        while True:
+            entry_ids = yield self.claim_due(now)
+            if not entry_ids:
+                break
+            results = yield gatherResults(
+                [self.deliver_entry(entry_id) for entry_id in entry_ids],
+                consumeErrors=True)
+            delivered += sum(results)
+        returnValue(delivered)
@@ -4,27 +4,54 @@
 
 import time
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, succeed)
 
 from vumi import log
+from vumi.utils import LRUCache
 
 
 class SessionManager(object):
     """A manager for sessions.
 
+    Sessions are stored as Redis hashes. Each session written with
+    :meth:`create_session` or :meth:`save_session` is also recorded in a
+    sorted set scored by its expiry time, so :meth:`active_sessions`
+    doesn't need to scan the keyspace.
+
+    An in-process LRU cache of loaded sessions can be enabled with
+    `cache_size`. Writes made through this manager update the cache, but
+    writes made by other processes don't, so only enable it when this
+    process is the only writer for the sessions it reads or when slightly
+    stale session data is acceptable.
+
     :param TxRedisManager redis:
         Redis manager object.
     :param int max_session_length:
         Time before a session expires. Default is None (never expire).
     :param float gc_period:
         Deprecated and ignored.
+    :param int cache_size:
+        Maximum number of sessions to cache in-process. Default is 0 (no
+        caching).
+    :param float cache_ttl:
+        Time before a cached session is reloaded from Redis. Defaults to
+        `max_session_length`.
     """
 
-    def __init__(self, redis, max_session_length=None, gc_period=None):
+    SESSION_INDEX_KEY = 'session_index'
+
+    def __init__(self, redis, max_session_length=None, gc_period=None,
+                 cache_size=0, cache_ttl=None):
         self.max_session_length = max_session_length
         self.redis = redis
         if gc_period is not None:
             log.warning("SessionManager 'gc_period' parameter is deprecated.")
+        self.cache = None
+        if cache_size:
+            if cache_ttl is None:
+                cache_ttl = max_session_length
+            self.cache = LRUCache(cache_size, ttl=cache_ttl)
 
     @inlineCallbacks
     def stop(self, stop_redis=True):
@@ -33,37 +60,76 @@ class SessionManager(object):
 
     @classmethod
     def from_redis_config(cls, config, key_prefix=None,
-                          max_session_length=None, gc_period=None):
+                          max_session_length=None, gc_period=None,
+                          cache_size=0, cache_ttl=None):
         """Create a `SessionManager` instance using `TxRedisManager`.
         """
         from vumi.persist.txredis_manager import TxRedisManager
         d = TxRedisManager.from_config(config)
         if key_prefix is not None:
             d.addCallback(lambda m: m.sub_manager(key_prefix))
-        return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
+        return d.addCallback(lambda m: cls(
+            m, max_session_length, gc_period, cache_size, cache_ttl))
+
+    def _session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    def _encode(self, value):
+        """Encode a value the same way Redis will store it."""
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        if isinstance(value, float):
+            # str() rounds floats to 12 significant digits.
+            return repr(value)
+        return str(value)
+
+    def _expires_at(self, timeout):
+        if timeout is None:
+            return '+inf'
+        return time.time() + timeout
+
+    @inlineCallbacks
+    def active_session_ids(self):
+        """Return a list of user_ids with active sessions.
+
+        Expired sessions are removed from the session index first.
+        """
+        yield self.redis.zremrangebyscore(
+            self.SESSION_INDEX_KEY, '-inf', time.time())
+        user_ids = yield self.redis.zrange(self.SESSION_INDEX_KEY, 0, -1)
+        returnValue(user_ids)
 
     @inlineCallbacks
     def active_sessions(self):
         """Return a list of active user_ids and associated sessions.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        The sessions are loaded concurrently.
         """
-        keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
-
-        returnValue(sessions)
+        user_ids = yield self.active_session_ids()
+        sessions = yield gatherResults(
+            [self.load_session(user_id) for user_id in user_ids],
+            consumeErrors=True)
+        returnValue(zip(user_ids, sessions))
 
     def load_session(self, user_id):
         """
         Load session data from Redis
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        if self.cache is not None:
+            session = self.cache.get(user_id)
+            if session is not None:
+                return succeed(dict(session))
+        d = self.redis.hgetall(self._session_key(user_id))
+        if self.cache is not None:
+            d.addCallback(self._cache_session, user_id)
+        return d
+
+    def _cache_session(self, session, user_id):
+        if session:
+            self.cache.set(user_id, dict(session))
+        return session
 
+    @inlineCallbacks
     def schedule_session_expiry(self, user_id, timeout):
         """
         Schedule a session to timeout
@@ -75,28 +141,54 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        tx = self.redis.transaction()
+        tx.expire(self._session_key(user_id), timeout)
+        tx.zadd(self.SESSION_INDEX_KEY,
+                **{user_id: self._expires_at(timeout)})
+        [expired, _] = yield tx.execute()
+        returnValue(expired)
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
         """
         Create a new session using the given user_id
+
+        Any existing session is replaced. The session is written and given
+        its expiry time in a single transaction.
         """
-        yield self.clear_session(user_id)
         defaults = {
             'created_at': time.time()
         }
         defaults.update(kwargs)
-        yield self.save_session(user_id, defaults)
+        session = dict((self._encode(k), self._encode(v))
+                       for k, v in defaults.iteritems())
+        ukey = self._session_key(user_id)
+        timeout = None
         if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
-        returnValue((yield self.load_session(user_id)))
+            timeout = int(self.max_session_length)
+
+        tx = self.redis.transaction()
+        tx.delete(ukey)
+        tx.hmset(ukey, session)
+        if timeout is not None:
+            tx.expire(ukey, timeout)
+        tx.zadd(self.SESSION_INDEX_KEY,
+                **{user_id: self._expires_at(timeout)})
+        yield tx.execute()
+
+        if self.cache is not None:
+            self._cache_session(session, user_id)
+        returnValue(session)
 
+    @inlineCallbacks
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        if self.cache is not None:
+            self.cache.pop(user_id)
+        tx = self.redis.transaction()
+        tx.delete(self._session_key(user_id))
+        tx.zrem(self.SESSION_INDEX_KEY, user_id)
+        [deleted, _] = yield tx.execute()
+        returnValue(deleted)
 
     @inlineCallbacks
     def save_session(self, user_id, session):
@@ -111,8 +203,24 @@ class SessionManager(object):
             The session info, nested dictionaries are not supported. Any
             values that are dictionaries are converted to strings by Redis.
 
+        The session is added to the session index with the expiry time of
+        its Redis key, if it has one.
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
+        if self.cache is not None:
+            cached = self.cache.pop(user_id)
+            if cached is not None:
+                cached.update((self._encode(k), self._encode(v))
+                              for k, v in session.iteritems())
+                self.cache.set(user_id, cached)
+        if session:
+            ukey = self._session_key(user_id)
+            tx = self.redis.transaction()
+            tx.hmset(ukey, session)
+            tx.ttl(ukey)
+            [_, ttl] = yield tx.execute()
+            if ttl is None or ttl < 0:
+                # The session doesn't expire.
+                ttl = None
+            yield self.redis.zadd(self.SESSION_INDEX_KEY,
+                                  **{user_id: self._expires_at(ttl)})
         returnValue(session)
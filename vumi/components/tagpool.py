@@ -5,6 +5,7 @@
 
 import json
 import time
+import random
 
 from twisted.internet.defer import returnValue
 
@@ -19,12 +20,41 @@ class TagpoolError(VumiError):
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
+    Each pool keeps its free tags in both a set (for membership) and a
+    sorted set scored by a per-pool sequence number (for acquisition order),
+    and its in-use tags in a set. Removing an arbitrary tag from the free
+    sorted set is O(log N), so acquiring a specific tag doesn't get slower
+    as the pool grows.
+
+    A tag is claimed by whichever caller manages to ``ZREM`` it from the
+    free sorted set. The ``ZREM`` and the move to the in-use set happen in
+    one MULTI/EXEC block, so concurrent workers can never acquire the same
+    tag and a crash can't leave a tag in neither state.
+
+    Pools created before the free sorted set was introduced keep their free
+    tags in a list. These are migrated to the sorted set the first time the
+    pool appears to have run out of free tags. Only one caller migrates a
+    pool at a time, and each chunk of tags is added to the free sets and
+    removed from the list in one MULTI/EXEC block, so a crash can't strand
+    or lose a tag.
+
     :param redis:
         An instance of :class:`vumi.persist.redis_base.Manager`.
     """
 
     encoding = "UTF-8"
 
+    # Number of tags written per Redis command when declaring tags.
+    declare_chunk_size = 1000
+
+    # Number of free tags at the front of the pool that acquire_tag() tries
+    # before looking again.
+    acquire_candidates = 10
+
+    # Seconds after which a legacy free list migration lock is considered
+    # abandoned.
+    migration_lock_timeout = 60
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
@@ -83,7 +113,7 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def purge_pool(self, pool):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
         metadata_key = self._tag_pool_metadata_key(pool)
         in_use_count = yield self.redis.scard(inuse_set_key)
         if in_use_count:
@@ -91,7 +121,10 @@ class TagpoolManager(object):
                                in_use_count, pool))
         else:
             yield self.redis.delete(free_set_key)
-            yield self.redis.delete(free_list_key)
+            yield self.redis.delete(free_zset_key)
+            yield self.redis.delete(self._tag_pool_free_list_key(pool))
+            yield self.redis.delete(self._tag_pool_migration_lock_key(pool))
+            yield self.redis.delete(self._tag_pool_sequence_key(pool))
             yield self.redis.delete(inuse_set_key)
             yield self.redis.delete(metadata_key)
             yield self._unregister_pool(pool)
@@ -104,14 +137,14 @@ class TagpoolManager(object):
 
     @Manager.calls_manager
     def free_tags(self, pool):
-        _free_list, free_set_key, _inuse_set = self._tag_pool_keys(pool)
+        _free_zset, free_set_key, _inuse_set = self._tag_pool_keys(pool)
         free_tags = yield self.redis.smembers(free_set_key)
         returnValue([(pool, self._decode(local_tag))
                      for local_tag in free_tags])
 
     @Manager.calls_manager
     def inuse_tags(self, pool):
-        _free_list, _free_set, inuse_set_key = self._tag_pool_keys(pool)
+        _free_zset, _free_set, inuse_set_key = self._tag_pool_keys(pool)
         inuse_tags = yield self.redis.smembers(inuse_set_key)
         returnValue([(pool, self._decode(local_tag))
                      for local_tag in inuse_tags])
@@ -155,49 +188,166 @@ class TagpoolManager(object):
     def _tag_pool_keys(self, pool):
         pool = self._encode(pool)
         return tuple(":".join(["tagpools", pool, state])
-                     for state in ("free:list", "free:set", "inuse:set"))
+                     for state in ("free:zset", "free:set", "inuse:set"))
+
+    def _tag_pool_free_list_key(self, pool):
+        """Key of the free list used by pools declared before the free
+        sorted set was introduced."""
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:list"])
+
+    def _tag_pool_migration_lock_key(self, pool):
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:list:lock"])
+
+    def _tag_pool_sequence_key(self, pool):
+        pool = self._encode(pool)
+        return ":".join(["tagpools", pool, "free:seq"])
 
     def _tag_pool_metadata_key(self, pool):
         pool = self._encode(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
+    @Manager.calls_manager
+    def _claim_tag(self, pool, local_tag):
+        """Move a free tag to the in-use set.
+
+        Returns ``True`` if we claimed the tag and ``False`` if someone else
+        got it first.
+        """
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        tx = self.redis.transaction()
+        tx.zrem(free_zset_key, local_tag)
+        tx.smove(free_set_key, inuse_set_key, local_tag)
+        [claimed, moved] = yield tx.execute()
+        if moved and not claimed:
+            # The tag was in the free set without being in the free sorted
+            # set, which happens while it's being released or migrated.
+            # It isn't ours, so put it back.
+            yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
+        returnValue(bool(claimed))
+
     @Manager.calls_manager
     def _acquire_tag(self, pool, owner, reason):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+        free_zset_key, _free_set, _inuse_set = self._tag_pool_keys(pool)
+        while True:
+            candidates = yield self.redis.zrange(
+                free_zset_key, 0, self.acquire_candidates - 1)
+            if not candidates:
+                migrated = yield self._migrate_free_list(pool)
+                if migrated:
+                    continue
+                returnValue(None)
+            # Try the first free tag. If someone else claimed it, try the
+            # others in random order so that we don't race them again.
+            first, others = candidates[0], candidates[1:]
+            random.shuffle(others)
+            for tag in [first] + others:
+                if (yield self._claim_tag(pool, tag)):
+                    yield self._store_reason(pool, tag, owner, reason)
+                    returnValue(self._decode(tag))
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
-        if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
+        claimed = yield self._claim_tag(pool, local_tag)
+        if not claimed and (yield self._migrate_free_list(pool)):
+            claimed = yield self._claim_tag(pool, local_tag)
+        if claimed:
             yield self._store_reason(pool, local_tag, owner, reason)
-        returnValue(moved)
+        returnValue(claimed)
 
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
         count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
         if count == 1:
-            yield self.redis.rpush(free_list_key, local_tag)
+            [score] = yield self._next_scores(pool, 1)
+            yield self.redis.zadd(free_zset_key, **{local_tag: score})
             yield self._remove_reason(pool, local_tag)
 
+    @Manager.calls_manager
+    def _next_scores(self, pool, count):
+        """Reserve ``count`` consecutive free sorted set scores."""
+        last = yield self.redis.incr(self._tag_pool_sequence_key(pool), count)
+        returnValue(range(last - count + 1, last + 1))
+
+    @Manager.calls_manager
+    def _add_free_tags(self, pool, tags):
+        """Add tags to the end of the pool's free tags in bulk."""
+        free_zset_key, free_set_key, _inuse_set = self._tag_pool_keys(pool)
+        for i in range(0, len(tags), self.declare_chunk_size):
+            chunk = tags[i:i + self.declare_chunk_size]
+            scores = yield self._next_scores(pool, len(chunk))
+            tx = self.redis.transaction()
+            tx.sadd(free_set_key, *chunk)
+            tx.zadd(free_zset_key, **dict(zip(chunk, scores)))
+            yield tx.execute()
+
+    @Manager.calls_manager
+    def _lock_migration(self, pool):
+        """Take the pool's legacy free list migration lock.
+
+        Returns ``True`` if we got the lock. A lock left without a timeout
+        by a caller that crashed while taking it is given one.
+        """
+        lock_key = self._tag_pool_migration_lock_key(pool)
+        locked = yield self.redis.setnx(lock_key, 1)
+        if not locked:
+            ttl = yield self.redis.ttl(lock_key)
+            if ttl is not None and ttl >= 0:
+                returnValue(False)
+        yield self.redis.expire(lock_key, self.migration_lock_timeout)
+        returnValue(bool(locked))
+
+    @Manager.calls_manager
+    def _migrate_free_list(self, pool):
+        """Move tags from a legacy free list into the free sorted set.
+
+        Each chunk of tags is read from the front of the list, then added to
+        the free sets and trimmed off the list in a single transaction. The
+        migration lock stops two callers from migrating the same tags, which
+        could put a tag that had already been acquired back in the free
+        sets. Returns ``True`` if any tags were migrated and ``False`` if
+        there were none or another caller is migrating the pool.
+        """
+        free_list_key = self._tag_pool_free_list_key(pool)
+        free_zset_key, free_set_key, _inuse_set = self._tag_pool_keys(pool)
+        if not (yield self.redis.llen(free_list_key)):
+            returnValue(False)
+        if not (yield self._lock_migration(pool)):
+            returnValue(False)
+        migrated = False
+        try:
+            while True:
+                tags = yield self.redis.lrange(
+                    free_list_key, 0, self.declare_chunk_size - 1)
+                if not tags:
+                    break
+                scores = yield self._next_scores(pool, len(tags))
+                tx = self.redis.transaction()
+                tx.sadd(free_set_key, *tags)
+                tx.zadd(free_zset_key, **dict(zip(tags, scores)))
+                if len(tags) < self.declare_chunk_size:
+                    tx.delete(free_list_key)
+                else:
+                    tx.ltrim(free_list_key, len(tags), -1)
+                yield tx.execute()
+                migrated = True
+        finally:
+            yield self.redis.delete(self._tag_pool_migration_lock_key(pool))
+        returnValue(migrated)
+
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        free_zset_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        # Keep tags from a legacy free list ahead of the newly declared ones.
+        yield self._migrate_free_list(pool)
         new_tags = set(self._encode(tag) for tag in local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
         old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        yield self._add_free_tags(pool, sorted(new_tags - old_tags))
 
     def _tag_pool_reason_key(self, pool):
         pool = self._encode(pool)
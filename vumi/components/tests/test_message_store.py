@@ -4,7 +4,8 @@
 import time
 from datetime import datetime, timedelta
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, fail
+from twisted.internet.task import Clock
 
 from vumi.message import TransportEvent
 from vumi.tests.helpers import (
@@ -353,6 +354,49 @@ class TestMessageStore(TestMessageStoreBase):
             self.msg_helper.make_outbound("foo"), batch_id=batch_id)
         self.assertEqual(2, (yield self.store.batch_outbound_count(batch_id)))
 
+    @inlineCallbacks
+    def test_counts_over_multiple_pages(self):
+        self.store.index_page_size = 2
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_inbound_messages(batch_id, 5)
+        yield self.create_outbound_messages(batch_id, 3)
+        self.assertEqual(5, (yield self.store.batch_inbound_count(batch_id)))
+        self.assertEqual(3, (yield self.store.batch_outbound_count(batch_id)))
+
+    @inlineCallbacks
+    def test_batch_inbound_keys_page(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_inbound_messages(batch_id, 5)
+        msg_ids = sorted(msg['message_id'] for msg in messages)
+
+        page = yield self.store.batch_inbound_keys_page(batch_id, 2)
+        self.assertEqual(len(page), 2)
+        keys = list(page)
+        while page.has_next_page():
+            page = yield page.next_page()
+            keys.extend(page)
+        self.assertEqual(sorted(keys), msg_ids)
+
+        self.store.index_page_size = 2
+        self.assertEqual(
+            sorted((yield self.store.batch_inbound_keys(batch_id))), msg_ids)
+
+    @inlineCallbacks
+    def test_batch_outbound_keys_page(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        messages = yield self.create_outbound_messages(batch_id, 5)
+        msg_ids = sorted(msg['message_id'] for msg in messages)
+
+        page = yield self.store.batch_outbound_keys_page(batch_id, 2)
+        self.assertEqual(len(page), 2)
+        keys = []
+        yield page.foreach_key(keys.append)
+        self.assertEqual(sorted(keys), msg_ids)
+
+        self.store.index_page_size = 2
+        self.assertEqual(
+            sorted((yield self.store.batch_outbound_keys(batch_id))), msg_ids)
+
     @inlineCallbacks
     def test_inbound_keys_matching(self):
         msg_id, msg, batch_id = yield self._create_inbound(content='hello')
@@ -415,6 +459,124 @@ class TestMessageStore(TestMessageStoreBase):
             }])))
 
 
+class TestMessageStoreTagCache(TestMessageStoreBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestMessageStoreTagCache, self).setUp()
+        from vumi.components.message_store import MessageStore
+        from vumi.blinkenlights.metrics import MetricManager
+        self.metrics = MetricManager("vumi.test.")
+        self.store = MessageStore(
+            self.manager, self.redis, tag_cache_size=10,
+            tag_cache_check_interval=5, metrics=self.metrics)
+        self.clock = Clock()
+        self.store.tag_cache.clock = self.clock
+        self.tag_loads = []
+        orig_load = self.store.current_tags.load
+
+        def record_load(key):
+            self.tag_loads.append(key)
+            return orig_load(key)
+
+        self.patch(self.store.current_tags, 'load', record_load)
+
+    def poll_count(self, name):
+        return len(self.metrics[name].poll())
+
+    @inlineCallbacks
+    def test_get_current_batch_id_cached(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        del self.tag_loads[:]
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id)
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id)
+        self.assertEqual(self.tag_loads, [tag])
+        self.assertEqual(self.store.tag_cache_stats(), {
+            'hits': 1, 'misses': 1, 'hit_rate': 0.5})
+        self.assertEqual(self.poll_count('tag_cache.hits'), 1)
+        self.assertEqual(self.poll_count('tag_cache.misses'), 1)
+
+    @inlineCallbacks
+    def test_get_current_batch_id_caches_unknown_tags(self):
+        tag = ("pool", "tag")
+        self.assertEqual((yield self.store.get_current_batch_id(tag)), None)
+        self.assertEqual((yield self.store.get_current_batch_id(tag)), None)
+        self.assertEqual(self.tag_loads, [tag])
+
+    @inlineCallbacks
+    def test_tag_cache_expires(self):
+        tag = ("pool", "tag")
+        yield self.store.batch_start([tag])
+        del self.tag_loads[:]
+        yield self.store.get_current_batch_id(tag)
+        self.clock.advance(self.store.DEFAULT_TAG_CACHE_TTL)
+        yield self.store.get_current_batch_id(tag)
+        self.assertEqual(self.tag_loads, [tag, tag])
+
+    @inlineCallbacks
+    def test_batch_start_invalidates_tag_cache(self):
+        tag = ("pool", "tag")
+        batch_id_1 = yield self.store.batch_start([tag])
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id_1)
+        batch_id_2 = yield self.store.batch_start([tag])
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id_2)
+
+    @inlineCallbacks
+    def test_batch_done_invalidates_tag_cache(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id)
+        yield self.store.batch_done(batch_id)
+        self.assertEqual((yield self.store.get_current_batch_id(tag)), None)
+
+    @inlineCallbacks
+    def test_tag_cache_invalidated_by_other_store(self):
+        from vumi.components.message_store import MessageStore
+        other_store = MessageStore(self.manager, self.redis)
+        tag = ("pool", "tag")
+        batch_id_1 = yield self.store.batch_start([tag])
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id_1)
+
+        batch_id_2 = yield other_store.batch_start([tag])
+        # We only notice once the check interval has passed.
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id_1)
+        self.clock.advance(5)
+        self.assertEqual(
+            (yield self.store.get_current_batch_id(tag)), batch_id_2)
+
+    @inlineCallbacks
+    def test_add_outbound_message_uses_tag_cache(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        del self.tag_loads[:]
+        for i in range(3):
+            msg = self.msg_helper.make_outbound("foo %d" % (i,))
+            yield self.store.add_outbound_message(msg, tag=tag)
+        self.assertEqual(self.tag_loads, [tag])
+        keys = yield self.store.batch_outbound_keys(batch_id)
+        self.assertEqual(len(keys), 3)
+
+    @inlineCallbacks
+    def test_add_inbound_message_uses_tag_cache(self):
+        tag = ("pool", "tag")
+        batch_id = yield self.store.batch_start([tag])
+        del self.tag_loads[:]
+        for i in range(3):
+            msg = self.msg_helper.make_inbound("foo %d" % (i,))
+            yield self.store.add_inbound_message(msg, tag=tag)
+        self.assertEqual(self.tag_loads, [tag])
+        keys = yield self.store.batch_inbound_keys(batch_id)
+        self.assertEqual(len(keys), 3)
+
+
 class TestMessageStoreCache(TestMessageStoreBase):
 
     def clear_cache(self, message_store):
@@ -510,6 +672,87 @@ class TestMessageStoreCache(TestMessageStoreBase):
         self.assertEqual(batch_status['ack'], 10)
         self.assertEqual(batch_status['sent'], 10)
 
+    @inlineCallbacks
+    def test_reconcile_cache_keeps_cache_until_done(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_outbound_messages(batch_id, 4)
+        yield self.create_inbound_messages(batch_id, 3)
+        extra_msg = self.msg_helper.make_outbound("extra")
+        yield self.store.cache.add_outbound_message(batch_id, extra_msg)
+
+        progress = []
+
+        def record_progress(direction, processed):
+            d = self.store.cache.count_outbound_message_keys(batch_id)
+            d.addCallback(
+                lambda count: progress.append((direction, processed, count)))
+
+        self.store.index_page_size = 2
+        yield self.store.reconcile_cache(
+            batch_id, progress_callback=record_progress)
+        # The cached values we had are left alone until we're done.
+        self.assertEqual(progress, [
+            ('inbound', 2, 5),
+            ('inbound', 3, 5),
+            ('outbound', 2, 5),
+            ('outbound', 4, 5),
+        ])
+        self.assertEqual(
+            (yield self.store.cache.count_outbound_message_keys(batch_id)), 4)
+        self.assertEqual(
+            (yield self.store.cache.count_inbound_message_keys(batch_id)), 3)
+        self.assertFalse((yield self.store.needs_reconciliation(batch_id,
+            delta=0)))
+
+    @inlineCallbacks
+    def test_reconcile_cache_aborts_on_failed_load(self):
+        from vumi.components.message_store_cache import (
+            MessageStoreCacheException)
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        yield self.create_outbound_messages(batch_id, 4)
+        extra_msg = self.msg_helper.make_outbound("extra")
+        yield self.store.cache.add_outbound_message(batch_id, extra_msg)
+
+        def load_all_bunches(keys):
+            return [fail(ValueError("Riak is down."))]
+
+        self.patch(
+            self.store.outbound_messages, 'load_all_bunches', load_all_bunches)
+        yield self.assertFailure(
+            self.store.reconcile_cache(batch_id), MessageStoreCacheException)
+        [err] = self.flushLoggedErrors(ValueError)
+        # The cached values we had are left alone.
+        self.assertEqual(
+            (yield self.store.cache.count_outbound_message_keys(batch_id)), 5)
+        self.assertTrue((yield self.store.needs_reconciliation(batch_id)))
+
+    @inlineCallbacks
+    def test_reconcile_cache_time_window(self):
+        batch_id = yield self.store.batch_start([("pool", "tag")])
+        now = datetime.now()
+        messages = yield self.create_outbound_messages(
+            batch_id, 4, start_timestamp=now)
+        for msg in messages:
+            yield self.store.add_event(self.msg_helper.make_ack(msg))
+        yield self.clear_cache(self.store)
+
+        # Our messages are 10 days apart, starting from now.
+        yield self.store.reconcile_cache(
+            batch_id, start_timestamp=now - timedelta(days=25),
+            end_timestamp=now)
+        keys = yield self.store.cache.get_outbound_message_keys(batch_id)
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in messages[1:3]))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 2)
+        self.assertEqual(batch_status['sent'], 2)
+
+        # Reconciling another window adds to what's already there.
+        yield self.store.reconcile_cache(batch_id, end_timestamp=now)
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status['ack'], 3)
+        self.assertEqual(batch_status['sent'], 3)
+
     @inlineCallbacks
     def test_find_inbound_keys_matching(self):
         batch_id = yield self.store.batch_start([("pool", "tag")])
@@ -42,6 +42,13 @@ class TestMessageStoreCache(VumiTestCase):
             messages.append(msg)
         returnValue(messages)
 
+    @inlineCallbacks
+    def test_current_tag_version(self):
+        self.assertEqual((yield self.cache.get_current_tag_version()), 0)
+        yield self.cache.incr_current_tag_version()
+        yield self.cache.incr_current_tag_version()
+        self.assertEqual((yield self.cache.get_current_tag_version()), 2)
+
     @inlineCallbacks
     def test_add_outbound_message(self):
         msg = self.msg_helper.make_outbound("outbound")
@@ -251,6 +258,138 @@ class TestMessageStoreCache(VumiTestCase):
         self.assertEqual(
             (yield self.cache.count_outbound_message_keys(self.batch_id)), 0)
 
+    @inlineCallbacks
+    def test_add_outbound_messages(self):
+        msgs = [self.msg_helper.make_outbound("outbound", to_addr='to-%s' % i)
+                for i in range(3)]
+        yield self.cache.add_outbound_messages(self.batch_id, msgs)
+        yield self.cache.add_outbound_messages(self.batch_id, msgs[:1])
+        keys = yield self.cache.get_outbound_message_keys(self.batch_id)
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in msgs))
+        self.assertEqual((yield self.cache.count_to_addrs(self.batch_id)), 3)
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status['sent'], 3)
+
+    @inlineCallbacks
+    def test_add_inbound_messages(self):
+        msgs = [
+            self.msg_helper.make_inbound("inbound", from_addr='from-%s' % i)
+            for i in range(3)]
+        yield self.cache.add_inbound_messages(self.batch_id, msgs)
+        keys = yield self.cache.get_inbound_message_keys(self.batch_id)
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in msgs))
+        self.assertEqual(
+            (yield self.cache.count_from_addrs(self.batch_id)), 3)
+
+    @inlineCallbacks
+    def test_add_events(self):
+        msg = self.msg_helper.make_outbound("outbound")
+        ack = self.msg_helper.make_ack(msg)
+        delivery = self.msg_helper.make_delivery_report(msg)
+        yield self.cache.add_events(self.batch_id, [ack, delivery])
+        yield self.cache.add_events(self.batch_id, [ack])
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual(status, {
+            'delivery_report': 1,
+            'delivery_report.delivered': 1,
+            'delivery_report.failed': 0,
+            'delivery_report.pending': 0,
+            'ack': 1,
+            'nack': 0,
+            'sent': 0,
+            })
+
+    @inlineCallbacks
+    def test_reconciliation(self):
+        old_msg = self.msg_helper.make_outbound("old")
+        yield self.cache.add_outbound_message(self.batch_id, old_msg)
+        yield self.cache.add_event(
+            self.batch_id, self.msg_helper.make_ack(old_msg))
+
+        shadow_batch_id = yield self.cache.start_reconciliation(self.batch_id)
+        msgs = [self.msg_helper.make_outbound("new") for i in range(2)]
+        yield self.cache.add_outbound_messages(shadow_batch_id, msgs)
+
+        # The current cache is untouched until reconciliation finishes.
+        self.assertEqual(
+            (yield self.cache.get_outbound_message_keys(self.batch_id)),
+            [old_msg['message_id']])
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual((status['sent'], status['ack']), (1, 1))
+
+        yield self.cache.finish_reconciliation(self.batch_id)
+        keys = yield self.cache.get_outbound_message_keys(self.batch_id)
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in msgs))
+        status = yield self.cache.get_event_status(self.batch_id)
+        self.assertEqual((status['sent'], status['ack']), (2, 0))
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 0)
+        self.assertTrue((yield self.cache.batch_exists(self.batch_id)))
+        self.assertEqual((yield self.redis.keys('*:reconcile:*')), [])
+        self.assertEqual(
+            (yield self.redis.smembers(self.cache.reconciling_key())), set())
+
+    @inlineCallbacks
+    def test_messages_added_during_reconciliation(self):
+        shadow_batch_id = yield self.cache.start_reconciliation(self.batch_id)
+        msg_in = self.msg_helper.make_inbound("inbound")
+        msg_out = self.msg_helper.make_outbound("outbound")
+        yield self.cache.add_inbound_message(self.batch_id, msg_in)
+        yield self.cache.add_outbound_message(self.batch_id, msg_out)
+        yield self.cache.add_event(
+            self.batch_id, self.msg_helper.make_ack(msg_out))
+        # Reconciliation may find the same messages again.
+        yield self.cache.add_outbound_messages(shadow_batch_id, [msg_out])
+
+        for batch_id in [self.batch_id, shadow_batch_id]:
+            self.assertEqual(
+                (yield self.cache.get_inbound_message_keys(batch_id)),
+                [msg_in['message_id']])
+            self.assertEqual(
+                (yield self.cache.get_outbound_message_keys(batch_id)),
+                [msg_out['message_id']])
+            status = yield self.cache.get_event_status(batch_id)
+            self.assertEqual((status['sent'], status['ack']), (1, 1))
+
+        yield self.cache.finish_reconciliation(self.batch_id)
+        yield self.cache.add_inbound_message(
+            self.batch_id, self.msg_helper.make_inbound("inbound"))
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(self.batch_id)), 2)
+        self.assertEqual(
+            (yield self.cache.count_inbound_message_keys(shadow_batch_id)), 0)
+
+    @inlineCallbacks
+    def test_bulk_adds_during_reconciliation(self):
+        shadow_batch_id = yield self.cache.start_reconciliation(self.batch_id)
+        msg_out = self.msg_helper.make_outbound("outbound")
+        yield self.cache.add_outbound_messages(self.batch_id, [msg_out])
+        yield self.cache.add_events(
+            self.batch_id, [self.msg_helper.make_ack(msg_out)])
+
+        for batch_id in [self.batch_id, shadow_batch_id]:
+            status = yield self.cache.get_event_status(batch_id)
+            self.assertEqual((status['sent'], status['ack']), (1, 1))
+
+    @inlineCallbacks
+    def test_abort_reconciliation(self):
+        msg = self.msg_helper.make_outbound("outbound")
+        yield self.cache.add_outbound_message(self.batch_id, msg)
+        shadow_batch_id = yield self.cache.start_reconciliation(self.batch_id)
+        yield self.cache.add_outbound_messages(
+            shadow_batch_id, [self.msg_helper.make_outbound("outbound")])
+        yield self.cache.abort_reconciliation(self.batch_id)
+
+        self.assertEqual(
+            (yield self.cache.get_outbound_message_keys(self.batch_id)),
+            [msg['message_id']])
+        self.assertEqual((yield self.redis.keys('*:reconcile:*')), [])
+        self.assertEqual(
+            (yield self.redis.smembers(self.cache.reconciling_key())), set())
+
     @inlineCallbacks
     def test_count_inbound_throughput(self):
         # test for empty batches.
@@ -0,0 +1,180 @@
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
+
+from vumi.components.scheduler import Scheduler
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, MessageHelper
+
+
+class TestScheduler(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.persistence_helper = PersistenceHelper()
+        self.add_cleanup(self.persistence_helper.cleanup)
+        self.redis = yield self.persistence_helper.get_redis_manager()
+        self.msg_helper = MessageHelper()
+        self.clock = Clock()
+        self.clock.advance(1000)
+        self.patch(Scheduler, 'get_clock', lambda _: self.clock)
+        self.delivered = []
+        self.scheduler = self.get_scheduler(self.deliver)
+        self.add_cleanup(self.scheduler.stop)
+
+    def get_scheduler(self, callback, **kw):
+        return Scheduler(self.redis, callback, **kw)
+
+    def deliver(self, scheduled_at, payload):
+        self.delivered.append((scheduled_at, payload))
+
+    @inlineCallbacks
+    def test_schedule(self):
+        entry_id = yield self.scheduler.schedule(10, {'foo': 'bar'})
+        self.assertEqual((yield self.scheduler.count_scheduled()), 1)
+        self.assertEqual((yield self.scheduler.count_due()), 0)
+        self.assertEqual(
+            (yield self.scheduler.get_entry(entry_id)),
+            (1010, {'foo': 'bar'}))
+
+    @inlineCallbacks
+    def test_schedule_unencodable(self):
+        yield self.assertFailure(
+            self.scheduler.schedule(10, object()), TypeError)
+        self.assertEqual((yield self.scheduler.count_scheduled()), 0)
+
+    @inlineCallbacks
+    def test_deliver_due(self):
+        yield self.scheduler.schedule(10, {'a': 1})
+        yield self.scheduler.schedule(20, {'b': 2})
+        self.assertEqual((yield self.scheduler.deliver_due()), 0)
+        self.assertEqual(self.delivered, [])
+
+        self.clock.advance(15)
+        self.assertEqual((yield self.scheduler.deliver_due()), 1)
+        self.assertEqual(self.delivered, [(1010, {'a': 1})])
+
+        self.clock.advance(10)
+        self.assertEqual((yield self.scheduler.deliver_due()), 1)
+        self.assertEqual(self.delivered, [(1010, {'a': 1}), (1020, {'b': 2})])
+        self.assertEqual((yield self.scheduler.count_scheduled()), 0)
+        self.assertEqual((yield self.scheduler.count_leased()), 0)
+        self.assertEqual((yield self.redis.keys('entry:*')), [])
+
+    @inlineCallbacks
+    def test_deliver_due_in_batches(self):
+        scheduler = self.get_scheduler(self.deliver, batch_size=3)
+        for i in range(10):
+            yield scheduler.schedule(i, {'i': i})
+        self.clock.advance(10)
+        self.assertEqual((yield scheduler.deliver_due()), 10)
+        self.assertEqual(
+            sorted(payload['i'] for _, payload in self.delivered), range(10))
+
+    @inlineCallbacks
+    def test_deliver_message(self):
+        msg = self.msg_helper.make_inbound("hello")
+        yield self.scheduler.schedule(10, msg.payload)
+        self.clock.advance(10)
+        yield self.scheduler.deliver_due()
+        [(_, payload)] = self.delivered
+        self.assertEqual(payload, msg.payload)
+
+    @inlineCallbacks
+    def test_claim_due_only_once(self):
+        other = self.get_scheduler(self.deliver)
+        yield self.scheduler.schedule(0, {'a': 1})
+        claimed = yield self.scheduler.claim_due()
+        self.assertEqual(len(claimed), 1)
+        self.assertEqual((yield other.claim_due()), [])
+        self.assertEqual((yield self.scheduler.count_leased()), 1)
+
+    @inlineCallbacks
+    def test_lost_claim_race_leaves_no_lease(self):
+        # Another process read the entry as due, but only tried to claim it
+        # after we had delivered and released it.
+        other = self.get_scheduler(self.deliver)
+        entry_id = yield self.scheduler.schedule(0, {'a': 1})
+        self.assertEqual((yield self.scheduler.deliver_due()), 1)
+        claimed = yield other._move(
+            other.due_key(), other.lease_key(), [entry_id], 2000)
+        self.assertEqual(claimed, [])
+        self.assertEqual((yield other.count_leased()), 0)
+        self.assertEqual((yield other.count_scheduled()), 0)
+
+    @inlineCallbacks
+    def test_lost_claim_race_keeps_winners_lease(self):
+        other = self.get_scheduler(self.deliver)
+        entry_id = yield self.scheduler.schedule(0, {'a': 1})
+        self.assertEqual((yield self.scheduler.claim_due()), [entry_id])
+        claimed = yield other._move(
+            other.due_key(), other.lease_key(), [entry_id], 2000)
+        self.assertEqual(claimed, [])
+        self.assertEqual((yield other.count_leased()), 1)
+
+    @inlineCallbacks
+    def test_failed_delivery_redelivered_after_lease(self):
+        failures = [False, True]
+
+        def deliver(scheduled_at, payload):
+            if failures.pop():
+                raise ValueError("Nope.")
+            self.delivered.append((scheduled_at, payload))
+
+        scheduler = self.get_scheduler(deliver, lease_time=30)
+        yield scheduler.schedule(0, {'a': 1})
+        self.assertEqual((yield scheduler.deliver_due()), 0)
+        [err] = self.flushLoggedErrors(ValueError)
+        self.assertEqual((yield scheduler.count_leased()), 1)
+
+        self.clock.advance(10)
+        self.assertEqual((yield scheduler.deliver_due()), 0)
+        self.assertEqual(self.delivered, [])
+
+        self.clock.advance(30)
+        self.assertEqual((yield scheduler.deliver_due()), 1)
+        self.assertEqual(self.delivered, [(1000, {'a': 1})])
+        self.assertEqual((yield scheduler.count_leased()), 0)
+
+    @inlineCallbacks
+    def test_requeue_expired_leases(self):
+        yield self.scheduler.schedule(0, {'a': 1})
+        yield self.scheduler.claim_due()
+        self.assertEqual((yield self.scheduler.requeue_expired_leases()), 0)
+        self.clock.advance(self.scheduler.lease_time)
+        self.assertEqual((yield self.scheduler.requeue_expired_leases()), 1)
+        self.assertEqual((yield self.scheduler.count_leased()), 0)
+        self.assertEqual((yield self.scheduler.count_due()), 1)
+
+    @inlineCallbacks
+    def test_deliver_async_callback(self):
+        d = Deferred()
+        scheduler = self.get_scheduler(lambda *args: d)
+        yield scheduler.schedule(0, {'a': 1})
+        delivery_d = scheduler.deliver_due()
+        # The lease is held until the callback's deferred fires.
+        self.assertEqual((yield scheduler.count_leased()), 1)
+        d.callback(None)
+        self.assertEqual((yield delivery_d), 1)
+        self.assertEqual((yield scheduler.count_leased()), 0)
+
+    @inlineCallbacks
+    def test_cancel(self):
+        entry_id = yield self.scheduler.schedule(10, {'a': 1})
+        self.assertEqual((yield self.scheduler.cancel(entry_id)), True)
+        self.assertEqual((yield self.scheduler.cancel(entry_id)), False)
+        self.assertEqual((yield self.scheduler.get_entry(entry_id)), None)
+        self.clock.advance(10)
+        self.assertEqual((yield self.scheduler.deliver_due()), 0)
+
+    @inlineCallbacks
+    def test_start_and_stop(self):
+        scheduler = self.get_scheduler(self.deliver, delivery_period=5)
+        yield scheduler.schedule(7, {'a': 1})
+        scheduler.start()
+        self.assertTrue(scheduler.is_running)
+        self.assertEqual(self.delivered, [])
+        self.clock.advance(5)
+        self.assertEqual(self.delivered, [])
+        self.clock.advance(5)
+        self.assertEqual(self.delivered, [(1007, {'a': 1})])
+        scheduler.stop()
+        self.assertFalse(scheduler.is_running)
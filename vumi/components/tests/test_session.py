@@ -71,3 +71,99 @@ class TestSessionManager(VumiTestCase):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_session_indexes_session(self):
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.assertEqual((yield self.sm.active_session_ids()), ["u1"])
+        self.assertEqual(
+            (yield self.manager.zscore("session_index", "u1")), float('inf'))
+
+        yield self.manager.expire("session:u1", 60)
+        yield self.sm.save_session("u1", {"foo": "baz"})
+        expires_at = yield self.manager.zscore("session_index", "u1")
+        self.assertTrue(time.time() < expires_at <= time.time() + 60)
+
+    @inlineCallbacks
+    def test_create_session_float_value(self):
+        session = yield self.sm.create_session("u1", created_at=1.0 / 3)
+        self.assertEqual(float(session['created_at']), 1.0 / 3)
+        loaded = yield self.sm.load_session("u1")
+        self.assertEqual(loaded, session)
+
+    @inlineCallbacks
+    def test_create_session_with_expiry(self):
+        self.sm.max_session_length = 60.0
+        yield self.sm.create_session("u1")
+        ttl = yield self.manager.ttl("session:u1")
+        self.assertTrue(0 < ttl <= 60)
+        expires_at = yield self.manager.zscore("session_index", "u1")
+        self.assertTrue(time.time() < expires_at <= time.time() + 60)
+
+    @inlineCallbacks
+    def test_create_session_unicode_user_id(self):
+        yield self.sm.create_session(u"\u1234")
+        self.assertEqual(len((yield self.sm.active_session_ids())), 1)
+        session = yield self.sm.load_session(u"\u1234")
+        self.assertEqual(sorted(session.keys()), ['created_at'])
+
+    @inlineCallbacks
+    def test_active_sessions_excludes_expired(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.create_session("u2")
+        # Pretend u2 expired a second ago.
+        yield self.manager.zadd("session_index", u2=time.time() - 1)
+        self.assertEqual((yield self.sm.active_session_ids()), ["u1"])
+        self.assertEqual((yield self.manager.zcard("session_index")), 1)
+
+    @inlineCallbacks
+    def test_clear_session(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+        self.assertEqual((yield self.sm.active_sessions()), [])
+
+    @inlineCallbacks
+    def test_no_cache_by_default(self):
+        self.assertEqual(self.sm.cache, None)
+        yield self.sm.create_session("u1")
+        yield self.manager.delete("session:u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_cached_load_session(self):
+        sm = SessionManager(self.manager, cache_size=10)
+        session = yield sm.create_session("u1", foo="bar")
+        # Remove the session behind the cache's back.
+        yield self.manager.delete("session:u1")
+        self.assertEqual((yield sm.load_session("u1")), session)
+        self.assertEqual(sm.cache.hits, 1)
+
+    @inlineCallbacks
+    def test_cached_load_session_miss(self):
+        yield self.sm.create_session("u1", foo="bar")
+        sm = SessionManager(self.manager, cache_size=10)
+        session = yield sm.load_session("u1")
+        self.assertEqual(session["foo"], "bar")
+        self.assertEqual((sm.cache.hits, sm.cache.misses), (0, 1))
+        self.assertEqual((yield sm.load_session("u1")), session)
+        self.assertEqual((sm.cache.hits, sm.cache.misses), (1, 1))
+
+    @inlineCallbacks
+    def test_cached_save_session(self):
+        sm = SessionManager(self.manager, cache_size=10)
+        yield sm.create_session("u1", foo="bar")
+        yield sm.save_session("u1", {"foo": "baz", "count": 5})
+        cached = yield sm.load_session("u1")
+        self.assertEqual(sm.cache.hits, 1)
+        stored = yield self.manager.hgetall("session:u1")
+        self.assertEqual(cached, stored)
+        self.assertEqual(cached["count"], "5")
+
+    @inlineCallbacks
+    def test_cached_clear_session(self):
+        sm = SessionManager(self.manager, cache_size=10)
+        yield sm.create_session("u1", foo="bar")
+        yield sm.clear_session("u1")
+        self.assertEqual((yield sm.load_session("u1")), {})
+        self.assertEqual(sm.cache.hits, 0)
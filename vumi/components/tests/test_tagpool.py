@@ -90,7 +90,7 @@ class TestTxTagpoolManager(VumiTestCase):
         self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
         self.assertEqual((yield self.tpm.acquire_tag("poolB")), None)
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          ["tag2"])
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(["tag2"]))
@@ -115,7 +115,7 @@ class TestTxTagpoolManager(VumiTestCase):
         free_local_tags = [t[1] for t in tags]
         free_local_tags.remove("tag5")
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          free_local_tags)
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
@@ -138,7 +138,7 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.acquire_tag("poolA")
         yield self.tpm.release_tag(tag1)
         redis = self.redis
-        self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
+        self.assertEqual((yield redis.zrange(tkey("free:zset"), 0, -1)),
                          ["tag3", "tag1"])
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(["tag1", "tag3"]))
@@ -153,6 +153,145 @@ class TestTxTagpoolManager(VumiTestCase):
         yield self.tpm.release_tag(tag)
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
 
+    @inlineCallbacks
+    def test_release_tag_after_acquire_specific(self):
+        tags = [("poolA", "tag%d" % i) for i in range(3)]
+        yield self.tpm.declare_tags(tags)
+        yield self.tpm.acquire_specific_tag(tags[1])
+        yield self.tpm.release_tag(tags[1])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tags[0])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tags[2])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tags[1])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_release_free_tag(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2"])
+
+    @inlineCallbacks
+    def test_acquire_tag_claimed_elsewhere(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
+        yield self.tpm.declare_tags([tag1, tag2])
+        # Simulate another worker claiming tag1 between our ZRANGE and ZREM.
+        orig_zrange = self.redis.zrange
+
+        def zrange(key, start, stop, *args, **kw):
+            self.redis.zrange = orig_zrange
+            result = orig_zrange(key, start, stop, *args, **kw)
+            self.redis.zrem(tkey("free:zset"), "tag1")
+            return result
+
+        self.redis.zrange = zrange
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+
+    @inlineCallbacks
+    def test_declare_tags_in_chunks(self):
+        tkey = self.pool_key_generator("poolA")
+        self.tpm.declare_chunk_size = 3
+        tags = [("poolA", "tag%02d" % i) for i in range(10)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         [t[1] for t in tags])
+        self.assertEqual((yield self.redis.smembers(tkey("free:set"))),
+                         set(t[1] for t in tags))
+        for tag in tags:
+            self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag)
+
+    @inlineCallbacks
+    def add_legacy_free_list(self, pool, local_tags):
+        tkey = self.pool_key_generator(pool)
+        for local_tag in local_tags:
+            yield self.redis.sadd(tkey("free:set"), local_tag)
+            yield self.redis.rpush(tkey("free:list"), local_tag)
+
+    @inlineCallbacks
+    def test_acquire_tag_from_legacy_free_list(self):
+        tkey = self.pool_key_generator("poolA")
+        yield self.add_legacy_free_list("poolA", ["tag1", "tag2"])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag1"))
+        self.assertEqual((yield self.redis.llen(tkey("free:list"))), 0)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag2"])
+        self.assertEqual((yield self.redis.smembers(tkey("inuse:set"))),
+                         set(["tag1"]))
+
+    @inlineCallbacks
+    def test_acquire_specific_tag_from_legacy_free_list(self):
+        yield self.add_legacy_free_list("poolA", ["tag1", "tag2"])
+        tag2 = ("poolA", "tag2")
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tag2)), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag1"))
+
+    @inlineCallbacks
+    def test_migrate_legacy_free_list_in_chunks(self):
+        tkey = self.pool_key_generator("poolA")
+        self.tpm.declare_chunk_size = 2
+        local_tags = ["tag%d" % i for i in range(5)]
+        yield self.add_legacy_free_list("poolA", local_tags)
+        self.assertEqual((yield self.tpm._migrate_free_list("poolA")), True)
+        self.assertEqual((yield self.tpm._migrate_free_list("poolA")), False)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         local_tags)
+
+    @inlineCallbacks
+    def test_migrate_legacy_free_list_locked(self):
+        tkey = self.pool_key_generator("poolA")
+        yield self.add_legacy_free_list("poolA", ["tag1", "tag2"])
+        yield self.redis.setex(tkey("free:list:lock"), 60, 1)
+        self.assertEqual((yield self.tpm._migrate_free_list("poolA")), False)
+        self.assertEqual((yield self.redis.llen(tkey("free:list"))), 2)
+        self.assertEqual((yield self.redis.zcard(tkey("free:zset"))), 0)
+
+        # A lock without a timeout was left by a caller that crashed while
+        # taking it, so it gets a timeout.
+        yield self.redis.persist(tkey("free:list:lock"))
+        self.assertEqual((yield self.tpm._migrate_free_list("poolA")), False)
+        self.assertTrue((yield self.redis.ttl(tkey("free:list:lock"))) > 0)
+
+        yield self.redis.delete(tkey("free:list:lock"))
+        self.assertEqual((yield self.tpm._migrate_free_list("poolA")), True)
+        self.assertEqual((yield self.redis.zrange(tkey("free:zset"), 0, -1)),
+                         ["tag1", "tag2"])
+        self.assertEqual((yield self.redis.exists(tkey("free:list:lock"))),
+                         False)
+
+    @inlineCallbacks
+    def test_claim_tag_not_in_free_zset(self):
+        # A tag being released is briefly in the free set but not yet in
+        # the free sorted set. Nobody can claim it then.
+        tkey = self.pool_key_generator("poolA")
+        yield self.redis.sadd(tkey("free:set"), "tag1")
+        self.assertEqual((yield self.tpm._claim_tag("poolA", "tag1")), False)
+        self.assertEqual((yield self.redis.smembers(tkey("free:set"))),
+                         set(["tag1"]))
+        self.assertEqual((yield self.redis.smembers(tkey("inuse:set"))),
+                         set())
+
+    @inlineCallbacks
+    def test_declare_tags_on_legacy_free_list(self):
+        yield self.add_legacy_free_list("poolA", ["tag2"])
+        yield self.tpm.declare_tags([("poolA", "tag1"), ("poolA", "tag2")])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag2"))
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")),
+                         ("poolA", "tag1"))
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_purge_pool_removes_all_keys(self):
+        yield self.add_legacy_free_list("poolA", ["tag1"])
+        yield self.tpm.declare_tags([("poolA", "tag2")])
+        yield self.tpm.purge_pool("poolA")
+        self.assertEqual((yield self.redis.keys("tagpools:poolA:*")), [])
+
     @inlineCallbacks
     def test_metadata(self):
         mkey = self.pool_key_generator("poolA")("metadata")
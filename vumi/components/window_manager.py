@@ -111,8 +111,8 @@ class WindowManager(object):
         room_available = self.window_size - flight_size
 
         if room_available > 0:
-            log.debug('Window %s has space for %s' % (window_key,
-                                                        room_available))
+            log.debug(format='Window %(window)s has space for %(room)s',
+                      window=window_key, room=room_available)
             next_key = yield self.redis.rpoplpush(window_key, inflight_key)
             if next_key:
                 yield self._set_timestamp(window_id, next_key)
@@ -48,6 +48,65 @@ class DictConfigData(Adapter):
 registerAdapter(DictConfigData, dict, IConfigData)
 
 
+def _read_only(self, *args, **kw):
+    raise TypeError("Config values are read-only.")
+
+
+class FrozenDict(dict):
+    """Read-only dict returned by :class:`ConfigDict` fields.
+
+    Copies of a :class:`FrozenDict` are ordinary (mutable) dicts.
+    """
+
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+    def __copy__(self):
+        return dict(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+    def __reduce__(self):
+        return (dict, (dict(self),))
+
+
+class FrozenList(list):
+    """Read-only list returned by :class:`ConfigList` fields.
+
+    Copies of a :class:`FrozenList` are ordinary (mutable) lists.
+    """
+
+    __setitem__ = __delitem__ = __setslice__ = __delslice__ = _read_only
+    __iadd__ = __imul__ = _read_only
+    append = extend = insert = pop = remove = reverse = sort = _read_only
+
+    def __copy__(self):
+        return list(self)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(list(self), memo)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def freeze(value):
+    """Return a read-only version of a config value.
+
+    Dicts and lists (including those nested inside other containers) are
+    converted to :class:`FrozenDict` and :class:`FrozenList`. Other values
+    are returned unchanged.
+    """
+    if isinstance(value, dict):
+        return FrozenDict((k, freeze(v)) for k, v in value.iteritems())
+    if isinstance(value, list):
+        return FrozenList(freeze(v) for v in value)
+    if isinstance(value, tuple):
+        return tuple(freeze(v) for v in value)
+    return value
+
+
 class ConfigField(object):
     _creation_order = 0
 
@@ -79,12 +138,13 @@ class ConfigField(object):
         return obj._config_data.has_key(self.name)
 
     def validate(self, obj):
+        """Validate this field's value and return the cleaned value."""
         if self.required:
             if not self.present(obj):
                 raise ConfigError(
                     "Missing required config field '%s'" % (self.name))
         # This will raise an exception if the value exists, but is invalid.
-        self.get_value(obj)
+        return self.get_value(obj)
 
     def raise_config_error(self, message_suffix):
         raise ConfigError("Field '%s' %s" % (self.name, message_suffix))
@@ -99,7 +159,11 @@ class ConfigField(object):
     def __get__(self, obj, cls):
         if obj.static and not self.static:
             self.raise_config_error("is not marked as static.")
-        return self.get_value(obj)
+        try:
+            return obj._field_values[self.name]
+        except KeyError:
+            value = obj._field_values[self.name] = self.get_value(obj)
+            return value
 
     def __set__(self, obj, value):
         raise AttributeError("Config fields are read-only.")
@@ -156,7 +220,7 @@ class ConfigList(ConfigField):
             value = list(value)
         if not isinstance(value, list):
             self.raise_config_error("is not a list.")
-        return deepcopy(value)
+        return freeze(value)
 
 
 class ConfigDict(ConfigField):
@@ -165,7 +229,7 @@ class ConfigDict(ConfigField):
     def clean(self, value):
         if not isinstance(value, dict):
             self.raise_config_error("is not a dict.")
-        return deepcopy(value)
+        return freeze(value)
 
 
 class ConfigUrl(ConfigField):
@@ -321,18 +385,39 @@ class ConfigMetaClass(type):
 
 
 class Config(object):
-    """Config object."""
+    """Config object.
+
+    Field values are cleaned once, when the config is validated, and the
+    cleaned values are reused for every subsequent access. The config data
+    should therefore not be modified after the config object is created.
+
+    :param config_data:
+        The config data, usually a dict.
+    :param bool static:
+        If ``True``, only static fields are validated and accessible.
+    :param Config base:
+        An existing config of the same class built from the same static
+        config data (usually a worker's static config). Its cleaned static
+        field values are reused instead of being cleaned again, which makes
+        deriving per-message configs cheaper.
+    """
 
     __metaclass__ = ConfigMetaClass
 
-    def __init__(self, config_data, static=False):
+    def __init__(self, config_data, static=False, base=None):
         self._config_data = IConfigData(config_data)
         self.static = static
+        self._field_values = {}
         for field in self.fields:
             if self.static and not field.static:
                 # Skip non-static fields on static configs.
                 continue
-            field.validate(self)
+            if (base is not None and field.static and
+                    field.name in base._field_values):
+                self._field_values[field.name] = base._field_values[
+                    field.name]
+                continue
+            self._field_values[field.name] = field.validate(self)
         self.post_validate()
 
     def raise_config_error(self, message):
@@ -27,6 +27,12 @@ class BaseConnector(object):
         self._prefetch_count = prefetch_count
         self._middlewares = MiddlewareStack(middlewares
                                             if middlewares is not None else [])
+        # Counters reported in worker heartbeats.
+        self.consumed = 0
+        self.published = 0
+        self.in_flight = 0
+        # A vumi.backpressure.BackpressureController, if one is attached.
+        self.backpressure = None
 
     def _rkey(self, mtype):
         return '%s.%s' % (self.name, mtype)
@@ -35,10 +41,16 @@ class BaseConnector(object):
         raise NotImplementedError()
 
     def teardown(self):
+        if self.backpressure is not None:
+            self.backpressure.stop()
         d = gatherResults([c.stop() for c in self._consumers.values()])
         d.addCallback(lambda r: self._middlewares.teardown())
         return d
 
+    @property
+    def consumer_count(self):
+        return len(self._consumers)
+
     @property
     def paused(self):
         return all(consumer.paused
@@ -61,7 +73,9 @@ class BaseConnector(object):
 
     def _set_prefetch_count(self, consumer):
         if self._prefetch_count is not None:
-            consumer.channel.basic_qos(0, self._prefetch_count, False)
+            # Consumers sharing a channel share its prefetch limit.
+            consumer.channel.basic_qos(
+                0, self._prefetch_count, consumer.channel_shared)
 
     @inlineCallbacks
     def _setup_consumer(self, mtype, msg_class, default_handler):
@@ -70,7 +84,8 @@ class BaseConnector(object):
 
         consumer = yield self.worker.consume(self._rkey(mtype), handler,
                                              message_class=msg_class,
-                                             paused=True)
+                                             paused=True,
+                                             channel_group=self.name)
         self._consumers[mtype] = consumer
         self._set_default_endpoint_handler(mtype, default_handler)
         self._set_prefetch_count(consumer)
@@ -91,13 +106,26 @@ class BaseConnector(object):
         handler = self._endpoint_handlers[mtype].get(endpoint_name)
         if handler is None:
             handler = self._default_handlers.get(mtype)
+        self.consumed += 1
+        self.in_flight += 1
+        started = None
+        if self.backpressure is not None:
+            started = self.backpressure.message_started()
         d = self._middlewares.apply_consume(mtype, msg, self.name)
         d.addCallback(handler)
-        return d.addErrback(self._ignore_message, msg)
+        d.addErrback(self._ignore_message, msg)
+        return d.addBoth(self._message_done, started)
+
+    def _message_done(self, result, started=None):
+        self.in_flight -= 1
+        if self.backpressure is not None and started is not None:
+            self.backpressure.message_done(started)
+        return result
 
     def _publish_message(self, mtype, msg, endpoint_name):
         if endpoint_name is not None:
             msg.set_routing_endpoint(endpoint_name)
+        self.published += 1
         d = self._middlewares.apply_publish(mtype, msg, self.name)
         return d.addCallback(self._publishers[mtype].publish_message)
 
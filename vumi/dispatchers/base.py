@@ -10,7 +10,7 @@ from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.utils import load_class_by_string, get_first_word
+from vumi.utils import load_class_by_string, get_first_word, LRUCache
 from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
 from vumi import log
 from vumi.components.session import SessionManager
@@ -397,8 +397,15 @@ class UserGroupingRouter(SimpleDispatchRouter):
     :param str dispatcher_name:
         The name of the dispatcher, used internally as
         the prefix for Redis keys.
+
+    :param int user_cache_size:
+        Maximum number of user to group assignments to cache in memory.
+        Assignments never change once made, so cached assignments never
+        need to be reloaded from Redis. Defaults to 10000.
     """
 
+    DEFAULT_USER_CACHE_SIZE = 10000
+
     def setup_routing(self):
         r_config = self.config.get('redis_manager', {})
         r_prefix = self.config['dispatcher_name']
@@ -409,6 +416,9 @@ class UserGroupingRouter(SimpleDispatchRouter):
 
         self.groups = self.config['group_mappings']
         self.nr_of_groups = len(self.groups)
+        self.sorted_groups = sorted(self.groups.items())
+        self.user_groups = LRUCache(self.config.get(
+            'user_cache_size', self.DEFAULT_USER_CACHE_SIZE))
 
     def _setup_redis(self, redis):
         self.redis = redis
@@ -417,17 +427,25 @@ class UserGroupingRouter(SimpleDispatchRouter):
     def get_next_group(self):
         counter = (yield self.redis.incr('round-robin')) - 1
         current_group_id = counter % self.nr_of_groups
-        sorted_groups = sorted(self.groups.items())
-        group = sorted_groups[current_group_id]
+        group = self.sorted_groups[current_group_id]
         returnValue(group)
 
     @inlineCallbacks
     def get_group_for_user(self, user_id):
+        group = self.user_groups.get(user_id)
+        if group is not None:
+            returnValue(group)
         user_key = "user:%s" % (user_id,)
         group = yield self.redis.get(user_key)
         if not group:
-            group, transport_name = yield self.get_next_group()
-            yield self.redis.set(user_key, group)
+            next_group, transport_name = yield self.get_next_group()
+            # If another message from this user beat us to it, we use the
+            # group it was assigned instead of the one we picked.
+            if (yield self.redis.setnx(user_key, next_group)):
+                group = next_group
+            else:
+                group = yield self.redis.get(user_key)
+        self.user_groups.set(user_id, group)
         returnValue(group)
 
     @inlineCallbacks
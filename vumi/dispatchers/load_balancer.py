@@ -1,16 +1,70 @@
 # -*- test-case-name: vumi.dispatchers.tests.test_load_balancer -*-
 
-"""Router for round-robin load balancing between two transports."""
+"""Router for load balancing between transports."""
 
 import itertools
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, gatherResults
+from twisted.internet.task import LoopingCall
+from txamqp.client import Closed
 
 from vumi import log
 from vumi.errors import ConfigError
 from vumi.dispatchers.base import BaseDispatchRouter
+from vumi.blinkenlights.metrics import MetricManager, Metric, Count
+
+
+class OutstandingMessages(object):
+    """Messages routed to a transport that haven't been acked or nacked,
+    in the order they were routed."""
+
+    def __init__(self):
+        self._routed_at = {}
+        self._order = deque()
+
+    def __len__(self):
+        return len(self._routed_at)
+
+    def add(self, message_id, timestamp):
+        self._routed_at[message_id] = timestamp
+        self._order.append((timestamp, message_id))
+
+    def remove(self, message_id):
+        """Forget a message. Returns `True` if it was outstanding."""
+        return self._routed_at.pop(message_id, None) is not None
+
+    def clear(self):
+        self._routed_at.clear()
+        self._order.clear()
+
+    def _trim(self):
+        # Entries for messages that have since been removed (or routed
+        # again) are left in the queue until they reach the front.
+        while self._order:
+            timestamp, message_id = self._order[0]
+            if self._routed_at.get(message_id) == timestamp:
+                break
+            self._order.popleft()
+
+    def oldest(self):
+        """Return when the oldest outstanding message was routed, or `None`
+        if there aren't any."""
+        self._trim()
+        return self._order[0][0] if self._order else None
+
+    def expire(self, cutoff):
+        """Forget messages routed at or before `cutoff`."""
+        self._trim()
+        while self._order and self._order[0][0] <= cutoff:
+            _timestamp, message_id = self._order.popleft()
+            del self._routed_at[message_id]
+            self._trim()
 
 
 class LoadBalancingRouter(BaseDispatchRouter):
-    """Router that does round-robin dispatching to transports.
+    """Router that load balances dispatching to transports.
 
     Supports only one exposed name and requires at least one transport
     name.
@@ -19,13 +73,56 @@ class LoadBalancingRouter(BaseDispatchRouter):
 
     :param bool reply_affinity:
         If set to true, replies are sent back to the same transport
-        they were sent from. If false, replies are round-robinned in
+        they were sent from. If false, replies are load balanced in
         the same way other outbound messages are. Default: true.
     :param bool rewrite_transport_name:
         If set to true, rewrites message `transport_names` in both
         directions. Default: true.
+    :param str strategy:
+        How to pick a transport for an outbound message. One of:
+
+        * ``round_robin``: cycle through the transports in turn.
+        * ``weighted``: smooth weighted round-robin using ``weights``.
+        * ``least_outstanding``: pick the transport with the fewest
+          messages that have not yet been acked or nacked.
+        * ``queue_depth``: pick the transport with the fewest messages
+          waiting in its outbound queue. Queue depths are polled every
+          ``queue_depth_interval`` seconds.
+
+        Default: ``round_robin``.
+    :param dict weights:
+        Mapping of transport name to relative weight for the
+        ``weighted`` strategy. Transports not listed have a weight of 1.
+    :param float ack_timeout:
+        If set, a transport whose oldest unacknowledged message is older
+        than this many seconds is taken out of rotation until an ack or
+        nack arrives from it again. While it is out of rotation, one
+        message is sent to it every ``probe_interval`` seconds so that it
+        can be restored. If every transport is out of rotation, messages
+        are balanced over all of them. Default: no timeout.
+    :param float probe_interval:
+        Seconds between messages sent to a transport that is out of
+        rotation. Default: ``ack_timeout``.
+    :param float outstanding_timeout:
+        Seconds after which a message that hasn't been acked or nacked
+        stops counting as outstanding. Default: 300, or ``ack_timeout`` if
+        that is longer.
+    :param float queue_depth_interval:
+        Seconds between queue depth polls for the ``queue_depth``
+        strategy. Default: 5.
+    :param str metrics_prefix:
+        If set, per-transport routing metrics are published with this
+        prefix. Default: metrics are not published.
     """
 
+    STRATEGIES = {
+        'round_robin': 'choose_round_robin',
+        'weighted': 'choose_weighted',
+        'least_outstanding': 'choose_least_outstanding',
+        'queue_depth': 'choose_queue_depth',
+    }
+
+    @inlineCallbacks
     def setup_routing(self):
         self.reply_affinity = self.config.get('reply_affinity', True)
         self.rewrite_transport_names = self.config.get(
@@ -37,9 +134,72 @@ class LoadBalancingRouter(BaseDispatchRouter):
         if not self.dispatcher.transport_names:
             raise ConfigError("At least one transport name is needed for %s" %
                               (type(self).__name__,))
-        self.transport_name_cycle = itertools.cycle(
-            self.dispatcher.transport_names)
-        self.transport_name_set = set(self.dispatcher.transport_names)
+        self.transport_names = list(self.dispatcher.transport_names)
+        self.transport_name_cycle = itertools.cycle(self.transport_names)
+        self.transport_name_set = set(self.transport_names)
+
+        strategy = self.config.get('strategy', 'round_robin')
+        if strategy not in self.STRATEGIES:
+            raise ConfigError("Unknown load balancing strategy %r for %s." %
+                              (strategy, type(self).__name__))
+        self.strategy = strategy
+        self.choose_transport_name = getattr(self, self.STRATEGIES[strategy])
+
+        weights = self.config.get('weights', {})
+        self.weights = dict((name, int(weights.get(name, 1)))
+                            for name in self.transport_names)
+        self.current_weights = dict.fromkeys(self.transport_names, 0)
+
+        self.ack_timeout = self.config.get('ack_timeout')
+        self.probe_interval = self.config.get(
+            'probe_interval', self.ack_timeout)
+        self.outstanding_timeout = max(
+            self.config.get('outstanding_timeout', 300),
+            self.ack_timeout or 0)
+        self.track_outstanding = (self.ack_timeout is not None or
+                                  strategy == 'least_outstanding')
+        self.outstanding = dict(
+            (name, OutstandingMessages()) for name in self.transport_names)
+        # Transport name -> time of the next probe message.
+        self.unavailable = {}
+
+        self.queue_depths = dict.fromkeys(self.transport_names, 0)
+        self._queue_depth_poller = None
+        if strategy == 'queue_depth':
+            self._queue_depth_poller = LoopingCall(self.poll_queue_depths)
+            self._queue_depth_poller.clock = self.get_clock()
+            self._queue_depth_poller.start(
+                self.config.get('queue_depth_interval', 5), now=True)
+
+        self.metrics = None
+        metrics_prefix = self.config.get('metrics_prefix')
+        if metrics_prefix is not None:
+            yield self.setup_metrics(metrics_prefix)
+
+    def teardown_routing(self):
+        if self._queue_depth_poller is not None:
+            if self._queue_depth_poller.running:
+                self._queue_depth_poller.stop()
+            self._queue_depth_poller = None
+        if self.metrics is not None:
+            self.metrics.stop()
+
+    @inlineCallbacks
+    def setup_metrics(self, prefix):
+        self.metrics = yield self.dispatcher.start_publisher(
+            MetricManager, prefix)
+        for name in self.transport_names:
+            self.metrics.register(Count('%s.routed' % (name,)))
+            self.metrics.register(Metric('%s.outstanding' % (name,)))
+            self.metrics.register(Metric('%s.available' % (name,)))
+
+    def set_metric(self, name, value):
+        # Metrics are only collected if they're being published.
+        if self.metrics is not None:
+            self.metrics[name].set(value)
+
+    def get_clock(self):
+        return reactor
 
     def push_transport_name(self, msg, transport_name):
         hm = msg['helper_metadata']
@@ -55,6 +215,162 @@ class LoadBalancingRouter(BaseDispatchRouter):
             return None
         return transport_names.pop()
 
+    def outstanding_counts(self):
+        return dict((name, len(outstanding))
+                    for name, outstanding in self.outstanding.iteritems())
+
+    def check_transport_health(self):
+        """Take transports that have stopped acking out of rotation."""
+        now = self.get_clock().seconds()
+        for name, outstanding in self.outstanding.iteritems():
+            outstanding.expire(now - self.outstanding_timeout)
+        if self.ack_timeout is None:
+            return
+        cutoff = now - self.ack_timeout
+        for name, outstanding in self.outstanding.iteritems():
+            if name in self.unavailable:
+                continue
+            oldest = outstanding.oldest()
+            if oldest is not None and oldest <= cutoff:
+                log.warning("LoadBalancer transport %r has not acked a"
+                            " message in %s seconds. Removing it from"
+                            " rotation." % (name, self.ack_timeout))
+                self.unavailable[name] = now + self.probe_interval
+                # These will probably never be acked, so we stop counting
+                # them against the transport.
+                outstanding.clear()
+                self.set_metric('%s.available' % (name,), 0)
+
+    def restore_transport(self, name):
+        if name in self.unavailable:
+            log.msg("LoadBalancer transport %r is acking again. Restoring"
+                    " it to rotation." % (name,))
+            del self.unavailable[name]
+            self.set_metric('%s.available' % (name,), 1)
+
+    def available_transport_names(self):
+        self.check_transport_health()
+        available = [name for name in self.transport_names
+                     if name not in self.unavailable]
+        return available or self.transport_names
+
+    def probe_transport_name(self):
+        """Return the name of an out of rotation transport that is due to
+        be sent a message, or `None`.
+
+        If the transport acks or nacks the message, it is restored.
+        """
+        now = self.get_clock().seconds()
+        for name in self.transport_names:
+            next_probe = self.unavailable.get(name)
+            if next_probe is not None and next_probe <= now:
+                self.unavailable[name] = now + self.probe_interval
+                return name
+        return None
+
+    def pick_transport_name(self):
+        available = self.available_transport_names()
+        return (self.probe_transport_name() or
+                self.choose_transport_name(available))
+
+    def choose_round_robin(self, candidates):
+        candidate_set = set(candidates)
+        for _ in self.transport_names:
+            name = self.transport_name_cycle.next()
+            if name in candidate_set:
+                return name
+
+    def choose_weighted(self, candidates):
+        # Smooth weighted round-robin, as used by nginx. Heavier transports
+        # are picked more often, but not in long runs.
+        total = 0
+        for name in candidates:
+            self.current_weights[name] += self.weights[name]
+            total += self.weights[name]
+        name = max(candidates, key=lambda n: self.current_weights[n])
+        self.current_weights[name] -= total
+        return name
+
+    def _choose_least(self, candidates, load):
+        # Start from the next transport in the cycle so ties are spread
+        # across the transports rather than always going to the first one.
+        start = self.transport_name_cycle.next()
+        offset = self.transport_names.index(start)
+        rotated = self.transport_names[offset:] + self.transport_names[:offset]
+        candidate_set = set(candidates)
+        return min((name for name in rotated if name in candidate_set),
+                   key=load)
+
+    def choose_least_outstanding(self, candidates):
+        return self._choose_least(
+            candidates, lambda name: len(self.outstanding[name]))
+
+    def choose_queue_depth(self, candidates):
+        return self._choose_least(
+            candidates, lambda name: self.queue_depths[name])
+
+    @inlineCallbacks
+    def get_queue_depth(self, transport_name):
+        """Return the number of messages in a transport's outbound queue,
+        or `None` if the queue doesn't exist yet.
+
+        The broker closes the channel if the queue doesn't exist, so the
+        queue is declared on a channel of its own rather than one our
+        publishers share.
+        """
+        queue = '%s.outbound' % (transport_name,)
+        channel = yield self.dispatcher._amqp_client.get_channel()
+        try:
+            reply = yield channel.queue_declare(queue=queue, passive=True)
+        except Closed, e:
+            # The reason is usually the broker's channel.close method.
+            reason = e.args[0] if e.args else None
+            log.warning("Can't poll queue depth for %r: %s" % (
+                transport_name, getattr(reason, 'reply_text', reason)))
+            returnValue(None)
+        yield channel.channel_close()
+        channel.close(None)
+        returnValue(reply.message_count)
+
+    def poll_queue_depths(self):
+        def set_depth(depth, name):
+            # Keep the last known depth if we couldn't get a new one.
+            if depth is not None:
+                self.queue_depths[name] = depth
+
+        def log_failure(f, name):
+            log.err(f, "Failed to poll queue depth for %r" % (name,))
+
+        return gatherResults([
+            self.get_queue_depth(name).addCallbacks(
+                set_depth, log_failure, callbackArgs=(name,),
+                errbackArgs=(name,))
+            for name in self.transport_names])
+
+    def record_routed(self, transport_name, msg):
+        if self.metrics is not None:
+            self.metrics['%s.routed' % (transport_name,)].inc()
+        # Until the next poll, count messages we've routed against the
+        # transport so that we don't send everything to the same one.
+        self.queue_depths[transport_name] += 1
+        if self.track_outstanding:
+            outstanding = self.outstanding[transport_name]
+            outstanding.add(msg['message_id'], self.get_clock().seconds())
+            self.set_metric(
+                '%s.outstanding' % (transport_name,), len(outstanding))
+
+    def record_event(self, msg):
+        transport_name = msg['transport_name']
+        if msg['event_type'] not in ('ack', 'nack'):
+            return
+        if transport_name not in self.transport_name_set:
+            return
+        outstanding = self.outstanding[transport_name]
+        if outstanding.remove(msg['user_message_id']):
+            self.set_metric(
+                '%s.outstanding' % (transport_name,), len(outstanding))
+        self.restore_transport(transport_name)
+
     def dispatch_inbound_message(self, msg):
         if self.reply_affinity:
             # TODO: we should really be pushing the endpoint name
@@ -65,6 +381,7 @@ class LoadBalancingRouter(BaseDispatchRouter):
         self.dispatcher.publish_inbound_message(self.exposed_name, msg)
 
     def dispatch_inbound_event(self, msg):
+        self.record_event(msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = self.exposed_name
         self.dispatcher.publish_inbound_event(self.exposed_name, msg)
@@ -75,11 +392,12 @@ class LoadBalancingRouter(BaseDispatchRouter):
             if transport_name not in self.transport_name_set:
                 log.warning("LoadBalancer is configured for reply affinity but"
                             " reply for unknown load balancer endpoint %r was"
-                            " was received. Using round-robin routing instead."
-                            % (transport_name,))
-                transport_name = self.transport_name_cycle.next()
+                            " was received. Using %s routing instead."
+                            % (transport_name, self.strategy))
+                transport_name = self.pick_transport_name()
         else:
-            transport_name = self.transport_name_cycle.next()
+            transport_name = self.pick_transport_name()
+        self.record_routed(transport_name, msg)
         if self.rewrite_transport_names:
             msg['transport_name'] = transport_name
         self.dispatcher.publish_outbound_message(transport_name, msg)
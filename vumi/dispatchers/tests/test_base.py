@@ -419,6 +419,38 @@ class TestUserGroupingRouter(VumiTestCase):
             'group2',
         ])
 
+    @inlineCallbacks
+    def test_group_assignment_race(self):
+        # Simulate another dispatcher assigning the user to group2 while
+        # we're choosing a group.
+        orig_get_next_group = self.router.get_next_group
+
+        @inlineCallbacks
+        def get_next_group():
+            group = yield orig_get_next_group()
+            yield self.redis.set("user:from_1", "group2")
+            returnValue(group)
+
+        self.router.get_next_group = get_next_group
+        group = yield self.router.get_group_for_user("from_1")
+        self.assertEqual(group, "group2")
+        self.assertEqual((yield self.redis.get("user:from_1")), "group2")
+
+    @inlineCallbacks
+    def test_group_assignment_cached(self):
+        group = yield self.router.get_group_for_user("from_1")
+        yield self.redis.delete("user:from_1")
+        self.assertEqual((yield self.router.get_group_for_user("from_1")),
+                         group)
+        self.assertEqual(self.router.user_groups.hits, 1)
+
+    @inlineCallbacks
+    def test_existing_group_assignment_loaded(self):
+        yield self.redis.set("user:from_1", "group2")
+        self.assertEqual((yield self.router.get_group_for_user("from_1")),
+                         "group2")
+        self.assertEqual((yield self.redis.get("round-robin")), None)
+
     def make_inbound_from(self, from_addr):
         return self.disp_helper.make_inbound("foo", from_addr=from_addr)
 
@@ -1,10 +1,12 @@
 """Tests for vumi.dispatchers.load_balancer."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, succeed
+from twisted.internet.task import Clock
 
 from vumi.dispatchers.load_balancer import LoadBalancingRouter
 from vumi.dispatchers.tests.helpers import DummyDispatcher
-from vumi.tests.helpers import VumiTestCase, MessageHelper
+from vumi.errors import ConfigError
+from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
 from vumi.tests.utils import LogCatcher
 
 
@@ -12,9 +14,12 @@ class BaseLoadBalancingTestCase(VumiTestCase):
 
     reply_affinity = None
     rewrite_transport_names = None
+    extra_config = {}
 
     @inlineCallbacks
     def setUp(self):
+        self.clock = Clock()
+        self.patch(LoadBalancingRouter, 'get_clock', lambda _: self.clock)
         config = {
             "transport_names": [
                 "transport_1",
@@ -28,12 +33,29 @@ class BaseLoadBalancingTestCase(VumiTestCase):
             config['reply_affinity'] = self.reply_affinity
         if self.rewrite_transport_names is not None:
             config['rewrite_transport_names'] = self.rewrite_transport_names
-        self.dispatcher = DummyDispatcher(config)
+        config.update(self.extra_config)
+        self.dispatcher = self.make_dispatcher(config)
         self.router = LoadBalancingRouter(self.dispatcher, config)
         self.add_cleanup(self.router.teardown_routing)
         yield self.router.setup_routing()
         self.msg_helper = MessageHelper()
 
+    def make_dispatcher(self, config):
+        return DummyDispatcher(config)
+
+    def send_outbound(self, content):
+        msg = self.msg_helper.make_outbound(content)
+        self.router.dispatch_outbound_message(msg)
+        return msg
+
+    def send_ack(self, msg):
+        self.router.dispatch_inbound_event(self.msg_helper.make_ack(
+            msg, transport_name=msg['transport_name']))
+
+    def routed_contents(self, transport_name):
+        return [msg['content'] for msg in
+                self.dispatcher.transport_publisher[transport_name].msgs]
+
 
 class TestLoadBalancingWithoutReplyAffinity(BaseLoadBalancingTestCase):
 
@@ -167,3 +189,227 @@ class TestLoadBalancingWithoutRewriteTransportNames(BaseLoadBalancingTestCase):
         self.router.dispatch_outbound_message(msg1)
         [new_msg] = self.dispatcher.transport_publisher['transport_1'].msgs
         self.assertEqual(new_msg['transport_name'], 'round_robin')
+
+
+class TestLoadBalancingConfig(VumiTestCase):
+
+    def test_unknown_strategy(self):
+        config = {
+            "transport_names": ["transport_1"],
+            "exposed_names": ["round_robin"],
+            "strategy": "coin_toss",
+        }
+        router = LoadBalancingRouter(DummyDispatcher(config), config)
+        return self.assertFailure(router.setup_routing(), ConfigError)
+
+
+class TestLoadBalancingWeighted(BaseLoadBalancingTestCase):
+
+    extra_config = {
+        "strategy": "weighted",
+        "weights": {"transport_1": 2},
+    }
+
+    def test_outbound_message_routing(self):
+        for i in range(6):
+            self.send_outbound('msg %d' % (i,))
+        self.assertEqual(self.routed_contents('transport_1'),
+                         ['msg 0', 'msg 2', 'msg 3', 'msg 5'])
+        self.assertEqual(self.routed_contents('transport_2'),
+                         ['msg 1', 'msg 4'])
+
+
+class TestLoadBalancingLeastOutstanding(BaseLoadBalancingTestCase):
+
+    extra_config = {"strategy": "least_outstanding"}
+
+    def test_outbound_message_routing(self):
+        self.send_outbound('msg 1')
+        msg2 = self.send_outbound('msg 2')
+        self.assertEqual(self.router.outstanding_counts(), {
+            'transport_1': 1, 'transport_2': 1})
+        self.send_ack(msg2)
+        self.assertEqual(self.router.outstanding_counts(), {
+            'transport_1': 1, 'transport_2': 0})
+        self.send_outbound('msg 3')
+        self.assertEqual(self.routed_contents('transport_1'), ['msg 1'])
+        self.assertEqual(self.routed_contents('transport_2'),
+                         ['msg 2', 'msg 3'])
+
+    def test_unacked_messages_expire(self):
+        self.send_outbound('msg 1')
+        self.clock.advance(299)
+        self.send_outbound('msg 2')
+        self.assertEqual(self.router.outstanding_counts(), {
+            'transport_1': 1, 'transport_2': 1})
+        self.clock.advance(1)
+        self.send_outbound('msg 3')
+        self.assertEqual(self.router.outstanding_counts(), {
+            'transport_1': 1, 'transport_2': 1})
+        self.assertEqual(self.routed_contents('transport_1'),
+                         ['msg 1', 'msg 3'])
+
+    def test_no_metrics(self):
+        self.send_outbound('msg 1')
+        self.assertEqual(self.router.metrics, None)
+
+    def test_delivery_reports_ignored(self):
+        msg = self.send_outbound('msg 1')
+        self.router.dispatch_inbound_event(
+            self.msg_helper.make_delivery_report(
+                msg, transport_name='transport_1'))
+        self.assertEqual(self.router.outstanding_counts(), {
+            'transport_1': 1, 'transport_2': 0})
+
+
+class TestLoadBalancingQueueDepth(BaseLoadBalancingTestCase):
+
+    extra_config = {"strategy": "queue_depth", "queue_depth_interval": 5}
+
+    @inlineCallbacks
+    def setUp(self):
+        self.depths = {'transport_1': 10, 'transport_2': 0}
+        self.patch(LoadBalancingRouter, 'get_queue_depth',
+                   lambda _, name: succeed(self.depths[name]))
+        yield super(TestLoadBalancingQueueDepth, self).setUp()
+
+    def test_outbound_message_routing(self):
+        for i in range(3):
+            self.send_outbound('msg %d' % (i,))
+        self.assertEqual(self.routed_contents('transport_2'),
+                         ['msg 0', 'msg 1', 'msg 2'])
+
+        self.depths = {'transport_1': 0, 'transport_2': 10}
+        self.clock.advance(5)
+        self.send_outbound('msg 3')
+        self.assertEqual(self.routed_contents('transport_1'), ['msg 3'])
+
+
+class TestLoadBalancingQueueDepthPoll(BaseLoadBalancingTestCase):
+
+    extra_config = {"strategy": "queue_depth", "queue_depth_interval": 5}
+
+    def make_dispatcher(self, config):
+        dispatcher = DummyDispatcher(config)
+        dispatcher._amqp_client = WorkerHelper.get_fake_amqp_client(None)
+        self.broker = dispatcher._amqp_client.broker
+        return dispatcher
+
+    def fill_queue(self, queue, count):
+        self.broker.exchange_declare('vumi', 'direct')
+        self.broker.queue_declare(queue)
+        self.broker.queue_bind(queue, 'vumi', queue)
+        for i in range(count):
+            self.broker.publish_raw('vumi', queue, 'msg %d' % (i,))
+
+    @inlineCallbacks
+    def test_get_queue_depth(self):
+        self.fill_queue('transport_1.outbound', 3)
+        channels = len(self.broker.channels)
+        self.assertEqual((yield self.router.get_queue_depth('transport_1')), 3)
+        # The channel used for the query is closed again.
+        self.assertEqual(len(self.broker.channels), channels)
+
+    @inlineCallbacks
+    def test_get_queue_depth_missing_queue(self):
+        with LogCatcher() as lc:
+            depth = yield self.router.get_queue_depth('transport_1')
+            [warning] = lc.messages()
+        self.assertEqual(depth, None)
+        self.assertTrue("NOT_FOUND" in warning)
+        self.assertEqual(self.router.queue_depths['transport_1'], 0)
+
+    @inlineCallbacks
+    def test_unknown_queue_depth_keeps_last_depth(self):
+        self.fill_queue('transport_1.outbound', 3)
+        yield self.router.poll_queue_depths()
+        self.assertEqual(self.router.queue_depths, {
+            'transport_1': 3, 'transport_2': 0})
+        del self.broker.queues['transport_1.outbound']
+        with LogCatcher():
+            yield self.router.poll_queue_depths()
+        self.assertEqual(self.router.queue_depths, {
+            'transport_1': 3, 'transport_2': 0})
+
+
+class TestLoadBalancingAckTimeout(BaseLoadBalancingTestCase):
+
+    extra_config = {"ack_timeout": 10}
+
+    def test_unacked_transport_removed_and_restored(self):
+        msg1 = self.send_outbound('msg 1')
+        msg2 = self.send_outbound('msg 2')
+        self.send_ack(msg2)
+        self.clock.advance(10)
+        with LogCatcher() as lc:
+            self.send_outbound('msg 3')
+            self.send_outbound('msg 4')
+            [warning] = lc.messages()
+        self.assertTrue("'transport_1' has not acked" in warning)
+        self.assertEqual(set(self.router.unavailable), set(['transport_1']))
+        self.assertEqual(self.routed_contents('transport_1'), ['msg 1'])
+        self.assertEqual(self.routed_contents('transport_2'),
+                         ['msg 2', 'msg 3', 'msg 4'])
+
+        self.send_ack(msg1)
+        self.assertEqual(set(self.router.unavailable), set())
+        self.send_outbound('msg 5')
+        self.send_outbound('msg 6')
+        self.assertEqual(self.routed_contents('transport_1'),
+                         ['msg 1', 'msg 5'])
+
+    def test_unavailable_transport_probed(self):
+        self.send_outbound('msg 1')
+        msg2 = self.send_outbound('msg 2')
+        self.send_ack(msg2)
+        self.clock.advance(10)
+        msg3 = self.send_outbound('msg 3')
+        self.send_ack(msg3)
+        self.assertEqual(set(self.router.unavailable), set(['transport_1']))
+
+        # One message goes to transport_1 once the probe interval is up.
+        self.clock.advance(10)
+        for i in range(4, 7):
+            self.send_outbound('msg %d' % (i,))
+        self.assertEqual(self.routed_contents('transport_1'),
+                         ['msg 1', 'msg 4'])
+        probe = self.dispatcher.transport_publisher['transport_1'].msgs[-1]
+        self.send_ack(probe)
+        self.assertEqual(set(self.router.unavailable), set())
+
+    def test_all_transports_unavailable(self):
+        self.send_outbound('msg 1')
+        self.send_outbound('msg 2')
+        self.clock.advance(10)
+        self.send_outbound('msg 3')
+        self.send_outbound('msg 4')
+        self.assertEqual(set(self.router.unavailable),
+                         set(['transport_1', 'transport_2']))
+        self.assertEqual(self.routed_contents('transport_1'),
+                         ['msg 1', 'msg 3'])
+        self.assertEqual(self.routed_contents('transport_2'),
+                         ['msg 2', 'msg 4'])
+
+
+class TestLoadBalancingMetrics(BaseLoadBalancingTestCase):
+
+    extra_config = {"ack_timeout": 10, "metrics_prefix": "lb."}
+
+    def setUp(self):
+        self.patch(DummyDispatcher, 'start_publisher',
+                   lambda _, cls, *args: succeed(cls(*args)))
+        return super(TestLoadBalancingMetrics, self).setUp()
+
+    def test_metrics(self):
+        msg1 = self.send_outbound('msg 1')
+        self.send_outbound('msg 2')
+        self.send_outbound('msg 3')
+        self.send_ack(msg1)
+        metrics = self.router.metrics
+        self.assertEqual(
+            [v for _, v in metrics['transport_1.routed'].poll()], [1.0, 1.0])
+        self.assertEqual(
+            [v for _, v in metrics['transport_2.routed'].poll()], [1.0])
+        self.assertEqual(
+            [v for _, v in metrics['transport_1.outstanding'].poll()],
+            [1, 2, 1])
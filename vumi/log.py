@@ -1,15 +1,100 @@
 # -*- test-case-name: vumi.tests.test_log -*-
+"""Levelled logging on top of Twisted's logging system.
+
+Calls below the minimum level set with :func:`set_level` return before
+anything is formatted or passed to Twisted's log observers, so debug
+logging on hot paths is cheap when it's switched off. Workers started
+with ``twistd vumi_worker`` set the level from the ``log_level`` key in
+their config (e.g. ``log_level: info``). To avoid building
+log messages that may be dropped, pass a ``format`` string and keyword
+arguments instead of formatting the message yourself::
+
+    log.debug(format="Sent %(count)d messages to %(addr)s",
+              count=count, addr=addr)
+
+The keyword arguments are added to the Twisted log event, where
+observers can use them as structured data. They mustn't clash with the
+keys Twisted uses itself (such as ``message``, ``system`` or ``time``).
+The message is only formatted if an observer renders the event as text.
+Logging keyword arguments without a message or format renders them as
+``key=value`` pairs::
+
+    log.info(event='window_full', window=window_key, size=size)
+"""
+
 import logging
-from functools import partial
 
 from twisted.python import log
 
 
-debug = partial(log.msg, logLevel=logging.DEBUG)
-info = partial(log.msg, logLevel=logging.INFO)
-warning = partial(log.msg, logLevel=logging.WARNING)
-error = partial(log.err, logLevel=logging.ERROR)
-critical = partial(log.err, logLevel=logging.CRITICAL)
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+_min_level = logging.DEBUG
+
+
+def set_level(level):
+    """Set the minimum level of log calls that are passed on to Twisted.
+
+    :param level:
+        Either a level from the :mod:`logging` module or its name (e.g.
+        ``'info'``).
+    """
+    global _min_level
+    if not isinstance(level, int):
+        if level.lower() not in LEVELS:
+            raise ValueError("Unknown log level %r." % (level,))
+        level = LEVELS[level.lower()]
+    _min_level = level
+
+
+def get_level():
+    """Return the current minimum log level."""
+    return _min_level
+
+
+def enabled_for(level):
+    """Return `True` if calls at the given log level are logged.
+
+    Use this to guard expensive work done only to build a log message.
+    """
+    return level >= _min_level
+
+
+def _key_value_format(kw):
+    return ' '.join('%s=%%(%s)r' % (key, key) for key in sorted(kw))
+
+
+def _msg_logger(level):
+    def logger(*message, **kw):
+        if level < _min_level:
+            return
+        if not message and kw and 'format' not in kw:
+            kw['format'] = _key_value_format(kw)
+        kw.setdefault('logLevel', level)
+        log.msg(*message, **kw)
+    return logger
+
+
+def _err_logger(level):
+    def logger(_stuff=None, _why=None, **kw):
+        if level < _min_level:
+            return
+        kw.setdefault('logLevel', level)
+        log.err(_stuff, _why, **kw)
+    return logger
+
+
+debug = _msg_logger(logging.DEBUG)
+info = _msg_logger(logging.INFO)
+warning = _msg_logger(logging.WARNING)
+error = _err_logger(logging.ERROR)
+critical = _err_logger(logging.CRITICAL)
 
 # make transition from twisted.python.log easier
 msg = info
@@ -1,6 +1,9 @@
 # -*- test-case-name: vumi.middleware.tests.test_logging -*-
 
+from twisted.internet import reactor
+
 from vumi.middleware import BaseMiddleware
+from vumi.errors import ConfigError
 from vumi import log
 
 
@@ -16,29 +19,108 @@ class LoggingMiddleware(BaseMiddleware):
     :param string failure_log_level:
         Log level from :mod:`vumi.log` to log failure messages at.
         Default is `error`.
+    :param bool summary:
+        If true, only the fields listed in `summary_fields` are logged
+        for inbound and outbound messages and events instead of the whole
+        message. Default is false.
+    :param list summary_fields:
+        Message fields to log in summary mode. The special field
+        `content_length` logs the length of the message content. Fields
+        a message doesn't have are left out. Default is
+        ``DEFAULT_SUMMARY_FIELDS``.
+    :param int sample_rate:
+        Log only one in every `sample_rate` inbound and outbound messages
+        and events. Default is 1 (log all of them).
+    :param int max_per_second:
+        Log at most this many inbound and outbound messages and events in
+        each second. Default is no limit.
+
+    Failure messages are always logged in full.
     """
 
+    DEFAULT_SUMMARY_FIELDS = (
+        'message_id', 'event_id', 'from_addr', 'to_addr', 'transport_name',
+        'event_type', 'user_message_id', 'content_length')
+
     def setup_middleware(self):
         log_level = self.config.get('log_level', 'info')
         self.message_logger = getattr(log, log_level)
+        self.message_log_level = log.LEVELS.get(
+            log_level, log.LEVELS['info'])
         failure_log_level = self.config.get('failure_log_level', 'error')
         self.failure_logger = getattr(log, failure_log_level)
 
+        self.summary = self.config.get('summary', False)
+        self.summary_fields = self.config.get(
+            'summary_fields', self.DEFAULT_SUMMARY_FIELDS)
+        self.sample_rate = self.config.get('sample_rate', 1)
+        if self.sample_rate < 1:
+            raise ConfigError("sample_rate must be at least 1, not %r." % (
+                self.sample_rate,))
+        self.max_per_second = self.config.get('max_per_second')
+        if self.max_per_second is not None and self.max_per_second < 1:
+            raise ConfigError("max_per_second must be at least 1, not %r." % (
+                self.max_per_second,))
+        self._seen = 0
+        self._current_second = None
+        self._logged_this_second = 0
+
+    def get_clock(self):
+        return reactor
+
+    def _sampled(self):
+        if not log.enabled_for(self.message_log_level):
+            return False
+        self._seen += 1
+        if (self._seen - 1) % self.sample_rate:
+            return False
+        if self.max_per_second is not None:
+            second = int(self.get_clock().seconds())
+            if second != self._current_second:
+                self._current_second = second
+                self._logged_this_second = 0
+            if self._logged_this_second >= self.max_per_second:
+                return False
+            self._logged_this_second += 1
+        return True
+
+    def _summarise(self, msg):
+        parts = []
+        for field in self.summary_fields:
+            if field == 'content_length':
+                content = msg.get('content')
+                value = len(content) if content is not None else None
+            else:
+                value = msg.get(field)
+            if value is not None:
+                parts.append('%s=%s' % (field, value))
+        return ' '.join(parts)
+
     def _log(self, direction, logger, msg, connector_name):
         logger("Processed %s message for %s: %s" % (
                 direction, connector_name, msg.to_json()))
         return msg
 
+    def _log_message(self, direction, msg, connector_name):
+        if not self._sampled():
+            return msg
+        if not self.summary:
+            return self._log(
+                direction, self.message_logger, msg, connector_name)
+        # The message is passed positionally, because log.err() expects
+        # a failure (or nothing) rather than keyword arguments.
+        self.message_logger("Processed %s message for %s: %s" % (
+            direction, connector_name, self._summarise(msg)))
+        return msg
+
     def handle_inbound(self, message, connector_name):
-        return self._log(
-            "inbound", self.message_logger, message, connector_name)
+        return self._log_message("inbound", message, connector_name)
 
     def handle_outbound(self, message, connector_name):
-        return self._log(
-            "outbound", self.message_logger, message, connector_name)
+        return self._log_message("outbound", message, connector_name)
 
     def handle_event(self, event, connector_name):
-        return self._log("event", self.message_logger, event, connector_name)
+        return self._log_message("event", event, connector_name)
 
     def handle_failure(self, failure, connector_name):
         return self._log(
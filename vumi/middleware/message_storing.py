@@ -1,14 +1,334 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import os
+import json
+from collections import deque
 
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed)
+
+from vumi import log
+from vumi.message import TransportUserMessage, TransportEvent
 from vumi.middleware.base import BaseMiddleware
 from vumi.middleware.tagger import TaggingMiddleware
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.components.message_store import MessageStore
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
+class WriteBehindStore(object):
+    """
+    Buffers writes to a message store and makes them in the background.
+
+    Writes are queued in memory and made by up to `concurrency` writers
+    at a time. Events waiting in the buffer for the same outbound message
+    are stored together, so the message is only loaded once for all of
+    them. Events aren't stored until their outbound message has been, if
+    it is also in the buffer. Callers only have to wait when `max_size`
+    writes are buffered.
+
+    Failed writes stay in the buffer and are retried, starting
+    `RETRY_DELAY` seconds later and doubling the delay after each failure
+    up to `MAX_RETRY_DELAY`.
+
+    :param MessageStore store:
+        The message store to write to.
+    :param int max_size:
+        The maximum number of buffered writes.
+    :param int concurrency:
+        The maximum number of writes to make at once.
+    :param str journal_path:
+        Optional file to record buffered writes in. Writes still recorded
+        in the journal when the process stops are queued again by
+        :meth:`open_journal` the next time it starts. Finished writes are
+        removed from the journal whenever the buffer empties or the
+        journal grows to twice `max_size`.
+    :param clock:
+        An `IReactorTime` provider for scheduling retries. Defaults to
+        the reactor.
+    """
+
+    MESSAGE_CLASSES = {
+        'inbound': TransportUserMessage,
+        'outbound': TransportUserMessage,
+        'event': TransportEvent,
+    }
+
+    RETRY_DELAY = 1.0
+    MAX_RETRY_DELAY = 60.0
+
+    def __init__(self, store, max_size, concurrency, journal_path=None,
+                 clock=None):
+        self.store = store
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.journal_path = journal_path
+        self.clock = clock if clock is not None else reactor
+        self._journal = None
+        self._journal_entries = 0
+        self._entries = {}
+        self._next_entry_id = 0
+        self._writers = 0
+        self._pending = deque()
+        self._pending_events = {}
+        # Outbound message ids with writes in the buffer, and the event
+        # groups held back until those writes are done.
+        self._outbound_entries = {}
+        self._outbound_ids = {}
+        self._held_events = set()
+        self._failures = {}
+        self._retries = {}
+        self._waiting = deque()
+        self._flush_waiters = []
+        self._closing = False
+        self._idle_waiters = []
+
+    def open_journal(self):
+        """
+        Open the journal and queue any writes left in it.
+
+        :returns:
+            The number of writes queued from the journal.
+        """
+        entries = []
+        if os.path.exists(self.journal_path):
+            with open(self.journal_path, 'rb') as journal:
+                for line in journal:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        # We may have died halfway through writing a line.
+                        log.warning("Ignoring bad write-behind journal"
+                                    " entry: %r" % (line,))
+        # We rewrite the journal without any bad entries before we queue
+        # anything, so that dying before the replayed writes are done
+        # doesn't lose them.
+        self._rewrite_journal(entries)
+        for kind, msg_json, tag in entries:
+            msg = self.MESSAGE_CLASSES[kind].from_json(msg_json)
+            # JSON turns our tag tuples into lists.
+            self._enqueue(kind, msg, tuple(tag) if tag is not None else None,
+                          journal=False)
+        return len(entries)
+
+    def close_journal(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def __len__(self):
+        return len(self._entries)
+
+    def put(self, kind, msg, tag=None):
+        """
+        Queue a message or event to be stored.
+
+        :param str kind:
+            One of ``'inbound'``, ``'outbound'`` or ``'event'``.
+
+        :returns:
+            A deferred that fires once the write has been buffered.
+        """
+        if self._closing or (
+                len(self._entries) < self.max_size and not self._waiting):
+            self._enqueue(kind, msg, tag)
+            return succeed(None)
+        d = Deferred()
+        self._waiting.append((d, kind, msg, tag))
+        return d
+
+    def flush(self):
+        """
+        Return a deferred that fires once all buffered writes are done.
+        """
+        if not self._entries and not self._waiting:
+            return succeed(None)
+        d = Deferred()
+        self._flush_waiters.append(d)
+        return d
+
+    @inlineCallbacks
+    def close(self):
+        """
+        Stop retrying failed writes, wait for the writes in progress and
+        close the journal.
+
+        Writes that haven't succeeded are left in the journal to be queued
+        again by :meth:`open_journal`, or are lost if there is no journal.
+        """
+        self._closing = True
+        for delayed_call in self._retries.values():
+            delayed_call.cancel()
+        self._retries.clear()
+        while self._waiting:
+            d, kind, msg, tag = self._waiting.popleft()
+            self._enqueue(kind, msg, tag)
+            d.callback(None)
+        if self._writers:
+            d = Deferred()
+            self._idle_waiters.append(d)
+            yield d
+        if self._entries:
+            if self._journal is not None:
+                log.warning("Leaving %d unstored messages in the"
+                            " write-behind journal." % (len(self._entries),))
+            else:
+                log.warning("Failed to store %d messages." % (
+                    len(self._entries),))
+        if self._journal is not None:
+            self._compact_journal()
+        self.close_journal()
+
+    def _write_journal_entry(self, journal, entry):
+        journal.write(json.dumps(entry) + "\n")
+
+    def _rewrite_journal(self, entries):
+        # We write the new journal alongside the old one and rename it so
+        # that dying halfway through doesn't lose anything.
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, 'wb') as tmp_journal:
+            for entry in entries:
+                self._write_journal_entry(tmp_journal, entry)
+        self.close_journal()
+        os.rename(tmp_path, self.journal_path)
+        self._journal = open(self.journal_path, 'ab')
+        self._journal_entries = len(entries)
+
+    def _compact_journal(self):
+        if not self._entries:
+            self._journal.seek(0)
+            self._journal.truncate()
+            self._journal_entries = 0
+        else:
+            self._rewrite_journal([
+                self._entries[entry_id] for entry_id in sorted(self._entries)])
+
+    def _enqueue(self, kind, msg, tag, journal=True):
+        # Serialising the message takes a snapshot of it, so later changes
+        # made by other middleware don't end up in the store.
+        entry = (kind, msg.to_json(), tag)
+        entry_id = self._next_entry_id
+        self._next_entry_id += 1
+        self._entries[entry_id] = entry
+        if journal and self._journal is not None:
+            self._write_journal_entry(self._journal, entry)
+            self._journal.flush()
+            self._journal_entries += 1
+
+        if kind == 'event':
+            msg_id = msg['user_message_id']
+            if msg_id not in self._pending_events:
+                self._pending_events[msg_id] = []
+                self._pending.append((kind, msg_id))
+            self._pending_events[msg_id].append(entry_id)
+        else:
+            if kind == 'outbound':
+                msg_id = msg['message_id']
+                self._outbound_entries[entry_id] = msg_id
+                self._outbound_ids[msg_id] = (
+                    self._outbound_ids.get(msg_id, 0) + 1)
+            self._pending.append((kind, entry_id))
+        self._start_writers()
+
+    def _start_writers(self):
+        while self._writers < self.concurrency and self._pending:
+            self._writers += 1
+            self._write_pending()
+
+    def _store(self, kind, entries):
+        if kind == 'event':
+            return self.store.add_events([
+                TransportEvent.from_json(msg_json)
+                for _kind, msg_json, _tag in entries])
+        [(_kind, msg_json, tag)] = entries
+        msg = TransportUserMessage.from_json(msg_json)
+        if kind == 'inbound':
+            return self.store.add_inbound_message(msg, tag=tag)
+        return self.store.add_outbound_message(msg, tag=tag)
+
+    @inlineCallbacks
+    def _write_pending(self):
+        while self._pending:
+            kind, key = self._pending.popleft()
+            if kind == 'event':
+                if key in self._outbound_ids:
+                    # The message store needs the outbound message to add
+                    # its events, so we wait until it has been stored.
+                    self._held_events.add(key)
+                    continue
+                entry_ids = self._pending_events.pop(key)
+            else:
+                entry_ids = [key]
+            try:
+                yield self._store(
+                    kind, [self._entries[entry_id] for entry_id in entry_ids])
+            except Exception:
+                log.err(None, "Error storing %s message." % (kind,))
+                self._write_failed(kind, key, entry_ids)
+            else:
+                self._failures.pop((kind, key), None)
+                if kind == 'outbound':
+                    self._outbound_stored(key)
+                self._release(entry_ids)
+        self._writers -= 1
+        if not self._writers:
+            idle_waiters, self._idle_waiters = self._idle_waiters, []
+            for d in idle_waiters:
+                d.callback(None)
+
+    def _write_failed(self, kind, key, entry_ids):
+        if kind == 'event':
+            # Any events that arrived while we were writing these are
+            # retried along with them.
+            self._pending_events[key] = (
+                entry_ids + self._pending_events.get(key, []))
+            if len(self._pending_events[key]) > len(entry_ids):
+                # The newer events are already queued, so we wait for
+                # them to come up instead.
+                return
+        if self._closing:
+            return
+        failures = self._failures.get((kind, key), 0) + 1
+        self._failures[(kind, key)] = failures
+        delay = min(self.RETRY_DELAY * 2 ** (failures - 1),
+                    self.MAX_RETRY_DELAY)
+        self._retries[(kind, key)] = self.clock.callLater(
+            delay, self._retry, kind, key)
+
+    def _retry(self, kind, key):
+        del self._retries[(kind, key)]
+        self._pending.append((kind, key))
+        self._start_writers()
+
+    def _outbound_stored(self, entry_id):
+        msg_id = self._outbound_entries.pop(entry_id)
+        self._outbound_ids[msg_id] -= 1
+        if not self._outbound_ids[msg_id]:
+            del self._outbound_ids[msg_id]
+            if msg_id in self._held_events:
+                self._held_events.remove(msg_id)
+                self._pending.append(('event', msg_id))
+                self._start_writers()
+
+    def _release(self, entry_ids):
+        for entry_id in entry_ids:
+            del self._entries[entry_id]
+        while self._waiting and len(self._entries) < self.max_size:
+            d, kind, msg, tag = self._waiting.popleft()
+            self._enqueue(kind, msg, tag)
+            d.callback(None)
+        if self._journal is not None and (
+                not self._entries or
+                self._journal_entries >= 2 * self.max_size):
+            self._compact_journal()
+        if not self._entries:
+            flush_waiters, self._flush_waiters = self._flush_waiters, []
+            for d in flush_waiters:
+                d.callback(None)
+
+
 class StoringMiddleware(BaseMiddleware):
     """
     Middleware for storing inbound and outbound messages and events.
@@ -35,6 +355,33 @@ class StoringMiddleware(BaseMiddleware):
     :param dict riak:
         Riak configuration parameters. Must contain at least
         a bucket_prefix key.
+    :param bool write_behind:
+        If true, messages are passed on without waiting for them to be
+        stored and are stored in the background instead (see
+        :class:`WriteBehindStore`). Default is False.
+    :param int write_behind_buffer_size:
+        The maximum number of messages and events waiting to be stored
+        before messages are held up. Default is 1000.
+    :param int write_behind_concurrency:
+        The maximum number of messages and events to store at once.
+        Default is 4.
+    :param string write_behind_journal:
+        File to record messages and events waiting to be stored in, so
+        that they're stored after a restart if the process dies or they
+        still couldn't be stored when the worker stopped. Default is not
+        to keep a journal.
+    :param int tag_cache_size:
+        Number of tag to batch mappings to cache (see
+        :class:`vumi.components.message_store.MessageStore`). Default is 0,
+        which disables the cache.
+    :param float tag_cache_ttl:
+        Seconds to cache tag to batch mappings for. Default is 60.
+    :param float tag_cache_check_interval:
+        Seconds between checks for batches started or finished elsewhere.
+        Default is 1.
+    :param string metrics_prefix:
+        If set, tag cache hits and misses are published as metrics with
+        this prefix. Default is not to publish metrics.
     """
 
     @inlineCallbacks
@@ -43,23 +390,58 @@ class StoringMiddleware(BaseMiddleware):
         r_config = self.config.get('redis_manager', {})
         self.redis = yield TxRedisManager.from_config(r_config)
         manager = TxRiakManager.from_config(self.config.get('riak_manager'))
-        self.store = MessageStore(manager,
-                                  self.redis.sub_manager(store_prefix))
+        self.metrics = None
+        metrics_prefix = self.config.get('metrics_prefix')
+        if metrics_prefix is not None:
+            self.metrics = yield self.worker.start_publisher(
+                MetricManager, metrics_prefix)
+        self.store = MessageStore(
+            manager, self.redis.sub_manager(store_prefix),
+            tag_cache_size=self.config.get('tag_cache_size', 0),
+            tag_cache_ttl=self.config.get('tag_cache_ttl'),
+            tag_cache_check_interval=self.config.get(
+                'tag_cache_check_interval'),
+            metrics=self.metrics)
+        self.write_behind = None
+        if self.config.get('write_behind', False):
+            self.write_behind = WriteBehindStore(
+                self.store,
+                self.config.get('write_behind_buffer_size', 1000),
+                self.config.get('write_behind_concurrency', 4),
+                self.config.get('write_behind_journal'))
+            if self.write_behind.journal_path is not None:
+                replayed = self.write_behind.open_journal()
+                if replayed:
+                    log.info("Storing %d messages left in the write-behind"
+                             " journal." % (replayed,))
 
     @inlineCallbacks
     def teardown_middleware(self):
+        if self.write_behind is not None:
+            yield self.write_behind.close()
+        if self.metrics is not None:
+            self.metrics.stop()
         yield self.redis.close_manager()
 
+    def _store(self, kind, message, tag=None):
+        if self.write_behind is not None:
+            return self.write_behind.put(kind, message, tag)
+        if kind == 'inbound':
+            return self.store.add_inbound_message(message, tag=tag)
+        if kind == 'outbound':
+            return self.store.add_outbound_message(message, tag=tag)
+        return self.store.add_event(message)
+
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        yield self._store('inbound', message, tag)
         returnValue(message)
 
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        yield self._store('outbound', message, tag)
         returnValue(message)
 
     @inlineCallbacks
@@ -72,5 +454,5 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        yield self._store('event', event)
         returnValue(event)
@@ -1,8 +1,12 @@
 """Tests from vumi.middleware.logging."""
 
+from twisted.internet.task import Clock
+
+from vumi import log
+from vumi.errors import ConfigError
 from vumi.middleware.logging import LoggingMiddleware
 from vumi.tests.utils import LogCatcher
-from vumi.tests.helpers import VumiTestCase
+from vumi.tests.helpers import VumiTestCase, MessageHelper
 
 
 class DummyMessage(object):
@@ -65,3 +69,109 @@ class TestLoggingMiddleware(VumiTestCase):
         self.assertEqual([log['message'][0] for log in logs], [
             "Processed failure message for dummy_connector: failure",
             ])
+
+
+class TestLoggingMiddlewareSummary(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.msg_helper = MessageHelper()
+
+    def mklogger(self, config):
+        worker = object()
+        mw = LoggingMiddleware("test_logger", config, worker)
+        mw.get_clock = lambda: self.clock
+        mw.setup_middleware()
+        return mw
+
+    def test_summary(self):
+        mw = self.mklogger({'summary': True})
+        msg = self.msg_helper.make_inbound("hello")
+        ack = self.msg_helper.make_ack(msg)
+        with LogCatcher() as lc:
+            mw.handle_inbound(msg, "dummy_connector")
+            mw.handle_event(ack, "dummy_connector")
+        self.assertEqual(lc.messages(), [
+            "Processed inbound message for dummy_connector: message_id=%s"
+            " from_addr=+41791234567 to_addr=9292 transport_name=sphex"
+            " content_length=5" % (msg['message_id'],),
+            "Processed event message for dummy_connector: event_id=%s"
+            " transport_name=sphex event_type=ack user_message_id=%s" % (
+                ack['event_id'], msg['message_id']),
+        ])
+
+    def test_summary_fields(self):
+        mw = self.mklogger({
+            'summary': True,
+            'summary_fields': ['to_addr', 'content_length'],
+        })
+        msg = self.msg_helper.make_outbound(None)
+        with LogCatcher() as lc:
+            result = mw.handle_outbound(msg, "dummy_connector")
+        self.assertEqual(result, msg)
+        self.assertEqual(lc.messages(), [
+            "Processed outbound message for dummy_connector:"
+            " to_addr=+41791234567",
+        ])
+
+    def test_summary_at_error_level(self):
+        mw = self.mklogger({'summary': True, 'log_level': 'error'})
+        msg = self.msg_helper.make_inbound("hello")
+        with LogCatcher() as lc:
+            result = mw.handle_inbound(msg, "dummy_connector")
+        self.assertEqual(result, msg)
+        [error] = lc.errors
+        self.assertTrue(
+            "Processed inbound message for dummy_connector: message_id=%s" % (
+                msg['message_id'],) in " ".join(error['message']))
+
+    def test_summary_doesnt_serialise_message(self):
+        mw = self.mklogger({'summary': True})
+        msg = self.msg_helper.make_inbound("hello")
+        self.patch(msg, 'to_json', lambda: self.fail("Serialised message."))
+        with LogCatcher() as lc:
+            mw.handle_inbound(msg, "dummy_connector")
+        self.assertEqual(len(lc.messages()), 1)
+
+    def test_sample_rate(self):
+        mw = self.mklogger({'summary': True, 'sample_rate': 3})
+        msgs = [self.msg_helper.make_inbound("hi") for _ in range(7)]
+        with LogCatcher() as lc:
+            for msg in msgs:
+                mw.handle_inbound(msg, "dummy_connector")
+        self.assertEqual(len(lc.messages()), 3)
+        for msg, line in zip([msgs[0], msgs[3], msgs[6]], lc.messages()):
+            self.assertTrue(msg['message_id'] in line)
+
+    def test_max_per_second(self):
+        mw = self.mklogger({'max_per_second': 2})
+        with LogCatcher() as lc:
+            for _ in range(3):
+                mw.handle_inbound(DummyMessage("inbound"), "dummy_connector")
+            self.clock.advance(1)
+            for _ in range(3):
+                mw.handle_inbound(DummyMessage("inbound"), "dummy_connector")
+        self.assertEqual(len(lc.messages()), 4)
+
+    def test_invalid_sample_rate(self):
+        self.assertRaises(ConfigError, self.mklogger, {'sample_rate': 0})
+
+    def test_invalid_max_per_second(self):
+        self.assertRaises(ConfigError, self.mklogger, {'max_per_second': 0})
+
+    def test_failures_not_sampled(self):
+        mw = self.mklogger({'sample_rate': 10, 'failure_log_level': 'info'})
+        with LogCatcher() as lc:
+            for _ in range(3):
+                mw.handle_failure(DummyMessage("failure"), "dummy_connector")
+        self.assertEqual(len(lc.messages()), 3)
+
+    def test_below_log_level(self):
+        self.add_cleanup(log.set_level, log.get_level())
+        log.set_level('warning')
+        mw = self.mklogger({})
+        msg = DummyMessage("inbound")
+        self.patch(msg, 'to_json', lambda: self.fail("Serialised message."))
+        with LogCatcher() as lc:
+            mw.handle_inbound(msg, "dummy_connector")
+        self.assertEqual(lc.logs, [])
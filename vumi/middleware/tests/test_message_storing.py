@@ -1,20 +1,25 @@
 """Tests for vumi.middleware.message_storing."""
 
-from twisted.internet.defer import inlineCallbacks
+import json
+
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.task import Clock
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.message import TransportUserMessage, TransportEvent
-from vumi.tests.helpers import VumiTestCase, PersistenceHelper
+from vumi.tests.helpers import VumiTestCase, PersistenceHelper, import_skip
 
 
 class TestStoringMiddleware(VumiTestCase):
 
+    config = {}
+
     @inlineCallbacks
     def setUp(self):
         self.persistence_helper = PersistenceHelper(use_riak=True)
         self.add_cleanup(self.persistence_helper.cleanup)
         dummy_worker = object()
-        config = self.persistence_helper.mk_config({})
+        config = self.persistence_helper.mk_config(self.config)
 
         # Create and stash a riak manager to clean up afterwards, because we
         # don't get access to the one inside the middleware.
@@ -113,3 +118,285 @@ class TestStoringMiddleware(VumiTestCase):
         response = yield self.mw.handle_event(ack, "dummy_connector")
         self.assertTrue(isinstance(response, TransportEvent))
         yield self.assert_outbound_stored(msg, events=[event_id])
+
+
+class TestStoringMiddlewareTagCache(TestStoringMiddleware):
+
+    config = {'tag_cache_size': 10}
+
+    def test_tag_cache_enabled(self):
+        self.assertEqual(self.store.tag_cache.max_size, 10)
+
+
+class TestStoringMiddlewareWriteBehind(TestStoringMiddleware):
+
+    config = {'write_behind': True}
+
+    @inlineCallbacks
+    def assert_outbound_stored(self, *args, **kw):
+        yield self.mw.write_behind.flush()
+        yield super(TestStoringMiddlewareWriteBehind,
+                    self).assert_outbound_stored(*args, **kw)
+
+    @inlineCallbacks
+    def assert_inbound_stored(self, *args, **kw):
+        yield self.mw.write_behind.flush()
+        yield super(TestStoringMiddlewareWriteBehind,
+                    self).assert_inbound_stored(*args, **kw)
+
+
+class RecordingStore(object):
+    """Message store stand-in that records writes and lets tests finish
+    them."""
+
+    def __init__(self):
+        self.writes = []
+
+    def record(self, *args):
+        d = Deferred()
+        self.writes.append((args, d))
+        return d
+
+    def add_inbound_message(self, msg, tag=None):
+        return self.record('inbound', msg['message_id'], tag)
+
+    def add_outbound_message(self, msg, tag=None):
+        return self.record('outbound', msg['message_id'], tag)
+
+    def add_events(self, events):
+        return self.record('events', [e['event_id'] for e in events])
+
+    def finish_write(self, index=0, result=None):
+        args, d = self.writes.pop(index)
+        d.callback(result)
+        return args
+
+
+class TestWriteBehindStore(VumiTestCase):
+
+    def setUp(self):
+        try:
+            from vumi.middleware.message_storing import WriteBehindStore
+        except ImportError, e:
+            import_skip(e, 'riakasaurus', 'riakasaurus.riak')
+        self.store = RecordingStore()
+        self.write_behind_cls = WriteBehindStore
+        self.clock = Clock()
+
+    def mk_write_behind(self, max_size=10, concurrency=1, journal_path=None):
+        write_behind = self.write_behind_cls(
+            self.store, max_size, concurrency, journal_path, clock=self.clock)
+        self.add_cleanup(write_behind.close_journal)
+        return write_behind
+
+    def mk_msg(self, content="hi"):
+        return TransportUserMessage(to_addr="45678", from_addr="12345",
+                                    transport_name="dummy_connector",
+                                    transport_type="dummy_transport_type",
+                                    content=content)
+
+    def mk_ack(self, msg):
+        return TransportEvent(event_type="ack",
+                              user_message_id=msg['message_id'],
+                              sent_message_id="1")
+
+    def assert_fired(self, d):
+        fired = []
+        d.addCallback(fired.append)
+        self.assertEqual(fired, [None])
+
+    def assert_not_fired(self, d):
+        fired = []
+        d.addCallback(fired.append)
+        self.assertEqual(fired, [])
+
+    def test_put(self):
+        write_behind = self.mk_write_behind()
+        msg = self.mk_msg()
+        self.assert_fired(write_behind.put('outbound', msg, ("pool", "tag")))
+        self.assertEqual(len(write_behind), 1)
+        self.assertEqual(self.store.finish_write(), (
+            'outbound', msg['message_id'], ("pool", "tag")))
+        self.assertEqual(len(write_behind), 0)
+
+    def test_put_snapshots_message(self):
+        write_behind = self.mk_write_behind()
+        # This keeps our only writer busy while the message is queued.
+        write_behind.put('inbound', self.mk_msg())
+        msg = self.mk_msg()
+        msg_id = msg['message_id']
+        write_behind.put('inbound', msg)
+        msg['message_id'] = 'changed'
+        self.store.finish_write()
+        self.assertEqual(self.store.finish_write(), ('inbound', msg_id, None))
+
+    def test_concurrency(self):
+        write_behind = self.mk_write_behind(concurrency=2)
+        for i in range(3):
+            write_behind.put('inbound', self.mk_msg())
+        self.assertEqual(len(self.store.writes), 2)
+        self.store.finish_write()
+        self.assertEqual(len(self.store.writes), 2)
+        self.store.finish_write()
+        self.store.finish_write()
+        self.assertEqual(len(write_behind), 0)
+
+    def test_back_pressure(self):
+        write_behind = self.mk_write_behind(max_size=2)
+        self.assert_fired(write_behind.put('inbound', self.mk_msg()))
+        self.assert_fired(write_behind.put('inbound', self.mk_msg()))
+        d3 = write_behind.put('inbound', self.mk_msg())
+        d4 = write_behind.put('inbound', self.mk_msg())
+        self.assert_not_fired(d3)
+        self.assertEqual(len(write_behind), 2)
+
+        self.store.finish_write()
+        self.assert_fired(d3)
+        self.assert_not_fired(d4)
+        self.store.finish_write()
+        self.assert_fired(d4)
+
+    def test_events_coalesced(self):
+        write_behind = self.mk_write_behind()
+        msg1, msg2 = self.mk_msg(), self.mk_msg()
+        # This keeps our only writer busy while the events are queued.
+        write_behind.put('outbound', msg1)
+        acks1 = [self.mk_ack(msg1) for i in range(3)]
+        ack2 = self.mk_ack(msg2)
+        for ack in acks1 + [ack2]:
+            write_behind.put('event', ack)
+        self.assertEqual(len(write_behind), 5)
+
+        self.store.finish_write()
+        self.assertEqual(self.store.finish_write(), (
+            'events', [ack['event_id'] for ack in acks1]))
+        self.assertEqual(self.store.finish_write(), (
+            'events', [ack2['event_id']]))
+        self.assertEqual(len(write_behind), 0)
+
+    def test_flush(self):
+        write_behind = self.mk_write_behind()
+        self.assert_fired(write_behind.flush())
+        write_behind.put('inbound', self.mk_msg())
+        d = write_behind.flush()
+        self.assert_not_fired(d)
+        self.store.finish_write()
+        self.assert_fired(d)
+
+    def fail_write(self, index=0):
+        args, d = self.store.writes.pop(index)
+        d.errback(ValueError("Riak is down."))
+        [failure] = self.flushLoggedErrors(ValueError)
+        return args
+
+    def test_failed_write(self):
+        write_behind = self.mk_write_behind()
+        msg = self.mk_msg()
+        write_behind.put('inbound', msg)
+        write_behind.put('inbound', self.mk_msg())
+        self.fail_write()
+        self.assertEqual(len(write_behind), 2)
+        self.store.finish_write()
+        self.assertEqual(len(write_behind), 1)
+
+        # The failed write is retried with increasing delays.
+        self.clock.advance(1)
+        self.assertEqual(
+            self.fail_write(), ('inbound', msg['message_id'], None))
+        self.clock.advance(1)
+        self.assertEqual(self.store.writes, [])
+        self.clock.advance(1)
+        self.assertEqual(
+            self.store.finish_write(), ('inbound', msg['message_id'], None))
+        self.assertEqual(len(write_behind), 0)
+
+    def test_events_wait_for_outbound(self):
+        write_behind = self.mk_write_behind(concurrency=2)
+        msg = self.mk_msg()
+        ack = self.mk_ack(msg)
+        write_behind.put('outbound', msg)
+        write_behind.put('event', ack)
+        self.assertEqual(len(self.store.writes), 1)
+        self.fail_write()
+
+        # The event waits while the outbound message is retried.
+        self.assertEqual(self.store.writes, [])
+        self.clock.advance(1)
+        self.assertEqual(
+            self.store.finish_write(), ('outbound', msg['message_id'], None))
+        self.assertEqual(
+            self.store.finish_write(), ('events', [ack['event_id']]))
+        self.assertEqual(len(write_behind), 0)
+
+    @inlineCallbacks
+    def test_close(self):
+        journal_path = self.mktemp()
+        write_behind = self.mk_write_behind(journal_path=journal_path)
+        write_behind.open_journal()
+        msg = self.mk_msg()
+        write_behind.put('inbound', msg)
+        self.fail_write()
+
+        yield write_behind.close()
+        self.clock.advance(1)
+        self.assertEqual(self.store.writes, [])
+        self.assertEqual(self.read_journal(journal_path), [
+            ['inbound', msg.to_json(), None],
+        ])
+
+    def read_journal(self, journal_path):
+        with open(journal_path, 'rb') as journal:
+            return [json.loads(line) for line in journal]
+
+    def test_journal(self):
+        journal_path = self.mktemp()
+        write_behind = self.mk_write_behind(journal_path=journal_path)
+        self.assertEqual(write_behind.open_journal(), 0)
+        msg = self.mk_msg()
+        write_behind.put('outbound', msg, ("pool", "tag"))
+        self.assertEqual(self.read_journal(journal_path), [
+            ['outbound', msg.to_json(), ["pool", "tag"]],
+        ])
+        self.store.finish_write()
+        self.assertEqual(self.read_journal(journal_path), [])
+
+    def test_journal_replay(self):
+        journal_path = self.mktemp()
+        msg = self.mk_msg()
+        ack = self.mk_ack(msg)
+        with open(journal_path, 'wb') as journal:
+            journal.write(json.dumps(
+                ['outbound', msg.to_json(), ["pool", "tag"]]) + "\n")
+            journal.write(json.dumps(['event', ack.to_json(), None]) + "\n")
+            journal.write('["inbound", "trunca')
+
+        write_behind = self.mk_write_behind(journal_path=journal_path)
+        self.assertEqual(write_behind.open_journal(), 2)
+        # The replayed writes stay in the journal until they're done.
+        self.assertEqual(self.read_journal(journal_path), [
+            ['outbound', msg.to_json(), ["pool", "tag"]],
+            ['event', ack.to_json(), None],
+        ])
+        self.assertEqual(self.store.finish_write(), (
+            'outbound', msg['message_id'], ("pool", "tag")))
+        self.assertEqual(self.store.finish_write(), (
+            'events', [ack['event_id']]))
+        self.assertEqual(self.read_journal(journal_path), [])
+
+    def test_journal_compaction(self):
+        journal_path = self.mktemp()
+        write_behind = self.mk_write_behind(
+            max_size=2, journal_path=journal_path)
+        write_behind.open_journal()
+        msgs = [self.mk_msg(content=str(i)) for i in range(4)]
+        write_behind.put('inbound', msgs[0])
+        write_behind.put('inbound', msgs[1])
+        self.store.finish_write()
+        write_behind.put('inbound', msgs[2])
+        self.store.finish_write()
+        write_behind.put('inbound', msgs[3])
+        self.assertEqual(len(self.read_journal(journal_path)), 4)
+        self.store.finish_write()
+        self.assertEqual(self.read_journal(journal_path), [
+            ['inbound', msgs[3].to_json(), None],
+        ])
@@ -1,8 +1,59 @@
 # -*- test-case-name: vumi.tests.test_multiworker -*-
 
+import os
+import sys
+import shutil
+import tempfile
 from copy import deepcopy
 
+import yaml
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed, inlineCallbacks
+from twisted.runner.procmon import ProcessMonitor
+
 from vumi.service import Worker, WorkerCreator
+from vumi.blinkenlights.metrics import MetricManager, Metric, LAST
+from vumi import log
+
+
+class ChildProcessMonitor(ProcessMonitor):
+    """A process monitor for a :class:`MultiWorker`'s subprocess children.
+
+    Processes are restarted when they exit while the monitor is running.
+    Stopping the monitor sends each process ``SIGTERM``, which twistd
+    handles by stopping the worker cleanly, and ``SIGKILL`` if it hasn't
+    exited after ``killTime`` seconds. :meth:`stopService` returns a
+    deferred that fires once every process has exited.
+    """
+
+    def __init__(self, reactor=reactor):
+        ProcessMonitor.__init__(self, reactor=reactor)
+        self.restarts = {}
+        self._stop_waiters = []
+
+    def addProcess(self, name, args, uid=None, gid=None, env={}):
+        self.restarts[name] = 0
+        ProcessMonitor.addProcess(self, name, args, uid, gid, env)
+
+    def connectionLost(self, name):
+        if self.running and name in self.processes:
+            self.restarts[name] += 1
+            log.warning(
+                format="Child worker process %(child)s exited, restarting.",
+                child=name)
+        ProcessMonitor.connectionLost(self, name)
+        if not self.running and not self.protocols:
+            stop_waiters, self._stop_waiters = self._stop_waiters, []
+            for d in stop_waiters:
+                d.callback(None)
+
+    def stopService(self):
+        ProcessMonitor.stopService(self)
+        if not self.protocols:
+            return succeed(None)
+        d = Deferred()
+        self._stop_waiters.append(d)
+        return d
 
 
 class MultiWorker(Worker):
@@ -16,14 +67,42 @@ class MultiWorker(Worker):
     :type defaults: dict
     :param defaults:
         Default configuration for child workers.
+    :type processes: dict
+    :param processes:
+        Dict of worker_name -> number of replicas. Child workers listed
+        here are run in separate processes instead of in this one, so
+        that CPU-heavy children don't slow their siblings down. Each
+        process is restarted if it exits.
+    :type process_kill_time: float
+    :param process_kill_time:
+        Seconds to give a child process to stop cleanly before it is
+        killed. Default is 5.
+    :type process_max_restart_delay: float
+    :param process_max_restart_delay:
+        The longest time in seconds to wait before restarting a child
+        process that keeps exiting as soon as it starts. Default is 60.
+    :type metrics_prefix: str
+    :param metrics_prefix:
+        Prefix for the metrics published about child processes. Default is
+        ``vumi.multiworker.``. For each child worker in ``processes``, the
+        number of ``<worker_name>.replicas``, how many are
+        ``<worker_name>.running`` and the total number of
+        ``<worker_name>.restarts`` are published.
 
     Each entry in the ``workers`` config dict defines a child worker to start.
     A child worker's configuration should be provided in a config dict keyed by
     its name. Common configuration across child workers should go in the
     ``defaults`` config dict.
+
+    Replicas of a child worker all get the same config, so they publish
+    heartbeats and metrics as instances of the same worker.
     """
 
     WORKER_CREATOR = WorkerCreator
+    PROCESS_MONITOR = ChildProcessMonitor
+
+    process_monitor = None
+    metrics = None
 
     def construct_worker_config(self, worker_name):
         """
@@ -43,13 +122,139 @@ class MultiWorker(Worker):
         worker.setServiceParent(self)
         return worker
 
+    def worker_process_args(self, worker_name, worker_class, config_file,
+                            vumi_config_file):
+        """
+        Build the command line that runs a child worker in its own process.
+        """
+        return [sys.executable, '-c',
+                'from twisted.scripts.twistd import run; run()',
+                '--nodaemon', '--pidfile=', 'vumi_worker',
+                '--worker-class', worker_class, '--config', config_file,
+                '--vumi-config', vumi_config_file]
+
+    def write_vumi_config(self):
+        """
+        Write our vumi options to a file for child processes and return the
+        file's path.
+
+        The options include the AMQP password, so they go in our private
+        config directory rather than on the child's command line, where
+        any user could see them.
+        """
+        config_file = os.path.join(self._config_dir, 'vumi.yaml')
+        options = dict((key, value) for key, value in self.options.items()
+                       if value is not None)
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(options, f)
+        return config_file
+
+    def write_worker_config(self, worker_name):
+        """
+        Write a child worker's config to a file and return the file's path.
+        """
+        config_file = os.path.join(self._config_dir, '%s.yaml' % (
+            worker_name,))
+        with open(config_file, 'w') as f:
+            yaml.safe_dump(self.construct_worker_config(worker_name), f)
+        return config_file
+
+    def create_worker_processes(self, worker_name, worker_class, replicas):
+        """
+        Add processes running `replicas` copies of a child worker to the
+        process monitor.
+        """
+        config_file = self.write_worker_config(worker_name)
+        args = self.worker_process_args(
+            worker_name, worker_class, config_file, self._vumi_config_file)
+        names = []
+        for i in range(replicas):
+            name = '%s.%s' % (worker_name, i)
+            self.process_monitor.addProcess(name, args, env=os.environ)
+            names.append(name)
+        return names
+
+    def create_process_monitor(self):
+        monitor = self.PROCESS_MONITOR()
+        monitor.killTime = self.config.get('process_kill_time', 5)
+        monitor.maxRestartDelay = self.config.get(
+            'process_max_restart_delay', 60)
+        monitor.setName('process_monitor')
+        return monitor
+
     def startService(self):
         super(MultiWorker, self).startService()
         self.workers = []
+        self.worker_processes = {}
         self.worker_creator = self.WORKER_CREATOR(self.options)
+        processes = self.config.get('processes', {})
+        if processes:
+            self._config_dir = tempfile.mkdtemp(prefix='vumi-multiworker-')
+            self._vumi_config_file = self.write_vumi_config()
+            self.process_monitor = self.create_process_monitor()
         for wname, wclass in self.config.get('workers', {}).items():
-            worker = self.create_worker(wname, wclass)
-            self.workers.append(worker)
+            if wname in processes:
+                self.worker_processes[wname] = self.create_worker_processes(
+                    wname, wclass, processes[wname])
+            else:
+                worker = self.create_worker(wname, wclass)
+                self.workers.append(worker)
+        if self.process_monitor is not None:
+            self.process_monitor.setServiceParent(self)
+
+    def stopService(self):
+        d = super(MultiWorker, self).stopService()
+        if self.process_monitor is not None:
+            d.addBoth(self._remove_config_dir)
+        return d
+
+    def _remove_config_dir(self, result):
+        shutil.rmtree(self._config_dir, ignore_errors=True)
+        return result
 
+    def child_status(self):
+        """
+        Return a dict of worker_name -> status for child workers running in
+        subprocesses. Each status has the number of ``replicas``, how many
+        are ``running`` and how many ``restarts`` there have been in total.
+        """
+        status = {}
+        for wname, names in self.worker_processes.iteritems():
+            status[wname] = {
+                'replicas': len(names),
+                'running': len([n for n in names
+                                if n in self.process_monitor.protocols]),
+                'restarts': sum(self.process_monitor.restarts[n]
+                                for n in names),
+            }
+        return status
+
+    @inlineCallbacks
     def startWorker(self):
-        pass
+        if self.process_monitor is None:
+            return
+        self.metrics = yield self.start_publisher(
+            MetricManager,
+            self.config.get('metrics_prefix', 'vumi.multiworker.'),
+            on_publish=self.update_child_metrics)
+        for wname in self.worker_processes:
+            for key in ('replicas', 'running', 'restarts'):
+                self.metrics.register(
+                    Metric('%s.%s' % (wname, key), [LAST]))
+        self.update_child_metrics(self.metrics)
+
+    def stopWorker(self):
+        if self.metrics is not None:
+            self.metrics.stop()
+            self.metrics = None
+
+    def update_child_metrics(self, metrics):
+        """
+        Set the child process metrics to the current :meth:`child_status`.
+
+        This is called each time the metrics are published, so the values
+        published are as of the previous publish.
+        """
+        for wname, status in self.child_status().iteritems():
+            for key, value in status.iteritems():
+                metrics['%s.%s' % (wname, key)].set(value)
@@ -87,14 +87,58 @@ class FakeRedis(object):
     def exists(self, key):
         return key in self._data
 
+    @maybe_async
+    def rename(self, key, newkey):
+        if key not in self._data:
+            raise ValueError("ERR no such key")
+        delayed = self._expiries.get(key)
+        remaining = None
+        if delayed is not None and delayed.active():
+            remaining = delayed.getTime() - self.clock.seconds()
+        self.persist.sync(self, key)
+        self.persist.sync(self, newkey)
+        self._data[newkey] = self._data.pop(key)
+        if remaining is not None:
+            self.expire.sync(self, newkey, remaining)
+        return True
+
     @maybe_async
     def keys(self, pattern='*'):
         return fnmatch.filter(self._data.keys(), pattern)
 
+    @maybe_async
+    def scan(self, cursor, match=None, count=None):
+        # We use an offset into the sorted keys as our cursor. This is
+        # enough for iterating over keys that don't change while we're
+        # scanning, which is all we need in tests.
+        if count is None:
+            count = 10
+        start = int(cursor)
+        keys = sorted(self._data.keys())
+        if match is not None:
+            keys = fnmatch.filter(keys, match)
+        end = start + count
+        if end >= len(keys):
+            end = 0
+            batch = keys[start:]
+        else:
+            batch = keys[start:end]
+        return end, batch
+
     @maybe_async
     def flushdb(self):
         self._data = {}
 
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self)
+
+    @maybe_async
+    def _execute_pipeline(self, calls):
+        # Nothing else can happen while we're running these, so they're
+        # trivially atomic.
+        return [getattr(self, call).sync(self, *args, **kw)
+                for call, args, kw in calls]
+
     # String operations
 
     @maybe_async
@@ -184,6 +228,7 @@ class FakeRedis(object):
     def hmset(self, key, mapping):
         hval = self._data.setdefault(key, {})
         hval.update(dict([(k, v) for k, v in mapping.items()]))
+        return True
 
     @maybe_async
     def hgetall(self, key):
@@ -273,6 +318,14 @@ class FakeRedis(object):
         zval = self._data.setdefault(key, Zset())
         return zval.zrem(value)
 
+    @maybe_async
+    def zremrangebyscore(self, key, min, max):
+        zval = self._data.get(key, Zset())
+        values = [v for v, k in zval.zrangebyscore(min, max)]
+        for value in values:
+            zval.zrem(value)
+        return len(values)
+
     @maybe_async
     def zcard(self, key):
         zval = self._data.get(key, Zset())
@@ -329,8 +382,10 @@ class FakeRedis(object):
         self._data.setdefault(key, []).insert(0, obj)
 
     @maybe_async
-    def rpush(self, key, obj):
-        self._data.setdefault(key, []).append(obj)
+    def rpush(self, key, obj, *objs):
+        lval = self._data.setdefault(key, [])
+        lval.append(obj)
+        lval.extend(objs)
         return self.llen.sync(self, key) - 1
 
     @maybe_async
@@ -406,6 +461,29 @@ class FakeRedis(object):
         return 0
 
 
+class FakeRedisPipeline(object):
+    """A fake of the Python redis module's pipeline.
+
+    Calls are recorded and only made when :meth:`execute` is called.
+    """
+
+    def __init__(self, fake_redis):
+        self._redis = fake_redis
+        self._calls = []
+
+    def __getattr__(self, name):
+        if not hasattr(self._redis, name):
+            raise AttributeError(name)
+
+        def record_call(*args, **kw):
+            self._calls.append((name, args, kw))
+        return record_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        return self._redis._execute_pipeline(calls)
+
+
 class Zset(object):
     """A Redis-like ordered set implementation."""
 
@@ -2,8 +2,13 @@
 
 """Base classes for Vumi persistence models."""
 
+import json
+import urllib
+from collections import deque
 from functools import wraps
 
+from twisted.internet.defer import Deferred, returnValue
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
@@ -256,13 +261,17 @@ class Model(object):
         return manager.load(cls, key, result=result)
 
     @classmethod
-    def load_all_bunches(cls, manager, keys):
+    def load_all_bunches(cls, manager, keys, ordered=False):
         """Load batches of objects for the given list of keys.
 
+        :param bool ordered:
+            If true, the objects in each batch are in the same order as
+            their keys.
+
         :returns:
             An iterator over (possibly deferred) lists of model instances.
         """
-        return manager.load_all_bunches(cls, keys)
+        return manager.load_all_bunches(cls, keys, ordered=ordered)
 
     @classmethod
     def all_keys(cls, manager):
@@ -277,6 +286,26 @@ class Model(object):
         return manager.index_keys(cls, '$bucket', manager.bucket_name(cls),
                                   None)
 
+    @classmethod
+    def all_keys_page(cls, manager, max_results=None, continuation=None):
+        """Return a page of keys in this model's bucket.
+
+        Uses Riak's special `$bucket` index, so the same caveats about
+        tombstones as for :meth:`all_keys` apply.
+
+        :param int max_results:
+            Maximum number of keys in the page. If ``None``, all keys are
+            returned in a single page.
+        :param str continuation:
+            Continuation token from a previous page.
+
+        :returns:
+            :class:`IndexPage` of keys from this model's bucket.
+        """
+        return manager.index_keys_page(
+            cls, '$bucket', manager.bucket_name(cls), None,
+            max_results=max_results, continuation=continuation)
+
     @classmethod
     def index_keys(cls, manager, field_name, value):
         """Find objects by index.
@@ -287,6 +316,25 @@ class Model(object):
             cls, field_name, value, None)
         return manager.index_keys(cls, index_name, start_value, end_value)
 
+    @classmethod
+    def index_keys_page(cls, manager, field_name, value, end_value=None,
+                        max_results=None, continuation=None):
+        """Find a page of objects by index.
+
+        :param int max_results:
+            Maximum number of keys in the page. If ``None``, all matching
+            keys are returned in a single page.
+        :param str continuation:
+            Continuation token from a previous page.
+
+        :returns: :class:`IndexPage` of keys matching the index param.
+        """
+        index_name, start_value, end_value = index_vals_for_field(
+            cls, field_name, value, end_value)
+        return manager.index_keys_page(
+            cls, index_name, start_value, end_value,
+            max_results=max_results, continuation=continuation)
+
     @classmethod
     def index_lookup(cls, manager, field_name, value):
         """Find objects by index.
@@ -365,6 +413,108 @@ def index_vals_for_field(model, field_name, start_value, end_value):
     return descriptor.index_name, start_value, end_value
 
 
+class IndexPage(object):
+    """A page of keys from a secondary index query.
+
+    Iterating over the page yields its keys. :meth:`next_page` fetches the
+    next page of the same query.
+
+    :param Manager manager:
+        The manager the query was made with.
+    :param keys:
+        List of keys in this page.
+    :param str continuation:
+        Token for fetching the next page, or ``None`` if this is the last
+        page.
+    """
+
+    def __init__(self, manager, model, index_name, start_value, end_value,
+                 max_results, keys, continuation):
+        self._manager = manager
+        self._model = model
+        self._index_name = index_name
+        self._start_value = start_value
+        self._end_value = end_value
+        self._max_results = max_results
+        self.keys = keys
+        self.continuation = continuation
+
+    def __iter__(self):
+        return iter(self.keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def has_next_page(self):
+        return self.continuation is not None
+
+    def next_page(self):
+        """Fetch the next page.
+
+        :returns:
+            The next :class:`IndexPage` (or a deferred that fires with it if
+            using an asynchronous manager), or ``None`` if this is the last
+            page.
+        """
+        if not self.has_next_page():
+            return None
+        return self._manager.index_keys_page(
+            self._model, self._index_name, self._start_value,
+            self._end_value, max_results=self._max_results,
+            continuation=self.continuation)
+
+    def foreach_page(self, func):
+        """Call ``func`` with this page and each page after it.
+
+        If ``func`` returns a deferred, the next page isn't processed until
+        it fires. The next page is fetched while ``func`` processes the
+        current one.
+
+        :returns:
+            ``None`` (or a deferred that fires with ``None`` once all pages
+            have been processed if using an asynchronous manager).
+        """
+        return self._manager.call_decorator(self._foreach_page)(func)
+
+    def _foreach_page(self, func):
+        page = self
+        while page is not None:
+            next_page = page.next_page()
+            yield func(page)
+            page = yield next_page
+
+    def foreach_key(self, func):
+        """Call ``func`` with each key in this page and the pages after it.
+
+        See :meth:`foreach_page`.
+        """
+        return self._manager.call_decorator(self._foreach_key)(func)
+
+    def _foreach_key(self, func):
+        def process_page(page):
+            return self._manager.call_decorator(self._process_page_keys)(
+                page, func)
+        yield self.foreach_page(process_page)
+
+    def _process_page_keys(self, page, func):
+        for key in page:
+            yield func(key)
+
+    def count(self):
+        """Count the keys in this page and the pages after it.
+
+        :returns:
+            The number of keys (or a deferred that fires with it if using an
+            asynchronous manager).
+        """
+        return self._manager.call_decorator(self._count)()
+
+    def _count(self):
+        counts = []
+        yield self.foreach_page(lambda page: counts.append(len(page)))
+        returnValue(sum(counts))
+
+
 class VumiMapReduceError(Exception):
     pass
 
@@ -505,21 +655,41 @@ class Manager(object):
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
+    # Number of bunches load_all_bunches() keeps in flight at once.
+    DEFAULT_LOAD_BUNCH_CONCURRENCY = 1
+    # How bunches are fetched: 'mapreduce' runs a single mapreduce per
+    # bunch, 'multiget' fetches each key in the bunch separately.
+    LOAD_BUNCH_METHODS = ('mapreduce', 'multiget')
+    DEFAULT_LOAD_BUNCH_METHOD = 'mapreduce'
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None):
+                 mapreduce_timeout=None, load_bunch_concurrency=None,
+                 load_bunch_method=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
+        self.load_bunch_concurrency = (load_bunch_concurrency or
+                                       self.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        self.load_bunch_method = (load_bunch_method or
+                                  self.DEFAULT_LOAD_BUNCH_METHOD)
+        if self.load_bunch_method not in self.LOAD_BUNCH_METHODS:
+            raise ValueError("Unknown load_bunch_method %r, expected one of"
+                             " %r." % (self.load_bunch_method,
+                                       self.LOAD_BUNCH_METHODS))
         self._bucket_cache = {}
 
     def proxy(self, modelcls):
         return ModelProxy(self, modelcls)
 
     def sub_manager(self, sub_prefix):
-        return self.__class__(self.client, self.bucket_prefix + sub_prefix)
+        return self.__class__(
+            self.client, self.bucket_prefix + sub_prefix,
+            load_bunch_size=self.load_bunch_size,
+            mapreduce_timeout=self.mapreduce_timeout,
+            load_bunch_concurrency=self.load_bunch_concurrency,
+            load_bunch_method=self.load_bunch_method)
 
     def bucket_name(self, modelcls_or_obj):
         return self.bucket_prefix + modelcls_or_obj.bucket
@@ -605,16 +775,70 @@ class Manager(object):
         return self.run_map_reduce(
             mr._riak_mapreduce_obj, lambda mgr, obj: model.load(mgr, *obj))
 
-    def load_all_bunches(self, model, keys):
+    def _load_bunch_multiget(self, model, keys):
+        """Load the model instances for a batch of keys from Riak.
+
+        This fetches each key separately instead of running a mapreduce,
+        which avoids the JavaScript map phase and returns the objects in
+        key order. If a key doesn't exist, no object will be returned for
+        it.
+        """
+        assert len(keys) <= self.load_bunch_size
+        return self.call_decorator(self._multiget)(model, keys)
+
+    def _multiget(self, model, keys):
+        objs = yield self._load_multiple(model, keys)
+        returnValue([obj for obj in objs if obj is not None])
+
+    def _load_multiple(self, model, keys):
+        """Load a model instance (or None) for each of the keys."""
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._load_multiple(...)")
+
+    def _load_bunch_ordered(self, model, keys):
+        """Load a batch of model instances and return them in key order."""
+        return self.call_decorator(self._reorder_bunch)(model, keys)
+
+    def _reorder_bunch(self, model, keys):
+        objs = yield self._load_bunch(model, keys)
+        objs_by_key = dict((obj.key, obj) for obj in objs)
+        returnValue([objs_by_key[key] for key in keys if key in objs_by_key])
+
+    def load_all_bunches(self, model, keys, ordered=False):
         """Load batches of model instances for a list of keys from Riak.
 
+        Up to `load_bunch_concurrency` bunches are loaded at once: each
+        bunch yielded has the following bunches already loading behind it.
+
+        :param bool ordered:
+            If true, the instances in each bunch are returned in the same
+            order as their keys. Bunches are always yielded in key order.
+
         :returns:
             An iterator over (possibly deferred) lists of model instances.
         """
-        while keys:
-            batch_keys = keys[:self.load_bunch_size]
-            keys = keys[self.load_bunch_size:]
-            yield self._load_bunch(model, batch_keys)
+        if self.load_bunch_method == 'multiget':
+            load_bunch = self._load_bunch_multiget
+        elif ordered:
+            load_bunch = self._load_bunch_ordered
+        else:
+            load_bunch = self._load_bunch
+        in_flight = deque()
+        try:
+            for i in xrange(0, len(keys), self.load_bunch_size):
+                in_flight.append(
+                    load_bunch(model, keys[i:i + self.load_bunch_size]))
+                if len(in_flight) >= self.load_bunch_concurrency:
+                    yield in_flight.popleft()
+            while in_flight:
+                yield in_flight.popleft()
+        finally:
+            # If the caller stops iterating early, nobody will look at the
+            # bunches still loading, so we don't want their failures logged
+            # as unhandled.
+            for bunch in in_flight:
+                if isinstance(bunch, Deferred):
+                    bunch.addErrback(lambda f: None)
 
     def riak_map_reduce(self):
         """Construct a RiakMapReduce object for this client."""
@@ -631,6 +855,63 @@ class Manager(object):
         bucket = self.bucket_for_modelcls(model)
         return bucket.get_index(index_name, start_value, end_value)
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        """Fetch a page of keys from a secondary index query.
+
+        Pagination is only possible over HTTP. Over protocol buffers,
+        `max_results` and `continuation` are ignored and all matching keys
+        are returned in a single page.
+
+        :returns:
+            An :class:`IndexPage` (or a deferred that fires with one).
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .index_keys_page(...)")
+
+    def _index_page_request(self, model, index_name, start_value, end_value,
+                            max_results, continuation):
+        """Build the HTTP path and parameters for a paginated index query.
+
+        The client libraries we use don't support pagination, so we build
+        the query ourselves. Riak 1.4 or newer is needed for this.
+        """
+        segments = ["buckets", self.bucket_name(model), "index", index_name,
+                    start_value]
+        if end_value is not None:
+            segments.append(end_value)
+        # The transport adds the leading slash when it builds the URL.
+        uri = "/".join(
+            urllib.quote(self._encode_path_segment(segment), safe="$")
+            for segment in segments)
+        params = {}
+        if max_results is not None:
+            params['max_results'] = max_results
+        if continuation is not None:
+            params['continuation'] = continuation
+        return uri, params or None
+
+    def _encode_path_segment(self, segment):
+        if isinstance(segment, unicode):
+            return segment.encode('utf-8')
+        return str(segment)
+
+    def _index_page_from_response(self, model, index_name, start_value,
+                                  end_value, max_results, data):
+        results = json.loads(data)
+        return IndexPage(self, model, index_name, start_value, end_value,
+                         max_results, results['keys'],
+                         results.get('continuation'))
+
+    def _index_page_from_keys(self, model, index_name, start_value,
+                              end_value, keys):
+        """Wrap a complete set of index results in a single page.
+
+        This is used with transports we can't make paginated queries over.
+        """
+        return IndexPage(self, model, index_name, start_value, end_value,
+                         None, keys, None)
+
     def mr_from_field(self, model, field_name, start_value, end_value=None):
         return VumiMapReduce.from_field(
             self, model, field_name, start_value, end_value)
@@ -688,10 +969,20 @@ class ModelProxy(object):
     def all_keys(self):
         return self._modelcls.all_keys(self._manager)
 
+    def all_keys_page(self, max_results=None, continuation=None):
+        return self._modelcls.all_keys_page(
+            self._manager, max_results=max_results, continuation=continuation)
+
     def index_keys(self, field_name, value):
         return self._modelcls.index_keys(
             self._manager, field_name, value)
 
+    def index_keys_page(self, field_name, value, end_value=None,
+                        max_results=None, continuation=None):
+        return self._modelcls.index_keys_page(
+            self._manager, field_name, value, end_value,
+            max_results=max_results, continuation=continuation)
+
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
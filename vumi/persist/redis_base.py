@@ -182,6 +182,38 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    def _execute_transaction(self, calls):
+        """Make a list of redis API calls in a single MULTI/EXEC block.
+
+        The underlying client must provide a `pipeline()` method that
+        behaves like the one in the Python redis module.
+        """
+        pipe = self._client.pipeline(transaction=True)
+        for call, args, kw in calls:
+            getattr(pipe, call)(*args, **kw)
+        return pipe.execute()
+
+    def transaction(self):
+        """Return a :class:`Transaction` for this manager.
+        """
+        return Transaction(self)
+
+    def _execute_pipeline(self, calls):
+        """Make a list of redis API calls in a single round trip.
+
+        Unlike :meth:`_execute_transaction`, the calls aren't wrapped in a
+        MULTI/EXEC block where the underlying client supports that.
+        """
+        pipe = self._client.pipeline(transaction=False)
+        for call, args, kw in calls:
+            getattr(pipe, call)(*args, **kw)
+        return pipe.execute()
+
+    def pipeline(self):
+        """Return a :class:`Pipeline` for this manager.
+        """
+        return Pipeline(self)
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -208,6 +240,7 @@ class Manager(object):
     exists = RedisCall(['key'])
     keys = RedisCall(['pattern'], defaults=['*'], key_args=['pattern'],
                      filter_func='_unkeys')
+    rename = RedisCall(['key', 'newkey'], key_args=['key', 'newkey'])
 
     # String operations
 
@@ -251,6 +284,7 @@ class Manager(object):
 
     zadd = RedisCall(['key'], kwarg='valscores')
     zrem = RedisCall(['key', 'value'])
+    zremrangebyscore = RedisCall(['key', 'min', 'max'])
     zcard = RedisCall(['key'])
     zrange = RedisCall(['key', 'start', 'stop', 'desc', 'withscores'],
                        defaults=[False, False])
@@ -265,7 +299,7 @@ class Manager(object):
     lpop = RedisCall(['key'])
     rpop = RedisCall(['key'])
     lpush = RedisCall(['key', 'obj'])
-    rpush = RedisCall(['key', 'obj'])
+    rpush = RedisCall(['key', 'obj'], vararg='objs')
     lrange = RedisCall(['key', 'start', 'end'])
     lrem = RedisCall(['key', 'value', 'num'], defaults=[0])
     rpoplpush = RedisCall(['source'], vararg='destination',
@@ -277,3 +311,63 @@ class Manager(object):
     expire = RedisCall(['key', 'seconds'])
     persist = RedisCall(['key'])
     ttl = RedisCall(['key'])
+
+
+class Transaction(Manager):
+    """Collects redis calls to be made atomically in a MULTI/EXEC block.
+
+    Calls made on a transaction are recorded rather than sent and return
+    `None`. :meth:`execute` sends all recorded calls to redis in a single
+    round trip and returns a list of their results (or a deferred that
+    fires with the list, for asynchronous managers).
+
+    Only calls with scalar replies (integers, status replies and single
+    values) are supported, because txredis can't parse nested replies.
+
+    :param Manager manager:
+        The manager to execute the transaction with.
+    """
+
+    def __init__(self, manager):
+        super(Transaction, self).__init__(
+            manager._client, manager._config, manager._key_prefix,
+            manager._key_separator)
+        self._manager = manager
+        self._calls = []
+        self._filters = []
+
+    def _make_redis_call(self, call, *args, **kw):
+        self._calls.append((call, args, kw))
+        self._filters.append(None)
+
+    def _filter_redis_results(self, func, results):
+        self._filters[-1] = func
+
+    def _execute(self, calls):
+        return self._manager._execute_transaction(calls)
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        filters, self._filters = self._filters, []
+
+        def filter_results(results):
+            return [r if f is None else f(r)
+                    for f, r in zip(filters, results)]
+
+        return self._manager._filter_redis_results(
+            filter_results, self._execute(calls))
+
+
+class Pipeline(Transaction):
+    """Collects redis calls to be sent in a single round trip.
+
+    This behaves like :class:`Transaction`, but the calls aren't made
+    atomically. Use it to batch up independent calls, such as reads of
+    many unrelated keys.
+
+    :param Manager manager:
+        The manager to execute the pipeline with.
+    """
+
+    def _execute(self, calls):
+        return self._manager._execute_pipeline(calls)
@@ -2,11 +2,26 @@
 
 import redis
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import Manager, RedisCall
 from vumi.persist.fake_redis import FakeRedis
 from vumi.utils import flatten_generator
 
 
+class VumiRedis(redis.Redis):
+    """Wrapper around the redis client for operations it lacks.
+    """
+
+    def scan(self, cursor, match=None, count=None):
+        # SCAN needs Redis 2.8 or newer.
+        args = ['SCAN', cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        cursor, keys = self.execute_command(*args)
+        return int(cursor), keys
+
+
 class RedisManager(Manager):
 
     call_decorator = staticmethod(flatten_generator)
@@ -31,7 +46,7 @@ class RedisManager(Manager):
             Key prefix for namespacing.
         """
 
-        return cls(redis.Redis(**config), **manager_config)
+        return cls(VumiRedis(**config), **manager_config)
 
     def _close(self):
         """Close redis connection."""
@@ -55,3 +70,12 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    def _unkeys_scan(self, results):
+        cursor, keys = results
+        return cursor, self._unkeys(keys)
+
+    # SCAN replies are nested, which txredis can't parse, so we only support
+    # it here.
+    scan = RedisCall(['cursor', 'match', 'count'], defaults=['*', None],
+                     key_args=['match'], filter_func='_unkeys_scan')
@@ -24,6 +24,10 @@ class RiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_bunch_concurrency = config.pop(
+            'load_bunch_concurrency', cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        load_bunch_method = config.pop(
+            'load_bunch_method', cls.DEFAULT_LOAD_BUNCH_METHOD)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': RiakHttpTransport,
@@ -53,7 +57,9 @@ class RiakManager(Manager):
         client.set_decoder('application/json', json.loads)
         client.set_decoder('text/json', json.loads)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency,
+                   load_bunch_method=load_bunch_method)
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -97,6 +103,26 @@ class RiakManager(Manager):
             riak_object = migrator(riak_object).get_riak_object()
         return None
 
+    def _load_multiple(self, modelcls, keys):
+        return [modelcls.load(self, key) for key in keys]
+
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        transport = self.client.get_transport()
+        if not hasattr(transport, 'get_request'):
+            # We can only make paginated queries over HTTP.
+            keys = self.index_keys(model, index_name, start_value, end_value)
+            return self._index_page_from_keys(
+                model, index_name, start_value, end_value, keys)
+        uri, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        response = transport.get_request(uri, params)
+        transport.check_http_code(response, [200])
+        return self._index_page_from_response(
+            model, index_name, start_value, end_value, max_results,
+            response[1])
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
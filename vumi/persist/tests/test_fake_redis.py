@@ -20,6 +20,23 @@ class TestFakeRedis(VumiTestCase):
         yield self.assert_redis_op(True, 'delete', "delete_me")
         yield self.assert_redis_op(False, 'delete', "delete_me")
 
+    @inlineCallbacks
+    def test_rename(self):
+        yield self.redis.set("old", 1)
+        yield self.redis.set("new", 2)
+        yield self.assert_redis_op(True, 'rename', "old", "new")
+        yield self.assert_redis_op(False, 'exists', "old")
+        yield self.assert_redis_op('1', 'get', "new")
+        self.assertRaises(ValueError, self.redis.rename, "old", "new")
+
+    @inlineCallbacks
+    def test_rename_keeps_expiry(self):
+        yield self.redis.set("old", 1)
+        yield self.redis.expire("old", 10)
+        yield self.redis.rename("old", "new")
+        yield self.assert_redis_op(None, 'ttl', "old")
+        yield self.assert_redis_op(9, 'ttl', "new")
+
     @inlineCallbacks
     def test_incr(self):
         yield self.redis.set("inc", 1)
@@ -155,6 +172,47 @@ class TestFakeRedis(VumiTestCase):
         yield self.assert_redis_op(
             [('two', 0.2)], 'zrange', 'set', 0, -1, withscores=True)
 
+    @inlineCallbacks
+    def test_zremrangebyscore(self):
+        yield self.redis.zadd('set', one=0.1, two=0.2, three=0.3)
+        yield self.assert_redis_op(2, 'zremrangebyscore', 'set', '-inf', 0.2)
+        yield self.assert_redis_op(
+            [('three', 0.3)], 'zrange', 'set', 0, -1, withscores=True)
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.redis.pipeline(transaction=True)
+        self.assertEqual(pipe.set('foo', 'bar'), None)
+        self.assertEqual(pipe.incr('counter', 2), None)
+        self.assertEqual(pipe.get('foo'), None)
+        self.assertEqual((yield self.redis.get('foo')), None)
+        results = yield pipe.execute()
+        self.assertEqual(results, [None, 2, 'bar'])
+        self.assertEqual((yield self.redis.get('counter')), '2')
+
+    @inlineCallbacks
+    def test_scan(self):
+        for i in range(5):
+            yield self.redis.set('key%d' % (i,), i)
+        yield self.redis.set('other', 'x')
+        yield self.assert_redis_op((2, ['key0', 'key1']), 'scan', 0,
+                                   match='key*', count=2)
+        yield self.assert_redis_op((4, ['key2', 'key3']), 'scan', 2,
+                                   match='key*', count=2)
+        yield self.assert_redis_op((0, ['key4']), 'scan', 4,
+                                   match='key*', count=2)
+        yield self.assert_redis_op(
+            (0, ['key0', 'key1', 'key2', 'key3', 'key4', 'other']), 'scan', 0)
+
+    @inlineCallbacks
+    def test_rpush_many(self):
+        yield self.assert_redis_op(2, 'rpush', 'list', 'a', 'b', 'c')
+        yield self.assert_redis_op(['a', 'b', 'c'], 'lrange', 'list', 0, -1)
+
+    def test_pipeline_unknown_call(self):
+        pipe = self.redis.pipeline(transaction=True)
+        self.assertRaises(AttributeError, getattr, pipe, 'no_such_call')
+
     @inlineCallbacks
     def test_zscore(self):
         yield self.redis.zadd('set', one=0.1, two=0.2)
@@ -334,6 +334,68 @@ class TestModelOnTxRiak(VumiTestCase):
             simple_model, (yield simple_model.all_keys()))
         self.assertEqual(sorted(keys), [u"foo-1", u"foo-2"])
 
+    @Manager.calls_manager
+    def test_all_keys_page(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        for i in range(5):
+            yield simple_model(u"foo-%d" % i, a=i, b=u'x').save()
+
+        keys = []
+        page = yield simple_model.all_keys_page(max_results=2)
+        while page is not None:
+            self.assertTrue(len(page) <= 2)
+            keys.extend(page)
+            page = yield page.next_page()
+        keys = yield self.filter_tombstones(simple_model, keys)
+        self.assertEqual(sorted(keys), [u"foo-%d" % i for i in range(5)])
+
+    @Manager.calls_manager
+    def test_all_keys_page_unpaginated(self):
+        simple_model = self.manager.proxy(SimpleModel)
+        yield simple_model("foo-1", a=5, b=u'1').save()
+        yield simple_model("foo-2", a=5, b=u'2').save()
+
+        page = yield simple_model.all_keys_page()
+        self.assertFalse(page.has_next_page())
+        keys = yield self.filter_tombstones(simple_model, list(page))
+        self.assertEqual(sorted(keys), [u"foo-1", u"foo-2"])
+
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        for i in range(5):
+            yield indexed_model(u"foo%d" % i, a=1, b=u"one").save()
+        yield indexed_model(u"bar", a=2, b=u"two").save()
+
+        page = yield indexed_model.index_keys_page('a', 1, max_results=2)
+        self.assertEqual(len(page), 2)
+        self.assertTrue(page.has_next_page())
+        keys = []
+        yield page.foreach_key(keys.append)
+        self.assertEqual(sorted(keys), [u"foo%d" % i for i in range(5)])
+
+        page = yield indexed_model.index_keys_page('a', 1, max_results=2)
+        self.assertEqual((yield page.count()), 5)
+
+    def test_index_page_request(self):
+        uri, params = self.manager._index_page_request(
+            IndexedModel, 'b_bin', u'caf\xe9/1', None, 10, 'token')
+        self.assertEqual(
+            uri, "buckets/%s/index/b_bin/caf%%C3%%A9%%2F1" % (
+                self.manager.bucket_name(IndexedModel),))
+        self.assertEqual(params, {'max_results': 10, 'continuation': 'token'})
+
+    @Manager.calls_manager
+    def test_index_keys_page_range(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        for i in range(1, 5):
+            yield indexed_model(u"foo%d" % i, a=i, b=u"x").save()
+
+        page = yield indexed_model.index_keys_page('a', 2, 3, max_results=1)
+        keys = []
+        yield page.foreach_key(keys.append)
+        self.assertEqual(sorted(keys), [u"foo2", u"foo3"])
+
     @Manager.calls_manager
     def test_index_keys(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -41,3 +41,48 @@ class TestRedisManager(VumiTestCase):
     def test_disconnect_twice(self):
         self.manager._close()
         self.manager._close()
+
+    def test_transaction(self):
+        tx = self.manager.transaction()
+        self.assertEqual(tx.set('foo', 'bar'), None)
+        self.assertEqual(tx.hmset('hash', {'a': '1', 'b': '2'}), None)
+        self.assertEqual(tx.expire('hash', 60), None)
+        self.assertEqual(tx.get('foo'), None)
+        self.assertEqual(self.manager.get('foo'), None)
+        results = tx.execute()
+        self.assertEqual(results[1:], [True, 1, 'bar'])
+        self.assertEqual(self.manager.hgetall('hash'),
+                         {'a': '1', 'b': '2'})
+        self.assertTrue(0 < self.manager.ttl('hash') <= 60)
+        self.assertEqual(sorted(self.manager.keys()), ['foo', 'hash'])
+
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        self.assertEqual(pipe.set('foo', 'bar'), None)
+        self.assertEqual(pipe.sadd('set', 'a', 'b'), None)
+        self.assertEqual(pipe.smembers('set'), None)
+        self.assertEqual(pipe.keys(), None)
+        self.assertEqual(self.manager.get('foo'), None)
+        results = pipe.execute()
+        self.assertEqual(results[2], set(['a', 'b']))
+        self.assertEqual(sorted(results[3]), ['foo', 'set'])
+        self.assertEqual(self.manager.get('foo'), 'bar')
+
+    def test_scan(self):
+        self.manager.set('foo', '1')
+        self.manager.set('bar', '2')
+        self.manager._client.set('other:baz', '3')
+        self.add_cleanup(self.manager._client.delete, 'other:baz')
+        keys = []
+        cursor, batch = self.manager.scan(0, count=1)
+        keys.extend(batch)
+        while cursor != 0:
+            cursor, batch = self.manager.scan(cursor, count=1)
+            keys.extend(batch)
+        self.assertEqual(sorted(keys), ['bar', 'foo'])
+
+    def test_rpush_many(self):
+        self.manager.rpush('list', 'a')
+        self.manager.rpush('list', 'b', 'c', 'd')
+        self.assertEqual(self.manager.lrange('list', 0, -1),
+                         ['a', 'b', 'c', 'd'])
@@ -43,3 +43,18 @@ class TestTxRedisManager(VumiTestCase):
     def test_disconnect_twice(self):
         yield self.manager._close()
         yield self.manager._close()
+
+    @inlineCallbacks
+    def test_transaction(self):
+        tx = self.manager.transaction()
+        self.assertEqual(tx.set('foo', 'bar'), None)
+        self.assertEqual(tx.hmset('hash', {'a': '1', 'b': '2'}), None)
+        self.assertEqual(tx.expire('hash', 60), None)
+        self.assertEqual(tx.get('foo'), None)
+        self.assertEqual((yield self.manager.get('foo')), None)
+        results = yield tx.execute()
+        self.assertEqual(results[1:], [True, 1, 'bar'])
+        self.assertEqual((yield self.manager.hgetall('hash')),
+                         {'a': '1', 'b': '2'})
+        self.assertTrue(0 < (yield self.manager.ttl('hash')) <= 60)
+        self.assertEqual(sorted((yield self.manager.keys())), ['foo', 'hash'])
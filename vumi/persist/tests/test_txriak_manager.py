@@ -1,6 +1,6 @@
 """Tests for vumi.persist.txriak_manager."""
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
 
 from vumi.persist.model import Manager
 from vumi.tests.helpers import VumiTestCase, import_skip
@@ -57,6 +57,9 @@ class CommonRiakManagerTests(object):
                          manager.DEFAULT_LOAD_BUNCH_SIZE)
         self.assertEqual(manager.mapreduce_timeout,
                          manager.DEFAULT_MAPREDUCE_TIMEOUT)
+        self.assertEqual(manager.load_bunch_concurrency,
+                         manager.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        self.assertEqual(manager.load_bunch_method, 'mapreduce')
 
     def test_from_config_with_bunch_size(self):
         manager_cls = self.manager.__class__
@@ -72,11 +75,41 @@ class CommonRiakManagerTests(object):
                                            })
         self.assertEqual(manager.mapreduce_timeout, 1000)
 
+    def test_from_config_with_load_bunch_concurrency(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'load_bunch_concurrency': 8,
+                                           })
+        self.assertEqual(manager.load_bunch_concurrency, 8)
+
+    def test_from_config_with_load_bunch_method(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'load_bunch_method': 'multiget',
+                                           })
+        self.assertEqual(manager.load_bunch_method, 'multiget')
+
+    def test_from_config_with_bad_load_bunch_method(self):
+        manager_cls = self.manager.__class__
+        self.assertRaises(ValueError, manager_cls.from_config, {
+            'bucket_prefix': 'test.',
+            'load_bunch_method': 'bad',
+        })
+
     def test_sub_manager(self):
         sub_manager = self.manager.sub_manager("foo.")
         self.assertEqual(sub_manager.client, self.manager.client)
         self.assertEqual(sub_manager.bucket_prefix, 'test.foo.')
 
+    def test_sub_manager_load_bunch_settings(self):
+        self.manager.load_bunch_size = 10
+        self.manager.load_bunch_concurrency = 3
+        self.manager.load_bunch_method = 'multiget'
+        sub_manager = self.manager.sub_manager("foo.")
+        self.assertEqual(sub_manager.load_bunch_size, 10)
+        self.assertEqual(sub_manager.load_bunch_concurrency, 3)
+        self.assertEqual(sub_manager.load_bunch_method, 'multiget')
+
     def test_bucket_name_on_modelcls(self):
         dummy = self.mkdummy("bar")
         bucket_name = self.manager.bucket_name(type(dummy))
@@ -146,6 +179,44 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    @Manager.calls_manager
+    def test_load_all_bunches_ordered(self):
+        for i in range(5):
+            yield self.manager.store(self.mkdummy(str(i), {"a": i}))
+        self.manager.load_bunch_size = 2
+
+        keys = ["3", "unknown", "0", "4", "2", "1"]
+
+        result_keys = []
+        for result_bunch in self.manager.load_all_bunches(
+                DummyModel, keys, ordered=True):
+            bunch = yield result_bunch
+            result_keys.extend(result.key for result in bunch)
+        self.assertEqual(result_keys, ["3", "0", "4", "2", "1"])
+
+    @Manager.calls_manager
+    def test_load_all_bunches_multiget(self):
+        for i in range(5):
+            yield self.manager.store(self.mkdummy(str(i), {"a": i}))
+        self.manager.load_bunch_size = 2
+        self.manager.load_bunch_method = 'multiget'
+
+        def fail_mapreduce(model, keys):
+            self.fail("Unexpected mapreduce bunch load.")
+        self.patch(self.manager, '_load_bunch', fail_mapreduce)
+
+        keys = ["3", "unknown", "0", "4", "2", "1"]
+
+        result_bunches = []
+        for result_bunch in self.manager.load_all_bunches(DummyModel, keys):
+            bunch = yield result_bunch
+            result_bunches.append([result.get_data() for result in bunch])
+        self.assertEqual(result_bunches, [
+            [{"a": 3}],
+            [{"a": 0}, {"a": 4}],
+            [{"a": 2}, {"a": 1}],
+        ])
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
@@ -221,6 +292,46 @@ class TestTxRiakManager(CommonRiakManagerTests, VumiTestCase):
     def test_call_decorator(self):
         self.assertEqual(type(self.manager).call_decorator, inlineCallbacks)
 
+    def test_load_all_bunches_concurrency(self):
+        self.manager.load_bunch_size = 2
+        self.manager.load_bunch_concurrency = 2
+        loads = []
+
+        def load_bunch(model, keys):
+            d = Deferred()
+            loads.append((keys, d))
+            return d
+        self.patch(self.manager, '_load_bunch', load_bunch)
+
+        bunches = self.manager.load_all_bunches(
+            DummyModel, ["a", "b", "c", "d", "e", "f", "g"])
+        first = bunches.next()
+        self.assertEqual([keys for keys, _ in loads], [["a", "b"], ["c", "d"]])
+        self.assertEqual(first, loads[0][1])
+        self.assertEqual(bunches.next(), loads[1][1])
+        self.assertEqual(len(loads), 3)
+        self.assertEqual(bunches.next(), loads[2][1])
+        self.assertEqual(len(loads), 4)
+        self.assertEqual(bunches.next(), loads[3][1])
+        self.assertRaises(StopIteration, bunches.next)
+        self.assertEqual([keys for keys, _ in loads],
+                         [["a", "b"], ["c", "d"], ["e", "f"], ["g"]])
+
+    def test_load_all_bunches_abandoned(self):
+        self.manager.load_bunch_size = 1
+        self.manager.load_bunch_concurrency = 3
+        bunch_ds = [Deferred() for _ in range(3)]
+        self.patch(self.manager, '_load_bunch',
+                   lambda model, keys: bunch_ds[int(keys[0])])
+
+        bunches = self.manager.load_all_bunches(DummyModel, ["0", "1", "2"])
+        bunches.next().callback([])
+        bunches.close()
+        # Failures in bunches nobody is waiting for anymore are ignored.
+        bunch_ds[1].errback(ValueError("Failed to load."))
+        bunch_ds[2].errback(ValueError("Failed to load."))
+        self.assertEqual(self.flushLoggedErrors(ValueError), [])
+
     def test_transport_class_protocol_buffer(self):
         manager_class = type(self.manager)
         manager = manager_class.from_config({
@@ -12,8 +12,7 @@ except ImportError:
     txr = txrp
 
 from twisted.internet import reactor
-from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+from twisted.internet.defer import inlineCallbacks, succeed, Deferred
 from twisted.internet.error import ConnectionDone
 
 from vumi.persist.redis_base import Manager
@@ -79,12 +78,25 @@ class VumiRedis(txr.Redis):
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        deferreds = [orig_zadd(key, member, score) for member, score in pieces]
-        d = DeferredList(deferreds, fireOnOneErrback=True)
-        d.addCallback(lambda results: sum([result for success, result
-                                            in results if success]))
-        return d
+        # Variadic ZADD needs Redis 2.4 or newer.
+        command = ['ZADD', key]
+        for member, score in pieces:
+            command.extend([score, member])
+        self._send(*command)
+        return self.getResponse()
+
+    def sadd(self, key, *values):
+        # Variadic SADD needs Redis 2.4 or newer.
+        self._send('SADD', key, *values)
+        return self.getResponse()
+
+    def rpush(self, key, *values):
+        # Variadic RPUSH needs Redis 2.4 or newer.
+        self._send('RPUSH', key, *values)
+        return self.getResponse()
+
+    def pipeline(self, transaction=True):
+        return VumiRedisTransaction(self)
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -93,13 +105,56 @@ class VumiRedis(txr.Redis):
 
     def zrangebyscore(self, key, min, max, start=None, num=None,
                      withscores=False, score_cast_func=float):
-        d = super(VumiRedis, self).zrangebyscore(key, min, max,
-                        offset=start, count=num, withscores=withscores)
+        # txredis silently drops the LIMIT clause if the offset is 0, so we
+        # build the command ourselves.
+        args = ['ZRANGEBYSCORE', key, min, max]
+        if start is not None and num is not None:
+            args.extend(['LIMIT', start, num])
         if withscores:
-            d.addCallback(lambda r: [(v, score_cast_func(s)) for v, s in r])
+            args.append('WITHSCORES')
+        self._send(*args)
+        d = self.getResponse()
+        if withscores:
+            d.addCallback(lambda r: [(v, score_cast_func(s))
+                                     for v, s in zip(r[::2], r[1::2])])
         return d
 
 
+class VumiRedisTransaction(object):
+    """Pipeline-like wrapper that sends calls in a MULTI/EXEC block.
+
+    Calls are recorded and only sent when :meth:`execute` is called. Only
+    calls with scalar replies are supported, because txredis can't parse
+    the nested replies other calls would produce.
+    """
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        if not hasattr(self._client, name):
+            raise AttributeError(name)
+
+        def record_call(*args, **kw):
+            self._calls.append((name, args, kw))
+        return record_call
+
+    def execute(self):
+        calls, self._calls = self._calls, []
+        client = self._client
+        # Everything up to EXEC is sent without returning to the reactor, so
+        # no other calls on this connection can end up in our transaction.
+        # The individual replies are just "QUEUED", so we ignore them (and
+        # any errors the client's reply processing raises on them).
+        client._send('MULTI')
+        client.getResponse().addErrback(lambda f: None)
+        for call, args, kw in calls:
+            getattr(client, call)(*args, **kw).addErrback(lambda f: None)
+        client._send('EXEC')
+        return client.getResponse()
+
+
 class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
 
@@ -14,6 +14,8 @@ class TxRiakManager(Manager):
     """A persistence manager for txriak."""
 
     call_decorator = staticmethod(inlineCallbacks)
+    # Bunches load concurrently here, so keep a few in flight by default.
+    DEFAULT_LOAD_BUNCH_CONCURRENCY = 4
 
     @classmethod
     def from_config(cls, config):
@@ -23,6 +25,10 @@ class TxRiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_bunch_concurrency = config.pop(
+            'load_bunch_concurrency', cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
+        load_bunch_method = config.pop(
+            'load_bunch_method', cls.DEFAULT_LOAD_BUNCH_METHOD)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': transport.HTTPTransport,
@@ -41,7 +47,9 @@ class TxRiakManager(Manager):
             mapred_prefix=mapred_prefix, client_id=client_id,
             transport=transport_class)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency,
+                   load_bunch_method=load_bunch_method)
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -119,6 +127,31 @@ class TxRiakManager(Manager):
 
         return d.addCallback(build_model_object)
 
+    def _load_multiple(self, modelcls, keys):
+        return gatherResults([modelcls.load(self, key) for key in keys])
+
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        transport = self.client.transport
+        if not hasattr(transport, 'get_request'):
+            # We can only make paginated queries over HTTP.
+            d = self.index_keys(model, index_name, start_value, end_value)
+            return d.addCallback(
+                lambda keys: self._index_page_from_keys(
+                    model, index_name, start_value, end_value, keys))
+
+        uri, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+
+        def build_page(response):
+            transport.check_http_code(response, [200])
+            return self._index_page_from_response(
+                model, index_name, start_value, end_value, max_results,
+                response[1])
+
+        return transport.get_request(uri, params).addCallback(build_page)
+
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
@@ -0,0 +1,89 @@
+import sys
+import time
+from twisted.python import usage
+
+from vumi.config import (
+    ConfigText, ConfigInt, ConfigDict, ConfigList, ConfigRegex, ConfigUrl)
+from vumi.message import TransportUserMessage
+from vumi.worker import BaseWorker
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["messages", "m", "10000",
+         "Number of messages to fetch and read config for."],
+    ]
+
+    longdesc = """Benchmarks per-message config retrieval and field access"""
+
+
+class BenchConfig(BaseWorker.CONFIG_CLASS):
+    name = ConfigText("A text field.", static=True)
+    count = ConfigInt("An int field.")
+    status_mapping = ConfigDict("A dict field.", static=True)
+    addresses = ConfigList("A list field.")
+    keyword = ConfigRegex("A regex field.")
+    url = ConfigUrl("A URL field.")
+
+
+class BenchWorker(BaseWorker):
+    CONFIG_CLASS = BenchConfig
+
+
+BENCH_CONFIG = {
+    'name': 'bench',
+    'count': 10,
+    'status_mapping': dict(('%d' % i, 'delivered') for i in range(10)),
+    'addresses': ['+2783123%04d' % i for i in range(20)],
+    'keyword': r'^\s*(\w+)',
+    'url': 'http://www.example.com/foo?bar=baz',
+}
+
+
+class ConfigBenchmark(object):
+    """
+    Reads config fields for each of a number of messages, first building a
+    new config object per message and then using the worker's get_config().
+    """
+
+    def __init__(self, options):
+        self.messages = int(options['messages'])
+        self.worker = BenchWorker({}, BENCH_CONFIG)
+
+    def read_fields(self, config):
+        return (config.name, config.count, config.status_mapping.get('1'),
+                config.addresses[0], config.keyword.match('hi'),
+                config.url.netloc)
+
+    def per_message_config(self, msg):
+        self.read_fields(BenchConfig(BENCH_CONFIG))
+
+    def get_config(self, msg):
+        self.worker.get_config(msg).addCallback(self.read_fields)
+
+    def timed(self, name, func):
+        msg = TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="bench",
+            transport_type="sms", content="hi")
+        start = time.time()
+        for _ in xrange(self.messages):
+            func(msg)
+        taken = time.time() - start
+        print "%s took %.2f seconds (%.2f messages/s)" % (
+            name, taken, self.messages / taken)
+
+    def run(self):
+        self.timed("New config per message", self.per_message_config)
+        self.timed("Worker get_config", self.get_config)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    ConfigBenchmark(options).run()
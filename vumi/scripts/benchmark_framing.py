@@ -0,0 +1,110 @@
+import sys
+import time
+import struct
+from twisted.python import usage
+
+from vumi.transports.framing import LengthPrefixedFramer, uint32_length
+from vumi.transports.mtn_nigeria.xml_over_tcp import XmlOverTcpClient
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["packets", "p", "20000", "Number of packets to frame."],
+        ["read-size", "r", "65536",
+         "Number of bytes delivered per simulated socket read."],
+    ]
+
+    longdesc = """Benchmarks length-prefixed framing of TCP byte streams"""
+
+
+def string_buffer_frames(data, read_size):
+    """
+    Reference implementation of the string buffer approach TCP transports
+    used previously, for comparison.
+    """
+    buf = ''
+    frames = 0
+    for i in xrange(0, len(data), read_size):
+        buf += data[i:i + read_size]
+        while len(buf) >= 4:
+            length = uint32_length(buf[:4])
+            if len(buf) < length:
+                break
+            buf = buf[length:]
+            frames += 1
+    return frames
+
+
+def framer_frames(data, read_size):
+    framer = LengthPrefixedFramer(4, uint32_length)
+    frames = 0
+    for i in xrange(0, len(data), read_size):
+        for _ in framer.feed_frames(data[i:i + read_size]):
+            frames += 1
+    return frames
+
+
+class BenchXmlOverTcpClient(XmlOverTcpClient):
+    def __init__(self):
+        XmlOverTcpClient.__init__(self, 'user', 'pass', '1234')
+        self.authenticated = True
+        self.received = 0
+
+    def packet_received(self, session_id, packet_type, params):
+        self.received += 1
+
+
+class FramingBenchmark(object):
+    """
+    Splits a stream of packets delivered in large reads into frames.
+    """
+
+    def __init__(self, options):
+        self.packets = int(options['packets'])
+        self.read_size = int(options['read-size'])
+
+    def timed(self, name, func, *args):
+        start = time.time()
+        frames = func(*args)
+        taken = time.time() - start
+        if frames != self.packets:
+            raise RuntimeError("%s produced %d packets, expected %d." % (
+                name, frames, self.packets))
+        print "%s took %.2f seconds (%.2f packets/s)" % (
+            name, taken, self.packets / taken)
+
+    def xml_over_tcp_frames(self, data, read_size):
+        client = BenchXmlOverTcpClient()
+        for i in xrange(0, len(data), read_size):
+            client.dataReceived(data[i:i + read_size])
+        return client.received
+
+    def run(self):
+        body = 'x' * 100
+        data = ''.join(struct.pack('!I', len(body) + 4) + body
+                       for _ in xrange(self.packets))
+        self.timed("String buffer framing", string_buffer_frames,
+                   data, self.read_size)
+        self.timed("FrameBuffer framing", framer_frames, data, self.read_size)
+
+        xml_body = XmlOverTcpClient.serialize_body('USSDRequest', [
+            ('requestId', '1234567890'), ('msisdn', '2347067123456'),
+            ('starCode', '759'), ('clientId', '441'), ('phase', '2'),
+            ('msgtype', '4'), ('dcs', '15'), ('userdata', 'Hello'),
+        ])
+        xml_packet = XmlOverTcpClient.serialize_header(
+            '1234', xml_body) + xml_body
+        self.timed("XML over TCP parsing", self.xml_over_tcp_frames,
+                   xml_packet * self.packets, self.read_size)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    FramingBenchmark(options).run()
@@ -0,0 +1,98 @@
+import sys
+import time
+import logging
+from functools import partial
+
+from twisted.python import log as twisted_log
+from twisted.python import usage
+
+from vumi import log
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["calls", "c", "200000", "Number of log calls to make."],
+    ]
+
+    longdesc = """Benchmarks log calls below the configured log level"""
+
+
+class NullObserver(object):
+    """
+    Log observer that renders and discards log events, so that logged
+    calls pay the cost of formatting.
+    """
+
+    def __init__(self):
+        self.events = 0
+
+    def __call__(self, event_dict):
+        twisted_log.textFromEventDict(event_dict)
+        self.events += 1
+
+
+class LogBenchmark(object):
+    """
+    Makes debug log calls with the log level set to info, so that they
+    should all be dropped.
+    """
+
+    def __init__(self, options):
+        self.calls = int(options['calls'])
+        self.message = {'message_id': 'abc123', 'content': 'x' * 100}
+
+    def timed(self, name, func):
+        start = time.time()
+        for _ in xrange(self.calls):
+            func()
+        taken = time.time() - start
+        print "%s took %.2f seconds (%.2f us/call)" % (
+            name, taken, taken * 1e6 / self.calls)
+
+    def ungated_debug(self):
+        # This is how vumi.log.debug used to be defined.
+        debug = partial(twisted_log.msg, logLevel=logging.DEBUG)
+        self.timed("Ungated debug", lambda: debug(
+            "Consumed outgoing message %r" % (self.message,)))
+
+    def eager_debug(self):
+        self.timed("Gated debug with eager formatting", lambda: log.debug(
+            "Consumed outgoing message %r" % (self.message,)))
+
+    def lazy_debug(self):
+        self.timed("Gated debug with lazy formatting", lambda: log.debug(
+            format="Consumed outgoing message %(msg)r", msg=self.message))
+
+    def guarded_debug(self):
+        def guarded():
+            if log.enabled_for(logging.DEBUG):
+                log.debug(format="Consumed outgoing message %(msg)r",
+                          msg=self.message)
+        self.timed("Debug guarded by enabled_for", guarded)
+
+    def run(self):
+        observer = NullObserver()
+        twisted_log.addObserver(observer)
+        old_level = log.get_level()
+        log.set_level(logging.INFO)
+        try:
+            self.ungated_debug()
+            self.eager_debug()
+            self.lazy_debug()
+            self.guarded_debug()
+        finally:
+            log.set_level(old_level)
+            twisted_log.removeObserver(observer)
+        print "%d events reached the log observer." % (observer.events,)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    LogBenchmark(options).run()
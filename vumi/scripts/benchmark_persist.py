@@ -17,8 +17,24 @@ class Options(usage.Options):
          "Total number of messages to write and read back."],
         ["concurrent-messages", "c", "100",
          "Number of messages to read and write concurrently"],
+        ["load-bunch-sizes", "b", "10,100",
+         "Comma-separated bunch sizes to benchmark bulk loads with."],
+        ["load-concurrency", "l", "1,4",
+         "Comma-separated numbers of bunches to keep in flight during"
+         " bulk loads."],
+        ["load-methods", None, "mapreduce,multiget",
+         "Comma-separated bunch loading methods to benchmark."],
     ]
 
+    def postOptions(self):
+        for opt in ['load-bunch-sizes', 'load-concurrency']:
+            try:
+                self[opt] = [int(v) for v in self[opt].split(',')]
+            except ValueError:
+                raise usage.UsageError("%s must be a comma-separated list"
+                                       " of integers." % (opt,))
+        self['load-methods'] = self['load-methods'].split(',')
+
     longdesc = """Benchmarks vumi.persist.model.Model"""
 
 
@@ -28,12 +44,16 @@ class MessageModel(Model):
 
 class WriteReadBenchmark(object):
     """
-    Writes messages to Riak and then reads them back.
+    Writes messages to Riak and then reads them back, one at a time and in
+    bunches.
     """
 
     def __init__(self, options):
         self.messages = int(options['messages'])
         self.concurrent = int(options['concurrent-messages'])
+        self.load_bunch_sizes = options['load-bunch-sizes']
+        self.load_concurrency = options['load-concurrency']
+        self.load_methods = options['load-methods']
 
     def make_batches(self):
         num_batches, rem = divmod(self.messages, self.concurrent)
@@ -64,6 +84,24 @@ class WriteReadBenchmark(object):
             deferreds.append(model.load(msg['message_id']))
         return DeferredList(deferreds)
 
+    @inlineCallbacks
+    def bulk_load(self, manager, keys, bunch_size, concurrency, method):
+        manager.load_bunch_size = bunch_size
+        manager.load_bunch_concurrency = concurrency
+        manager.load_bunch_method = method
+        start = time.time()
+        loaded = 0
+        for bunch in manager.load_all_bunches(MessageModel, keys):
+            loaded += len((yield bunch))
+        load_time = time.time() - start
+        if loaded != len(keys):
+            raise RuntimeError("Loaded %d of %d messages."
+                               % (loaded, len(keys)))
+        print ("Bulk load (%s, bunch size %d, concurrency %d) took %.2f"
+               " seconds (%.2f objects/s)" % (
+                   method, bunch_size, concurrency, load_time,
+                   loaded / load_time))
+
     @inlineCallbacks
     def run(self):
         manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
@@ -103,6 +141,13 @@ class WriteReadBenchmark(object):
 
         print "Messages retrieved successfully."
 
+        keys = [msg['message_id'] for batch in msg_batches for msg in batch]
+        for method in self.load_methods:
+            for bunch_size in self.load_bunch_sizes:
+                for concurrency in self.load_concurrency:
+                    yield self.bulk_load(
+                        manager, keys, bunch_size, concurrency, method)
+
         yield manager.purge_all()
         print "Messages purged."
 
@@ -0,0 +1,117 @@
+import sys
+import time
+from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred, inlineCallbacks, DeferredList
+
+from vumi.components.scheduler import Scheduler
+from vumi.message import TransportUserMessage
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["entries", "e", "10000",
+         "Total number of entries to schedule and deliver."],
+        ["concurrent-entries", "c", "100",
+         "Number of entries to schedule concurrently."],
+        ["batch-size", "b", "100",
+         "Number of due entries claimed per delivery batch."],
+        ["redis-host", None, "localhost", "Redis host."],
+        ["redis-port", None, "6379", "Redis port."],
+    ]
+
+    optFlags = [
+        ["fake-redis", None, "Use an in-process fake Redis."],
+    ]
+
+    longdesc = """Benchmarks vumi.components.scheduler.Scheduler"""
+
+
+class ScheduleDeliverBenchmark(object):
+    """
+    Schedules messages for immediate delivery and then delivers them.
+    """
+
+    def __init__(self, options):
+        self.entries = int(options['entries'])
+        self.concurrent = int(options['concurrent-entries'])
+        self.batch_size = int(options['batch-size'])
+        self.redis_config = {
+            'key_prefix': 'test.bench.scheduler',
+            'host': options['redis-host'],
+            'port': int(options['redis-port']),
+        }
+        if options['fake-redis']:
+            self.redis_config['FAKE_REDIS'] = 'yes'
+        self.delivered = 0
+
+    def make_payload(self, i):
+        return TransportUserMessage(
+            to_addr="1234", from_addr="5678", transport_name="bench",
+            transport_type="sms", content="Entry: %d" % (i,)).payload
+
+    def deliver(self, scheduled_at, payload):
+        self.delivered += 1
+
+    def schedule_batch(self, scheduler, start, count):
+        return DeferredList([
+            scheduler.schedule(0, self.make_payload(i))
+            for i in range(start, start + count)], fireOnOneErrback=True)
+
+    @inlineCallbacks
+    def run(self):
+        redis = yield TxRedisManager.from_config(self.redis_config)
+        yield redis._purge_all()
+        scheduler = Scheduler(redis, self.deliver, batch_size=self.batch_size)
+
+        start = time.time()
+
+        for batch_start in range(0, self.entries, self.concurrent):
+            yield self.schedule_batch(
+                scheduler, batch_start,
+                min(self.concurrent, self.entries - batch_start))
+
+        schedule_done = time.time()
+        schedule_time = schedule_done - start
+        print "Schedule took %.2f seconds (%.2f entries/s)" % (
+            schedule_time, self.entries / schedule_time)
+
+        yield scheduler.deliver_due(now=schedule_done + 1)
+
+        deliver_done = time.time()
+        deliver_time = deliver_done - schedule_done
+        print "Deliver took %.2f seconds (%.2f entries/s)" % (
+            deliver_time, self.entries / deliver_time)
+
+        if self.delivered != self.entries:
+            raise RuntimeError("Delivered %d entries, expected %d." % (
+                self.delivered, self.entries))
+
+        print "Entries delivered successfully."
+
+        yield redis._purge_all()
+        yield redis.close_manager()
+        print "Entries purged."
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    bench = ScheduleDeliverBenchmark(options)
+
+    def _eb(f):
+        f.printTraceback()
+
+    def _main():
+        d = maybeDeferred(bench.run)
+        d.addErrback(_eb)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callLater(0, _main)
+    reactor.run()
@@ -0,0 +1,108 @@
+import sys
+import time
+from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred, inlineCallbacks, DeferredList
+
+from vumi.components.session import SessionManager
+from vumi.persist.txredis_manager import TxRedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["sessions", "s", "10000",
+         "Total number of sessions to create, load and save."],
+        ["concurrent-sessions", "c", "100",
+         "Number of sessions to operate on concurrently."],
+        ["cache-size", None, "0",
+         "Number of sessions to cache in-process (0 disables caching)."],
+        ["redis-host", None, "localhost", "Redis host."],
+        ["redis-port", None, "6379", "Redis port."],
+    ]
+
+    optFlags = [
+        ["fake-redis", None, "Use an in-process fake Redis."],
+    ]
+
+    longdesc = """Benchmarks vumi.components.session.SessionManager"""
+
+
+class SessionBenchmark(object):
+    """
+    Creates sessions, loads them twice, updates them and lists them.
+    """
+
+    def __init__(self, options):
+        self.sessions = int(options['sessions'])
+        self.concurrent = int(options['concurrent-sessions'])
+        self.cache_size = int(options['cache-size'])
+        self.redis_config = {
+            'key_prefix': 'test.bench.session',
+            'host': options['redis-host'],
+            'port': int(options['redis-port']),
+        }
+        if options['fake-redis']:
+            self.redis_config['FAKE_REDIS'] = 'yes'
+
+    def user_ids(self):
+        return ["+27831234%03d" % (i,) for i in range(self.sessions)]
+
+    @inlineCallbacks
+    def timed(self, name, func):
+        user_ids = self.user_ids()
+        start = time.time()
+        for i in range(0, len(user_ids), self.concurrent):
+            yield DeferredList(
+                [func(user_id) for user_id in user_ids[i:i + self.concurrent]],
+                fireOnOneErrback=True)
+        taken = time.time() - start
+        print "%s took %.2f seconds (%.2f sessions/s)" % (
+            name, taken, self.sessions / taken)
+
+    @inlineCallbacks
+    def run(self):
+        redis = yield TxRedisManager.from_config(self.redis_config)
+        yield redis._purge_all()
+        sm = SessionManager(redis, max_session_length=600,
+                            cache_size=self.cache_size)
+
+        yield self.timed("Create", lambda user_id: sm.create_session(
+            user_id, state="start", count=0))
+        yield self.timed("Load", sm.load_session)
+        yield self.timed("Save", lambda user_id: sm.save_session(
+            user_id, {"state": "next", "count": 1}))
+        yield self.timed("Load after save", sm.load_session)
+
+        start = time.time()
+        sessions = yield sm.active_sessions()
+        taken = time.time() - start
+        print "Listing %d sessions took %.2f seconds" % (len(sessions), taken)
+        if len(sessions) != self.sessions:
+            raise RuntimeError("Listed %d sessions, expected %d." % (
+                len(sessions), self.sessions))
+
+        yield redis._purge_all()
+        yield redis.close_manager()
+        print "Sessions purged."
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    bench = SessionBenchmark(options)
+
+    def _eb(f):
+        f.printTraceback()
+
+    def _main():
+        d = maybeDeferred(bench.run)
+        d.addErrback(_eb)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callLater(0, _main)
+    reactor.run()
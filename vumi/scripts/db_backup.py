@@ -1,6 +1,8 @@
 # -*- test-case-name: vumi.scripts.tests.test_db_backup -*-
 import sys
 import json
+import gzip
+import zlib
 import pkg_resources
 import traceback
 import re
@@ -21,35 +23,107 @@ def vumi_version():
     return str(vumi)
 
 
+GZIP_MAGIC = '\x1f\x8b'
+
+
+def open_backup(filename):
+    """Open a backup for reading, decompressing it if it is gzipped."""
+    with open(filename, "rb") as backup:
+        magic = backup.read(len(GZIP_MAGIC))
+    if magic == GZIP_MAGIC:
+        return gzip.open(filename, "rb")
+    return open(filename, "rb")
+
+
+def chunks(items, size):
+    for i in xrange(0, len(items), size):
+        yield items[i:i + size]
+
+
 class KeyHandler(object):
+    """Dumps and restores redis keys.
+
+    Keys are handled in batches. Each batch is dumped with two pipelined
+    round trips (one for the key types and one for the values and TTLs)
+    and restored with one, no matter how many keys it contains.
+
+    :param int chunk_size:
+        Maximum number of elements to write in a single variadic command
+        when restoring lists, sets, sorted sets and hashes.
+    """
 
     REDIS_TYPES = ('string', 'list', 'set', 'zset', 'hash')
 
-    def __init__(self):
+    def __init__(self, chunk_size=1000):
+        self.chunk_size = chunk_size
         self._get_handlers = dict((ktype, getattr(self, '%s_get' % ktype))
                                   for ktype in self.REDIS_TYPES)
         self._set_handlers = dict((ktype, getattr(self, '%s_set' % ktype))
                                   for ktype in self.REDIS_TYPES)
+        self._value_filters = dict(
+            (ktype, getattr(self, '%s_value' % ktype, None))
+            for ktype in self.REDIS_TYPES)
+
+    def dump_keys(self, redis, keys):
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.type(key)
+        key_types = pipe.execute()
+
+        # Keys may have been deleted since they were listed.
+        keys = [(key, key_type) for key, key_type in zip(keys, key_types)
+                if key_type in self._get_handlers]
+        pipe = redis.pipeline()
+        for key, key_type in keys:
+            self._get_handlers[key_type](pipe, key)
+            pipe.ttl(key)
+        results = pipe.execute()
+
+        records = []
+        for (key, key_type), value, ttl in zip(
+                keys, results[::2], results[1::2]):
+            value_filter = self._value_filters[key_type]
+            if value_filter is not None:
+                value = value_filter(value)
+            if ttl is not None and ttl < 0:
+                # Newer redis versions return negative TTLs for keys that
+                # don't expire.
+                ttl = None
+            records.append({
+                'type': key_type,
+                'key': key,
+                'value': value,
+                'ttl': ttl,
+            })
+        return records
 
     def dump_key(self, redis, key):
-        key_type = redis.type(key)
-        record = {
-            'type': key_type,
-            'key': key,
-            'value': self._get_handlers[key_type](redis, key),
-            'ttl': redis.ttl(key),
-        }
+        [record] = self.dump_keys(redis, [key])
         return record
 
-    def restore_key(self, redis, record, ttl_offset=0):
-        key, key_type, ttl = record['key'], record['type'], record['ttl']
-        if ttl is not None:
-            ttl -= ttl_offset
-            if ttl <= 0:
-                return
-        self._set_handlers[key_type](redis, key, record['value'])
-        if ttl is not None:
-            redis.expire(key, int(round(ttl)))
+    def restore_keys(self, redis, records, ttl_offset=0, replace=False):
+        """Restore dumped records.
+
+        Lists, sets, sorted sets and hashes are merged into any existing
+        value for their key unless `replace` is true, in which case the
+        existing value is deleted first.
+        """
+        pipe = redis.pipeline()
+        for record in records:
+            key, key_type, ttl = record['key'], record['type'], record['ttl']
+            if ttl is not None:
+                ttl -= ttl_offset
+                if ttl <= 0:
+                    continue
+            if replace:
+                pipe.delete(key)
+            self._set_handlers[key_type](pipe, key, record['value'])
+            if ttl is not None:
+                pipe.expire(key, int(round(ttl)))
+        pipe.execute()
+
+    def restore_key(self, redis, record, ttl_offset=0, replace=False):
+        self.restore_keys(redis, [record], ttl_offset, replace)
 
     def record_okay(self, record):
         if not isinstance(record, dict):
@@ -69,28 +143,33 @@ class KeyHandler(object):
         return redis.lrange(key, 0, -1)
 
     def list_set(self, redis, key, value):
-        for item in value:
-            redis.rpush(key, item)
+        for chunk in chunks(value, self.chunk_size):
+            redis.rpush(key, *chunk)
 
     def set_get(self, redis, key):
-        return sorted(redis.smembers(key))
+        return redis.smembers(key)
+
+    def set_value(self, value):
+        return sorted(value)
 
     def set_set(self, redis, key, value):
-        for item in value:
-            redis.sadd(key, item)
+        for chunk in chunks(value, self.chunk_size):
+            redis.sadd(key, *chunk)
 
     def zset_get(self, redis, key):
         return redis.zrange(key, 0, -1, withscores=True)
 
     def zset_set(self, redis, key, value):
-        for item, score in value:
-            redis.zadd(key, **{item.encode('utf8'): score})
+        for chunk in chunks(value, self.chunk_size):
+            redis.zadd(key, **dict((item.encode('utf8'), score)
+                                   for item, score in chunk))
 
     def hash_get(self, redis, key):
         return redis.hgetall(key)
 
     def hash_set(self, redis, key, value):
-        redis.hmset(key, value)
+        for chunk in chunks(value.items(), self.chunk_size):
+            redis.hmset(key, dict(chunk))
 
 
 class BackupDbsCmd(usage.Options):
@@ -98,16 +177,50 @@ class BackupDbsCmd(usage.Options):
     synopsis = "<db-config.yaml> <db-backup-output.json>"
 
     optFlags = [
-        ["not-sorted", None, "Don't sort keys when doing backup."],
+        ["not-sorted", None, "Don't sort keys when doing backup. Unsorted "
+                             "backups are written as keys are scanned "
+                             "instead of after all keys have been listed, "
+                             "and only the names of list keys are kept in "
+                             "memory. SCAN may return a key more than once, "
+                             "so keys of other types may appear more than "
+                             "once in an unsorted backup. Restoring them "
+                             "more than once is harmless."],
+        ["gzip", None, "Compress the backup with gzip."],
+    ]
+
+    optParameters = [
+        ["batch-size", None, 1000,
+         "Number of keys to scan and fetch per round trip.", int],
+        ["shards", None, 1,
+         "Number of shards to split the keys into. Run one backup per shard "
+         "(in parallel, if you like) to back up all the keys. Keys are "
+         "assigned to shards by hash after they are scanned, so every shard "
+         "still scans the whole key space. Only fetching and writing the "
+         "values is split between shards.", int],
+        ["shard", None, 0,
+         "Which shard (from 0 to shards - 1) to back up.", int],
     ]
 
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "wb")
+        self.db_backup_name = db_backup
         self.redis_config = self.db_config.get('redis_manager', {})
 
+    def postOptions(self):
+        if self['batch-size'] < 1:
+            raise usage.UsageError("Batch size must be at least 1.")
+        if self['shards'] < 1:
+            raise usage.UsageError("Number of shards must be at least 1.")
+        if not (0 <= self['shard'] < self['shards']):
+            raise usage.UsageError(
+                "Shard must be between 0 and %d." % (self['shards'] - 1,))
+        if self['gzip']:
+            self.db_backup = gzip.open(self.db_backup_name, "wb")
+        else:
+            self.db_backup = open(self.db_backup_name, "wb")
+
     def header(self, cfg):
-        return {
+        header = {
             'vumi_version': vumi_version(),
             'format': 'LF separated JSON',
             'backup_type': 'redis',
@@ -115,24 +228,69 @@ class BackupDbsCmd(usage.Options):
             'sorted': not bool(self['not-sorted']),
             'redis_config': self.redis_config,
         }
+        if self['shards'] > 1:
+            header['shard'] = self['shard']
+            header['shards'] = self['shards']
+        return header
 
     def write_line(self, data):
         self.db_backup.write(json.dumps(data))
         self.db_backup.write("\n")
 
+    def in_shard(self, key):
+        shards = self['shards']
+        if shards == 1:
+            return True
+        return (zlib.crc32(key) & 0xffffffff) % shards == self['shard']
+
+    def scan_keys(self, redis):
+        """Yield batches of keys in our shard.
+
+        SCAN only blocks redis for a short while for each batch rather than
+        for the whole key space like KEYS does. SCAN may return a key more
+        than once. Repeats within a batch are dropped, but keys from earlier
+        batches aren't remembered, so a key may appear in several batches.
+        """
+        cursor = 0
+        while True:
+            cursor, batch = redis.scan(cursor, count=self['batch-size'])
+            keys, batch_keys = [], set()
+            for key in batch:
+                if key not in batch_keys and self.in_shard(key):
+                    batch_keys.add(key)
+                    keys.append(key)
+            if keys:
+                yield keys
+            if cursor == 0:
+                break
+
+    def key_batches(self, redis):
+        if self['not-sorted']:
+            return self.scan_keys(redis)
+        keys = sorted(set(key for batch in self.scan_keys(redis)
+                          for key in batch))
+        return chunks(keys, self['batch-size'])
+
     def run(self, cfg):
         cfg.emit("Backing up dbs ...")
         redis = cfg.get_redis(self.redis_config)
         key_handler = KeyHandler()
-        keys = redis.keys()
-        if not self.opts['not-sorted']:
-            keys = sorted(keys)
         self.write_line(self.header(cfg))
-        for key in keys:
-            record = key_handler.dump_key(redis, key)
-            self.write_line(record)
+        keys = 0
+        # Restoring a list appends its items, so a list that SCAN returned
+        # twice mustn't be backed up twice. Restoring any other type twice
+        # is harmless, so we only remember list keys.
+        seen_lists = set()
+        for batch in self.key_batches(redis):
+            for record in key_handler.dump_keys(redis, batch):
+                if record['type'] == 'list':
+                    if record['key'] in seen_lists:
+                        continue
+                    seen_lists.add(record['key'])
+                self.write_line(record)
+                keys += 1
         self.db_backup.close()
-        cfg.emit("Backed up %d keys." % (len(keys),))
+        cfg.emit("Backed up %d keys." % (keys,))
 
 
 class RestoreDbsCmd(usage.Options):
@@ -142,6 +300,9 @@ class RestoreDbsCmd(usage.Options):
     optFlags = [
         ["purge", None, "Purge all keys from the redis manager before "
                         "restoring."],
+        ["replace", None, "Replace the values of keys that already exist. "
+                          "By default, restored lists, sets, sorted sets "
+                          "and hashes are merged into existing ones."],
         ["frozen-ttls", None, "Restore TTLs of keys to the same value they "
                               "had when the backup was created, disregarding "
                               "how much time has passed since the backup was "
@@ -150,11 +311,20 @@ class RestoreDbsCmd(usage.Options):
                               "keys whose TTLs are then zero or negative."],
     ]
 
+    optParameters = [
+        ["batch-size", None, 1000,
+         "Number of keys to restore per round trip.", int],
+    ]
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.redis_config = self.db_config.get('redis_manager', {})
 
+    def postOptions(self):
+        if self['batch-size'] < 1:
+            raise usage.UsageError("Batch size must be at least 1.")
+
     def check_header(self, header):
         if header is None:
             return None, "Header not found."
@@ -199,6 +369,7 @@ class RestoreDbsCmd(usage.Options):
             redis._purge_all()
         key_handler = KeyHandler()
         keys, skipped = 0, 0
+        batch = []
         for i, line in enumerate(line_iter):
             try:
                 record = json.loads(line)
@@ -212,8 +383,15 @@ class RestoreDbsCmd(usage.Options):
                 cfg.emit("Skipping bad backup record on line %d." % (i + 1,))
                 skipped += 1
                 continue
-            key_handler.restore_key(redis, record, ttl_offset)
+            batch.append(record)
             keys += 1
+            if len(batch) >= self['batch-size']:
+                key_handler.restore_keys(
+                    redis, batch, ttl_offset, self.opts['replace'])
+                batch = []
+        if batch:
+            key_handler.restore_keys(
+                redis, batch, ttl_offset, self.opts['replace'])
 
         cfg.emit("%d keys successfully restored." % keys)
         if skipped != 0:
@@ -227,7 +405,7 @@ class MigrateDbsCmd(usage.Options):
 
     def parseArgs(self, migration_config, db_backup, migrated_backup):
         self.migration_config = yaml.safe_load(open(migration_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
         self.migrated_backup = open(migrated_backup, "wb")
 
     def postOptions(self):
@@ -358,7 +536,7 @@ class AnalyzeCmd(usage.Options):
     ]
 
     def parseArgs(self, db_backup):
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup)
 
     def run(self, cfg):
         backup_lines = iter(self.db_backup)
@@ -1,10 +1,17 @@
 # -*- test-case-name: vumi.scripts.tests.test_model_migrator -*-
+import os
 import sys
+import json
+import time
+from collections import defaultdict
 
+from twisted.internet.defer import (
+    inlineCallbacks, gatherResults, DeferredSemaphore, maybeDeferred)
+from twisted.internet.task import react
 from twisted.python import usage
 
 from vumi.utils import load_class_by_string
-from vumi.persist.riak_manager import RiakManager
+from vumi.persist.txriak_manager import TxRiakManager
 
 
 class Options(usage.Options):
@@ -17,10 +24,23 @@ class Options(usage.Options):
         ["keys", None, None,
          "Migrate these specific keys rather than the whole bucket."
          " E.g. --keys 'foo,bar,baz'"],
+        ["index-page-size", "p", 1000,
+         "The number of keys to fetch in each index query.", int],
+        ["concurrency", "c", 4,
+         "The number of bunches of objects to load and save at once.", int],
+        ["continuation-token", None, None,
+         "Continuation token of the index page to start from. Useful for"
+         " resuming a migration that was interrupted."],
+        ["progress-file", None, None,
+         "File to record migration progress in after each index page. If"
+         " the file exists, the migration resumes from the progress"
+         " recorded in it."],
     ]
 
     optFlags = [
-        ["dry-run", None, "Don't save anything back to Riak."],
+        ["dry-run", None, "Don't load or save any objects. Report how"
+                          " many objects are at each model version and how"
+                          " many keys are tombstones."],
     ]
 
     longdesc = """Offline model migrator. Necessary for updating
@@ -33,74 +53,223 @@ class Options(usage.Options):
             raise usage.UsageError("Please specify a model class.")
         if self['bucket-prefix'] is None:
             raise usage.UsageError("Please specify a bucket prefix.")
+        if self['index-page-size'] < 1:
+            raise usage.UsageError("Index page size must be at least 1.")
+        if self['concurrency'] < 1:
+            raise usage.UsageError("Concurrency must be at least 1.")
 
 
-class ProgressEmitter(object):
-    """Report progress as a percentage to an emitter."""
+class ProgressReporter(object):
+    """Report the number of objects migrated and the throughput."""
 
-    def __init__(self, total, emit):
+    def __init__(self, emit, processed=0, get_time=time.time):
         self.emit = emit
-        self.total = total
-        self.percentage = 0
+        self.get_time = get_time
+        self.start_time = get_time()
+        self.start_processed = processed
+        self.processed = processed
 
-    def _calculate_percentage(self, value):
-        if value == 0:
-            return 0
-        return int(value * 100.0 / self.total)
-
-    def update(self, value):
-        old_percentage = self.percentage
-        self.percentage = self._calculate_percentage(value)
-        if self.percentage != old_percentage:
-            self.emit(self.percentage)
+    def update(self, processed):
+        self.processed += processed
+        elapsed = self.get_time() - self.start_time
+        done = self.processed - self.start_processed
+        rate = (done / elapsed) if elapsed > 0 else 0.0
+        self.emit("%d objects processed (%.1f objects/s)." % (
+            self.processed, rate))
 
 
 class ModelMigrator(object):
+
+    VERSION_MAP_FUNCTION = """
+        function (v) {
+            try {
+                var version = JSON.parse(v.values[0].data)['$VERSION'];
+            } catch (e) {
+                return [];
+            }
+            return [version === undefined ? null : version];
+        }
+        """
+
     def __init__(self, options):
         self.options = options
+        self.dry_run = options["dry-run"]
+        self.index_page_size = options["index-page-size"]
+        self.concurrency = options["concurrency"]
+        self.progress_file = options["progress-file"]
         model_cls = load_class_by_string(options['model'])
         riak_config = {
             'bucket_prefix': options['bucket-prefix'],
         }
-        manager = self.get_riak_manager(riak_config)
-        self.model = manager.proxy(model_cls)
+        self.manager = self.get_riak_manager(riak_config)
+        self.model_cls = model_cls
+        self.model = self.manager.proxy(model_cls)
+        self.versions = defaultdict(int)
+        self.tombstones = 0
 
     def get_riak_manager(self, riak_config):
-        return RiakManager.from_config(riak_config)
+        # This uses the default HTTP transport. Index queries can't be paged
+        # over protocol buffers, so we'd get every key in a single page.
+        return TxRiakManager.from_config(riak_config)
 
     def emit(self, s):
         print s
 
+    def get_time(self):
+        return time.time()
+
+    def load_progress(self):
+        if self.progress_file is None or not os.path.exists(
+                self.progress_file):
+            return None
+        with open(self.progress_file, "rb") as progress_file:
+            return json.load(progress_file)
+
+    def save_progress(self, continuation, processed):
+        if self.progress_file is None:
+            return
+        progress = {
+            'continuation': continuation,
+            'processed': processed,
+            # JSON object keys must be strings, but versions needn't be.
+            'versions': self.versions.items(),
+            'tombstones': self.tombstones,
+        }
+        # We write to a temporary file and rename it so that an interrupted
+        # write doesn't lose the previous checkpoint.
+        tmp_file = self.progress_file + ".tmp"
+        with open(tmp_file, "wb") as progress_file:
+            json.dump(progress, progress_file)
+        os.rename(tmp_file, self.progress_file)
+
+    def count_versions(self, keys):
+        mr = self.manager.mr_from_keys(self.model_cls, keys)
+        mr._riak_mapreduce_obj.map(function=self.VERSION_MAP_FUNCTION)
+        d = self.manager.run_map_reduce(
+            mr._riak_mapreduce_obj, lambda mgr, version: version)
+        return d.addCallback(self.add_versions, len(keys))
+
+    def add_versions(self, versions, key_count):
+        for version in versions:
+            self.versions[version] += 1
+        # The map function returns nothing for tombstones.
+        self.tombstones += key_count - len(versions)
+
+    @inlineCallbacks
+    def migrate_key(self, key):
+        try:
+            obj = yield self.model.load(key)
+            if obj is not None:
+                if not self.dry_run:
+                    yield obj.save()
+            else:
+                self.emit("Skipping tombstone key %r." % (key,))
+        except Exception, e:
+            self.emit("Failed to migrate key %r:" % (key,))
+            self.emit("  %s: %s" % (type(e).__name__, e))
+
+    @inlineCallbacks
+    def migrate_bunch(self, keys):
+        if self.dry_run:
+            # The versions come from a mapreduce, so we don't need to load
+            # the objects.
+            yield self.count_versions(keys)
+            return
+        try:
+            bunches = yield gatherResults(
+                list(self.model.load_all_bunches(keys)))
+        except Exception:
+            # Something in the bunch couldn't be loaded, so we fall back to
+            # loading the keys one at a time to find out which.
+            yield gatherResults([self.migrate_key(key) for key in keys])
+            return
+
+        objs = [obj for bunch in bunches for obj in bunch]
+        loaded = set(obj.key for obj in objs)
+        for key in keys:
+            if key not in loaded:
+                self.emit("Skipping tombstone key %r." % (key,))
+        if not self.dry_run:
+            yield gatherResults([self.save_obj(obj) for obj in objs])
+
+    @inlineCallbacks
+    def save_obj(self, obj):
+        try:
+            yield obj.save()
+        except Exception, e:
+            self.emit("Failed to migrate key %r:" % (obj.key,))
+            self.emit("  %s: %s" % (type(e).__name__, e))
+
+    def migrate_keys(self, keys):
+        # Depending on our Riak client, Python version, and JSON library we may
+        # get bytes or unicode here.
+        keys = [k.decode('utf-8') if isinstance(k, str) else k for k in keys]
+        bunch_size = self.manager.load_bunch_size
+        semaphore = DeferredSemaphore(self.concurrency)
+        return gatherResults([
+            semaphore.run(self.migrate_bunch, keys[i:i + bunch_size])
+            for i in xrange(0, len(keys), bunch_size)])
+
+    def emit_versions(self):
+        self.emit("Model versions found:")
+        for version, count in sorted(self.versions.items()):
+            if version is None:
+                version = "unversioned"
+            self.emit("  %s: %d" % (version, count))
+        if self.tombstones:
+            self.emit("Tombstones found: %d" % (self.tombstones,))
+
+    @inlineCallbacks
+    def migrate_pages(self):
+        continuation = self.options["continuation-token"]
+        processed = 0
+        progress = self.load_progress()
+        if progress is not None:
+            continuation = progress['continuation']
+            processed = progress['processed']
+            self.versions.update(dict(progress['versions']))
+            self.tombstones = progress.get('tombstones', 0)
+            if continuation is None:
+                self.emit("Migration already complete.")
+                return
+            self.emit("Resuming migration after %d objects ..." % (
+                processed,))
+        else:
+            self.emit("Migrating ...")
+
+        reporter = ProgressReporter(self.emit, processed, self.get_time)
+        page = yield self.model.all_keys_page(
+            max_results=self.index_page_size, continuation=continuation)
+        while page is not None:
+            # Fetch the next page while we migrate this one.
+            next_page_d = maybeDeferred(page.next_page)
+            yield self.migrate_keys(page.keys)
+            reporter.update(len(page))
+            self.save_progress(page.continuation, reporter.processed)
+            if page.has_next_page():
+                self.emit("Continuation token: %r" % (page.continuation,))
+            page = yield next_page_d
+
+    @inlineCallbacks
     def run(self):
-        dry_run = self.options["dry-run"]
         if self.options["keys"] is not None:
             keys = self.options["keys"].split(",")
             self.emit("Migrating %d specified keys ..." % len(keys))
+            reporter = ProgressReporter(self.emit, 0, self.get_time)
+            yield self.migrate_keys(keys)
+            reporter.update(len(keys))
         else:
-            keys = self.model.all_keys()
-            self.emit("%d keys found. Migrating ..." % len(keys))
-        # Depending on our Riak client, Python version, and JSON library we may
-        # get bytes or unicode here.
-        keys = [k.decode('utf-8') if isinstance(k, str) else k for k in keys]
-        progress = ProgressEmitter(
-            len(keys),
-            lambda p: self.emit("%s%% complete." % (p,))
-        )
-        for i, key in enumerate(keys):
-            try:
-                obj = self.model.load(key)
-                if obj is not None:
-                    if not dry_run:
-                        obj.save()
-                else:
-                    self.emit("Skipping tombstone key %r." % (key,))
-            except Exception, e:
-                self.emit("Failed to migrate key %r:" % (key,))
-                self.emit("  %s: %s" % (type(e).__name__, e))
-            progress.update(i)
+            yield self.migrate_pages()
+        if self.dry_run:
+            self.emit_versions()
         self.emit("Done.")
 
 
+def main(_reactor, options):
+    migrator = ModelMigrator(options)
+    return migrator.run()
+
+
 if __name__ == '__main__':
     try:
         options = Options()
@@ -110,5 +279,4 @@ if __name__ == '__main__':
         print '%s: Try --help for usage details.' % (sys.argv[0])
         sys.exit(1)
 
-    cfg = ModelMigrator(options)
-    cfg.run()
+    react(main, [options])
@@ -1,9 +1,11 @@
 """Tests for vumi.scripts.db_backup."""
 
 import json
+import gzip
 import datetime
 
 import yaml
+from twisted.python import usage
 
 from vumi.scripts.db_backup import ConfigHolder, Options, vumi_version
 from vumi.tests.helpers import VumiTestCase, PersistenceHelper
@@ -146,6 +148,126 @@ class TestBackupDbCmd(DbBackupBaseTestCase):
             self.assertEqual(record, {'key': 's', 'type': 'string',
                                       'value': "foo"})
 
+    def test_backup_batches(self):
+        for i in range(25):
+            self.redis.set("bar:s%02d" % (i,), str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--batch-size=4",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output[-1], 'Backed up 25 keys.')
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup][1:]
+        self.assertEqual([r['key'] for r in records],
+                         ["s%02d" % (i,) for i in range(25)])
+
+    def test_backup_not_sorted(self):
+        for i in range(25):
+            self.redis.set("bar:s%02d" % (i,), str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--batch-size=4",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output[-1], 'Backed up 25 keys.')
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(records[0]['sorted'], False)
+        self.assertEqual(sorted(r['key'] for r in records[1:]),
+                         ["s%02d" % (i,) for i in range(25)])
+
+    def test_backup_not_sorted_duplicate_keys(self):
+        for i in range(5):
+            self.redis.rpush("bar:l%02d" % (i,), str(i))
+        orig_get_sub_redis = self.get_sub_redis
+
+        def get_sub_redis(config):
+            redis = orig_get_sub_redis(config)
+            orig_scan = redis.scan
+
+            def scan(cursor, *args, **kw):
+                # SCAN may return keys more than once.
+                cursor, keys = orig_scan(cursor, *args, **kw)
+                return cursor, keys + keys
+
+            redis.scan = scan
+            return redis
+
+        self.get_sub_redis = get_sub_redis
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--batch-size=2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output[-1], 'Backed up 5 keys.')
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(sorted(r['key'] for r in records[1:]),
+                         ["l%02d" % (i,) for i in range(5)])
+
+    def test_backup_not_sorted_duplicate_keys_across_batches(self):
+        self.redis.set("bar:s", "1")
+        self.redis.rpush("bar:l", "1")
+        orig_get_sub_redis = self.get_sub_redis
+
+        def get_sub_redis(config):
+            redis = orig_get_sub_redis(config)
+            orig_scan = redis.scan
+
+            def scan(cursor, *args, **kw):
+                # Return every key twice, in two separate batches.
+                if cursor == 0:
+                    return 1, ["s", "l"]
+                return orig_scan(0, *args, **kw)
+
+            redis.scan = scan
+            return redis
+
+        self.get_sub_redis = get_sub_redis
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        # The list is only backed up once. The string is harmlessly backed
+        # up twice.
+        self.assertEqual(sorted(r['key'] for r in records[1:]),
+                         ["l", "s", "s"])
+        self.assertEqual(cfg.output[-1], 'Backed up 3 keys.')
+
+    def test_backup_gzip(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--gzip", self.mkdbconfig("bar"),
+                             db_backup])
+        cfg.run()
+        backup = gzip.open(db_backup)
+        self.assertEqual([json.loads(x) for x in backup][1:], [
+            {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+
+    def test_backup_shards(self):
+        keys = ["s%02d" % (i,) for i in range(20)]
+        for key in keys:
+            self.redis.set("bar:%s" % (key,), "foo")
+        backed_up = []
+        for shard in range(3):
+            db_backup = self.mktemp()
+            cfg = self.make_cfg(["backup", "--shards=3", "--shard=%d" % shard,
+                                 self.mkdbconfig("bar"), db_backup])
+            cfg.run()
+            with open(db_backup) as backup:
+                records = [json.loads(x) for x in backup]
+            self.assertEqual(records[0]['shard'], shard)
+            self.assertEqual(records[0]['shards'], 3)
+            shard_keys = [r['key'] for r in records[1:]]
+            self.assertTrue(len(shard_keys) < len(keys))
+            backed_up.extend(shard_keys)
+        self.assertEqual(sorted(backed_up), keys)
+
+    def test_backup_bad_shard(self):
+        self.assertRaises(usage.UsageError, self.make_cfg, [
+            "backup", "--shards=3", "--shard=3", self.mkdbconfig("bar"),
+            self.mktemp()])
+
 
 class TestRestoreDbCmd(DbBackupBaseTestCase):
 
@@ -267,6 +389,55 @@ class TestRestoreDbCmd(DbBackupBaseTestCase):
                              'ttl': None}],
                            {'h': hvalue}, self.redis.hgetall)
 
+    def test_restore_large_list(self):
+        lvalue = ['v%d' % (i,) for i in range(2500)]
+        self.check_restore([{'key': 'l', 'type': 'list', 'value': lvalue,
+                             'ttl': None}],
+                           {'l': lvalue},
+                           lambda k: self.redis.lrange(k, 0, -1))
+
+    def test_restore_merges_with_existing(self):
+        self.redis.rpush("bar:l", "old")
+        lvalue = ['z', 'a', 'c']
+        self.check_restore([{'key': 'l', 'type': 'list', 'value': lvalue,
+                             'ttl': None}],
+                           {'l': ['old'] + lvalue},
+                           lambda k: self.redis.lrange(k, 0, -1))
+
+    def test_restore_replaces_existing(self):
+        self.redis.rpush("bar:l", "old")
+        lvalue = ['z', 'a', 'c']
+        self.check_restore([{'key': 'l', 'type': 'list', 'value': lvalue,
+                             'ttl': None}],
+                           {'l': lvalue},
+                           lambda k: self.redis.lrange(k, 0, -1),
+                           args=["--replace"])
+
+    def test_restore_batches(self):
+        backup_data = [{'key': 's%02d' % (i,), 'type': 'string',
+                        'value': str(i), 'ttl': None} for i in range(25)]
+        self.check_restore(backup_data,
+                           dict(('s%02d' % (i,), str(i)) for i in range(25)),
+                           self.redis.get, args=["--batch-size=4"])
+
+    def test_restore_gzip(self):
+        backup_data = [
+            {'backup_type': 'redis',
+             'timestamp': datetime.datetime.utcnow().isoformat()},
+            {'key': 's', 'type': 'string', 'value': 'ping', 'ttl': None},
+        ]
+        db_backup = self.mktemp()
+        backup = gzip.open(db_backup, "wb")
+        backup.write("\n".join(json.dumps(x) for x in backup_data))
+        backup.close()
+        cfg = self.make_cfg(["restore", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output, [
+            'Restoring dbs ...',
+            '1 keys successfully restored.',
+        ])
+        self.assertEqual(self.redis.get("bar:s"), "ping")
+
     def test_restore_ttl(self):
         self.check_restore([{'key': 's', 'type': 'string', 'value': 'ping',
                              'ttl': 30}],
@@ -1,5 +1,8 @@
 """Tests for vumi.scripts.model_migrator."""
 
+import json
+
+from twisted.internet.defer import inlineCallbacks, succeed, fail
 from twisted.python import usage
 
 from vumi.persist.model import Model
@@ -21,6 +24,9 @@ class StubbedModelMigrator(ModelMigrator):
     def emit(self, s):
         self.output.append(s)
 
+    def get_time(self):
+        return 0
+
     def get_riak_manager(self, riak_config):
         return self.testcase.get_sub_riak(riak_config)
 
@@ -28,8 +34,7 @@ class StubbedModelMigrator(ModelMigrator):
 class TestModelMigrator(VumiTestCase):
 
     def setUp(self):
-        self.persistence_helper = PersistenceHelper(
-            use_riak=True, is_sync=True)
+        self.persistence_helper = PersistenceHelper(use_riak=True)
         self.add_cleanup(self.persistence_helper.cleanup)
         self.riak_manager = self.persistence_helper.get_riak_manager()
         self.model = self.riak_manager.proxy(SimpleModel)
@@ -53,26 +58,21 @@ class TestModelMigrator(VumiTestCase):
                          self.expected_bucket_prefix)
         return self.riak_manager
 
+    @inlineCallbacks
     def mk_simple_models(self, n):
         for i in range(n):
             obj = self.model(u"key-%d" % i, a=u"value-%d" % i)
-            obj.save()
-
-    def record_load_and_store(self):
-        loads, stores = [], []
-        orig_load = self.riak_manager.load
-
-        def record_load(modelcls, key, result=None):
-            loads.append(key)
-            return orig_load(modelcls, key, result=result)
+            yield obj.save()
 
-        self.patch(self.riak_manager, 'load', record_load)
+    def record_stores(self):
+        stores = []
 
         def record_store(obj):
             stores.append(obj.key)
+            return succeed(obj)
 
         self.patch(self.riak_manager, 'store', record_store)
-        return loads, stores
+        return stores
 
     def test_model_class_required(self):
         self.assertRaises(usage.UsageError, self.make_migrator, [
@@ -84,86 +84,195 @@ class TestModelMigrator(VumiTestCase):
             "-m", self.model_cls_path,
         ])
 
+    def test_concurrency_must_be_positive(self):
+        self.assertRaises(usage.UsageError, self.make_migrator,
+                          self.default_args + ["--concurrency", "0"])
+
+    @inlineCallbacks
     def test_successful_migration(self):
-        self.mk_simple_models(3)
-        loads, stores = self.record_load_and_store()
+        yield self.mk_simple_models(3)
+        stores = self.record_stores()
         cfg = self.make_migrator()
-        cfg.run()
+        yield cfg.run()
         self.assertEqual(cfg.output, [
-            "3 keys found. Migrating ...",
-            "33% complete.", "66% complete.",
+            "Migrating ...",
+            "3 objects processed (0.0 objects/s).",
             "Done.",
         ])
-        self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(3)])
 
-    def test_migration_with_tombstones(self):
-        self.mk_simple_models(3)
-
-        def tombstone_load(modelcls, key, result=None):
-            return None
+    @inlineCallbacks
+    def test_migration_in_pages(self):
+        yield self.mk_simple_models(5)
+        stores = self.record_stores()
+        cfg = self.make_migrator(self.default_args + ["-p", "2"])
+        yield cfg.run()
+        progress = [line for line in cfg.output if "objects processed" in line]
+        self.assertEqual(progress, [
+            "2 objects processed (0.0 objects/s).",
+            "4 objects processed (0.0 objects/s).",
+            "5 objects processed (0.0 objects/s).",
+        ])
+        tokens = [line for line in cfg.output
+                  if line.startswith("Continuation token: ")]
+        self.assertEqual(len(tokens), 2)
+        self.assertEqual(sorted(stores), [u"key-%d" % i for i in range(5)])
 
-        self.patch(self.riak_manager, 'load', tombstone_load)
+    @inlineCallbacks
+    def test_migration_with_tombstones(self):
+        yield self.mk_simple_models(3)
+        self.patch(self.riak_manager, '_load_bunch',
+                   lambda model, keys: succeed([]))
 
         cfg = self.make_migrator()
-        cfg.run()
+        yield cfg.run()
         for i in range(3):
             self.assertTrue(("Skipping tombstone key u'key-%d'." % i)
                             in cfg.output)
         self.assertEqual(cfg.output[:1], [
-            "3 keys found. Migrating ...",
+            "Migrating ...",
         ])
         self.assertEqual(cfg.output[-2:], [
-            "66% complete.",
+            "3 objects processed (0.0 objects/s).",
             "Done.",
         ])
 
+    @inlineCallbacks
     def test_migration_with_failures(self):
-        self.mk_simple_models(3)
+        yield self.mk_simple_models(3)
+        self.patch(self.riak_manager, '_load_bunch',
+                   lambda model, keys: fail(ValueError("Failed to load.")))
 
         def error_load(modelcls, key, result=None):
-            raise ValueError("Failed to load.")
+            return fail(ValueError("Failed to load."))
 
         self.patch(self.riak_manager, 'load', error_load)
 
         cfg = self.make_migrator()
-        cfg.run()
+        yield cfg.run()
         line_pairs = zip(cfg.output, cfg.output[1:])
         for i in range(3):
             self.assertTrue((
-                "Failed to migrate key u'key-0':",
+                "Failed to migrate key u'key-%d':" % i,
                 "  ValueError: Failed to load.",
             ) in line_pairs)
         self.assertEqual(cfg.output[:1], [
-            "3 keys found. Migrating ...",
+            "Migrating ...",
         ])
         self.assertEqual(cfg.output[-2:], [
-            "66% complete.",
+            "3 objects processed (0.0 objects/s).",
             "Done.",
         ])
 
+    @inlineCallbacks
     def test_migrating_specific_keys(self):
-        self.mk_simple_models(3)
-        loads, stores = self.record_load_and_store()
+        yield self.mk_simple_models(3)
+        stores = self.record_stores()
         cfg = self.make_migrator(self.default_args + ["--keys", "key-1,key-2"])
-        cfg.run()
+        yield cfg.run()
         self.assertEqual(cfg.output, [
             "Migrating 2 specified keys ...",
-            "50% complete.",
+            "2 objects processed (0.0 objects/s).",
             "Done.",
         ])
-        self.assertEqual(sorted(loads), [u"key-1", u"key-2"])
         self.assertEqual(sorted(stores), [u"key-1", u"key-2"])
 
+    @inlineCallbacks
     def test_dry_run(self):
-        self.mk_simple_models(3)
-        loads, stores = self.record_load_and_store()
+        yield self.mk_simple_models(3)
+        stores = self.record_stores()
         cfg = self.make_migrator(self.default_args + ["--dry-run"])
-        cfg.run()
+        yield cfg.run()
         self.assertEqual(cfg.output, [
-            "3 keys found. Migrating ...",
-            "33% complete.", "66% complete.",
+            "Migrating ...",
+            "3 objects processed (0.0 objects/s).",
+            "Model versions found:",
+            "  unversioned: 3",
             "Done.",
         ])
-        self.assertEqual(sorted(loads), [u"key-%d" % i for i in range(3)])
         self.assertEqual(sorted(stores), [])
+
+    @inlineCallbacks
+    def test_dry_run_does_not_load_objects(self):
+        yield self.mk_simple_models(3)
+        self.patch(self.riak_manager, '_load_bunch',
+                   lambda model, keys: fail(ValueError("Loaded.")))
+        self.patch(self.riak_manager, 'load',
+                   lambda modelcls, key, result=None: fail(
+                       ValueError("Loaded.")))
+        cfg = self.make_migrator(self.default_args + ["--dry-run"])
+        yield cfg.run()
+        self.assertEqual(cfg.output, [
+            "Migrating ...",
+            "3 objects processed (0.0 objects/s).",
+            "Model versions found:",
+            "  unversioned: 3",
+            "Done.",
+        ])
+
+    @inlineCallbacks
+    def test_dry_run_with_tombstones(self):
+        yield self.mk_simple_models(3)
+        orig_run_map_reduce = self.riak_manager.run_map_reduce
+
+        def run_map_reduce(mapreduce, mapper_func=None, reducer_func=None):
+            # Tombstones produce no mapreduce results.
+            d = orig_run_map_reduce(mapreduce, mapper_func, reducer_func)
+            return d.addCallback(lambda results: results[1:])
+
+        self.patch(self.riak_manager, 'run_map_reduce', run_map_reduce)
+        cfg = self.make_migrator(self.default_args + ["--dry-run"])
+        yield cfg.run()
+        self.assertEqual(cfg.output[-4:], [
+            "Model versions found:",
+            "  unversioned: 2",
+            "Tombstones found: 1",
+            "Done.",
+        ])
+
+    @inlineCallbacks
+    def test_progress_file(self):
+        yield self.mk_simple_models(3)
+        self.record_stores()
+        progress_file = self.mktemp()
+        cfg = self.make_migrator(self.default_args + [
+            "-p", "2", "--progress-file", progress_file])
+        yield cfg.run()
+        with open(progress_file) as f:
+            progress = json.load(f)
+        self.assertEqual(progress['continuation'], None)
+        self.assertEqual(progress['processed'], 3)
+
+        cfg = self.make_migrator(self.default_args + [
+            "-p", "2", "--progress-file", progress_file])
+        yield cfg.run()
+        self.assertEqual(cfg.output, [
+            "Migration already complete.",
+            "Done.",
+        ])
+
+    @inlineCallbacks
+    def test_resume_from_progress_file(self):
+        yield self.mk_simple_models(5)
+        first_page = yield self.model.all_keys_page(max_results=2)
+        progress_file = self.mktemp()
+        with open(progress_file, "wb") as f:
+            json.dump({
+                'continuation': first_page.continuation,
+                'processed': 2,
+                'versions': [],
+            }, f)
+
+        stores = self.record_stores()
+        cfg = self.make_migrator(self.default_args + [
+            "-p", "2", "--progress-file", progress_file])
+        yield cfg.run()
+        self.assertEqual(cfg.output[0],
+                         "Resuming migration after 2 objects ...")
+        self.assertEqual(cfg.output[-2:], [
+            "5 objects processed (0.0 objects/s).",
+            "Done.",
+        ])
+        self.assertEqual(
+            sorted(stores + list(first_page)),
+            [u"key-%d" % i for i in range(5)])
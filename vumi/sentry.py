@@ -1,14 +1,23 @@
 # -*- test-case-name: vumi.tests.test_sentry -*-
 
 import logging
+from collections import deque
 
 from twisted.python import log
 from twisted.web.client import HTTPClientFactory, _makeGetterFactory
-from twisted.internet.defer import DeferredList
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, maybeDeferred, succeed
 from twisted.application.service import Service
 
+from vumi.blinkenlights.metrics import Count, MetricManager
+from vumi.utils import LRUCache
+
 
 DEFAULT_LOG_CONTEXT_SENTINEL = "_SENTRY_CONTEXT_"
+DEFAULT_MAX_QUEUE_SIZE = 100
+DEFAULT_CONCURRENCY = 2
+DEFAULT_DEDUP_WINDOW = 60
+DEFAULT_MAX_FINGERPRINTS = 1000
 
 
 class QuietHTTPClientFactory(HTTPClientFactory):
@@ -25,7 +34,93 @@ def quiet_get_page(url, contextFactory=None, *args, **kwargs):
         *args, **kwargs).deferred
 
 
-def vumi_raven_client(dsn, log_context_sentinel=None):
+class SentryReportQueue(object):
+    """Bounded queue of reports waiting to be sent to Sentry.
+
+    At most `concurrency` reports are sent at once. If `max_size` reports
+    are already waiting, the oldest one is dropped to make room for a new
+    one, so that a Sentry server that is slow or down can't make reports
+    pile up without bound.
+
+    :param int max_size:
+        Maximum number of reports waiting to be sent.
+    :param int concurrency:
+        Maximum number of reports being sent at once.
+    :param dict log_context:
+        Context to log send failures with, so that they aren't reported
+        to Sentry themselves.
+    :param metrics:
+        Optional :class:`vumi.blinkenlights.metrics.MetricManager` to count
+        sent and dropped reports with. Nothing is counted until it has been
+        started.
+    """
+
+    def __init__(self, max_size, concurrency, log_context=None,
+                 metrics=None):
+        self.max_size = max_size
+        self.concurrency = concurrency
+        self.log_context = log_context or {}
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.register(Count('sentry.sent'))
+            metrics.register(Count('sentry.dropped'))
+        self.sent = 0
+        self.dropped = 0
+        self._pending = deque()
+        self._in_flight = 0
+        self._flush_waiters = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, send_report, *args):
+        """Queue a call to `send_report(*args)`, which should return a
+        Deferred that fires once the report has been sent."""
+        if len(self._pending) >= self.max_size:
+            self._pending.popleft()
+            self._count('dropped')
+        self._pending.append((send_report, args))
+        self._send_pending()
+
+    def flush(self):
+        """Return a Deferred that fires once all queued reports have been
+        sent (or have failed to send)."""
+        if not self._pending and not self._in_flight:
+            return succeed(None)
+        d = Deferred()
+        self._flush_waiters.append(d)
+        return d
+
+    def _count(self, name):
+        setattr(self, name, getattr(self, name) + 1)
+        if self.metrics is not None and self.metrics.is_started():
+            self.metrics['sentry.%s' % (name,)].inc()
+
+    def _send_pending(self):
+        while self._pending and self._in_flight < self.concurrency:
+            send_report, args = self._pending.popleft()
+            self._in_flight += 1
+            d = maybeDeferred(send_report, *args)
+            d.addCallbacks(self._report_sent, self._report_failed)
+            d.addBoth(self._report_done)
+
+    def _report_sent(self, _result):
+        self._count('sent')
+
+    def _report_failed(self, failure):
+        log.err(failure, **self.log_context)
+
+    def _report_done(self, _result):
+        self._in_flight -= 1
+        self._send_pending()
+        if not self._pending and not self._in_flight:
+            flush_waiters, self._flush_waiters = self._flush_waiters, []
+            for d in flush_waiters:
+                d.callback(None)
+
+
+def vumi_raven_client(dsn, log_context_sentinel=None, max_queue_size=None,
+                      concurrency=None, metrics=None):
     """Construct a custom raven client and transport-set pair.
 
     The raven client assumes that sends via transports return success or
@@ -37,6 +132,9 @@ def vumi_raven_client(dsn, log_context_sentinel=None):
     information back success and failure back to the client instance once
     deferreds complete.
 
+    Reports are sent through a :class:`SentryReportQueue` that holds at
+    most `max_queue_size` reports and sends at most `concurrency` at once.
+
     Pull-requests with better solutions welcomed.
     """
 
@@ -44,10 +142,15 @@ def vumi_raven_client(dsn, log_context_sentinel=None):
     from raven.transport.base import TwistedHTTPTransport
     from raven.transport.registry import TransportRegistry
 
-    remaining_deferreds = set()
     if log_context_sentinel is None:
         log_context_sentinel = DEFAULT_LOG_CONTEXT_SENTINEL
     log_context = {log_context_sentinel: True}
+    if max_queue_size is None:
+        max_queue_size = DEFAULT_MAX_QUEUE_SIZE
+    if concurrency is None:
+        concurrency = DEFAULT_CONCURRENCY
+    report_queue = SentryReportQueue(
+        max_queue_size, concurrency, log_context, metrics)
 
     class VumiRavenHTTPTransport(TwistedHTTPTransport):
 
@@ -56,18 +159,9 @@ def vumi_raven_client(dsn, log_context_sentinel=None):
         def _get_page(self, data, headers):
             d = quiet_get_page(self._url, method='POST', postdata=data,
                                headers=headers)
-            self._track_deferred(d)
             self._track_client_state(d)
             return d
 
-        def _track_deferred(self, d):
-            remaining_deferreds.add(d)
-            d.addBoth(self._untrack_deferred, d)
-
-        def _untrack_deferred(self, result, d):
-            remaining_deferreds.discard(d)
-            return result
-
         def _track_client_state(self, d):
             d.addCallbacks(self._set_client_success, self._set_client_fail)
 
@@ -80,8 +174,7 @@ def vumi_raven_client(dsn, log_context_sentinel=None):
             return result
 
         def send(self, data, headers):
-            d = self._get_page(data, headers)
-            d.addErrback(lambda f: log.err(f, **log_context))
+            report_queue.put(self._get_page, data, headers)
 
     class VumiRavenClient(raven.Client):
 
@@ -89,29 +182,61 @@ def vumi_raven_client(dsn, log_context_sentinel=None):
             VumiRavenHTTPTransport
         ])
 
+        report_queue = None
+
         def teardown(self):
-            return DeferredList(remaining_deferreds)
+            return self.report_queue.flush()
 
     client = VumiRavenClient(dsn)
+    client.report_queue = report_queue
     return client
 
 
 class SentryLogObserver(object):
-    """Twisted log observer that logs to a Raven Sentry client."""
+    """Twisted log observer that logs to a Raven Sentry client.
+
+    Repeats of an error or message that has already been reported within
+    the last `dedup_window` seconds aren't reported straight away. When
+    the window ends, the last repeat is reported with the number of
+    repeats suppressed as the `suppressed_occurrences` extra value. This
+    also happens when a fingerprint is evicted to make room for another
+    and when :meth:`flush` is called. Errors are considered repeats if
+    they have the same logger, exception type and traceback. Messages are
+    repeats if they have the same logger, level and text.
+    """
 
     DEFAULT_ERROR_LEVEL = logging.ERROR
     DEFAULT_LOG_LEVEL = logging.INFO
     LOG_LEVEL_THRESHOLD = logging.WARN
 
     def __init__(self, client, logger_name, worker_id,
-                 log_context_sentinel=None):
+                 log_context_sentinel=None, dedup_window=None,
+                 max_fingerprints=None, clock=None, metrics=None):
         if log_context_sentinel is None:
             log_context_sentinel = DEFAULT_LOG_CONTEXT_SENTINEL
+        if dedup_window is None:
+            dedup_window = DEFAULT_DEDUP_WINDOW
+        if max_fingerprints is None:
+            max_fingerprints = DEFAULT_MAX_FINGERPRINTS
         self.client = client
         self.logger_name = logger_name
         self.worker_id = worker_id
         self.log_context_sentinel = log_context_sentinel
         self.log_context = {self.log_context_sentinel: True}
+        self.dedup_window = dedup_window
+        self.max_fingerprints = max_fingerprints
+        self.clock = clock if clock is not None else reactor
+        self.metrics = metrics
+        if metrics is not None:
+            metrics.register(Count('sentry.suppressed'))
+        self.suppressed = 0
+        # fingerprint -> [time reported, repeats suppressed since, last
+        # repeat, delayed call that reports the repeats]
+        self._reported = LRUCache(max_fingerprints, clock=self.clock,
+                                  on_evict=self._evicted)
+        # fingerprint -> entry from _reported, for entries with repeats
+        # waiting to be reported
+        self._pending = {}
 
     def level_for_event(self, event):
         level = event.get('logLevel')
@@ -129,24 +254,88 @@ class SentryLogObserver(object):
         logger = ".".join(parts)
         return logger.lower()
 
+    def fingerprint_for_event(self, event, logger, level):
+        failure = event.get('failure')
+        if failure:
+            frames = tuple((frame[1], frame[2]) for frame in failure.frames)
+            if not frames:
+                frames = (str(failure.value),)
+            return (logger, failure.type, frames)
+        return (logger, level, log.textFromEventDict(event))
+
+    def _suppress(self, fingerprint, event):
+        """
+        Return `True` if the event with the given fingerprint is a repeat
+        that shouldn't be reported yet.
+        """
+        now = self.clock.seconds()
+        entry = self._reported.get(fingerprint)
+        if entry is None or now - entry[0] >= self.dedup_window:
+            # The fingerprints seen least recently are evicted first.
+            self._reported.set(fingerprint, [now, 0, None, None])
+            return False
+        entry[1] += 1
+        entry[2] = event
+        self.suppressed += 1
+        if self.metrics is not None and self.metrics.is_started():
+            self.metrics['sentry.suppressed'].inc()
+        if entry[3] is None:
+            entry[3] = self.clock.callLater(
+                entry[0] + self.dedup_window - now,
+                self._report_suppressed, fingerprint)
+            self._pending[fingerprint] = entry
+        return True
+
+    def _evicted(self, fingerprint, entry):
+        if fingerprint in self._pending:
+            self._report_suppressed(fingerprint)
+
+    def _report_suppressed(self, fingerprint):
+        entry = self._pending.pop(fingerprint)
+        delayed_call = entry[3]
+        if delayed_call.active():
+            delayed_call.cancel()
+        suppressed, event = entry[1], entry[2]
+        entry[1:] = [0, None, None]
+        log.callWithContext(
+            self.log_context, self._report, event, suppressed)
+
+    def flush(self):
+        """Report all repeats that are waiting for their window to end."""
+        for fingerprint in self._pending.keys():
+            self._report_suppressed(fingerprint)
+
     def _log_to_sentry(self, event):
         level = self.level_for_event(event)
         if level < self.LOG_LEVEL_THRESHOLD:
             return
+        if self.dedup_window > 0:
+            fingerprint = self.fingerprint_for_event(
+                event, self.logger_for_event(event), level)
+            if self._suppress(fingerprint, event):
+                return
+        self._report(event)
+
+    def _report(self, event, suppressed=0):
+        level = self.level_for_event(event)
+        logger = self.logger_for_event(event)
         data = {
-            "logger": self.logger_for_event(event),
+            "logger": logger,
             "level": level,
         }
         tags = {
             "worker-id": self.worker_id,
         }
+        kw = {}
+        if suppressed:
+            kw['extra'] = {"suppressed_occurrences": suppressed}
         failure = event.get('failure')
         if failure:
             exc_info = (failure.type, failure.value, failure.tb)
-            self.client.captureException(exc_info, data=data, tags=tags)
+            self.client.captureException(exc_info, data=data, tags=tags, **kw)
         else:
             msg = log.textFromEventDict(event)
-            self.client.captureMessage(msg, data=data, tags=tags)
+            self.client.captureMessage(msg, data=data, tags=tags, **kw)
 
     def __call__(self, event):
         if self.log_context_sentinel in event:
@@ -155,14 +344,45 @@ class SentryLogObserver(object):
 
 
 class SentryLoggerService(Service):
+    """Service that reports errors and warnings logged while it's running
+    to Sentry.
+
+    :param float dedup_window:
+        Seconds to suppress repeated reports of the same error for.
+        Defaults to ``DEFAULT_DEDUP_WINDOW``. Zero disables suppression.
+    :param int max_queue_size:
+        Maximum number of reports waiting to be sent before the oldest are
+        dropped. Defaults to ``DEFAULT_MAX_QUEUE_SIZE``.
+    :param int concurrency:
+        Maximum number of reports to send at once. Defaults to
+        ``DEFAULT_CONCURRENCY``.
+    :param metrics:
+        :class:`vumi.blinkenlights.metrics.MetricManager` to count sent,
+        suppressed and dropped reports with. Defaults to a new one with
+        the prefix ``vumi.<logger_name>.``. Nothing is counted until it
+        has been started, which :class:`vumi.worker.BaseWorker` does with
+        :meth:`start_metrics` when this service is one of its children.
+
+    Repeats that are still waiting for their dedup window to end are
+    reported when the service stops.
+    """
 
-    def __init__(self, dsn, logger_name, worker_id, logger=None):
-        self.setName('Sentry Logger')
+    SERVICE_NAME = 'Sentry Logger'
+
+    def __init__(self, dsn, logger_name, worker_id, logger=None,
+                 dedup_window=None, max_queue_size=None, concurrency=None,
+                 metrics=None):
+        self.setName(self.SERVICE_NAME)
         self.dsn = dsn
-        self.client = vumi_raven_client(dsn=dsn)
-        self.sentry_log_observer = SentryLogObserver(self.client,
-                                                     logger_name,
-                                                     worker_id)
+        if metrics is None:
+            metrics = MetricManager('vumi.%s.' % (logger_name,))
+        self.metrics = metrics
+        self.client = vumi_raven_client(
+            dsn=dsn, max_queue_size=max_queue_size, concurrency=concurrency,
+            metrics=metrics)
+        self.sentry_log_observer = SentryLogObserver(
+            self.client, logger_name, worker_id, dedup_window=dedup_window,
+            metrics=metrics)
         self.logger = logger if logger is not None else log.theLogPublisher
 
     def startService(self):
@@ -172,8 +392,24 @@ class SentryLoggerService(Service):
     def stopService(self):
         if self.running:
             self.logger.removeObserver(self.sentry_log_observer)
+            self.sentry_log_observer.flush()
+            self.stop_metrics()
             return self.client.teardown()
         return Service.stopService(self)
 
+    def start_metrics(self, worker):
+        """
+        Start publishing our metrics with one of the worker's publishers.
+        Returns a deferred that fires once they are being published.
+        """
+        self.stop_metrics()
+        # start_publisher() starts whatever the "class" we pass it returns,
+        # so this starts our existing metric manager.
+        return worker.start_publisher(lambda: self.metrics)
+
+    def stop_metrics(self):
+        if self.metrics.is_started():
+            self.metrics.stop()
+
     def registered(self):
         return self.sentry_log_observer in self.logger.observers
@@ -6,7 +6,9 @@ from copy import deepcopy
 from twisted.python import log
 from twisted.application.service import MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, DeferredLock, succeed,
+    maybeDeferred)
 from twisted.internet import protocol, reactor
 import txamqp
 from txamqp.client import TwistedDelegate
@@ -73,7 +75,140 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class ChannelManager(object):
+    """Hands out AMQP channels to a client's publishers and consumers.
+
+    Publishers don't need a channel of their own, so they share a pool of
+    at most `publisher_channels` channels, handed out in turn.
+
+    Consumers get a channel of their own unless consumer channel sharing
+    is enabled, in which case consumers with the same `channel_group` share
+    a channel. Consumers on a shared channel share its prefetch limit and
+    are paused and unpaused together, so only consumers that are always
+    paused together (such as those of a single connector) should be put in
+    the same group.
+
+    :param WorkerAMQClient client:
+        The client to open channels on.
+    :param int publisher_channels:
+        Maximum number of channels for publishers.
+    :param bool share_consumer_channels:
+        Whether consumers in the same group share a channel.
+    """
+
+    def __init__(self, client, publisher_channels=1,
+                 share_consumer_channels=False):
+        self.client = client
+        self.publisher_channels = max(publisher_channels, 1)
+        self.share_consumer_channels = share_consumer_channels
+        self._publisher_channels = []
+        self._next_publisher_channel = 0
+        self._consumer_groups = {}
+        self._consumer_channels = {}
+        self._declared_exchanges = set()
+        # Held while choosing or opening a channel, so that concurrent
+        # callers don't open more channels than they should.
+        self._lock = DeferredLock()
+        self.publishers = 0
+        self.consumers = 0
+
+    def get_publisher_channel(self):
+        return self._lock.run(self._get_publisher_channel)
+
+    @inlineCallbacks
+    def _get_publisher_channel(self):
+        self.publishers += 1
+        if len(self._publisher_channels) < self.publisher_channels:
+            channel = yield self.client.get_channel()
+            self._publisher_channels.append(channel)
+        else:
+            channel = self._publisher_channels[self._next_publisher_channel]
+            self._next_publisher_channel = (
+                (self._next_publisher_channel + 1) % self.publisher_channels)
+        returnValue(channel)
+
+    def get_consumer_channel(self, channel_group=None):
+        """
+        Return a deferred that fires with a channel for a consumer and
+        whether other consumers share it.
+        """
+        return self._lock.run(self._get_consumer_channel, channel_group)
+
+    @inlineCallbacks
+    def _get_consumer_channel(self, channel_group):
+        self.consumers += 1
+        if not self.share_consumer_channels or channel_group is None:
+            channel = yield self.client.get_channel()
+            self._consumer_channels[channel] = 1
+            returnValue((channel, False))
+        channel = self._consumer_groups.get(channel_group)
+        if channel is None:
+            channel = yield self.client.get_channel()
+            self._consumer_groups[channel_group] = channel
+            self._consumer_channels[channel] = 0
+        self._consumer_channels[channel] += 1
+        returnValue((channel, True))
+
+    def release_consumer_channel(self, channel):
+        """
+        Stop tracking a consumer's use of a channel. Returns `True` if no
+        other consumers use the channel, in which case it can be closed.
+        """
+        self.consumers -= 1
+        users = self._consumer_channels.get(channel, 1) - 1
+        if users > 0:
+            self._consumer_channels[channel] = users
+            return False
+        self._consumer_channels.pop(channel, None)
+        for group, group_channel in self._consumer_groups.items():
+            if group_channel is channel:
+                del self._consumer_groups[group]
+        return True
+
+    def declare_exchange(self, source, channel):
+        """
+        Declare the exchange a consumer or publisher uses, unless it has
+        already been declared on this connection.
+        """
+        exchange = (source.exchange_name, source.exchange_type,
+                    source.durable)
+        if exchange in self._declared_exchanges:
+            return succeed(None)
+        d = maybeDeferred(channel.exchange_declare,
+                          exchange=source.exchange_name,
+                          type=source.exchange_type, durable=source.durable)
+        return d.addCallback(
+            lambda r: self._declared_exchanges.add(exchange))
+
+    def stats(self):
+        """Return counts of the channels in use and their users."""
+        return {
+            'channels': (len(self._publisher_channels) +
+                         len(self._consumer_channels)),
+            'publisher_channels': len(self._publisher_channels),
+            'consumer_channels': len(self._consumer_channels),
+            'publishers': self.publishers,
+            'consumers': self.consumers,
+        }
+
+
 class WorkerAMQClient(AMQClient):
+    DEFAULT_PUBLISHER_CHANNELS = 1
+
+    @property
+    def channel_manager(self):
+        # vumi_options is only set after the client is created.
+        if getattr(self, '_channel_manager', None) is None:
+            options = getattr(self, 'vumi_options', {})
+            self._channel_manager = ChannelManager(
+                self,
+                publisher_channels=int(options.get(
+                    'amqp-publisher-channels',
+                    self.DEFAULT_PUBLISHER_CHANNELS)),
+                share_consumer_channels=(options.get(
+                    'amqp-consumer-channels', 'separate') == 'shared'))
+        return self._channel_manager
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -104,20 +239,18 @@ class WorkerAMQClient(AMQClient):
         return (max(self.channels) + 1) if self.channels else 0
 
     def _declare_exchange(self, source, channel):
-        # get the details for AMQP
-        exchange_name = source.exchange_name
-        exchange_type = source.exchange_type
-        durable = source.durable
-        return channel.exchange_declare(exchange=exchange_name,
-                                        type=exchange_type, durable=durable)
+        return self.channel_manager.declare_exchange(source, channel)
 
     @inlineCallbacks
     def start_consumer(self, consumer_class, *args, **kwargs):
-        channel = yield self.get_channel()
         consumer = consumer_class(*args, **kwargs)
+        channel, shared = yield self.channel_manager.get_consumer_channel(
+            consumer.channel_group)
         if consumer.start_paused:
             channel.channel_flow(active=False)
         consumer.vumi_options = self.vumi_options
+        consumer.channel_manager = self.channel_manager
+        consumer.channel_shared = shared
 
         # get the details for AMQP
         exchange_name = consumer.exchange_name
@@ -135,6 +268,7 @@ class WorkerAMQClient(AMQClient):
                                  routing_key=routing_key)
         # register the consumer
         reply = yield channel.basic_consume(queue=queue_name)
+        consumer.consumer_tag = reply.consumer_tag
         queue = yield self.queue(reply.consumer_tag)
         # start consuming! nom nom nom
         consumer.start(channel, queue)
@@ -145,7 +279,7 @@ class WorkerAMQClient(AMQClient):
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
         # get a channel
-        channel = yield self.get_channel()
+        channel = yield self.channel_manager.get_publisher_channel()
         # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
@@ -201,7 +335,7 @@ class Worker(MultiService, object):
 
     def consume(self, routing_key, callback, queue_name=None,
                 exchange_name='vumi', exchange_type='direct', durable=True,
-                message_class=None, paused=False):
+                message_class=None, paused=False, channel_group=None):
 
         # use the routing key to generate the name for the class
         # amq.routing.key -> AmqRoutingKey
@@ -214,6 +348,7 @@ class Worker(MultiService, object):
             'exchange_type': exchange_type,
             'durable': durable,
             'start_paused': paused,
+            'channel_group': channel_group,
         }
         log.msg('Starting %s with %s' % (class_name, kwargs))
         klass = type(class_name, (DynamicConsumer,), kwargs)
@@ -262,6 +397,11 @@ class Consumer(object):
 
     message_class = Message
     start_paused = False
+    # Consumers in the same group may share an AMQP channel (see
+    # ChannelManager).
+    channel_group = None
+    channel_shared = False
+    channel_manager = None
 
     @inlineCallbacks
     def start(self, channel, queue):
@@ -330,16 +470,23 @@ class Consumer(object):
         log.msg("Received message: %s" % message)
 
     def ack(self, message):
-        self.channel.basic_ack(message.delivery_tag, True)
+        # Acking multiple messages on a shared channel would also ack
+        # messages other consumers are still processing.
+        self.channel.basic_ack(message.delivery_tag, not self.channel_shared)
 
     @inlineCallbacks
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
-        # This actually closes the channel on the server
-        yield self.channel.channel_close()
-        # This just marks the channel as closed on the client
-        self.channel.close(None)
+        if (self.channel_manager is None or
+                self.channel_manager.release_consumer_channel(self.channel)):
+            # This actually closes the channel on the server
+            yield self.channel.channel_close()
+            # This just marks the channel as closed on the client
+            self.channel.close(None)
+        else:
+            # Other consumers still use the channel.
+            yield self.channel.basic_cancel(self.consumer_tag)
         self.queue.put(QueueCloseMarker())
         returnValue(self.keep_consuming)
 
@@ -14,6 +14,7 @@ from vumi.utils import (load_class_by_string,
                         generate_worker_id)
 from vumi.errors import VumiError
 from vumi.sentry import SentryLoggerService
+from vumi import log
 
 
 def overlay_configs(*configs):
@@ -51,7 +52,20 @@ class VumiOptions(usage.Options):
         ["password", None, None, "AMQP password (*)"],
         ["vhost", None, None, "AMQP virtual host (*)"],
         ["specfile", None, None, "AMQP spec file (*)"],
+        ["amqp-publisher-channels", None, None,
+         "Number of AMQP channels each worker's publishers share (*)", int],
+        ["amqp-consumer-channels", None, None,
+         "'shared' to put all consumers of each of a worker's connectors on"
+         " one AMQP channel with a shared prefetch limit, or 'separate'"
+         " (the default) for a channel per consumer (*)"],
         ["sentry", None, None, "Sentry DSN (*)"],
+        ["sentry-dedup-window", None, None,
+         "Seconds to suppress repeated Sentry reports of the same error"
+         " for (*)", float],
+        ["sentry-queue-size", None, None,
+         "Maximum number of Sentry reports waiting to be sent (*)", int],
+        ["sentry-concurrency", None, None,
+         "Maximum number of Sentry reports to send at once (*)", int],
         ["vumi-config", None, None,
          "YAML config file for setting core vumi options (any command-line"
          " parameter marked with an asterisk)"],
@@ -182,12 +196,25 @@ class VumiWorkerServiceMaker(object):
     options = StartWorkerOptions
 
     def makeService(self, options):
-        sentry_dsn = options.vumi_options.pop('sentry', None)
+        # The Sentry options stay in the vumi options so that workers which
+        # start other processes (such as MultiWorker) can pass them on.
+        sentry_dsn = options.vumi_options.get('sentry')
+        sentry_kw = {}
+        for opt, kw in [('sentry-dedup-window', 'dedup_window'),
+                        ('sentry-queue-size', 'max_queue_size'),
+                        ('sentry-concurrency', 'concurrency')]:
+            value = options.vumi_options.get(opt)
+            if value is not None:
+                sentry_kw[kw] = value
         class_name = options.worker_class.rpartition('.')[2].lower()
         logger_name = options.worker_config.get('worker_name', class_name)
         system_id = options.vumi_options.get('system-id', 'global')
         worker_id = generate_worker_id(system_id, logger_name)
 
+        log_level = options.worker_config.get('log_level')
+        if log_level is not None:
+            log.set_level(log_level)
+
         worker_creator = WorkerCreator(options.vumi_options)
         worker = worker_creator.create_worker(options.worker_class,
                                               options.worker_config)
@@ -195,7 +222,8 @@ class VumiWorkerServiceMaker(object):
         if sentry_dsn is not None:
             sentry_service = SentryLoggerService(sentry_dsn,
                                                  logger_name,
-                                                 worker_id)
+                                                 worker_id,
+                                                 **sentry_kw)
             worker.addService(sentry_service)
 
         return worker
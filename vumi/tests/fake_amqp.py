@@ -5,7 +5,7 @@ import re
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
-from txamqp.client import TwistedDelegate
+from txamqp.client import TwistedDelegate, Closed
 from txamqp.content import Content
 
 from vumi.service import WorkerAMQClient
@@ -123,7 +123,12 @@ class FakeAMQPBroker(object):
         assert exchange_type == self.exchanges[exchange].exchange_type
         return Message(mkMethod("declare-ok", 11))
 
-    def queue_declare(self, queue):
+    def queue_declare(self, queue, passive=False):
+        if passive and queue not in self.queues:
+            raise Closed(Message(mkMethod("close", 40), [
+                ('reply_code', 404),
+                ('reply_text', "NOT_FOUND - no queue '%s'" % (queue,)),
+            ]))
         if not queue:
             queue = gen_id('queue.')
         self.queues.setdefault(queue, FakeAMQPQueue(queue))
@@ -316,8 +321,11 @@ class FakeAMQPChannel(object):
     def exchange_declare(self, exchange, type, durable=None):
         return self.broker.exchange_declare(exchange, type)
 
-    def queue_declare(self, queue, durable=None):
-        return self.broker.queue_declare(queue)
+    def queue_declare(self, queue, durable=None, passive=False):
+        if passive and queue not in self.broker.queues:
+            # The broker closes the channel if the queue doesn't exist.
+            self.broker.channel_close(self)
+        return self.broker.queue_declare(queue, passive=passive)
 
     def queue_bind(self, queue, exchange, routing_key):
         return self.broker.queue_bind(queue, exchange, routing_key)
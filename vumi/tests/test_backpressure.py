@@ -0,0 +1,171 @@
+import logging
+
+from twisted.internet.task import Clock
+
+from vumi.backpressure import BackpressureController
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.tests.helpers import VumiTestCase
+from vumi.tests.utils import LogCatcher
+
+
+class FakeConnector(object):
+    def __init__(self, name='conn'):
+        self.name = name
+        self.in_flight = 0
+        self.paused = False
+
+    def pause(self):
+        self.paused = True
+
+    def unpause(self):
+        self.paused = False
+
+
+class TestBackpressureController(VumiTestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.connector = FakeConnector()
+
+    def mk_controller(self, **kw):
+        return BackpressureController(self.connector, clock=self.clock, **kw)
+
+    def start(self, controller):
+        self.connector.in_flight += 1
+        return controller.message_started()
+
+    def done(self, controller, started):
+        self.connector.in_flight -= 1
+        controller.message_done(started)
+
+    def test_defaults(self):
+        controller = self.mk_controller(high_watermark=10, high_latency=2.0)
+        self.assertEqual(5, controller.low_watermark)
+        self.assertEqual(1.0, controller.low_latency)
+
+    def test_watermarks(self):
+        controller = self.mk_controller(high_watermark=3, low_watermark=1)
+        started = [self.start(controller) for _ in range(2)]
+        self.assertFalse(self.connector.paused)
+        started.append(self.start(controller))
+        self.assertTrue(self.connector.paused)
+        self.assertTrue(controller.engaged)
+
+        self.done(controller, started.pop())
+        self.assertTrue(self.connector.paused)
+        self.clock.advance(2)
+        self.done(controller, started.pop())
+        self.assertFalse(self.connector.paused)
+        self.assertFalse(controller.engaged)
+        self.assertEqual(1, controller.pauses)
+        self.assertEqual(2.0, controller.paused_time)
+
+    def test_latency(self):
+        controller = self.mk_controller(high_latency=2.0, low_latency=1.0)
+        keep_busy = self.start(controller)
+        started = self.start(controller)
+        self.clock.advance(3)
+        self.done(controller, started)
+        self.assertTrue(self.connector.paused)
+        self.assertEqual(3.0, controller.latency)
+
+        # The average stays above the low mark after a fast message.
+        started = self.start(controller)
+        self.done(controller, started)
+        self.assertTrue(self.connector.paused)
+        self.assertEqual(2.4, controller.latency)
+
+        # Another slow message keeps it there.
+        self.done(controller, keep_busy)
+        self.assertTrue(self.connector.paused)
+
+    def test_latency_recovers(self):
+        controller = self.mk_controller(high_latency=2.0, low_latency=1.0)
+        controller.latency = 3.0
+        keep_busy = self.start(controller)
+        self.assertTrue(self.connector.paused)
+        for _ in range(10):
+            self.done(controller, self.start(controller))
+        self.assertFalse(self.connector.paused)
+        self.assertTrue(controller.latency <= 1.0)
+        self.done(controller, keep_busy)
+
+    def test_stays_engaged_over_slow_messages(self):
+        controller = self.mk_controller(
+            high_latency=2.0, low_latency=1.0, recheck_interval=10)
+        # Messages are handled one at a time, so nothing is in flight
+        # between them.
+        for _ in range(3):
+            started = self.start(controller)
+            self.clock.advance(3)
+            self.done(controller, started)
+            self.assertTrue(controller.engaged)
+            self.assertTrue(self.connector.paused)
+        self.assertEqual(3.0, controller.latency)
+        self.assertEqual(1, controller.pauses)
+
+    def test_released_once_latency_decays(self):
+        controller = self.mk_controller(high_latency=2.0, low_latency=1.0)
+        started = self.start(controller)
+        self.clock.advance(3)
+        self.done(controller, started)
+        self.assertTrue(self.connector.paused)
+
+        # The average decays by a fifth each second while nothing is
+        # being handled: 2.4, 1.92, 1.536, 1.2288, 0.98304.
+        self.clock.pump([1] * 4)
+        self.assertTrue(self.connector.paused)
+        self.clock.advance(1)
+        self.assertFalse(self.connector.paused)
+        self.assertFalse(controller.engaged)
+        self.assertTrue(controller.latency <= 1.0)
+        self.assertEqual(5.0, controller.paused_time)
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_no_decay_while_handling(self):
+        controller = self.mk_controller(high_latency=2.0, low_latency=1.0)
+        controller.latency = 3.0
+        started = self.start(controller)
+        self.assertTrue(self.connector.paused)
+        self.clock.pump([1] * 5)
+        self.assertEqual(3.0, controller.latency)
+        self.assertTrue(self.connector.paused)
+        self.done(controller, started)
+        self.assertTrue(self.connector.paused)
+
+    def test_stop(self):
+        controller = self.mk_controller(high_watermark=1)
+        self.start(controller)
+        self.assertEqual(1, len(self.clock.getDelayedCalls()))
+        controller.stop()
+        self.assertEqual([], self.clock.getDelayedCalls())
+
+    def test_check_consumers(self):
+        controller = self.mk_controller(high_watermark=3)
+        with LogCatcher(log_level=logging.WARNING) as lc:
+            controller.check_consumers(3)
+            self.assertEqual([], lc.messages())
+            controller.check_consumers(2)
+        [warning] = lc.messages()
+        self.assertEqual(
+            "Backpressure high watermark 3 for connector conn is above its 2"
+            " consumers, so it will never be reached.", warning)
+
+    def test_already_paused(self):
+        controller = self.mk_controller(high_watermark=1)
+        self.connector.paused = True
+        started = self.start(controller)
+        self.assertFalse(controller.engaged)
+        self.done(controller, started)
+        self.assertTrue(self.connector.paused)
+
+    def test_metrics(self):
+        metrics = MetricManager('vumi.test.')
+        controller = self.mk_controller(high_watermark=1, metrics=metrics)
+        started = self.start(controller)
+        self.clock.advance(1.5)
+        self.done(controller, started)
+        paused_time = metrics['conn.backpressure.paused_time']
+        self.assertEqual([1.5], [v for _, v in paused_time.poll()])
+        pauses = metrics['conn.backpressure.pauses']
+        self.assertEqual([1], [v for _, v in pauses.poll()])
@@ -1,3 +1,5 @@
+from copy import deepcopy
+
 from twisted.internet.endpoints import TCP4ServerEndpoint, TCP4ClientEndpoint
 
 from vumi.errors import ConfigError
@@ -168,6 +170,45 @@ class ConfigTest(VumiTestCase):
 
         self.assertRaises(ConfigError, FooConfig, {'foo': -1})
 
+    def test_field_values_cleaned_once(self):
+        cleaned = []
+
+        class CountingField(ConfigField):
+            def clean(self, value):
+                cleaned.append(value)
+                return value
+
+        class FooConfig(Config):
+            "Test config."
+            foo = CountingField("foo")
+
+        conf = FooConfig({'foo': 'blah'})
+        self.assertEqual(cleaned, ['blah'])
+        self.assertEqual(conf.foo, 'blah')
+        self.assertEqual(conf.foo, 'blah')
+        self.assertEqual(cleaned, ['blah'])
+
+    def test_base_config(self):
+        cleaned = []
+
+        class CountingField(ConfigField):
+            def clean(self, value):
+                cleaned.append(value)
+                return value
+
+        class FooConfig(Config):
+            "Test config."
+            foo = CountingField("foo", static=True)
+            bar = CountingField("bar")
+
+        static_conf = FooConfig({'foo': 'static'}, static=True)
+        self.assertEqual(cleaned, ['static'])
+        conf = FooConfig({'foo': 'static', 'bar': 'msg'}, base=static_conf)
+        self.assertEqual(cleaned, ['static', 'msg'])
+        self.assertEqual(conf.foo, 'static')
+        self.assertEqual(conf.bar, 'msg')
+        self.assertEqual(cleaned, ['static', 'msg'])
+
 
 class FakeModel(object):
     def __init__(self, config):
@@ -270,11 +311,21 @@ class ConfigFieldTest(VumiTestCase):
 
     def test_list_field_immutable(self):
         field = self.make_field(ConfigList)
-        model = self.fake_model(['fault', 'mine'])
+        model = self.fake_model(['fault', ['mine']])
         value = field.get_value(model)
-        self.assertEqual(value, ['fault', 'mine'])
-        value[1] = 'yours'
-        self.assertEqual(field.get_value(model), ['fault', 'mine'])
+        self.assertEqual(value, ['fault', ['mine']])
+        self.assertRaises(TypeError, value.__setitem__, 1, 'yours')
+        self.assertRaises(TypeError, value.append, 'yours')
+        self.assertRaises(TypeError, value[1].append, 'yours')
+        self.assertEqual(field.get_value(model), ['fault', ['mine']])
+
+    def test_list_field_copy(self):
+        field = self.make_field(ConfigList)
+        value = field.get_value(self.fake_model(['fault', ['mine']]))
+        value_copy = deepcopy(value)
+        value_copy[1].append('yours')
+        self.assertEqual(value_copy, ['fault', ['mine', 'yours']])
+        self.assertEqual(list(value) + ['ours'], ['fault', ['mine'], 'ours'])
 
     def test_dict_field(self):
         field = self.make_field(ConfigDict)
@@ -289,11 +340,24 @@ class ConfigFieldTest(VumiTestCase):
 
     def test_dict_field_immutable(self):
         field = self.make_field(ConfigDict)
-        model = self.fake_model({'fault': 'mine'})
+        model = self.fake_model({'fault': 'mine', 'nested': {}})
         value = field.get_value(model)
-        self.assertEqual(value, {'fault': 'mine'})
-        value['fault'] = 'yours'
-        self.assertEqual(field.get_value(model), {'fault': 'mine'})
+        self.assertEqual(value, {'fault': 'mine', 'nested': {}})
+        self.assertRaises(TypeError, value.__setitem__, 'fault', 'yours')
+        self.assertRaises(TypeError, value.update, {'fault': 'yours'})
+        self.assertRaises(TypeError, value['nested'].setdefault, 'a', 'b')
+        self.assertEqual(
+            field.get_value(model), {'fault': 'mine', 'nested': {}})
+
+    def test_dict_field_copy(self):
+        field = self.make_field(ConfigDict)
+        value = field.get_value(self.fake_model({'nested': {}}))
+        value_copy = deepcopy(value)
+        value_copy['nested']['fault'] = 'yours'
+        self.assertEqual(value_copy, {'nested': {'fault': 'yours'}})
+        value_copy = value.copy()
+        value_copy['fault'] = 'yours'
+        self.assertEqual(value_copy, {'nested': {}, 'fault': 'yours'})
 
     def test_url_field(self):
         def assert_url(value,
@@ -189,6 +189,37 @@ class TestBaseConnector(BaseConnectorTestCase):
         msgs = self.worker_helper.get_dispatched_outbound('foo')
         self.assertEqual(msgs, [msg])
 
+    @inlineCallbacks
+    def test_shared_consumer_channel(self):
+        worker = yield self.worker_helper.get_worker(
+            DummyWorker, {}, start=False)
+        worker._amqp_client.vumi_options = {'amqp-consumer-channels': 'shared'}
+        conn = yield self.mk_connector(worker=worker, prefetch_count=5)
+        con1 = yield conn._setup_consumer('inbound', TransportUserMessage,
+                                          lambda msg: None)
+        con2 = yield conn._setup_consumer('event', TransportUserMessage,
+                                          lambda msg: None)
+        self.assertTrue(con1.channel is con2.channel)
+        self.assertEqual(con1.channel.qos_prefetch_count, 5)
+
+    @inlineCallbacks
+    def test_message_counters(self):
+        msgs = []
+        conn = yield self.mk_connector(connector_name='foo')
+        yield conn._setup_publisher('outbound')
+        yield conn._setup_consumer('inbound', TransportUserMessage,
+                                   msgs.append)
+        conn.unpause()
+        self.assertEqual(
+            (conn.consumed, conn.published, conn.in_flight), (0, 0, 0))
+        yield self.worker_helper.dispatch_inbound(
+            self.msg_helper.make_inbound("inbound"), 'foo')
+        yield conn._publish_message(
+            'outbound', self.msg_helper.make_outbound("outbound"), None)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(
+            (conn.consumed, conn.published, conn.in_flight), (1, 1, 0))
+
 
 class TestReceiveInboundConnector(BaseConnectorTestCase):
 
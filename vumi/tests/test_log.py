@@ -45,3 +45,73 @@ class TestVumiLog(VumiTestCase):
             failure = entry['failure']
             exception = failure.trap(TestException)
             self.assertEqual(exception, TestException)
+
+
+class TestLogLevels(VumiTestCase):
+
+    def setUp(self):
+        self.add_cleanup(log.set_level, log.get_level())
+
+    def test_set_level_by_name(self):
+        log.set_level('WARNING')
+        self.assertEqual(log.get_level(), logging.WARNING)
+        log.set_level('info')
+        self.assertEqual(log.get_level(), logging.INFO)
+
+    def test_set_unknown_level(self):
+        self.assertRaises(ValueError, log.set_level, 'chatty')
+
+    def test_enabled_for(self):
+        log.set_level(logging.INFO)
+        self.assertFalse(log.enabled_for(logging.DEBUG))
+        self.assertTrue(log.enabled_for(logging.INFO))
+        self.assertTrue(log.enabled_for(logging.ERROR))
+
+    def test_calls_below_level_dropped(self):
+        log.set_level(logging.WARNING)
+        lc = LogCatcher()
+        with lc:
+            log.debug('foo')
+            log.info('bar')
+            log.warning('baz')
+        self.assertEqual(lc.messages(), ['baz'])
+
+    def test_errors_below_level_dropped(self):
+        self.add_cleanup(self.flushLoggedErrors, TestException)
+        log.set_level(logging.CRITICAL)
+        lc = LogCatcher()
+        with lc:
+            log.error(TestException('foo'))
+            log.critical(TestException('bar'))
+        [entry] = lc.errors
+        self.assertEqual(entry['logLevel'], logging.CRITICAL)
+
+    def test_dropped_calls_not_formatted(self):
+        log.set_level(logging.INFO)
+
+        class Unformattable(object):
+            def __repr__(self):
+                raise AssertionError("Formatted a dropped log message.")
+
+        lc = LogCatcher()
+        with lc:
+            log.debug(format="%(obj)r", obj=Unformattable())
+        self.assertEqual(lc.logs, [])
+
+    def test_format(self):
+        lc = LogCatcher()
+        with lc:
+            log.info(format="Sent %(count)d messages", count=3)
+        [entry] = lc.logs
+        self.assertEqual(entry['count'], 3)
+        self.assertEqual(entry['logLevel'], logging.INFO)
+        self.assertEqual(lc.messages(), ['Sent 3 messages'])
+
+    def test_key_value_event(self):
+        lc = LogCatcher()
+        with lc:
+            log.info(event='window_full', size=10)
+        [entry] = lc.logs
+        self.assertEqual(entry['event'], 'window_full')
+        self.assertEqual(entry['size'], 10)
+        self.assertEqual(lc.messages(), ["event='window_full' size=10"])
@@ -1,10 +1,15 @@
+import os
+
+import yaml
 from twisted.internet.defer import (Deferred, DeferredList, inlineCallbacks,
                                     returnValue)
+from twisted.internet.task import Clock
 
 from vumi.tests.utils import StubbedWorkerCreator
 from vumi.service import Worker
 from vumi.message import TransportUserMessage
-from vumi.multiworker import MultiWorker
+from vumi.blinkenlights.metrics import MetricMessage
+from vumi.multiworker import MultiWorker, ChildProcessMonitor
 from vumi.tests.helpers import VumiTestCase, MessageHelper, WorkerHelper
 
 
@@ -41,6 +46,35 @@ class StubbedMultiWorker(MultiWorker):
         return DeferredList([w._d for w in self.workers])
 
 
+class FakeChildProcessMonitor(ChildProcessMonitor):
+    """
+    Records started processes instead of spawning them. Stopped processes
+    exit immediately unless `exit_on_stop` is unset.
+    """
+
+    def __init__(self):
+        ChildProcessMonitor.__init__(self, reactor=Clock())
+        self.started = []
+        self.stopped = []
+        self.exit_on_stop = True
+
+    def startProcess(self, name):
+        if name in self.protocols:
+            return
+        self.protocols[name] = object()
+        self.timeStarted[name] = self._reactor.seconds()
+        self.started.append(name)
+
+    def stopProcess(self, name):
+        self.stopped.append(name)
+        if self.exit_on_stop and name in self.protocols:
+            self.connectionLost(name)
+
+
+class ProcessMultiWorker(StubbedMultiWorker):
+    PROCESS_MONITOR = FakeChildProcessMonitor
+
+
 class TestMultiWorker(VumiTestCase):
 
     base_config = {
@@ -76,6 +110,7 @@ class TestMultiWorker(VumiTestCase):
         self.worker = yield self.worker_helper.get_worker(
             StubbedMultiWorker, config, start=False)
         yield self.worker.startService()
+        yield self.worker.startWorker()
         yield self.worker.wait_for_workers()
         returnValue(self.worker)
 
@@ -100,6 +135,11 @@ class TestMultiWorker(VumiTestCase):
         self.assertEqual(['rab'], self.get_replies("worker2"))
         self.assertEqual(['zab'], self.get_replies("worker3"))
 
+    @inlineCallbacks
+    def test_no_child_metrics_without_processes(self):
+        worker = yield self.get_multiworker(self.base_config)
+        self.assertEqual(None, worker.metrics)
+
     @inlineCallbacks
     def test_config(self):
         worker = yield self.get_multiworker(self.base_config)
@@ -117,3 +157,136 @@ class TestMultiWorker(VumiTestCase):
         worker2 = worker.getServiceNamed("worker2")
         self.assertEqual({'foo': 'bar'}, worker1.config)
         self.assertEqual({'foo': 'baz'}, worker2.config)
+
+
+class TestMultiWorkerProcesses(VumiTestCase):
+
+    base_config = {
+        'workers': {
+            'worker1': "%s.ToyWorker" % (__name__,),
+            'worker2': "%s.ToyWorker" % (__name__,),
+            },
+        'processes': {'worker2': 2},
+        'defaults': {'foo': 'baz'},
+        'worker2': {'foo': 'bar'},
+        }
+
+    def setUp(self):
+        self.worker_helper = WorkerHelper()
+        self.add_cleanup(self.worker_helper.cleanup)
+        self.add_cleanup(self.clear_events)
+
+    def clear_events(self):
+        ToyWorker.events[:] = []
+
+    @inlineCallbacks
+    def get_multiworker(self, config):
+        worker = yield self.worker_helper.get_worker(
+            ProcessMultiWorker, config, start=False)
+        yield worker.startService()
+        # We aren't connected to AMQP, so we start the worker ourselves.
+        yield worker.startWorker()
+        yield worker.wait_for_workers()
+        returnValue(worker)
+
+    @inlineCallbacks
+    def test_start_processes(self):
+        worker = yield self.get_multiworker(self.base_config)
+        self.assertEqual(['worker1'], [w.name for w in worker.workers])
+        monitor = worker.process_monitor
+        self.assertEqual(['worker2.0', 'worker2.1'], sorted(monitor.started))
+        args = monitor.processes['worker2.0'][0]
+        self.assertEqual(
+            ['vumi_worker', '--worker-class', "%s.ToyWorker" % (__name__,)],
+            args[5:8])
+        self.assertEqual({'foo': 'bar'}, yaml.safe_load(open(args[9])))
+        self.assertEqual('--vumi-config', args[10])
+
+    @inlineCallbacks
+    def test_process_args_include_vumi_options(self):
+        worker = yield self.get_multiworker(self.base_config)
+        worker.options = {'hostname': 'amqp.local', 'password': 'secret',
+                          'sentry': None}
+        vumi_config_file = worker.write_vumi_config()
+        args = worker.worker_process_args(
+            'worker2', 'ToyWorker', 'c.yaml', vumi_config_file)
+        self.assertEqual(['--vumi-config', vumi_config_file], args[10:])
+        self.assertEqual({'hostname': 'amqp.local', 'password': 'secret'},
+                         yaml.safe_load(open(vumi_config_file)))
+
+    @inlineCallbacks
+    def test_restart_on_exit(self):
+        worker = yield self.get_multiworker(self.base_config)
+        monitor = worker.process_monitor
+        monitor._reactor.advance(10)
+        monitor.connectionLost('worker2.1')
+        self.assertEqual({'worker2': {
+            'replicas': 2, 'running': 1, 'restarts': 1,
+        }}, worker.child_status())
+        monitor._reactor.advance(0)
+        self.assertEqual(['worker2.0', 'worker2.1', 'worker2.1'],
+                         sorted(monitor.started))
+        self.assertEqual({'worker2': {
+            'replicas': 2, 'running': 2, 'restarts': 1,
+        }}, worker.child_status())
+
+    def get_datapoints(self):
+        msgs = self.worker_helper.broker.get_messages(
+            'vumi.metrics', 'vumi.metrics')
+        return [sorted((name, [v for _, v in points])
+                       for name, _, points in
+                       MetricMessage.from_dict(msg.payload).datapoints())
+                for msg in msgs]
+
+    @inlineCallbacks
+    def test_child_metrics(self):
+        worker = yield self.get_multiworker(self.base_config)
+        monitor = worker.process_monitor
+        monitor.connectionLost('worker2.1')
+        worker.metrics._publish_metrics()
+        monitor._reactor.advance(0)
+        worker.metrics._publish_metrics()
+        self.assertEqual([[
+            ('vumi.multiworker.worker2.replicas', [2]),
+            ('vumi.multiworker.worker2.restarts', [0]),
+            ('vumi.multiworker.worker2.running', [2]),
+        ], [
+            ('vumi.multiworker.worker2.replicas', [2]),
+            ('vumi.multiworker.worker2.restarts', [1]),
+            ('vumi.multiworker.worker2.running', [1]),
+        ]], self.get_datapoints())
+
+    @inlineCallbacks
+    def test_child_metrics_prefix(self):
+        config = {'metrics_prefix': 'foo.'}
+        config.update(self.base_config)
+        worker = yield self.get_multiworker(config)
+        self.assertEqual('foo.', worker.metrics.prefix)
+        self.assertTrue(worker.metrics.is_started())
+        metrics = worker.metrics
+        yield worker.stopService()
+        self.assertFalse(metrics.is_started())
+
+    @inlineCallbacks
+    def test_stop_processes(self):
+        worker = yield self.get_multiworker(self.base_config)
+        monitor = worker.process_monitor
+        monitor.exit_on_stop = False
+        config_dir = worker._config_dir
+        d = worker.stopService()
+        self.assertEqual(['worker2.0', 'worker2.1'], sorted(monitor.stopped))
+        self.assertNoResult(d)
+        monitor.connectionLost('worker2.0')
+        self.assertNoResult(d)
+        monitor.connectionLost('worker2.1')
+        yield d
+        self.assertEqual(['worker2.0', 'worker2.1'], sorted(monitor.started))
+        self.assertFalse(os.path.exists(config_dir))
+
+    @inlineCallbacks
+    def test_process_monitor_config(self):
+        config = {'process_kill_time': 10, 'process_max_restart_delay': 30}
+        config.update(self.base_config)
+        worker = yield self.get_multiworker(config)
+        self.assertEqual(10, worker.process_monitor.killTime)
+        self.assertEqual(30, worker.process_monitor.maxRestartDelay)
@@ -6,15 +6,30 @@ import json
 import sys
 import traceback
 
-from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, fail)
+from twisted.internet.task import Clock
 from twisted.web import http
 from twisted.python.failure import Failure
 from twisted.python.log import LogPublisher
 
-from vumi.tests.utils import MockHttpServer, LogCatcher
+from vumi.tests.utils import MockHttpServer, LogCatcher, get_stubbed_channel
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.service import Worker
 from vumi.sentry import (quiet_get_page, SentryLogObserver, vumi_raven_client,
-                         SentryLoggerService)
-from vumi.tests.helpers import VumiTestCase, import_skip
+                         SentryLoggerService, SentryReportQueue)
+from vumi.tests.helpers import VumiTestCase, WorkerHelper, import_skip
+
+
+@inlineCallbacks
+def start_metrics(test_case):
+    worker_helper = WorkerHelper()
+    test_case.add_cleanup(worker_helper.cleanup)
+    metrics = MetricManager("vumi.test.")
+    channel = yield get_stubbed_channel(worker_helper.broker)
+    metrics.start(channel)
+    test_case.add_cleanup(metrics.stop)
+    returnValue(metrics)
 
 
 class TestQuietGetPage(VumiTestCase):
@@ -107,12 +122,193 @@ class TestSentryLogObserver(VumiTestCase):
         self.assertEqual(self.client.messages, [])  # should be filtered out
 
 
+class TestSentryLogObserverDedup(VumiTestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.client = DummySentryClient()
+        self.clock = Clock()
+        self.metrics = yield start_metrics(self)
+        self.obs = SentryLogObserver(
+            self.client, 'test', "worker-1", dedup_window=60,
+            clock=self.clock, metrics=self.metrics)
+
+    def raise_error(self, msg):
+        try:
+            raise ValueError(msg)
+        except ValueError:
+            return Failure()
+
+    def log_error(self, msg="foo"):
+        self.obs({'failure': self.raise_error(msg), 'isError': 1})
+
+    def log_warning(self, msg="a"):
+        self.obs({'message': [msg], 'logLevel': logging.WARN})
+
+    def test_repeated_errors_suppressed(self):
+        for _ in range(3):
+            self.log_error()
+        self.assertEqual(len(self.client.exceptions), 1)
+        self.assertEqual(self.obs.suppressed, 2)
+        self.assertEqual(len(self.metrics['sentry.suppressed'].poll()), 2)
+
+    def test_unstarted_metrics_not_updated(self):
+        metrics = MetricManager("vumi.test.")
+        obs = SentryLogObserver(self.client, 'test', "worker-1",
+                                clock=self.clock, metrics=metrics)
+        for _ in range(3):
+            obs({'message': ["a"], 'logLevel': logging.WARN})
+        self.assertEqual(obs.suppressed, 2)
+        self.assertEqual(metrics['sentry.suppressed'].poll(), [])
+
+    def test_repeated_messages_suppressed(self):
+        for _ in range(3):
+            self.log_warning()
+        self.log_warning("b")
+        self.assertEqual([args for args, kw in self.client.messages],
+                         [("a",), ("b",)])
+
+    def test_suppressed_count_sent_when_window_ends(self):
+        for _ in range(3):
+            self.log_warning()
+        self.clock.advance(59)
+        self.assertEqual(len(self.client.messages), 1)
+        self.clock.advance(1)
+        [first, second] = self.client.messages
+        self.assertFalse('extra' in first[1])
+        self.assertEqual(second[0], ("a",))
+        self.assertEqual(second[1]['extra'], {'suppressed_occurrences': 2})
+        self.assertEqual(self.obs.suppressed, 2)
+
+        # The next repeat starts a new window.
+        self.log_warning()
+        self.log_warning()
+        self.assertEqual(len(self.client.messages), 3)
+        self.assertFalse('extra' in self.client.messages[2][1])
+        self.assertEqual(self.obs.suppressed, 3)
+
+    def test_suppressed_errors_reported_when_window_ends(self):
+        for _ in range(2):
+            self.log_error()
+        self.clock.advance(60)
+        [first, second] = self.client.exceptions
+        self.assertEqual(second[0][0][0], ValueError)
+        self.assertEqual(second[1]['extra'], {'suppressed_occurrences': 1})
+
+    def test_no_report_when_window_ends_without_repeats(self):
+        self.log_warning()
+        self.clock.advance(60)
+        self.assertEqual(len(self.client.messages), 1)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_suppressed_count_sent_when_evicted(self):
+        obs = SentryLogObserver(self.client, 'test', "worker-1",
+                                max_fingerprints=1, clock=self.clock)
+        for msg in ["a", "a", "b"]:
+            obs({'message': [msg], 'logLevel': logging.WARN})
+        self.assertEqual([(args, kw.get('extra'))
+                          for args, kw in self.client.messages], [
+            (("a",), None),
+            (("a",), {'suppressed_occurrences': 1}),
+            (("b",), None),
+        ])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_flush(self):
+        self.log_warning()
+        self.log_warning()
+        self.obs.flush()
+        self.assertEqual(self.client.messages[1][1]['extra'],
+                         {'suppressed_occurrences': 1})
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_different_errors_reported(self):
+        self.log_error("foo")
+        try:
+            {}['missing']
+        except KeyError:
+            f = Failure()
+        self.obs({'failure': f, 'isError': 1})
+        self.assertEqual(len(self.client.exceptions), 2)
+
+    def test_dedup_disabled(self):
+        obs = SentryLogObserver(self.client, 'test', "worker-1",
+                                dedup_window=0, clock=self.clock)
+        for _ in range(3):
+            obs({'message': ["a"], 'logLevel': logging.WARN})
+        self.assertEqual(len(self.client.messages), 3)
+
+    def test_max_fingerprints(self):
+        obs = SentryLogObserver(self.client, 'test', "worker-1",
+                                max_fingerprints=2, clock=self.clock)
+        for msg in ["a", "b", "c", "a"]:
+            obs({'message': [msg], 'logLevel': logging.WARN})
+        self.assertEqual([args for args, kw in self.client.messages],
+                         [("a",), ("b",), ("c",), ("a",)])
+
+
+class TestSentryReportQueue(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.metrics = yield start_metrics(self)
+        self.sends = []
+
+    def send(self, report):
+        d = Deferred()
+        self.sends.append((report, d))
+        return d
+
+    def test_concurrency(self):
+        queue = SentryReportQueue(10, 2)
+        for i in range(3):
+            queue.put(self.send, i)
+        self.assertEqual([r for r, d in self.sends], [0, 1])
+        self.assertEqual(len(queue), 1)
+        self.sends[0][1].callback(None)
+        self.assertEqual([r for r, d in self.sends], [0, 1, 2])
+        self.assertEqual(queue.sent, 1)
+
+    def test_drop_oldest(self):
+        queue = SentryReportQueue(2, 1, metrics=self.metrics)
+        for i in range(4):
+            queue.put(self.send, i)
+        self.assertEqual(queue.dropped, 1)
+        self.assertEqual(len(self.metrics['sentry.dropped'].poll()), 1)
+        self.sends[0][1].callback(None)
+        self.sends[1][1].callback(None)
+        self.assertEqual([r for r, d in self.sends], [0, 2, 3])
+        self.assertEqual(len(self.metrics['sentry.sent'].poll()), 2)
+
+    def test_send_failure(self):
+        queue = SentryReportQueue(10, 1, log_context={'_SENTINEL_': True})
+        with LogCatcher() as lc:
+            queue.put(lambda: fail(ValueError("Sentry is down.")))
+            queue.put(lambda: succeed(None))
+        [err] = lc.errors
+        self.assertTrue(err['_SENTINEL_'])
+        self.flushLoggedErrors(ValueError)
+        self.assertEqual(queue.sent, 1)
+
+    @inlineCallbacks
+    def test_flush(self):
+        queue = SentryReportQueue(10, 1)
+        yield queue.flush()
+        queue.put(self.send, 0)
+        queue.put(self.send, 1)
+        d = queue.flush()
+        self.sends[0][1].callback(None)
+        self.assertFalse(d.called)
+        self.sends[1][1].callback(None)
+        self.assertTrue(d.called)
+
+
 class TestSentryLoggerSerivce(VumiTestCase):
 
     def setUp(self):
         import vumi.sentry
         self.client = DummySentryClient()
-        self.patch(vumi.sentry, 'vumi_raven_client', lambda dsn: self.client)
+        self.patch(vumi.sentry, 'vumi_raven_client',
+                   lambda dsn, **kw: self.client)
         self.logger = LogPublisher()
         self.service = SentryLoggerService("http://example.com/",
                                            "test.logger",
@@ -133,6 +329,28 @@ class TestSentryLoggerSerivce(VumiTestCase):
         self.logger.msg("Foo", logLevel=logging.WARN)
         self.assertEqual(self.client.messages, [])
 
+    @inlineCallbacks
+    def test_stop_reports_suppressed_repeats(self):
+        yield self.service.startService()
+        self.logger.msg("Hello", logLevel=logging.WARN)
+        self.logger.msg("Hello", logLevel=logging.WARN)
+        yield self.service.stopService()
+        [first, second] = self.client.messages
+        self.assertEqual(second[1]['extra'], {'suppressed_occurrences': 1})
+
+    @inlineCallbacks
+    def test_start_metrics(self):
+        worker_helper = WorkerHelper()
+        self.add_cleanup(worker_helper.cleanup)
+        worker = worker_helper.get_worker_raw(
+            Worker, {}, worker_helper.broker)
+        self.assertEqual(self.service.metrics.prefix, 'vumi.test.logger.')
+        yield self.service.start_metrics(worker)
+        self.assertTrue(self.service.metrics.is_started())
+        yield self.service.startService()
+        yield self.service.stopService()
+        self.assertFalse(self.service.metrics.is_started())
+
     @inlineCallbacks
     def test_stop_not_running(self):
         yield self.service.stopService()
@@ -187,3 +405,25 @@ class TestRavenUtilityFunctions(VumiTestCase):
         [sentry_call] = call_history
         sentry_data = self.parse_call(sentry_call)
         self.assertEqual(sentry_data['message'], "my message")
+
+    def test_vumi_raven_client_queues_reports(self):
+        import vumi.sentry
+        dsn = self.mk_sentry_dsn()
+        pages = []
+
+        def fake_get_page(*args, **kw):
+            d = Deferred()
+            pages.append(d)
+            return d
+
+        self.patch(vumi.sentry, 'quiet_get_page', fake_get_page)
+        client = vumi_raven_client(dsn, max_queue_size=1, concurrency=1)
+        for msg in ["one", "two", "three"]:
+            client.captureMessage(msg)
+        self.assertEqual(len(pages), 1)
+        self.assertEqual(client.report_queue.dropped, 1)
+        teardown_d = client.teardown()
+        pages[0].callback("")
+        self.assertFalse(teardown_d.called)
+        pages[1].callback("")
+        self.assertTrue(teardown_d.called)
@@ -4,7 +4,8 @@ from collections import namedtuple
 from twisted.internet.defer import inlineCallbacks
 
 from vumi.message import Message
-from vumi.service import Worker, WorkerCreator
+from vumi.service import Worker, WorkerCreator, Consumer
+from vumi.tests.fake_amqp import FakeAMQPChannel
 from vumi.tests.helpers import VumiTestCase, WorkerHelper
 
 
@@ -55,6 +56,114 @@ class TestService(VumiTestCase):
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
 
+class TestChannelManager(VumiTestCase):
+    def setUp(self):
+        self.worker_helper = WorkerHelper()
+        self.add_cleanup(self.worker_helper.cleanup)
+
+    def get_worker(self, **vumi_options):
+        worker = WorkerHelper.get_worker_raw(Worker, {})
+        worker._amqp_client.vumi_options = vumi_options
+        return worker
+
+    @inlineCallbacks
+    def test_publishers_share_channel(self):
+        worker = self.get_worker()
+        pub1 = yield worker.publish_to('test.routing.key1')
+        pub2 = yield worker.publish_to('test.routing.key2')
+        self.assertTrue(pub1.channel is pub2.channel)
+        self.assertEqual(worker._amqp_client.channel_manager.stats(), {
+            'channels': 1,
+            'publisher_channels': 1,
+            'consumer_channels': 0,
+            'publishers': 2,
+            'consumers': 0,
+        })
+
+    @inlineCallbacks
+    def test_publisher_channel_pool(self):
+        worker = self.get_worker(**{'amqp-publisher-channels': 2})
+        pubs = []
+        for i in range(4):
+            pub = yield worker.publish_to('test.routing.key%d' % (i,))
+            pubs.append(pub)
+        channels = [p.channel for p in pubs]
+        self.assertTrue(channels[0] is not channels[1])
+        self.assertTrue(channels[2] is channels[0])
+        self.assertTrue(channels[3] is channels[1])
+
+    @inlineCallbacks
+    def test_exchange_declared_once(self):
+        declared = []
+        orig_declare = FakeAMQPChannel.exchange_declare
+
+        def exchange_declare(channel, exchange, type, durable=None):
+            declared.append(exchange)
+            return orig_declare(channel, exchange, type, durable)
+        self.patch(FakeAMQPChannel, 'exchange_declare', exchange_declare)
+
+        worker = self.get_worker()
+        yield worker.publish_to('test.routing.key1')
+        yield worker.publish_to('test.routing.key2')
+        yield worker.consume('test.routing.key1', lambda msg: None)
+        self.assertEqual(declared, ['vumi'])
+
+    @inlineCallbacks
+    def test_consumers_separate_by_default(self):
+        worker = self.get_worker()
+        con1 = yield worker.consume(
+            'test.routing.key1', lambda msg: None, channel_group='foo')
+        con2 = yield worker.consume(
+            'test.routing.key2', lambda msg: None, channel_group='foo')
+        self.assertTrue(con1.channel is not con2.channel)
+        self.assertFalse(con1.channel_shared)
+
+    @inlineCallbacks
+    def test_shared_consumer_channels(self):
+        worker = self.get_worker(**{'amqp-consumer-channels': 'shared'})
+        broker = worker._amqp_client.broker
+        msgs = []
+        con1 = yield worker.consume(
+            'test.routing.key1', msgs.append, channel_group='foo')
+        con2 = yield worker.consume(
+            'test.routing.key2', msgs.append, channel_group='foo')
+        con3 = yield worker.consume(
+            'test.routing.key3', msgs.append, channel_group='bar')
+        con4 = yield worker.consume('test.routing.key4', msgs.append)
+        self.assertTrue(con1.channel is con2.channel)
+        self.assertTrue(con1.channel_shared)
+        self.assertTrue(con3.channel is not con1.channel)
+        self.assertFalse(con4.channel_shared)
+        self.assertEqual(
+            worker._amqp_client.channel_manager.stats()['consumer_channels'],
+            3)
+
+        broker.publish_raw('vumi', 'test.routing.key1', '{"n": 1}')
+        broker.publish_raw('vumi', 'test.routing.key2', '{"n": 2}')
+        yield broker.wait_delivery()
+        self.assertEqual(sorted(m['n'] for m in msgs), [1, 2])
+
+        # the channel stays open until its last consumer stops
+        yield con1.stop()
+        self.assertTrue(con2.channel in broker.channels)
+        yield con2.stop()
+        self.assertFalse(con2.channel in broker.channels)
+
+    def test_ack_on_shared_channel(self):
+        acks = []
+
+        class FakeChannel(object):
+            def basic_ack(self, delivery_tag, multiple):
+                acks.append((delivery_tag, multiple))
+
+        consumer = Consumer()
+        consumer.channel = FakeChannel()
+        consumer.ack(fake_amq_message({}, 'tag1'))
+        consumer.channel_shared = True
+        consumer.ack(fake_amq_message({}, 'tag2'))
+        self.assertEqual(acks, [('tag1', True), ('tag2', False)])
+
+
 class LoadableTestWorker(Worker):
     def poke(self):
         return "poke"
@@ -1,6 +1,8 @@
+import logging
+
 from vumi.servicemaker import (
     VumiOptions, StartWorkerOptions, VumiWorkerServiceMaker)
-from vumi import servicemaker
+from vumi import servicemaker, log
 from vumi.tests.helpers import VumiTestCase
 
 
@@ -175,6 +177,18 @@ class TestVumiWorkerServiceMaker(OptionsTestCase):
         worker = maker.makeService(options)
         self.assertEqual({'transport_name': 'sphex'}, worker.config)
 
+    def test_make_worker_with_log_level(self):
+        self.add_cleanup(log.set_level, log.get_level())
+        self.mk_config_file('worker', [
+            "transport_name: sphex", "log_level: warning"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
+                              '--config', self.config_file['worker'],
+                              ])
+        maker = VumiWorkerServiceMaker()
+        maker.makeService(options)
+        self.assertEqual(log.get_level(), logging.WARNING)
+
     def test_make_worker_with_sentry(self):
         services = []
         dummy_service = DummyService()
@@ -198,3 +212,26 @@ class TestVumiWorkerServiceMaker(OptionsTestCase):
                   'global:echoworker'), {})
         ])
         self.assertTrue(dummy_service in worker.services)
+
+    def test_make_worker_with_sentry_options(self):
+        services = []
+
+        def service(*a, **kw):
+            services.append((a, kw))
+            return DummyService()
+
+        self.patch(servicemaker, 'SentryLoggerService', service)
+        self.mk_config_file('worker', ["transport_name: sphex"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
+                              '--config', self.config_file['worker'],
+                              '--sentry', 'http://1:2@example.com/2/',
+                              '--sentry-dedup-window', '30',
+                              '--sentry-concurrency', '4',
+                              ])
+        maker = VumiWorkerServiceMaker()
+        worker = maker.makeService(options)
+        [(args, kw)] = services
+        self.assertEqual(kw, {'dedup_window': 30.0, 'concurrency': 4})
+        # Passed on so that child processes also report to Sentry.
+        self.assertEqual(4, worker.options['sentry-concurrency'])
@@ -5,13 +5,15 @@ from twisted.internet.defer import Deferred, inlineCallbacks
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
-from twisted.web.client import WebClientContextFactory, Agent
+from twisted.web.client import (
+    WebClientContextFactory, Agent, HTTPConnectionPool)
 from twisted.internet.protocol import Protocol, Factory
+from twisted.internet.task import Clock
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
                         get_first_word, redis_from_config, build_web_site,
-                        LogFilterSite)
+                        LogFilterSite, LRUCache)
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.helpers import VumiTestCase, import_skip
 
@@ -106,6 +108,72 @@ class TestUtils(VumiTestCase):
         self.assertFalse(isinstance(site, LogFilterSite))
 
 
+class TestLRUCache(VumiTestCase):
+    def test_get_and_set(self):
+        cache = LRUCache(2)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.get('a', 'default'), 'default')
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertTrue('a' in cache)
+        self.assertFalse('b' in cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+
+    def test_on_evict(self):
+        evicted = []
+        cache = LRUCache(2, on_evict=lambda k, v: evicted.append((k, v)))
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 3)
+        self.assertEqual(evicted, [])
+        cache.set('c', 4)
+        self.assertEqual(evicted, [('b', 2)])
+
+    def test_ttl(self):
+        clock = Clock()
+        cache = LRUCache(2, ttl=10, clock=clock)
+        cache.set('a', 1)
+        clock.advance(9)
+        self.assertEqual(cache.get('a'), 1)
+        clock.advance(1)
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(len(cache), 0)
+
+    def test_pop_and_clear(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.pop('a'), 1)
+        self.assertEqual(cache.pop('a', 'gone'), 'gone')
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_set_existing_key_marks_it_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.set('a', 3)
+        cache.set('c', 4)
+        self.assertEqual(cache.get('a'), 3)
+        self.assertEqual(cache.get('b'), None)
+        cache.clear()
+        cache.set('d', 5)
+        cache.set('e', 6)
+        cache.set('f', 7)
+        self.assertEqual([cache.get(k) for k in 'def'], [None, 6, 7])
+
+
 class FakeHTTP10(Protocol):
     def dataReceived(self, data):
         self.transport.write(self.factory.response_body)
@@ -176,6 +244,23 @@ class TestHttpUtils(VumiTestCase):
         self.assertEqual(request.delivered_body, "Yay")
         self.assertEqual(request.code, http.OK)
 
+    @inlineCallbacks
+    def test_http_request_with_pool(self):
+        self.set_render(lambda r: "Yay")
+
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        self.add_cleanup(pool.closeCachedConnections)
+
+        class FakeAgent(Agent):
+            def __init__(slf, reactor, contextFactory=None, **kw):
+                self.assertEqual(kw, {'pool': pool})
+                super(FakeAgent, slf).__init__(reactor, contextFactory, **kw)
+
+        request = yield http_request_full(self.url, '', pool=pool,
+                                          agent_class=FakeAgent)
+        self.assertEqual(request.delivered_body, "Yay")
+        self.assertEqual(len(pool._connections), 1)
+
     @inlineCallbacks
     def test_http_request_full_drop(self):
         def interrupt(r):
@@ -70,12 +70,17 @@ class TestBaseWorker(VumiTestCase):
         worker.setup_worker = CallRecorder(worker.setup_worker, calls)
         with LogCatcher() as lc:
             yield worker.startWorker()
-            self.assertEqual(lc.messages(),
+            self.assertEqual(lc.messages()[:3],
                              ['Starting a DummyWorker worker with config: '
                               "{'worker_name': 'unnamed'}",
                               'Starting HeartBeat publisher with '
                               'worker_name=unnamed',
                               'Started the publisher'])
+            [started] = lc.messages()[3:]
+            self.assertTrue(started.startswith(
+                'Started a DummyWorker worker in '))
+            self.assertTrue(started.endswith(
+                'using 1 AMQP channels for 1 publishers and 0 consumers.'))
         self.assertEqual(calls, [
             ('setup_heartbeat', (), {}),
             ('setup_middleware', (), {}),
@@ -104,6 +109,20 @@ class TestBaseWorker(VumiTestCase):
             ('teardown_heartbeat', (), {}),
         ])
 
+    @inlineCallbacks
+    def test_sentry_metrics(self):
+        import vumi.sentry
+        self.patch(vumi.sentry, 'vumi_raven_client', lambda dsn, **kw: None)
+        sentry_service = vumi.sentry.SentryLoggerService(
+            "http://example.com/", "dummy", "worker-1")
+        self.worker.addService(sentry_service)
+        yield self.worker.startWorker()
+        self.assertTrue(sentry_service.metrics.is_started())
+        self.assertEqual(sentry_service.metrics.prefix, 'vumi.dummy.')
+        self.assertTrue('sentry.suppressed' in sentry_service.metrics)
+        yield self.worker.stopWorker()
+        self.assertFalse(sentry_service.metrics.is_started())
+
     def test_setup_connectors_raises(self):
         worker = self.worker_helper.get_worker_raw(BaseWorker, {})
         self.assertRaises(NotImplementedError, worker.setup_connectors)
@@ -145,16 +164,26 @@ class TestBaseWorker(VumiTestCase):
 
     def test_get_static_config(self):
         cfg = self.worker.get_static_config()
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields],
+                         ['amqp_prefetch_count', 'backpressure'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
     @inlineCallbacks
     def test_get_config(self):
         msg = self.msg_helper.make_inbound("inbound")
         cfg = yield self.worker.get_config(msg)
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields],
+                         ['amqp_prefetch_count', 'backpressure'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
+    @inlineCallbacks
+    def test_get_config_reused(self):
+        msg1 = self.msg_helper.make_inbound("inbound 1")
+        msg2 = self.msg_helper.make_inbound("inbound 2")
+        cfg1 = yield self.worker.get_config(msg1)
+        cfg2 = yield self.worker.get_config(msg2)
+        self.assertTrue(cfg1 is cfg2)
+
     def test__validate_config(self):
         # should call .validate_config()
         self.worker.validate_config = CallRecorder(self.worker.validate_config)
@@ -234,3 +263,73 @@ class TestBaseWorker(VumiTestCase):
         handler_continue.callback(None)
         yield d
         self.assertTrue(connector.paused)
+
+    @inlineCallbacks
+    def test_backpressure_settings(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'backpressure': {
+                'high_watermark': 10,
+                'connectors': {
+                    'foo': {'high_latency': 2.0, 'low_watermark': 3},
+                    'bar': {'high_watermark': None},
+                },
+            },
+        }, False)
+        yield worker.setup_backpressure()
+        self.add_cleanup(worker.teardown_backpressure)
+        foo = yield worker.setup_ri_connector('foo')
+        bar = yield worker.setup_ri_connector('bar')
+        baz = yield worker.setup_ri_connector('baz')
+        self.assertEqual(
+            (10, 3, 2.0),
+            (foo.backpressure.high_watermark, foo.backpressure.low_watermark,
+             foo.backpressure.high_latency))
+        self.assertEqual(None, bar.backpressure)
+        self.assertEqual(
+            (10, 5, None),
+            (baz.backpressure.high_watermark, baz.backpressure.low_watermark,
+             baz.backpressure.high_latency))
+
+    @inlineCallbacks
+    def test_backpressure_unreachable_watermark(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'backpressure': {'high_watermark': 3},
+        }, False)
+        yield worker.setup_backpressure()
+        self.add_cleanup(worker.teardown_backpressure)
+        with LogCatcher(message='never be reached') as lc:
+            connector = yield worker.setup_ri_connector('foo')
+        self.assertEqual(2, connector.consumer_count)
+        self.assertEqual(1, len(lc.messages()))
+
+    @inlineCallbacks
+    def test_no_backpressure(self):
+        connector = yield self.worker.setup_ri_connector('foo')
+        self.assertEqual(None, connector.backpressure)
+
+    @inlineCallbacks
+    def test_backpressure_pauses_connector(self):
+        worker = yield self.worker_helper.get_worker(DummyWorker, {
+            'backpressure': {'high_watermark': 1},
+        }, False)
+        yield worker.setup_backpressure()
+        self.add_cleanup(worker.teardown_backpressure)
+        handler_wait = Deferred()
+        handler_continue = Deferred()
+
+        def handler(msg):
+            handler_wait.callback(None)
+            return handler_continue
+
+        connector = yield worker.setup_ri_connector('foo')
+        connector.set_default_inbound_handler(handler)
+        connector.unpause()
+        self.worker_helper.dispatch_inbound(
+            self.msg_helper.make_inbound("inbound"), 'foo')
+
+        yield handler_wait
+        self.assertTrue(connector.paused)
+        handler_continue.callback(None)
+        yield self.worker_helper.kick_delivery()
+        self.assertFalse(connector.paused)
+        self.assertEqual(1, connector.backpressure.pauses)
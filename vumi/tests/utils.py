@@ -91,7 +91,8 @@ class LogCatcher(object):
         Only log events whose message contains the given regular
         expression pattern will be gathered. The message is
         constructed by joining the elements in the 'message' value
-        with a space (the same way Twisted does). Default: None
+        with a space (the same way Twisted does), or by formatting the
+        event's 'format' value if it has one. Default: None
         (i.e. keep all log events).
 
     :param int log_level:
@@ -110,15 +111,21 @@ class LogCatcher(object):
         return [ev for ev in self.logs if ev["isError"]]
 
     def messages(self):
-        return [" ".join(msg['message']) for msg in self.logs
+        return [self._event_text(msg) for msg in self.logs
                 if not msg["isError"]]
 
+    @staticmethod
+    def _event_text(event_dict):
+        if 'format' in event_dict and not event_dict.get('message'):
+            return log.textFromEventDict(event_dict) or ''
+        return " ".join(event_dict.get('message', []))
+
     def _keep_log(self, event_dict):
         if self.system is not None:
             if not self.system.search(event_dict.get('system', '-')):
                 return False
         if self.message is not None:
-            log_message = " ".join(event_dict.get('message', []))
+            log_message = self._event_text(event_dict)
             if not self.message.search(log_message):
                 return False
         if self.log_level is not None:
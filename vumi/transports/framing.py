@@ -0,0 +1,169 @@
+# -*- test-case-name: vumi.transports.tests.test_framing -*-
+
+"""
+Tools for splitting TCP byte streams into length-prefixed frames.
+"""
+
+import struct
+
+
+class FramingError(Exception):
+    """
+    Raised when a frame header describes a frame that is too large or too
+    small to be valid.
+    """
+
+
+class FrameBuffer(object):
+    """
+    Growable receive buffer.
+
+    Received data is appended to a single :class:`bytearray`. Consumed data
+    is tracked with an offset and only discarded once it makes up at least
+    half the buffer, so each byte is moved a constant number of times on
+    average no matter how many frames arrive in a single read.
+    """
+
+    def __init__(self):
+        self.clear()
+
+    def __len__(self):
+        return len(self._buffer) - self._offset
+
+    def clear(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def append(self, data):
+        self._buffer.extend(data)
+
+    def peek(self, n):
+        """
+        Return the first ``n`` bytes without consuming them, or ``None`` if
+        fewer than ``n`` bytes are available.
+        """
+        if n > len(self):
+            return None
+        return str(self._buffer[self._offset:self._offset + n])
+
+    def pop(self, n):
+        """
+        Return and consume the first ``n`` bytes, or ``None`` if fewer than
+        ``n`` bytes are available.
+        """
+        offset = self._offset
+        buf = self._buffer
+        end = offset + n
+        if end > len(buf):
+            return None
+        data = str(buf[offset:end])
+        if end * 2 >= len(buf):
+            del buf[:end]
+            end = 0
+        self._offset = end
+        return data
+
+
+class LengthPrefixedFramer(object):
+    """
+    Splits a byte stream into frames that start with a fixed-size header
+    containing the length of the frame.
+
+    :param int header_size:
+        Number of bytes in the frame header.
+    :param callable get_length:
+        Called with the header bytes and returns the length of the frame.
+    :param bool length_includes_header:
+        Whether the length in the header includes the header itself.
+        Defaults to ``True``.
+    :param int min_frame_size:
+        Smallest valid frame, including the header. Defaults to
+        ``header_size``.
+    :param int max_frame_size:
+        Largest valid frame, including the header. Defaults to no limit.
+
+    Frames are returned with their headers. A :class:`FramingError` is
+    raised as soon as a header describing an invalid frame arrives, before
+    any of the frame body is buffered.
+    """
+
+    def __init__(self, header_size, get_length, length_includes_header=True,
+                 min_frame_size=None, max_frame_size=None):
+        self.header_size = header_size
+        self.get_length = get_length
+        self.length_includes_header = length_includes_header
+        if min_frame_size is None:
+            min_frame_size = header_size
+        self.min_frame_size = min_frame_size
+        self.max_frame_size = max_frame_size
+        self.buffer = FrameBuffer()
+        self._frame_size = None
+
+    def reset(self):
+        self.buffer.clear()
+        self._frame_size = None
+
+    def feed(self, data):
+        """Add received data to the buffer."""
+        self.buffer.append(data)
+
+    def peek_header(self):
+        """
+        Return the header of the next frame, or ``None`` if it hasn't been
+        received yet.
+        """
+        return self.buffer.peek(self.header_size)
+
+    def next_frame_size(self):
+        """
+        Return the size of the next frame, or ``None`` if its header hasn't
+        been received yet.
+        """
+        if self._frame_size is None:
+            header = self.peek_header()
+            if header is None:
+                return None
+            size = self.get_length(header)
+            if not self.length_includes_header:
+                size += self.header_size
+            if size < self.min_frame_size:
+                raise FramingError(
+                    "Frame size %s is smaller than the minimum of %s." % (
+                        size, self.min_frame_size))
+            if self.max_frame_size is not None and (
+                    size > self.max_frame_size):
+                raise FramingError(
+                    "Frame size %s is larger than the maximum of %s." % (
+                        size, self.max_frame_size))
+            self._frame_size = size
+        return self._frame_size
+
+    def next_frame(self):
+        """
+        Return and consume the next complete frame, or ``None`` if it hasn't
+        been completely received yet.
+        """
+        size = self.next_frame_size()
+        if size is None:
+            return None
+        frame = self.buffer.pop(size)
+        if frame is not None:
+            self._frame_size = None
+        return frame
+
+    def frames(self):
+        """Return and consume all complete frames."""
+        frame = self.next_frame()
+        while frame is not None:
+            yield frame
+            frame = self.next_frame()
+
+    def feed_frames(self, data):
+        """Add received data to the buffer and return all complete frames."""
+        self.feed(data)
+        return self.frames()
+
+
+def uint32_length(header):
+    """Read a frame length from the first four bytes of a header."""
+    return struct.unpack('!I', header[:4])[0]
@@ -1,8 +1,9 @@
 # -*- test-case-name: vumi.transports.httprpc.tests.test_httprpc -*-
 
 import json
+import heapq
 
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
 from twisted.web import http
@@ -54,6 +55,30 @@ class HttpRpcTransportConfig(Transport.CONFIG_CLASS):
         " nor in IGNORED_FIELDS will raise an error. If 'permissive' then no"
         " error is raised as long as all the EXPECTED_FIELDS are present.",
         default='strict', static=True)
+    instance_routing = ConfigBool(
+        "Set to `True` to allow several instances of this transport to run"
+        " at the same time. Each instance stamps its `instance_id` into the"
+        " `transport_metadata` of inbound messages and consumes replies"
+        " forwarded to it on an instance-specific routing key, so replies"
+        " always reach the instance holding the HTTP request. Defaults to"
+        " `False`.", default=False, static=True)
+    instance_id = ConfigText(
+        "A lowercase identifier for this instance, unique among instances"
+        " of this transport. Required if `instance_routing` is enabled."
+        " Instance queues are named after this, so it must be stable"
+        " across restarts.", static=True)
+
+    def post_validate(self):
+        # Instance queues are durable, so a new random id on every restart
+        # would leave the old queue (and replies forwarded to it) behind.
+        if self.instance_routing and not self.instance_id:
+            self.raise_config_error(
+                "'instance_id' is required when 'instance_routing' is"
+                " enabled.")
+        # Routing keys must be lowercase.
+        if self.instance_id and self.instance_id != self.instance_id.lower():
+            self.raise_config_error(
+                "'instance_id' must be lowercase: %s" % (self.instance_id,))
 
 
 class HttpRpcHealthResource(Resource):
@@ -98,9 +123,13 @@ class HttpRpcTransport(Transport):
 
     Because a reply from an application worker is needed before the HTTP
     response can be completed, a reply needs to be returned to the same
-    transport worker that generated the inbound message. This means that
-    currently there many only be one transport worker for each instance
-    of this transport of a given name.
+    transport worker that generated the inbound message. Unless
+    `instance_routing` is enabled, this means that there may only be one
+    transport worker for each instance of this transport of a given name.
+
+    With `instance_routing` enabled, any instance consuming a reply for a
+    request held by another instance forwards it to that instance's
+    `<transport_name>.<instance_id>.outbound` routing key.
     """
     content_type = 'text/plain'
 
@@ -110,6 +139,7 @@ class HttpRpcTransport(Transport):
     PERMISSIVE_MODE = 'permissive'
     DEFAULT_VALIDATION_MODE = STRICT_MODE
     KNOWN_VALIDATION_MODES = [STRICT_MODE, PERMISSIVE_MODE]
+    INSTANCE_ID_KEY = 'http_rpc_instance_id'
 
     def validate_config(self):
         config = self.get_static_config()
@@ -125,6 +155,38 @@ class HttpRpcTransport(Transport):
         if self._validation_mode not in self.KNOWN_VALIDATION_MODES:
             raise ConfigError('Invalid validation mode: %s' % (
                 self._validation_mode,))
+        self.instance_routing = config.instance_routing
+        self.instance_id = config.instance_id
+
+    def get_instance_connector_name(self, instance_id):
+        return '%s.%s' % (self.transport_name, instance_id)
+
+    @inlineCallbacks
+    def setup_connectors(self):
+        connector = yield super(HttpRpcTransport, self).setup_connectors()
+        if self.instance_routing:
+            connector.set_outbound_handler(self.route_outbound_message)
+            # Messages forwarded to us have already been through our
+            # middleware on the instance that forwarded them.
+            instance_connector = yield self.setup_ro_connector(
+                self.get_instance_connector_name(self.instance_id),
+                middleware=False)
+            instance_connector.set_outbound_handler(self._process_message)
+            self.forwarding_publisher = yield self.publish_to(
+                '%s.outbound' % (instance_connector.name,))
+        returnValue(connector)
+
+    def route_outbound_message(self, message):
+        """Process a message ourselves or forward it to its owner."""
+        instance_id = message['transport_metadata'].get(self.INSTANCE_ID_KEY)
+        if instance_id is None or instance_id == self.instance_id:
+            return self._process_message(message)
+        self.emit("HttpRpcTransport forwarding %s to %s" % (
+            message, instance_id))
+        routing_key = '%s.outbound' % (
+            self.get_instance_connector_name(instance_id),)
+        return self.forwarding_publisher.publish_message(
+            message, routing_key=routing_key)
 
     def get_transport_url(self, suffix=''):
         """
@@ -140,6 +202,7 @@ class HttpRpcTransport(Transport):
     @inlineCallbacks
     def setup_transport(self):
         self._requests = {}
+        self._request_timeouts = []
         self.request_gc = LoopingCall(self.manually_close_requests)
         self.clock = self.get_clock()
         self.request_gc.clock = self.clock
@@ -189,9 +252,16 @@ class HttpRpcTransport(Transport):
         return missing_fields
 
     def manually_close_requests(self):
-        for request_id, request_data in self._requests.items():
-            timestamp = request_data['timestamp']
-            if timestamp < self.clock.seconds() - self.request_timeout:
+        # Requests are kept in a heap ordered by timestamp, so we only look
+        # at the ones that have expired. Entries for requests that have
+        # already been finished are discarded as they reach the top.
+        cutoff = self.clock.seconds() - self.request_timeout
+        timeouts = self._request_timeouts
+        while timeouts and timeouts[0][0] < cutoff:
+            timestamp, request_id = heapq.heappop(timeouts)
+            request_data = self._requests.get(request_id)
+            if request_data is not None and (
+                    request_data['timestamp'] == timestamp):
                 self.close_request(request_id)
 
     def close_request(self, request_id):
@@ -211,6 +281,7 @@ class HttpRpcTransport(Transport):
             'timestamp': timestamp,
             'request': request_object,
         }
+        heapq.heappush(self._request_timeouts, (timestamp, request_id))
 
     def get_request(self, request_id):
         if request_id in self._requests:
@@ -271,6 +342,9 @@ class HttpRpcTransport(Transport):
     #       in a consistent manner.
     def publish_message(self, **kwargs):
         self.set_request_to_addr(kwargs['message_id'], kwargs['to_addr'])
+        if self.instance_routing:
+            transport_metadata = kwargs.setdefault('transport_metadata', {})
+            transport_metadata[self.INSTANCE_ID_KEY] = self.instance_id
         return super(HttpRpcTransport, self).publish_message(**kwargs)
 
     def get_request_to_addr(self, request_id):
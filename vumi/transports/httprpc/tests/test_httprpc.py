@@ -8,6 +8,7 @@ from vumi.tests.helpers import VumiTestCase
 from vumi.tests.utils import LogCatcher
 from vumi.transports.httprpc import HttpRpcTransport
 from vumi.message import TransportUserMessage
+from vumi.errors import ConfigError
 from vumi.transports.tests.helpers import TransportHelper
 
 
@@ -86,6 +87,84 @@ class TestTransport(VumiTestCase):
         self.assertEqual(response.delivered_body, 'I am a teapot')
         self.assertEqual(response.code, 418)
 
+    @inlineCallbacks
+    def test_finished_requests_not_timed_out(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        yield self.tx_helper.make_dispatch_reply(msg, "OK")
+        self.assertEqual((yield d), 'OK')
+        self.assertEqual(len(self.transport._request_timeouts), 1)
+        with LogCatcher(message='Timing') as lc:
+            self.clock.advance(10.1)
+            self.assertEqual(lc.messages(), [])
+        self.assertEqual(self.transport._request_timeouts, [])
+
+
+class TestInstanceRouting(VumiTestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        config = {
+            'web_path': "foo",
+            'web_port': 0,
+            'instance_routing': True,
+            'instance_id': 'instance1',
+            }
+        self.tx_helper = TransportHelper(OkTransport)
+        self.add_cleanup(self.tx_helper.cleanup)
+        self.transport = yield self.tx_helper.get_transport(config)
+        self.transport_url = self.transport.get_transport_url()
+
+    def instance_connector_name(self, instance_id):
+        return '%s.%s' % (self.tx_helper.transport_name, instance_id)
+
+    @inlineCallbacks
+    def test_inbound_stamped_with_instance_id(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        self.assertEqual(
+            msg['transport_metadata']['http_rpc_instance_id'], 'instance1')
+        yield self.tx_helper.make_dispatch_reply(msg, "OK")
+        self.assertEqual((yield d), 'OK')
+
+    @inlineCallbacks
+    def test_reply_for_other_instance_forwarded(self):
+        msg = self.tx_helper.make_inbound(
+            "hi", transport_metadata={'http_rpc_instance_id': 'instance2'})
+        reply = yield self.tx_helper.make_dispatch_reply(msg, "OK")
+        [forwarded] = self.tx_helper.get_dispatched_outbound(
+            self.instance_connector_name('instance2'))
+        self.assertEqual(forwarded, reply)
+        self.assertEqual(self.tx_helper.get_dispatched_events(), [])
+
+    @inlineCallbacks
+    def test_forwarded_reply_processed(self):
+        d = http_request(self.transport_url + "foo", '', method='GET')
+        [msg] = yield self.tx_helper.wait_for_dispatched_inbound(1)
+        reply = self.tx_helper.make_reply(msg, "OK")
+        yield self.tx_helper.dispatch_outbound(
+            reply, connector_name=self.instance_connector_name('instance1'))
+        self.assertEqual((yield d), 'OK')
+        [ack] = yield self.tx_helper.wait_for_dispatched_events(1)
+        self.assertEqual(ack['user_message_id'], reply['message_id'])
+
+    def test_uppercase_instance_id(self):
+        config = {
+            'transport_name': self.tx_helper.transport_name,
+            'web_path': "foo",
+            'instance_routing': True,
+            'instance_id': 'Instance1',
+            }
+        self.assertRaises(ConfigError, OkTransport.CONFIG_CLASS, config)
+
+    def test_instance_id_required(self):
+        config = {
+            'transport_name': self.tx_helper.transport_name,
+            'web_path': "foo",
+            'instance_routing': True,
+            }
+        self.assertRaises(ConfigError, OkTransport.CONFIG_CLASS, config)
+
 
 class JSONTransport(HttpRpcTransport):
 
@@ -71,14 +71,19 @@ class TestXmlOverTcpClient(VumiTestCase, XmlOverTcpClientServerMixin):
         self.patch(CodedXmlOverTcpError, 'ERRORS', errors)
 
         self.logs = {'msg': [], 'err': [], 'debug': []}
-        self.patch(log, 'msg', lambda *a: self.append_to_log('msg', *a))
-        self.patch(log, 'err', lambda *a: self.append_to_log('err', *a))
-        self.patch(log, 'debug', lambda *a: self.append_to_log('debug', *a))
+        self.patch(log, 'msg', lambda *a, **kw: self.append_to_log(
+            'msg', *a, **kw))
+        self.patch(log, 'err', lambda *a, **kw: self.append_to_log(
+            'err', *a, **kw))
+        self.patch(log, 'debug', lambda *a, **kw: self.append_to_log(
+            'debug', *a, **kw))
 
         self.add_cleanup(self.stop_protocols)
         return self.start_protocols()
 
-    def append_to_log(self, log_name, *args):
+    def append_to_log(self, log_name, *args, **kw):
+        if 'format' in kw:
+            args = args + (kw['format'] % kw,)
         self.logs[log_name].append(' '.join(str(a) for a in args))
 
     def assert_in_log(self, log_name, substr):
@@ -104,6 +109,27 @@ class TestXmlOverTcpClient(VumiTestCase, XmlOverTcpClientServerMixin):
         self.assertTrue(data in err_msg)
         self.assertTrue(self.client.disconnected)
 
+    @inlineCallbacks
+    def test_oversized_packet(self):
+        data = self.mk_raw_packet(
+            '0', str(XmlOverTcpClient.MAX_PACKET_SIZE + 1), '')
+        self.client.authenticated = True
+        self.server.send_data(data)
+
+        yield self.client.wait_for_data()
+        self.assert_in_log('err', 'Error reading packet header')
+        self.assertTrue(self.client.disconnected)
+
+    @inlineCallbacks
+    def test_invalid_packet_length(self):
+        data = self.mk_raw_packet('0', 'abc', '')
+        self.client.authenticated = True
+        self.server.send_data(data)
+
+        yield self.client.wait_for_data()
+        self.assert_in_log('err', 'Invalid packet header')
+        self.assertTrue(self.client.disconnected)
+
     def test_packet_header_serializing(self):
         self.assertEqual(
             XmlOverTcpClient.serialize_header('23', 'abcdef'),
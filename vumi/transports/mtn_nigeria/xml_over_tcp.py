@@ -4,8 +4,9 @@ from random import randint
 from xml.etree import ElementTree as ET
 
 try:
-    from xml.etree.ElementTree import ParseError
+    from xml.etree.cElementTree import XMLParser, ParseError
 except ImportError:
+    from xml.etree.ElementTree import XMLParser
     from xml.parsers.expat import ExpatError as ParseError
 
 from twisted.internet import reactor
@@ -13,6 +14,7 @@ from twisted.internet.task import LoopingCall
 from twisted.internet.protocol import Protocol
 
 from vumi import log
+from vumi.transports.framing import LengthPrefixedFramer, FramingError
 
 
 class XmlOverTcpError(Exception):
@@ -64,6 +66,10 @@ class XmlOverTcpClient(Protocol):
     HEADER_SIZE = SESSION_ID_HEADER_SIZE + LENGTH_HEADER_SIZE
     HEADER_FORMAT = '!%ss%ss' % (SESSION_ID_HEADER_SIZE, LENGTH_HEADER_SIZE)
 
+    # Packets (including headers) larger than this are treated as a
+    # protocol error.
+    MAX_PACKET_SIZE = 64 * 1024
+
     REQUEST_ID_LENGTH = 10
 
     PACKET_RECEIVED_HANDLERS = {
@@ -131,8 +137,9 @@ class XmlOverTcpClient(Protocol):
         self.reset_buffer()
 
     def reset_buffer(self):
-        self._buffer = ''
-        self._current_header = None
+        self._framer = LengthPrefixedFramer(
+            self.HEADER_SIZE, self.deserialize_length,
+            max_frame_size=self.MAX_PACKET_SIZE)
 
     def timeout(self):
         log.msg("No enquire link response received after %s seconds, "
@@ -174,44 +181,23 @@ class XmlOverTcpClient(Protocol):
         log.msg("Heartbeat stopped")
 
     def dataReceived(self, data):
-        self._buffer += data
-
-        while self._buffer:
-            header = self.peak_buffer(self.HEADER_SIZE)
-
-            if not header:
-                return
-
-            session_id, length = self.deserialize_header(header)
-            packet = self.pop_buffer(length)
-
-            if not packet:
-                return
-
-            body = packet[self.HEADER_SIZE:]
-
-            try:
-                packet_type, params = self.deserialize_body(body)
-            except ParseError as e:
-                log.err("Error parsing packet (%s): %s" % (e, packet))
-                self.disconnect()
-                return
-
-            self.packet_received(session_id, packet_type, params)
-
-    def pop_buffer(self, n):
-        if n > len(self._buffer):
-            return None
-
-        buffer = self._buffer
-        self._buffer = buffer[n:]
-        return buffer[:n]
-
-    def peak_buffer(self, n):
-        if n > len(self._buffer):
-            return None
-
-        return self._buffer[:n]
+        try:
+            for packet in self._framer.feed_frames(data):
+                session_id, length = self.deserialize_header(
+                    packet[:self.HEADER_SIZE])
+                body = packet[self.HEADER_SIZE:]
+
+                try:
+                    packet_type, params = self.deserialize_body(body)
+                except ParseError as e:
+                    log.err("Error parsing packet (%s): %s" % (e, packet))
+                    self.disconnect()
+                    return
+
+                self.packet_received(session_id, packet_type, params)
+        except FramingError as e:
+            log.err("Error reading packet header: %s" % (e,))
+            self.disconnect()
 
     @classmethod
     def remove_nullbytes(cls, s):
@@ -226,18 +212,28 @@ class XmlOverTcpClient(Protocol):
         return (cls.remove_nullbytes(session_id),
                 int(cls.remove_nullbytes(length)))
 
+    @classmethod
+    def deserialize_length(cls, header):
+        try:
+            return cls.deserialize_header(header)[1]
+        except ValueError:
+            raise FramingError("Invalid packet header: %r" % (header,))
+
     @classmethod
     def deserialize_body(cls, body):
         # The 'requestId' field often has nullbytes in it. We suspect this
         # happens when the requestId length is shorter than 16 bytes, so they
         # just pad it with trailing nullbytes. We need to remove the nullbytes
-        # before parsing the xml to prevent parse errors
-        body = cls.remove_nullbytes(body.decode(cls.ENCODING))
+        # before parsing the xml to prevent parse errors. The protocol's
+        # encoding is a single-byte encoding, so we can do this on the raw
+        # bytes.
+        body = cls.remove_nullbytes(body)
 
-        # We transcode from the configured encoding to UTF-8, since ElementTree
-        # needs bytes, and all XML parsers need to accept UTF-8.
-        # http://www.w3.org/TR/xml/#charsets
-        root = ET.fromstring(body.encode('utf-8'))
+        # We tell the parser which encoding to use rather than transcoding the
+        # body ourselves, since the packets don't declare their encoding.
+        parser = XMLParser(encoding=cls.ENCODING)
+        parser.feed(body)
+        root = parser.close()
 
         packet_type = root.tag
         params = dict((el.tag.strip(), el.text.strip()) for el in root)
@@ -245,8 +241,10 @@ class XmlOverTcpClient(Protocol):
         return packet_type, params
 
     def packet_received(self, session_id, packet_type, params):
-        log.debug("Packet of type '%s' with session id '%s' received: %s"
-                  % (packet_type, session_id, params))
+        log.debug(format="Packet of type '%(packet_type)s' with session id"
+                  " '%(session_id)s' received: %(params)s",
+                  packet_type=packet_type, session_id=session_id,
+                  params=params)
 
         # dispatch the packet to the appropriate handler
         handler_name = self.PACKET_RECEIVED_HANDLERS.get(packet_type, None)
@@ -372,7 +370,7 @@ class XmlOverTcpClient(Protocol):
                 % packet_type)
 
         packet = self.serialize_packet(session_id, packet_type, params)
-        log.debug("Sending packet: %s" % packet)
+        log.debug(format="Sending packet: %(packet)s", packet=packet)
         self.transport.write(packet)
 
     @classmethod
@@ -13,8 +13,9 @@ from twisted.internet.task import LoopingCall
 from vumi import message
 
 
-warnings.warn("vumi.transport.scheduler is deprecated. A replacement is coming"
-              " soon.", category=DeprecationWarning)
+warnings.warn("vumi.transport.scheduler is deprecated. Use"
+              " vumi.components.scheduler instead.",
+              category=DeprecationWarning)
 
 
 class Scheduler(object):
@@ -2,6 +2,7 @@
 
 import json
 import uuid
+import logging
 from random import randint
 
 from twisted.internet import reactor
@@ -18,10 +19,22 @@ from smpp.pdu_inspector import (
     MultipartMessage, detect_multipart, multipart_key)
 
 from vumi import log
+from vumi.transports.framing import (
+    LengthPrefixedFramer, FramingError, uint32_length)
 
 
 GSM_MAX_SMS_BYTES = 140
 
+# Every SMPP PDU starts with a 16 byte header, the first four bytes of which
+# hold the length of the whole PDU.
+PDU_HEADER_SIZE = 16
+MAX_PDU_SIZE = 1024 * 1024
+
+
+def make_pdu_framer():
+    return LengthPrefixedFramer(
+        PDU_HEADER_SIZE, uint32_length, max_frame_size=MAX_PDU_SIZE)
+
 
 class UnbindResp(PDU):
     # pdu_builder doesn't have one of these yet.
@@ -66,7 +79,7 @@ class EsmeTransceiver(Protocol):
         self.smpp_bind_timeout = self.config.smpp_bind_timeout
         self.smpp_enquire_link_interval = \
                 self.config.smpp_enquire_link_interval
-        self.datastream = ''
+        self.framer = make_pdu_framer()
         self.redis = redis
         self._lose_conn = None
         # The PDU queue ensures that PDUs are processed in the order
@@ -134,21 +147,17 @@ class EsmeTransceiver(Protocol):
         yield self.redis.delete('smpp_last_sequence_number')
 
     def pop_data(self):
-        data = None
-        if(len(self.datastream) >= 16):
-            command_length = int(binascii.b2a_hex(self.datastream[0:4]), 16)
-            if(len(self.datastream) >= command_length):
-                data = self.datastream[0:command_length]
-                self.datastream = self.datastream[command_length:]
-        return data
+        return self.framer.next_frame()
 
     @inlineCallbacks
     def handle_data(self, data):
         pdu = unpack_pdu(data)
         command_id = pdu['header']['command_id']
         if command_id not in ('enquire_link', 'enquire_link_resp'):
-            log.debug('INCOMING <<<< %s' % binascii.b2a_hex(data))
-            log.debug('INCOMING <<<< %s' % pdu)
+            if log.enabled_for(logging.DEBUG):
+                log.debug(format='INCOMING <<<< %(data)s',
+                          data=binascii.b2a_hex(data))
+            log.debug(format='INCOMING <<<< %(pdu)s', pdu=pdu)
         handler = getattr(self, 'handle_%s' % (command_id,),
                           self._command_handler_not_found)
         yield handler(pdu)
@@ -196,18 +205,19 @@ class EsmeTransceiver(Protocol):
         self.esme_callbacks.disconnect()
 
     def dataReceived(self, data):
-        self.datastream += data
-        data = self.pop_data()
-        while data is not None:
-            self._pdu_queue.put(data)
-            data = self.pop_data()
+        try:
+            for data in self.framer.feed_frames(data):
+                self._pdu_queue.put(data)
+        except FramingError as e:
+            log.err('Error reading PDU header: %s' % (e,))
+            self.transport.loseConnection()
 
     def send_pdu(self, pdu):
         data = pdu.get_bin()
         unpacked = unpack_pdu(data)
         command_id = unpacked['header']['command_id']
         if command_id not in ('enquire_link', 'enquire_link_resp'):
-            log.debug('OUTGOING >>>> %s' % unpacked)
+            log.debug(format='OUTGOING >>>> %(pdu)s', pdu=unpacked)
         self.transport.write(data)
 
     @inlineCallbacks
@@ -424,7 +434,7 @@ class EsmeTransceiver(Protocol):
     def load_multipart_message(self, redis_key):
         value = yield self.redis.get(redis_key)
         value = json.loads(value) if value else {}
-        log.debug("Retrieved value: %s" % (repr(value)))
+        log.debug(format="Retrieved value: %(value)r", value=value)
         returnValue(MultipartMessage(self._unhex_from_redis(value)))
 
     def save_multipart_message(self, redis_key, multipart_message):
@@ -444,7 +454,7 @@ class EsmeTransceiver(Protocol):
     @inlineCallbacks
     def _handle_deliver_sm_multipart(self, pdu, pdu_params):
         redis_key = "multi_%s" % (multipart_key(detect_multipart(pdu)),)
-        log.debug("Redis multipart key: %s" % (redis_key))
+        log.debug(format="Redis multipart key: %(key)s", key=redis_key)
         multi = yield self.load_multipart_message(redis_key)
         multi.add_pdu(pdu)
         completed = multi.get_completed()
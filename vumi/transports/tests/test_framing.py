@@ -0,0 +1,114 @@
+import struct
+
+from vumi.tests.helpers import VumiTestCase
+from vumi.transports.framing import (
+    FrameBuffer, LengthPrefixedFramer, FramingError, uint32_length)
+
+
+def mk_frame(body):
+    return struct.pack('!I', len(body) + 4) + body
+
+
+class TestFrameBuffer(VumiTestCase):
+
+    def test_append_and_pop(self):
+        buf = FrameBuffer()
+        buf.append('abc')
+        buf.append('def')
+        self.assertEqual(len(buf), 6)
+        self.assertEqual(buf.pop(2), 'ab')
+        self.assertEqual(len(buf), 4)
+        self.assertEqual(buf.pop(4), 'cdef')
+        self.assertEqual(len(buf), 0)
+
+    def test_pop_too_much(self):
+        buf = FrameBuffer()
+        buf.append('abc')
+        self.assertEqual(buf.pop(4), None)
+        self.assertEqual(len(buf), 3)
+
+    def test_peek(self):
+        buf = FrameBuffer()
+        buf.append('abc')
+        self.assertEqual(buf.peek(2), 'ab')
+        self.assertEqual(buf.peek(4), None)
+        self.assertEqual(len(buf), 3)
+
+    def test_consumed_data_discarded(self):
+        buf = FrameBuffer()
+        buf.append('a' * 10)
+        buf.pop(4)
+        self.assertEqual(len(buf._buffer), 10)
+        buf.pop(1)
+        self.assertEqual(len(buf._buffer), 5)
+        self.assertEqual(buf.pop(5), 'aaaaa')
+
+    def test_clear(self):
+        buf = FrameBuffer()
+        buf.append('abc')
+        buf.clear()
+        self.assertEqual(len(buf), 0)
+
+
+class TestLengthPrefixedFramer(VumiTestCase):
+
+    def mk_framer(self, **kw):
+        return LengthPrefixedFramer(4, uint32_length, **kw)
+
+    def test_single_frame(self):
+        framer = self.mk_framer()
+        self.assertEqual(
+            list(framer.feed_frames(mk_frame('hello'))), [mk_frame('hello')])
+
+    def test_multiple_frames(self):
+        framer = self.mk_framer()
+        data = ''.join(mk_frame('frame %d' % i) for i in range(100))
+        self.assertEqual(
+            list(framer.feed_frames(data)),
+            [mk_frame('frame %d' % i) for i in range(100)])
+        self.assertEqual(len(framer.buffer), 0)
+
+    def test_split_frames(self):
+        framer = self.mk_framer()
+        data = mk_frame('hello') + mk_frame('world')
+        frames = []
+        for char in data:
+            frames.extend(framer.feed_frames(char))
+        self.assertEqual(frames, [mk_frame('hello'), mk_frame('world')])
+
+    def test_peek_header(self):
+        framer = self.mk_framer()
+        framer.feed(mk_frame('hello')[:3])
+        self.assertEqual(framer.peek_header(), None)
+        self.assertEqual(framer.next_frame_size(), None)
+        framer.feed(mk_frame('hello')[3:6])
+        self.assertEqual(framer.peek_header(), mk_frame('hello')[:4])
+        self.assertEqual(framer.next_frame_size(), 9)
+        self.assertEqual(framer.next_frame(), None)
+
+    def test_length_excludes_header(self):
+        framer = LengthPrefixedFramer(
+            4, uint32_length, length_includes_header=False)
+        data = struct.pack('!I', 5) + 'hello'
+        self.assertEqual(list(framer.feed_frames(data)), [data])
+
+    def test_max_frame_size(self):
+        framer = self.mk_framer(max_frame_size=8)
+        self.assertEqual(list(framer.feed_frames(mk_frame('abcd'))),
+                         [mk_frame('abcd')])
+        # The error is raised as soon as the header arrives.
+        framer.feed(mk_frame('abcde')[:4])
+        self.assertRaises(FramingError, framer.next_frame)
+
+    def test_min_frame_size(self):
+        framer = self.mk_framer()
+        framer.feed(struct.pack('!I', 0))
+        self.assertRaises(FramingError, framer.next_frame)
+
+    def test_reset(self):
+        framer = self.mk_framer()
+        framer.feed(mk_frame('hello')[:6])
+        framer.next_frame()
+        framer.reset()
+        self.assertEqual(list(framer.feed_frames(mk_frame('world'))),
+                         [mk_frame('world')])
@@ -115,9 +115,14 @@ class SimplishReceiver(protocol.Protocol):
 
 def http_request_full(url, data=None, headers={}, method='POST',
                       timeout=None, data_limit=None, context_factory=None,
-                      agent_class=Agent):
+                      agent_class=Agent, pool=None):
     context_factory = context_factory or WebClientContextFactory()
-    agent = agent_class(reactor, contextFactory=context_factory)
+    agent_kw = {}
+    if pool is not None:
+        # A :class:`twisted.web.client.HTTPConnectionPool` to reuse
+        # persistent connections from.
+        agent_kw['pool'] = pool
+    agent = agent_class(reactor, contextFactory=context_factory, **agent_kw)
     d = agent.request(method,
                       url,
                       mkheaders(headers),
@@ -427,3 +432,103 @@ def safe_routing_key(routing_key):
 
 def generate_worker_id(system_id, worker_id):
     return "%s:%s" % (system_id, worker_id,)
+
+
+class LRUCache(object):
+    """A bounded in-process cache that evicts the least recently used items.
+
+    :param int max_size:
+        Maximum number of items to keep.
+    :param float ttl:
+        Seconds after which an item expires. Items never expire if this is
+        `None` (the default).
+    :param clock:
+        An `IReactorTime` provider to use for expiry. Defaults to the
+        reactor.
+    :param on_evict:
+        Optional function to call with the key and value of each item
+        evicted to make room for a new one.
+    """
+
+    # Items are kept in a circular doubly linked list of
+    # [prev, next, key, expires_at, value] nodes, most recently used last,
+    # and indexed by key in a dict. (collections.OrderedDict would do, but
+    # it isn't available on Python 2.6.)
+    PREV, NEXT, KEY, EXPIRES_AT, VALUE = range(5)
+
+    def __init__(self, max_size, ttl=None, clock=None, on_evict=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock if clock is not None else reactor
+        self.on_evict = on_evict
+        self.hits = 0
+        self.misses = 0
+        self._items = {}
+        self._root = []
+        self._root[:] = [self._root, self._root, None, None, None]
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return self._lookup(key) is not None
+
+    def _unlink(self, node):
+        prev_node, next_node = node[self.PREV], node[self.NEXT]
+        prev_node[self.NEXT] = next_node
+        next_node[self.PREV] = prev_node
+
+    def _append(self, node):
+        last = self._root[self.PREV]
+        node[self.PREV], node[self.NEXT] = last, self._root
+        last[self.NEXT] = self._root[self.PREV] = node
+
+    def _remove(self, key):
+        node = self._items.pop(key, None)
+        if node is not None:
+            self._unlink(node)
+        return node
+
+    def _lookup(self, key):
+        node = self._items.get(key)
+        if node is None:
+            return None
+        expires_at = node[self.EXPIRES_AT]
+        if expires_at is not None and expires_at <= self.clock.seconds():
+            self._remove(key)
+            return None
+        return node
+
+    def get(self, key, default=None):
+        """Return the cached value for `key`, or `default` if it's missing
+        or expired. Updates the hit and miss counts."""
+        node = self._lookup(key)
+        if node is None:
+            self.misses += 1
+            return default
+        self.hits += 1
+        # Move the item to the most recently used end.
+        self._unlink(node)
+        self._append(node)
+        return node[self.VALUE]
+
+    def set(self, key, value):
+        expires_at = None
+        if self.ttl is not None:
+            expires_at = self.clock.seconds() + self.ttl
+        self._remove(key)
+        node = [None, None, key, expires_at, value]
+        self._append(node)
+        self._items[key] = node
+        while len(self._items) > self.max_size:
+            evicted = self._remove(self._root[self.NEXT][self.KEY])
+            if self.on_evict is not None:
+                self.on_evict(evicted[self.KEY], evicted[self.VALUE])
+
+    def pop(self, key, default=None):
+        node = self._remove(key)
+        return default if node is None else node[self.VALUE]
+
+    def clear(self):
+        self._items.clear()
+        self._root[:] = [self._root, self._root, None, None, None]
@@ -13,11 +13,15 @@ from twisted.python import log
 from vumi.service import Worker
 from vumi.middleware import setup_middlewares_from_config
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigInt, ConfigDict
 from vumi.errors import DuplicateConnectorError
 from vumi.utils import generate_worker_id
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
+from vumi.blinkenlights.heartbeat.telemetry import WorkerTelemetry
+from vumi.blinkenlights.metrics import MetricManager
+from vumi.backpressure import BackpressureController
+from vumi.sentry import SentryLoggerService
 
 
 def then_call(d, func, *args, **kw):
@@ -34,6 +38,19 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    backpressure = ConfigDict(
+        "Settings for pausing connectors while their message handlers are"
+        " slow. Keys are `high_watermark` and `low_watermark` (messages in"
+        " flight), `high_latency` and `low_latency` (average handler"
+        " latency in seconds), `recheck_interval` (seconds between checks"
+        " while paused) and `metrics_prefix` (default"
+        " `vumi.backpressure.`). A `connectors` dict of connector name to"
+        " settings overrides these for individual connectors. Connectors"
+        " without a high watermark or high latency are never paused. Each"
+        " consumer handles one message at a time, so a high watermark above"
+        " a connector's number of consumers is never reached. See"
+        " :class:`vumi.backpressure.BackpressureController`.",
+        default={}, static=True)
 
 
 class BaseWorker(Worker):
@@ -45,31 +62,54 @@ class BaseWorker(Worker):
     """
 
     CONFIG_CLASS = BaseConfig
+    BACKPRESSURE_KEYS = (
+        'high_watermark', 'low_watermark', 'high_latency', 'low_latency',
+        'recheck_interval')
 
     def __init__(self, options, config=None):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
+        self._config = None
         self._hb_pub = None
+        self._hb_telemetry = None
         self._worker_id = None
+        self._backpressure_metrics = None
 
     def startWorker(self):
         log.msg('Starting a %s worker with config: %s'
                 % (self.__class__.__name__, self.config))
+        started = time.time()
         d = maybeDeferred(self._validate_config)
         then_call(d, self.setup_heartbeat)
+        then_call(d, self.setup_sentry_metrics)
         then_call(d, self.setup_middleware)
+        then_call(d, self.setup_backpressure)
         then_call(d, self.setup_connectors)
         then_call(d, self.setup_worker)
+        then_call(d, self._log_startup, started)
         return d
 
+    def _log_startup(self, started):
+        self.startup_time = time.time() - started
+        if self._amqp_client is None:
+            return
+        stats = self._amqp_client.channel_manager.stats()
+        log.msg("Started a %s worker in %.3f seconds using %d AMQP channels"
+                " for %d publishers and %d consumers." % (
+                    self.__class__.__name__, self.startup_time,
+                    stats['channels'], stats['publishers'],
+                    stats['consumers']))
+
     def stopWorker(self):
         log.msg('Stopping a %s worker.' % (self.__class__.__name__,))
         d = succeed(None)
         then_call(d, self.teardown_worker)
         then_call(d, self.teardown_connectors)
+        then_call(d, self.teardown_backpressure)
         then_call(d, self.teardown_middleware)
+        then_call(d, self.teardown_sentry_metrics)
         then_call(d, self.teardown_heartbeat)
         return d
 
@@ -87,6 +127,8 @@ class BaseWorker(Worker):
                                                  self._worker_name)
             log.msg("Starting HeartBeat publisher with worker_name=%s"
                     % self._worker_name)
+            self._hb_telemetry = WorkerTelemetry()
+            self._hb_telemetry.start()
             self._hb_pub = yield self.start_publisher(HeartBeatPublisher,
                                                 self._gen_heartbeat_attrs)
         else:
@@ -97,6 +139,26 @@ class BaseWorker(Worker):
         if self._hb_pub is not None:
             self._hb_pub.stop()
             self._hb_pub = None
+        if self._hb_telemetry is not None:
+            self._hb_telemetry.stop()
+            self._hb_telemetry = None
+
+    def _sentry_service(self):
+        return self.namedServices.get(SentryLoggerService.SERVICE_NAME)
+
+    def setup_sentry_metrics(self):
+        """
+        Publish the metrics of the Sentry logger service, if the worker was
+        started with one.
+        """
+        sentry_service = self._sentry_service()
+        if sentry_service is not None:
+            return sentry_service.start_metrics(self)
+
+    def teardown_sentry_metrics(self):
+        sentry_service = self._sentry_service()
+        if sentry_service is not None:
+            sentry_service.stop_metrics()
 
     def _gen_heartbeat_attrs(self):
         # worker_name is guaranteed to be set here, otherwise this func would
@@ -110,6 +172,8 @@ class BaseWorker(Worker):
             'timestamp': time.time(),
             'pid': os.getpid(),
         }
+        if self._hb_telemetry is not None:
+            attrs.update(self._hb_telemetry.collect(self.connectors))
         attrs.update(self.custom_heartbeat_attrs())
         return attrs
 
@@ -117,6 +181,43 @@ class BaseWorker(Worker):
         """Worker subclasses can override this to add custom attributes"""
         return {}
 
+    def _backpressure_settings(self, connector_name):
+        config = self.get_static_config().backpressure
+        overrides = config.get('connectors', {}).get(connector_name, {})
+        settings = {}
+        for key in self.BACKPRESSURE_KEYS:
+            if key in overrides:
+                settings[key] = overrides[key]
+            elif key in config:
+                settings[key] = config[key]
+        if (settings.get('high_watermark') is None
+                and settings.get('high_latency') is None):
+            return None
+        return settings
+
+    @inlineCallbacks
+    def setup_backpressure(self):
+        config = self.get_static_config().backpressure
+        if config:
+            self._backpressure_metrics = yield self.start_publisher(
+                MetricManager,
+                config.get('metrics_prefix', 'vumi.backpressure.'))
+
+    def teardown_backpressure(self):
+        if self._backpressure_metrics is not None:
+            self._backpressure_metrics.stop()
+            self._backpressure_metrics = None
+
+    def attach_backpressure(self, connector):
+        """
+        Attach a backpressure controller to the connector if one is
+        configured for it.
+        """
+        settings = self._backpressure_settings(connector.name)
+        if settings is not None:
+            connector.backpressure = BackpressureController(
+                connector, metrics=self._backpressure_metrics, **settings)
+
     def teardown_connectors(self):
         d = succeed(None)
         for connector_name in self.connectors.keys():
@@ -152,8 +253,13 @@ class BaseWorker(Worker):
         It deliberately returns a deferred even when this isn't strictly
         necessary to ensure that workers will continue to work when per-message
         configuration needs to be fetched from elsewhere.
+
+        The default implementation doesn't depend on the message, so the
+        config object is built once and reused.
         """
-        return succeed(self.CONFIG_CLASS(self.config))
+        if self._config is None:
+            self._config = self.CONFIG_CLASS(self.config)
+        return succeed(self._config)
 
     def _validate_config(self):
         """Once subclasses call `super().validate_config` properly,
@@ -184,11 +290,17 @@ class BaseWorker(Worker):
                                   prefetch_count=prefetch_count,
                                   middlewares=middlewares)
         self.connectors[connector_name] = connector
+        self.attach_backpressure(connector)
 
         d = connector.setup()
+        d.addCallback(lambda r: self._check_backpressure(connector))
         d.addCallback(lambda r: connector)
         return d
 
+    def _check_backpressure(self, connector):
+        if connector.backpressure is not None:
+            connector.backpressure.check_consumers(connector.consumer_count)
+
     def teardown_connector(self, connector_name):
         connector = self.connectors.pop(connector_name)
         d = connector.teardown()